@@ -26,6 +26,7 @@ import re
 import uuid
 from datetime import datetime
 import json
+from hashlib import sha1
 
 try:
     from httplib import (
@@ -40,7 +41,7 @@ except ImportError:  # pragma: no cover
 from flask import request, g
 from flask.views import MethodView
 
-from sqlalchemy import or_, not_
+from sqlalchemy import or_, not_, func
 
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState, AgentState, _AgentState, STRING_TYPES
@@ -57,7 +58,8 @@ from pyfarm.models.disk import AgentDisk
 from pyfarm.master.application import db
 from pyfarm.master.utility import (
     jsonify, validate_with_model, get_ipaddr_argument, get_integer_argument,
-    get_hostname_argument, get_port_argument, isuuid)
+    get_hostname_argument, get_port_argument, isuuid, conditional_get)
+from pyfarm.master.writebehind import write_behind
 
 logger = getLogger("api.agents")
 
@@ -97,6 +99,168 @@ def fail_missing_assignments(agent, current_assignments):
 
     return failed_tasks
 
+
+def inventory_hash(mac_addresses=None, gpus=None, disks=None, tags=None):
+    """
+    Returns a hash of the hardware inventory an agent reported.  Only the
+    parts of the inventory which were provided contribute to the hash and
+    free disk space is left out since it changes on almost every update.
+    """
+    inventory = {}
+    if mac_addresses is not None:
+        inventory["mac_addresses"] = sorted(mac_addresses)
+    if gpus is not None:
+        inventory["gpus"] = sorted(gpus)
+    if disks is not None:
+        inventory["disks"] = sorted(
+            [disk["mountpoint"], disk["size"]] for disk in disks)
+    if tags is not None:
+        inventory["tags"] = sorted(tags)
+    return sha1(json.dumps(inventory, sort_keys=True).encode("utf-8")
+                ).hexdigest()
+
+
+def get_or_create(model, column, values):
+    """
+    Returns a dictionary mapping each of ``values`` to an instance of
+    ``model`` with ``column`` set to that value.  Existing rows are
+    retrieved with a single query, missing ones are added to the session.
+    """
+    values = set(values)
+    if not values:
+        return {}
+
+    attribute = getattr(model, column)
+    instances = dict(
+        (getattr(instance, column), instance)
+        for instance in model.query.filter(attribute.in_(values)))
+    for value in values - set(instances):
+        instance = model(**{column: value})
+        db.session.add(instance)
+        instances[value] = instance
+    return instances
+
+
+def update_inventory(agent, mac_addresses=None, gpus=None, disks=None,
+                     tags=None):
+    """
+    Brings an agent's mac addresses, gpus, disks and tags in line with
+    what the agent reported, ignoring the parts which are ``None``.  If
+    the inventory hashes the same as the last time only free disk space
+    is updated.  Returns True if any of the relationships changed.
+    """
+    new_hash = inventory_hash(
+        mac_addresses=mac_addresses, gpus=gpus, disks=disks, tags=tags)
+
+    if disks is not None:
+        existing_disks = dict(
+            (disk.mountpoint, disk) for disk in agent.disks)
+    else:
+        existing_disks = {}
+
+    if agent.inventory_hash is not None and agent.inventory_hash == new_hash:
+        for disk_dict in disks or []:
+            disk = existing_disks.get(disk_dict["mountpoint"])
+            if disk is not None and disk.free != disk_dict["free"]:
+                disk.free = disk_dict["free"]
+        return False
+
+    if mac_addresses is not None:
+        mac_addresses = set(mac_addresses)
+        for existing_address in agent.mac_addresses:
+            if existing_address.mac_address.lower() not in mac_addresses:
+                logger.debug("Existing address %s is not in supplied "
+                             "mac addresses, for agent %s, removing it.",
+                             existing_address.mac_address,
+                             agent.hostname)
+                agent.mac_addresses.remove(existing_address)
+            else:
+                mac_addresses.discard(existing_address.mac_address.lower())
+
+        for new_address in mac_addresses:
+            agent.mac_addresses.append(
+                AgentMacAddress(mac_address=new_address))
+
+    if gpus is not None:
+        gpus = set(gpus)
+        for existing_gpu in agent.gpus:
+            if existing_gpu.fullname not in gpus:
+                logger.debug("Existing gpu %s is not in supplied "
+                             "gpus, for agent %s, removing it.",
+                             existing_gpu.fullname, agent.hostname)
+                agent.gpus.remove(existing_gpu)
+            else:
+                gpus.discard(existing_gpu.fullname)
+
+        for gpu in get_or_create(GPU, "fullname", gpus).values():
+            agent.gpus.append(gpu)
+
+    if disks is not None:
+        reported = set()
+        for disk_dict in disks:
+            reported.add(disk_dict["mountpoint"])
+            disk = existing_disks.get(disk_dict["mountpoint"])
+            if disk is None:
+                agent.disks.append(
+                    AgentDisk(mountpoint=disk_dict["mountpoint"],
+                              size=disk_dict["size"],
+                              free=disk_dict["free"]))
+            else:
+                if disk.size != disk_dict["size"]:
+                    disk.size = disk_dict["size"]
+                if disk.free != disk_dict["free"]:
+                    disk.free = disk_dict["free"]
+
+        for mountpoint, disk in existing_disks.items():
+            if mountpoint not in reported:
+                agent.disks.remove(disk)
+
+    if tags is not None:
+        tags = set(tags)
+        for existing_tag in agent.tags:
+            if existing_tag.tag not in tags:
+                logger.debug("Existing tag %s is not in supplied "
+                             "tags, for agent %s, removing it.",
+                             existing_tag.tag, agent.hostname)
+                agent.tags.remove(existing_tag)
+            else:
+                tags.discard(existing_tag.tag)
+
+        for tag in get_or_create(Tag, "tag", tags).values():
+            agent.tags.append(tag)
+
+    # Set last, modifying the relationships above resets the hash
+    agent.inventory_hash = new_hash
+    return True
+
+
+def agent_index_freshness():
+    """Returns the freshness of the agent list for :func:`.conditional_get`"""
+    agents = db.session.query(
+        func.count(Agent.id),
+        func.sum(Agent.row_version), func.max(Agent.time_updated)).one()
+    return list(agents), None
+
+
+def agent_freshness(agent_id):
+    """
+    Returns the freshness of a single agent for :func:`.conditional_get` or
+    ``None`` if the agent does not exist.
+    """
+    agent = db.session.query(Agent.row_version, Agent.time_updated).\
+        filter(Agent.id == agent_id).first()
+
+    if agent is None:
+        return None
+
+    # Buffered updates have not bumped the row version yet
+    pending = write_behind.pending(Agent, agent_id)
+    if pending:
+        return [list(agent), pending], None
+
+    return list(agent), agent.time_updated
+
+
 def schema():
     """
     Returns the basic schema of :class:`.Agent`
@@ -280,28 +444,8 @@ class AgentIndexAPI(MethodView):
             for version in default_versions:
                  agent.software_versions.append(version)
 
-            if mac_addresses is not None:
-                for address in mac_addresses:
-                    mac_address = AgentMacAddress(agent=agent,
-                                                  mac_address=address)
-                    db.session.add(mac_address)
-
-            if gpus is not None:
-                for gpu_name in gpus:
-                    gpu = GPU.query.filter_by(
-                        fullname=gpu_name).first()
-                    if not gpu:
-                        gpu = GPU(fullname=gpu_name)
-                        db.session.add(gpu)
-                    agent.gpus.append(gpu)
-
-            if disks is not None:
-                for disk_dict in disks:
-                    disk = AgentDisk(agent=agent,
-                                     mountpoint=disk_dict["mountpoint"],
-                                     size=disk_dict["size"],
-                                     free=disk_dict["free"])
-                    db.session.add(disk)
+            update_inventory(
+                agent, mac_addresses=mac_addresses, gpus=gpus, disks=disks)
 
             if state is not None:
                 agent.state = state
@@ -333,6 +477,11 @@ class AgentIndexAPI(MethodView):
         else:
             updated = False
 
+            # Heartbeat data, written through the write-behind buffer
+            heartbeat = {"last_heard_from": datetime.utcnow()}
+            if "free_ram" in g.json:
+                heartbeat["free_ram"] = g.json.pop("free_ram")
+
             for key in g.json.copy():
                 value = g.json.pop(key)
 
@@ -352,82 +501,45 @@ class AgentIndexAPI(MethodView):
                     else:
                         updated = True
 
-            if mac_addresses is not None:
+            if update_inventory(agent, mac_addresses=mac_addresses,
+                                gpus=gpus, disks=disks):
                 updated = True
-                for existing_address in agent.mac_addresses:
-                    if existing_address.mac_address.lower() not in mac_addresses:
-                        logger.debug("Existing address %s is not in supplied "
-                                     "mac addresses, for agent %s, removing it.",
-                                     existing_address.mac_address,
-                                     agent.hostname)
-                        agent.mac_addresses.remove(existing_address)
-                    else:
-                        mac_addresses.remove(
-                            existing_address.mac_address.lower())
 
-                for new_address in mac_addresses:
-                    mac_address = AgentMacAddress(
-                        agent=agent, mac_address=new_address)
-                    db.session.add(mac_address)
-
-            if gpus is not None:
-                updated = True
-                for existing_gpu in agent.gpus:
-                    if existing_gpu.fullname not in gpus:
-                        logger.debug("Existing gpu %s is not in supplied "
-                                     "gpus, for agent %s, removing it.",
-                                     existing_address.mac_address,
-                                     agent.hostname)
-                        agent.gpus.remove(existing_gpu)
-                    else:
-                        gpus.remove(existing_gpu.fullname)
-
-                for gpu_name in gpus:
-                    gpu = GPU.query.filter_by(fullname=gpu_name).first()
-                    if not gpu:
-                        gpu = GPU(fullname=gpu_name)
-                        db.session.add(gpu)
-                    agent.gpus.append(gpu)
-
-            if disks is not None:
-                for old_disk in agent.disks:
-                    db.session.delete(old_disk)
-                for disk_dict in disks:
-                    disk = AgentDisk(agent=agent,
-                                     mountpoint=disk_dict["mountpoint"],
-                                     size=disk_dict["size"],
-                                     free=disk_dict["free"])
-                    db.session.add(disk)
-
-            if state is not None and agent.state != _AgentState.DISABLED:
+            if (state is not None and agent.state != state and
+                    agent.state != _AgentState.DISABLED):
                 agent.state = state
+                updated = True
 
             # TODO Only do that if this is really the agent speaking to us.
             failed_tasks = []
             if (current_assignments is not None and
                 agent.state != AgentState.OFFLINE):
-                    fail_missing_assignments(agent, current_assignments)
+                    failed_tasks = fail_missing_assignments(
+                        agent, current_assignments)
 
-            if updated or failed_tasks:
-                agent.last_heard_from = datetime.utcnow()
-                db.session.add(agent)
+            # Re-registering with unchanged data is common (for instance
+            # after restarting many agents at once), in that case we only
+            # record that we heard from the agent.
+            write_behind.set(agent, **heartbeat)
+            db.session.add(agent)
 
-                try:
-                    db.session.commit()
+            try:
+                db.session.commit()
 
-                except Exception as e:
-                    return jsonify(error="Unhandled error: %s" % e), \
-                           INTERNAL_SERVER_ERROR
+            except Exception as e:
+                return jsonify(error="Unhandled error: %s" % e), \
+                       INTERNAL_SERVER_ERROR
 
-                else:
-                    agent_data = agent.to_dict(unpack_relationships=["tags"])
-                    logger.info("Updated agent %r: %r", agent.id, agent_data)
-                    for task in failed_tasks:
-                        task.job.update_state()
-                    db.session.commit()
-                    assign_tasks.delay()
-                    return jsonify(agent_data), OK
+            agent_data = agent.to_dict(unpack_relationships=["tags"])
+            if updated or failed_tasks:
+                logger.info("Updated agent %r: %r", agent.id, agent_data)
+                for task in failed_tasks:
+                    task.job.update_state()
+                db.session.commit()
+                assign_tasks.delay()
+            return jsonify(agent_data), OK
 
+    @conditional_get(agent_index_freshness)
     def get(self):
         """
         A ``GET`` to this endpoint will return a list of known agents, with id
@@ -563,6 +675,7 @@ class SingleAgentAPI(MethodView):
     API view which is used for retrieving information about and updating
     single agents.
     """
+    @conditional_get(agent_freshness)
     def get(self, agent_id):
         """
         Return basic information about a single agent
@@ -714,6 +827,12 @@ class SingleAgentAPI(MethodView):
         except AttributeError:
             items = g.json.items
 
+        heartbeat = {"last_heard_from": datetime.utcnow()}
+        if "free_ram" in g.json:
+            heartbeat["free_ram"] = g.json.pop("free_ram")
+            if heartbeat["free_ram"] != agent.free_ram:
+                modified["free_ram"] = heartbeat["free_ram"]
+
         state = g.json.pop("state", None)
         if state and agent.state != _AgentState.DISABLED:
             agent.state = state
@@ -731,75 +850,17 @@ class SingleAgentAPI(MethodView):
 
                 modified[key] = value
 
-        agent.last_heard_from = datetime.utcnow()
+        write_behind.set(agent, **heartbeat)
 
         if "upgrade_to" in modified:
             update_agent.delay(agent.id)
 
-        if mac_addresses is not None:
-            modified["mac_addresses"] = mac_addresses
-            for existing_address in agent.mac_addresses:
-                if existing_address.mac_address.lower() not in mac_addresses:
-                    logger.debug("Existing address %s is not in supplied "
-                                 "mac addresses, for agent %s, removing it.",
-                                 existing_address.mac_address,
-                                 agent.hostname)
-                    agent.mac_addresses.remove(existing_address)
-                else:
-                    mac_addresses.remove(
-                        existing_address.mac_address.lower())
-
-            for new_address in mac_addresses:
-                mac_address = AgentMacAddress(
-                    agent=agent, mac_address=new_address)
-                db.session.add(mac_address)
-
-        if gpus is not None:
-            modified["gpus"] = gpus
-            for existing_gpu in agent.gpus:
-                if existing_gpu.fullname not in gpus:
-                    logger.debug("Existing gpu %s is not in supplied "
-                                    "gpus, for agent %s, removing it.",
-                                    existing_gpu.fullname,
-                                    agent.hostname)
-                    agent.gpus.remove(existing_gpu)
-                else:
-                    gpus.remove(existing_gpu.fullname)
-
-            for gpu_name in gpus:
-                gpu = GPU.query.filter_by(fullname=gpu_name).first()
-                if not gpu:
-                    gpu = GPU(fullname=gpu_name)
-                    db.session.add(gpu)
-                agent.gpus.append(gpu)
-
-        if disks is not None:
-            for old_disk in agent.disks:
-                db.session.delete(old_disk)
-            for disk_dict in disks:
-                disk = AgentDisk(agent=agent,
-                                    mountpoint=disk_dict["mountpoint"],
-                                    size=disk_dict["size"],
-                                    free=disk_dict["free"])
-                db.session.add(disk)
-
-        if tags is not None:
-            modified["tags"] = tags
-            for existing_tag in agent.tags:
-                if existing_tag.tag not in tags:
-                    logger.debug("Existing tag %s is not in supplied "
-                                 "tags, for agent %s, removing it.",
-                                 existing_tag.tag, agent.hostname)
-                    agent.tags.remove(existing_tag)
-                else:
-                    tags.remove(existing_tag.tag)
-
-            for tag_name in tags:
-                tag = Tag.query.filter_by(tag=tag_name).first()
-                if not tag:
-                    tag = Tag(tag=tag_name)
-                    db.session.add(tag)
-                agent.tags.append(tag)
+        if update_inventory(agent, mac_addresses=mac_addresses, gpus=gpus,
+                            disks=disks, tags=tags):
+            for key, value in (("mac_addresses", mac_addresses),
+                               ("gpus", gpus), ("tags", tags)):
+                if value is not None:
+                    modified[key] = value
 
         # TODO Only do that if this is really the agent speaking to us.
         failed_tasks = []
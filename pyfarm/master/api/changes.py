@@ -0,0 +1,182 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Changes
+-------
+
+This module defines an API which lets clients follow changes to jobs, tasks
+and agents incrementally instead of repeatedly fetching whole collections.
+"""
+
+import time
+
+try:
+    from httplib import OK, BAD_REQUEST, GONE
+except ImportError:  # pragma: no cover
+    from http.client import OK, BAD_REQUEST, GONE
+
+from flask import request
+from flask.views import MethodView
+
+from sqlalchemy import func
+
+from pyfarm.core.logger import getLogger
+from pyfarm.models.change import Change, ChangeSequence
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.master.utility import jsonify, get_integer_argument
+
+logger = getLogger("api.changes")
+
+CHANGE_TYPES = ("job", "task", "agent")
+MAX_WAIT = config.get("change_feed_max_wait")
+POLL_INTERVAL = config.get("change_feed_poll_interval")
+PAGE_SIZE = config.get("change_feed_page_size")
+
+
+class ChangesIndexAPI(MethodView):
+    def get(self):
+        """
+        A ``GET`` to this endpoint will return the changes to jobs, tasks
+        and agents which happened after the sequence number ``since``.
+
+        .. http:get:: /api/v1/changes HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/changes?since=41&wait=30 HTTP/1.1
+                Accept: application/json
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                {
+                    "last_seq": 43,
+                    "more": false,
+                    "changes": [
+                        {
+                            "seq": 42,
+                            "time": "2015-04-29T13:34:42.124352",
+                            "type": "task",
+                            "id": "5",
+                            "action": "update",
+                            "fields": {
+                                "state": "running",
+                                "attempts": 1
+                            }
+                        },
+                        {
+                            "seq": 43,
+                            "time": "2015-04-29T13:34:47.526310",
+                            "type": "job",
+                            "id": "1",
+                            "action": "delete",
+                            "fields": {}
+                        }
+                    ]
+                }
+
+        :qparam since:
+            Only return changes with a sequence number greater than this.
+            When not provided no changes are returned, only ``last_seq``,
+            which a client should use as the starting point for subsequent
+            requests.
+
+        :qparam wait:
+            If there are no changes yet, wait for up to this many seconds
+            for new changes to appear before responding.  This is capped
+            by the ``change_feed_max_wait`` setting, which disables
+            waiting by default.
+
+        :qparam limit:
+            The maximum number of changes to return.  If more changes are
+            available ``more`` will be true in the response.
+
+        :qparam type:
+            Only return changes of this type (``job``, ``task`` or
+            ``agent``), may be given more than once
+
+        :statuscode 200: no error
+        :statuscode 400: one of the url arguments was invalid
+        :statuscode 410: changes after ``since`` have already been cleaned
+                         up, the client has to refetch the collections it
+                         is interested in
+        """
+        since = get_integer_argument("since")
+        wait = get_integer_argument("wait", default=0)
+        limit = get_integer_argument("limit", default=PAGE_SIZE)
+        types = request.args.getlist("type")
+
+        if not 0 < limit <= PAGE_SIZE:
+            return (jsonify(error="`limit` must be between 1 and %s" %
+                                  PAGE_SIZE), BAD_REQUEST)
+
+        if wait < 0:
+            return jsonify(error="`wait` must not be negative"), BAD_REQUEST
+
+        for change_type in types:
+            if change_type not in CHANGE_TYPES:
+                return (jsonify(error="Unknown type %s" % change_type),
+                        BAD_REQUEST)
+
+        last_seq = db.session.query(func.max(Change.seq)).scalar()
+        purged = db.session.query(ChangeSequence.purged).filter(
+            ChangeSequence.id == 1).scalar() or 0
+        last_seq = max(last_seq or 0, purged)
+
+        if since is None:
+            return jsonify(last_seq=last_seq, more=False, changes=[]), OK
+
+        if since < purged:
+            return (jsonify(error="Changes after %s are no longer available, "
+                                  "changes up to %s have been cleaned up" %
+                                  (since, purged)), GONE)
+
+        query = Change.query.filter(Change.seq > since)
+        if types:
+            query = query.filter(Change.type.in_(types))
+        query = query.order_by(Change.seq).limit(limit + 1)
+
+        deadline = time.time() + min(wait, MAX_WAIT)
+        changes = query.all()
+        while not changes and time.time() < deadline:
+            # end the transaction so the next query sees new commits
+            db.session.rollback()
+            time.sleep(POLL_INTERVAL)
+            changes = query.all()
+
+        more = len(changes) > limit
+        changes = changes[:limit]
+
+        # Tell the client how far it has seen, even if all of the changes
+        # were filtered out by type
+        if more:
+            last_seq = changes[-1].seq
+        elif changes:
+            last_seq = max(last_seq, changes[-1].seq)
+        else:
+            last_seq = max(last_seq, since)
+
+        return jsonify(
+            last_seq=last_seq, more=more,
+            changes=[change.to_dict() for change in changes]), OK
@@ -0,0 +1,206 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Events
+------
+
+This module defines server-sent event streams which push job and task
+updates to clients as they happen.
+"""
+
+try:
+    from httplib import NOT_FOUND
+except ImportError:  # pragma: no cover
+    from http.client import NOT_FOUND
+
+from flask import Response, stream_with_context
+from flask.views import MethodView
+
+from pyfarm.core.enums import STRING_TYPES
+from pyfarm.models.job import Job
+from pyfarm.models.jobgroup import JobGroup
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.master.events import events
+from pyfarm.master.utility import jsonify, dumps
+
+KEEPALIVE_INTERVAL = config.get("event_stream_keepalive")
+
+
+def format_event(event_type, data):
+    """Formats a single event for an ``text/event-stream`` response"""
+    return "event: %s\ndata: %s\n\n" % (event_type, dumps(data))
+
+
+def event_stream(subscription):
+    """
+    Produces the body of an event stream response for ``subscription``,
+    closing the subscription once the client disconnects.
+    """
+    try:
+        # Ask clients to reconnect quickly if the connection drops
+        yield "retry: 3000\n\n"
+
+        while True:
+            if subscription.lost:
+                subscription.lost = False
+                yield format_event("resync", {})
+
+            event = subscription.get(KEEPALIVE_INTERVAL)
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield format_event(*event)
+    finally:
+        subscription.close()
+
+
+def event_stream_response(subscription):
+    # The stream may stay open for a long time, don't hold on to a
+    # database connection for all of it.
+    db.session.remove()
+    response = Response(
+        stream_with_context(event_stream(subscription)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Also release the subscription when the response is closed without its
+    # body being consumed, closing it twice is harmless
+    response.call_on_close(subscription.close)
+    return response
+
+
+class FarmEventsAPI(MethodView):
+    def get(self):
+        """
+        A ``GET`` to this endpoint opens a server-sent event stream with
+        updates to all jobs and tasks on the farm.
+
+        .. http:get:: /api/v1/events HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/events HTTP/1.1
+                Accept: text/event-stream
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: text/event-stream
+
+                retry: 3000
+
+                event: task
+                data: {"task_id": 2, "job_id": 1, "jobgroup_id": null, "state": "running", "progress": 0.25, "agent_id": "2b8d3b0e-52b6-4e24-9b38-4c6ee5ef9a37", "attempts": 1, "failures": 0}
+
+                event: job
+                data: {"job_id": 1, "jobgroup_id": null, "state": "running"}
+
+        Jobs and tasks which were deleted are sent with the state
+        ``deleted``.
+
+        Clients receive a ``resync`` event if they fell too far behind and
+        events were dropped.  They should refetch the objects they display
+        when this happens.
+
+        :statuscode 200: no error
+        """
+        return event_stream_response(events.subscribe())
+
+
+class JobEventsAPI(MethodView):
+    def get(self, job_name):
+        """
+        A ``GET`` to this endpoint opens a server-sent event stream with
+        updates to the given job and its tasks.  The events are the same as
+        for ``/api/v1/events``.
+
+        .. http:get:: /api/v1/jobs/[<str:name>|<int:id>]/events HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/jobs/Test%20Job/events HTTP/1.1
+                Accept: text/event-stream
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: text/event-stream
+
+                retry: 3000
+
+                event: task
+                data: {"task_id": 2, "job_id": 1, "jobgroup_id": null, "state": "done", "progress": 1.0, "agent_id": "2b8d3b0e-52b6-4e24-9b38-4c6ee5ef9a37", "attempts": 1, "failures": 0}
+
+        :statuscode 200: no error
+        :statuscode 404: job not found
+        """
+        if isinstance(job_name, STRING_TYPES):
+            job = Job.query.filter_by(title=job_name).first()
+        else:
+            job = Job.query.filter_by(id=job_name).first()
+
+        if not job:
+            return jsonify(error="Job not found"), NOT_FOUND
+
+        return event_stream_response(events.subscribe(job_id=job.id))
+
+
+class JobGroupEventsAPI(MethodView):
+    def get(self, group_id):
+        """
+        A ``GET`` to this endpoint opens a server-sent event stream with
+        updates to all jobs in the given job group and their tasks.  The
+        events are the same as for ``/api/v1/events``.
+
+        .. http:get:: /api/v1/jobgroups/<int:id>/events HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/jobgroups/2/events HTTP/1.1
+                Accept: text/event-stream
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: text/event-stream
+
+                retry: 3000
+
+                event: job
+                data: {"job_id": 1, "jobgroup_id": 2, "state": "done"}
+
+        :statuscode 200: no error
+        :statuscode 404: job group not found
+        """
+        jobgroup = JobGroup.query.filter_by(id=group_id).first()
+
+        if not jobgroup:
+            return jsonify(error="Job group not found"), NOT_FOUND
+
+        return event_stream_response(events.subscribe(jobgroup_id=group_id))
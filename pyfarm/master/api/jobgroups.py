@@ -34,9 +34,10 @@ from flask import g
 from sqlalchemy import func, asc
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState
+from pyfarm.scheduler.tasks import assign_tasks
 from pyfarm.models.user import User
 from pyfarm.models.jobtype import JobType
-from pyfarm.models.job import Job
+from pyfarm.models.job import Job, rerun_jobs
 from pyfarm.models.task import Task
 from pyfarm.models.jobgroup import JobGroup
 from pyfarm.master.config import config
@@ -359,6 +360,64 @@ class SingleJobGroupAPI(MethodView):
 
         return jsonify(), NO_CONTENT
 
+
+class JobGroupRerunAPI(MethodView):
+    failed_only = False
+
+    def post(self, group_id):
+        """
+        A ``POST`` to this endpoint will make all jobs in the specified job
+        group, and their children, run again.  Tasks which are currently
+        running are left untouched.
+
+        .. http:post:: /api/v1/jobgroups/<int:id>/rerun HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                POST /api/v1/jobgroups/2/rerun HTTP/1.1
+                Accept: application/json
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                {
+                    "restarted": 200
+                }
+
+        :statuscode 200: no error
+        :statuscode 404: the requested job group was not found
+        """
+        jobgroup = JobGroup.query.filter_by(id=group_id).first()
+
+        if not jobgroup:
+            return (jsonify(error="Requested job group %s not found" % group_id),
+                    NOT_FOUND)
+
+        job_ids = [job_id for job_id, in
+                   db.session.query(Job.id).filter_by(job_group_id=group_id)]
+        restarted = rerun_jobs(job_ids, failed_only=self.failed_only)
+        db.session.commit()
+        assign_tasks.delay()
+        logger.info("Rerunning %s tasks in job group %s (id %s)",
+                    restarted, jobgroup.title, jobgroup.id)
+
+        return jsonify(restarted=restarted), OK
+
+
+class JobGroupRerunFailedAPI(JobGroupRerunAPI):
+    """
+    Like :class:`JobGroupRerunAPI` but only the failed tasks are run again,
+    at ``/api/v1/jobgroups/<int:id>/rerun_failed``
+    """
+    failed_only = True
+
+
 class JobsInJobGroupIndexAPI(MethodView):
     def get(self, group_id):
         """
@@ -131,10 +131,6 @@ class JobQueueIndexAPI(MethodView):
 
         jobqueue = JobQueue(**g.json)
         db.session.add(jobqueue)
-        db.session.flush()
-
-        jobqueue.fullpath = jobqueue.path()
-        db.session.add(jobqueue)
         db.session.commit()
 
         jobqueue_data = jobqueue.to_dict()
@@ -310,14 +306,7 @@ class SingleJobQueueAPI(MethodView):
         if g.json:
             return jsonify(error="Unkown columns: %s" % g.json), BAD_REQUEST
 
-        # It is possible for a call to this to change a queue's name
-        db.session.add(jobqueue)
-        db.session.flush()
-        jobqueue.fullpath = jobqueue.path()
-        for childqueue in jobqueue.children:
-            childqueue.fullpath = childqueue.path()
-            db.session.add(childqueue)
-
+        # Renaming a queue updates the paths of all queues below it too
         db.session.add(jobqueue)
         db.session.commit()
 
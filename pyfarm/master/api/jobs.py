@@ -42,20 +42,23 @@ from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import STRING_TYPES, NUMERIC_TYPES, WorkState, _WorkState
 from pyfarm.scheduler.tasks import (
     assign_tasks_to_agent, assign_tasks, delete_job)
-from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.models.archive import ArchivedTask, find_archived_job
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.task import Task
 from pyfarm.models.user import User
-from pyfarm.models.job import Job, JobNotifiedUser
+from pyfarm.models.job import Job, JobNotifiedUser, rerun_jobs
 from pyfarm.models.software import (
     Software, SoftwareVersion, JobSoftwareRequirement)
 from pyfarm.models.tag import Tag, JobTagRequirement
 from pyfarm.models.jobqueue import JobQueue
 from pyfarm.models.agent import Agent
 from pyfarm.master.application import db
+from pyfarm.master.events import events
 from pyfarm.master.utility import (
-    jsonify, validate_with_model, get_request_argument)
+    jsonify, validate_with_model, get_request_argument, conditional_get)
 from pyfarm.master.config import config
+from pyfarm.master.writebehind import write_behind
+from pyfarm.master.taskevents import task_events
 
 RANGE_TYPES = NUMERIC_TYPES[:-1] + (Decimal, )
 
@@ -219,6 +222,128 @@ def schema():
     return jsonify(schema_dict), OK
 
 
+def job_index_freshness():
+    """
+    Returns the freshness of the job list for :func:`.conditional_get`.
+    The list also reports whether jobs have assigned tasks so the number
+    of assigned tasks per job is taken into account too, which only has
+    to look at tasks with an agent instead of the whole tasks table.
+    """
+    jobs = db.session.query(
+        func.count(Job.id), func.max(Job.id),
+        func.sum(Job.row_version), func.max(Job.time_updated)).one()
+    assigned_tasks = db.session.query(
+        Task.job_id, func.count(Task.id)).filter(
+            Task.agent_id != None).group_by(Task.job_id).order_by(Task.job_id)
+    return [list(jobs), [list(row) for row in assigned_tasks]], None
+
+
+def job_freshness(job_name):
+    """
+    Returns the freshness of a single job and its tasks for
+    :func:`.conditional_get` or ``None`` if the job does not exist.
+    """
+    job_query = db.session.query(Job.id, Job.row_version, Job.time_updated)
+    if isinstance(job_name, STRING_TYPES):
+        job_query = job_query.filter(Job.title == job_name)
+    else:
+        job_query = job_query.filter(Job.id == job_name)
+    job = job_query.first()
+
+    if job is None:
+        return None
+
+    tasks = db.session.query(
+        func.count(Task.id), func.max(Task.id),
+        func.sum(Task.row_version), func.max(Task.time_updated)).\
+        filter(Task.job_id == job.id).one()
+    last_modified = max(
+        x for x in (job.time_updated, tasks[-1]) if x is not None)
+    return [list(job), list(tasks)], last_modified
+
+
+def task_freshness(job_name, task_id):
+    """
+    Returns the freshness of a single task for :func:`.conditional_get` or
+    ``None`` if the task does not exist.
+    """
+    task_query = db.session.query(
+        Task.row_version, Task.time_updated,
+        Job.row_version, Job.time_updated).\
+        join(Job, Task.job_id == Job.id).filter(Task.id == task_id)
+    if isinstance(job_name, STRING_TYPES):
+        task_query = task_query.filter(Job.title == job_name)
+    else:
+        task_query = task_query.filter(Job.id == job_name)
+    task = task_query.first()
+
+    if task is None:
+        return None
+
+    # Buffered updates have not bumped the row version yet
+    pending = write_behind.pending(Task, task_id)
+    if pending:
+        return [list(task), pending], None
+
+    last_modified = max(x for x in task[1::2] if x is not None)
+    return list(task), last_modified
+
+
+def job_document(job):
+    """
+    Returns the document a ``GET`` of a single job returns for ``job`` or
+    ``None`` if the job does not have any tasks
+    """
+    job_data = job.to_dict(unpack_relationships=["tags",
+                                                 "data",
+                                                 "software_requirements",
+                                                 "parents",
+                                                 "children",
+                                                 "notified_users",
+                                                 "tag_requirements"])
+
+    first_task = Task.query.filter_by(job=job).order_by("frame asc").first()
+    last_task = Task.query.filter_by(job=job).order_by("frame desc").first()
+
+    if not first_task or not last_task:
+        return None
+
+    job_data["start"] = first_task.frame
+    job_data["end"] = last_task.frame
+    job_data["jobtype"] = job.jobtype_version.jobtype.name
+    job_data["jobtype_version"] = job.jobtype_version.version
+    job_data["user"] = job.user.username if job.user else None
+    del job_data["user_id"]
+    job_data["jobqueue"] = job.queue.path() if job.queue else None
+    del job_data["job_queue_id"]
+    job_data["jobgroup"] = job.group.title if job.group else None
+    if job.state is None:
+        num_assigned_tasks = Task.query.filter(Task.job == job,
+                                               Task.agent != None).count()
+        if num_assigned_tasks > 0:
+            job_data["state"] = "running"
+        else:
+            job_data["state"] = "queued"
+
+    del job_data["jobtype_version_id"]
+    return job_data
+
+
+def task_document(task, unpack_relationships=("job", "agent", "children",
+                                               "parents", "project")):
+    """
+    Returns the document the api returns for ``task``.  By default it is
+    the one of a single task, a ``GET`` of the tasks in a job passes
+    ``unpack_relationships=False``.
+    """
+    task_data = task.to_dict(unpack_relationships=unpack_relationships)
+    if task.state is None and task.agent is None:
+        task_data["state"] = "queued"
+    elif task.state is None:
+        task_data["state"] = "assigned"
+    return task_data
+
+
 class JobIndexAPI(MethodView):
     @validate_with_model(Job,
                          type_checks={"by": lambda x: isinstance(
@@ -227,7 +352,7 @@ class JobIndexAPI(MethodView):
                                  "user", "jobqueue", "tag_requirements"],
                          disallow=["jobtype_version_id", "time_submitted",
                                    "time_started", "time_finished",
-                                   "job_queue_id"])
+                                   "delete_after", "job_queue_id"])
     def post(self):
         """
         A ``POST`` to this endpoint will submit a new job.
@@ -387,14 +512,11 @@ class JobIndexAPI(MethodView):
         jobqueue = None
         jobqueue_name = g.json.pop("jobqueue", None)
         if jobqueue_name:
-            path_elements = jobqueue_name.split("/")
-            for element in path_elements:
-                jobqueue = JobQueue.query.filter_by(
-                    parent=jobqueue, name=element).first()
-                if not jobqueue:
-                    return (jsonify(error="Jobqueue %s not found" %
-                                    jobqueue_name),
-                            NOT_FOUND)
+            jobqueue = JobQueue.by_path(jobqueue_name)
+            if not jobqueue:
+                return (jsonify(error="Jobqueue %s not found" %
+                                jobqueue_name),
+                        NOT_FOUND)
 
         notified_usernames = g.json.pop("notified_users", None)
         tag_requirements = g.json.pop("tag_requirements", None)
@@ -508,6 +630,7 @@ class JobIndexAPI(MethodView):
 
         return jsonify(job_data), CREATED
 
+    @conditional_get(job_index_freshness)
     def get(self):
         """
         A ``GET`` to this endpoint will return a list of all jobs.
@@ -580,8 +703,7 @@ class JobIndexAPI(MethodView):
         if jobqueue_names:
             jobqueue_ids = []
             for jobqueue_name in jobqueue_names:
-                jobqueue = JobQueue.query.filter_by(
-                    fullpath=jobqueue_name).first()
+                jobqueue = JobQueue.by_path(jobqueue_name)
                 if not jobqueue:
                     return (
                         jsonify(error="Jobqueue %s not found" % jobqueue_name),
@@ -606,9 +728,12 @@ class JobIndexAPI(MethodView):
 
 
 class SingleJobAPI(MethodView):
+    @conditional_get(job_freshness)
     def get(self, job_name):
         """
         A ``GET`` to this endpoint will return the specified job, by name or id.
+        Jobs which have been archived are returned as they were when they
+        were archived, with ``"archived": true`` added.
 
         .. http:get:: /api/v1/jobs/[<str:name>|<int:id>] HTTP/1.1
 
@@ -684,42 +809,16 @@ class SingleJobAPI(MethodView):
             job = Job.query.filter_by(id=job_name).first()
 
         if not job:
+            archived_job = find_archived_job(job_name)
+            if archived_job is not None:
+                return jsonify(archived_job.to_document()), OK
             return jsonify(error="Job not found"), NOT_FOUND
 
-        job_data = job.to_dict(unpack_relationships=["tags",
-                                                     "data",
-                                                     "software_requirements",
-                                                     "parents",
-                                                     "children",
-                                                     "notified_users",
-                                                     "tag_requirements"])
-
-        first_task = Task.query.filter_by(job=job).order_by("frame asc").first()
-        last_task = Task.query.filter_by(job=job).order_by("frame desc").first()
-
-        if not first_task or not last_task: # pragma: no cover
+        job_data = job_document(job)
+        if job_data is None: # pragma: no cover
             return (jsonify(error="Job does not have any tasks"),
                     INTERNAL_SERVER_ERROR)
 
-        job_data["start"] = first_task.frame
-        job_data["end"] = last_task.frame
-        job_data["jobtype"] = job.jobtype_version.jobtype.name
-        job_data["jobtype_version"] = job.jobtype_version.version
-        job_data["user"] = job.user.username if job.user else None
-        del job_data["user_id"]
-        job_data["jobqueue"] = job.queue.path() if job.queue else None
-        del job_data["job_queue_id"]
-        job_data["jobgroup"] = job.group.title if job.group else None
-        if job.state is None:
-            num_assigned_tasks = Task.query.filter(Task.job == job,
-                                                   Task.agent != None).count()
-            if num_assigned_tasks > 0:
-                job_data["state"] = "running"
-            else:
-                job_data["state"] = "queued"
-
-        del job_data["jobtype_version_id"]
-
         return jsonify(job_data), OK
 
     def post(self, job_name):
@@ -879,6 +978,10 @@ class SingleJobAPI(MethodView):
             return (jsonify(error="`time_finished` cannot be set manually"),
                     BAD_REQUEST)
 
+        if "delete_after" in g.json:
+            return (jsonify(error="`delete_after` cannot be set manually"),
+                    BAD_REQUEST)
+
         if "time_submitted" in g.json:
             return (jsonify(error="`time_submitted` cannot be set manually"),
                     BAD_REQUEST)
@@ -1023,10 +1126,71 @@ class SingleJobAPI(MethodView):
         return jsonify(None), NO_CONTENT
 
 
+class JobRerunAPI(MethodView):
+    failed_only = False
+
+    def post(self, job_name):
+        """
+        A ``POST`` to this endpoint will make the specified job and all of
+        its children run again.  Tasks which are currently running are left
+        untouched.
+
+        .. http:post:: /api/v1/jobs/[<str:name>|<int:id>]/rerun HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                POST /api/v1/jobs/1/rerun HTTP/1.1
+                Accept: application/json
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                {
+                    "restarted": 5
+                }
+
+        :statuscode 200: no error
+        :statuscode 404: the job does not exist
+        """
+        if isinstance(job_name, STRING_TYPES):
+            job = Job.query.filter_by(title=job_name).first()
+        else:
+            job = Job.query.filter_by(id=job_name).first()
+
+        if not job:
+            return jsonify(error="Job not found"), NOT_FOUND
+
+        restarted = rerun_jobs([job.id], failed_only=self.failed_only)
+        db.session.commit()
+        assign_tasks.delay()
+        logger.info("Rerunning %s tasks of job %s (id %s)",
+                    restarted, job.title, job.id)
+
+        return jsonify(restarted=restarted), OK
+
+
+class JobRerunFailedAPI(JobRerunAPI):
+    """
+    Like :class:`JobRerunAPI` but only the failed tasks of the job and its
+    children are run again, at
+    ``/api/v1/jobs/[<str:name>|<int:id>]/rerun_failed``
+    """
+    failed_only = True
+
+
 class JobTasksIndexAPI(MethodView):
+    @conditional_get(job_freshness)
     def get(self, job_name):
         """
         A ``GET`` to this endpoint will return a list of all tasks in a job.
+        The tasks of archived jobs are returned as they were when they were
+        archived, with ``"archived": true`` added.
 
         .. http:get:: /api/v1/jobs/[<str:name>|<int:id>]/tasks HTTP/1.1
 
@@ -1083,18 +1247,18 @@ class JobTasksIndexAPI(MethodView):
             job = Job.query.filter_by(id=job_name).first()
 
         if not job:
+            archived_job = find_archived_job(job_name)
+            if archived_job is not None:
+                archived_tasks = ArchivedTask.query.filter_by(
+                    job_id=archived_job.id).order_by(ArchivedTask.frame)
+                return jsonify(
+                    [task.to_document() for task in archived_tasks]), OK
             return jsonify(error="Job not found",
                            id=job_name), NOT_FOUND
 
         tasks_q = Task.query.filter_by(job=job).order_by("frame asc")
-        out = []
-        for task in tasks_q:
-            data = task.to_dict(unpack_relationships=False)
-            if task.state == None and task.agent == None:
-                data["state"] = "queued"
-            elif task.state == None:
-                data["state"] = "assigned"
-            out.append(data)
+        out = [task_document(task, unpack_relationships=False)
+               for task in tasks_q]
 
         return jsonify(out), OK
 
@@ -1157,9 +1321,9 @@ class JobSingleTaskAPI(MethodView):
         """
         task_query = Task.query.filter_by(id=task_id)
         if isinstance(job_name, STRING_TYPES):
-            task_query.filter(Task.job.has(Job.title == job_name))
+            task_query = task_query.filter(Task.job.has(Job.title == job_name))
         else:
-            task_query.filter(Task.job.has(Job.id == job_name))
+            task_query = task_query.filter(Task.job.has(Job.id == job_name))
         task = task_query.first()
 
         if not task:
@@ -1175,6 +1339,10 @@ class JobSingleTaskAPI(MethodView):
             return (jsonify(error="`time_finished` cannot be set manually"),
                     BAD_REQUEST)
 
+        if "delete_after" in g.json:
+            return (jsonify(error="`delete_after` cannot be set manually"),
+                    BAD_REQUEST)
+
         if "time_submitted" in g.json:
             return (jsonify(error="`time_submitted` cannot be set manually"),
                     BAD_REQUEST)
@@ -1228,8 +1396,12 @@ class JobSingleTaskAPI(MethodView):
                               "type(s) %r" % (key, type(value),
                                               expected_types)), BAD_REQUEST)
 
-                # correct type for `value`
-                setattr(task, key, value)
+                # correct type for `value`, progress only updates are
+                # frequent and go through the write-behind buffer
+                if key == "progress" and not state_transition:
+                    write_behind.set(task, progress=value)
+                else:
+                    setattr(task, key, value)
 
         if g.json:
             return (jsonify(error="Unknown columns in request: %r" % g.json),
@@ -1247,6 +1419,11 @@ class JobSingleTaskAPI(MethodView):
             task_data["state"] = "assigned"
         logger.info("Task %s of job %s has been updated, new data: %r",
                     task_id, task.job.title, task_data)
+        events.publish(
+            "task", task_id=task.id, job_id=task.job_id,
+            jobgroup_id=task.job.job_group_id, state=task_data["state"],
+            progress=task.progress, agent_id=task.agent_id,
+            attempts=task.attempts, failures=task.failures)
 
         if agent:
             task_count = Task.query.filter(
@@ -1264,30 +1441,33 @@ class JobSingleTaskAPI(MethodView):
             old_state = task.job.state
             task.job.update_state()
             db.session.commit()
+            if task.job.state != old_state:
+                events.publish(
+                    "job", job_id=task.job.id,
+                    jobgroup_id=task.job.job_group_id,
+                    state=str(task.job.state) if task.job.state else "queued")
             if task.job.state != old_state and task.job.state == WorkState.DONE:
                 assign_tasks.delay()
 
-        if config.get("enable_statistics") and task.job and state_transition:
-            task_event_count = TaskEventCount(
-                job_queue_id=task.job.job_queue_id)
+        if task.job and state_transition:
             if new_state == "queued":
-                task_event_count.num_restarted = 1
+                task_events.count(task.job.job_queue_id, num_restarted=1)
             elif new_state == "running":
-                task_event_count.num_started = 1
+                task_events.count(task.job.job_queue_id, num_started=1)
             elif new_state == "done":
-                task_event_count.num_done = 1
+                task_events.count(task.job.job_queue_id, num_done=1)
             elif new_state == "failed":
-                task_event_count.num_failed = 1
-            task_event_count.time_start = datetime.utcnow()
-            task_event_count.time_end = datetime.utcnow()
-            db.session.add(task_event_count)
+                task_events.count(task.job.job_queue_id, num_failed=1)
             db.session.commit()
 
         return jsonify(task_data), OK
 
+    @conditional_get(task_freshness)
     def get(self, job_name, task_id):
         """
-        A ``GET`` to this endpoint will return the requested task
+        A ``GET`` to this endpoint will return the requested task.  Archived
+        tasks are returned as they were when they were archived, with
+        ``"archived": true`` added.
 
         .. http:get:: /api/v1/jobs/[<str:name>|<int:id>]/tasks/<int:task_id> HTTP/1.1
 
@@ -1332,23 +1512,18 @@ class JobSingleTaskAPI(MethodView):
         """
         task_query = Task.query.filter_by(id=task_id)
         if isinstance(job_name, STRING_TYPES):
-            task_query.filter(Task.job.has(Job.title == job_name))
+            task_query = task_query.filter(Task.job.has(Job.title == job_name))
         else:
-            task_query.filter(Task.job.has(Job.id == job_name))
+            task_query = task_query.filter(Task.job.has(Job.id == job_name))
         task = task_query.first()
 
         if not task:
+            archived_task = ArchivedTask.query.filter_by(id=task_id).first()
+            if archived_task is not None:
+                return jsonify(archived_task.to_document()), OK
             return jsonify(error="Task not found"), NOT_FOUND
 
-        task_data = task.to_dict(unpack_relationships=("job", "agent",
-                                                       "children", "parents",
-                                                       "project"))
-        if task.state is None and task.agent is None:
-            task_data["state"] = "queued"
-        elif task.state is None:
-            task_data["state"] = "assigned"
-
-        return jsonify(task_data), OK
+        return jsonify(task_document(task)), OK
 
 
 class TaskFailedOnAgentsIndexAPI(MethodView):
@@ -1384,7 +1559,7 @@ class TaskFailedOnAgentsIndexAPI(MethodView):
         :statuscode 404: job or task not found
         """
         task_query = Task.query.filter_by(id=task_id)
-        task_query.filter(Task.job.has(Job.id == job_id))
+        task_query = task_query.filter(Task.job.has(Job.id == job_id))
         task = task_query.first()
 
         if not task:
@@ -1434,7 +1609,7 @@ class TaskFailedOnAgentsIndexAPI(MethodView):
         :statuscode 404: the job, task or agent specified does not exist
         """
         task_query = Task.query.filter_by(id=task_id)
-        task_query.filter(Task.job.has(Job.id == job_id))
+        task_query = task_query.filter(Task.job.has(Job.id == job_id))
         task = task_query.first()
 
         if not task:
@@ -1479,7 +1654,7 @@ class SingleTaskOnAgentFailureAPI(MethodView):
         :statuscode 404: the job, task or agent does not exist
         """
         task_query = Task.query.filter_by(id=task_id)
-        task_query.filter(Task.job.has(Job.id == job_id))
+        task_query = task_query.filter(Task.job.has(Job.id == job_id))
         task = task_query.first()
 
         if not task:
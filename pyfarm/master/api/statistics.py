@@ -0,0 +1,350 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Statistics
+----------
+
+This module defines an API for the farm statistics gathered by
+:mod:`pyfarm.scheduler.statistics_tasks`.  The samples are downsampled by
+the database, so clients receive at most as many points as they draw.
+"""
+
+from calendar import timegm
+from datetime import datetime, timedelta
+from math import ceil
+
+try:
+    from httplib import OK, BAD_REQUEST
+except ImportError:  # pragma: no cover
+    from http.client import OK, BAD_REQUEST
+
+from flask import request
+from flask.views import MethodView
+
+from sqlalchemy import and_, func, or_, select
+
+from pyfarm.core.logger import getLogger
+from pyfarm.models.core.functions import time_bucket
+from pyfarm.models.statistics.agent_count import AgentCount
+from pyfarm.models.statistics.task_count import TaskCount
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.models.statistics.rollups import (
+    AgentCountRollup, TaskCountRollup, TaskEventCountRollup,
+    choose_resolution)
+from pyfarm.scheduler.statistics_tasks import (
+    AGENT_COUNT_COLUMNS, TASK_COUNT_COLUMNS, EVENT_COLUMNS)
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.master.utility import (
+    jsonify, get_integer_argument, get_datetime_argument)
+
+logger = getLogger("api.statistics")
+
+DEFAULT_POINTS = config.get("statistics_chart_points")
+MAX_POINTS = config.get("statistics_api_max_points")
+
+
+class StatisticsAPI(MethodView):
+    """
+    Base class for the statistics endpoints.  Subclasses name the models
+    and columns of one kind of statistic.
+    """
+    sample_model = NotImplemented
+    rollup_model = NotImplemented
+    time_name = NotImplemented
+    columns = NotImplemented
+
+    # Counts are averaged over each point, events are summed up
+    averaged = True
+    has_queues = True
+
+    def statistics(self):
+        time_end = get_datetime_argument("end", default=datetime.utcnow())
+        time_start = get_datetime_argument(
+            "start", default=time_end - timedelta(days=7))
+        max_points = get_integer_argument("max_points", default=DEFAULT_POINTS)
+        no_queue = request.args.get("no_queue", "").lower() == "true"
+        try:
+            queues = [int(queue) for queue in request.args.getlist("queue")]
+        except ValueError:
+            return jsonify(error="`queue` must be a queue id"), BAD_REQUEST
+
+        if time_start >= time_end:
+            return jsonify(error="`start` must be before `end`"), BAD_REQUEST
+
+        if not 0 < max_points <= MAX_POINTS:
+            return (jsonify(error="`max_points` must be between 1 and %s" %
+                                  MAX_POINTS), BAD_REQUEST)
+
+        if not self.has_queues and (queues or no_queue):
+            return (jsonify(error="Filtering by queue is not supported here"),
+                    BAD_REQUEST)
+
+        # The width of the returned buckets, which start at `start` so the
+        # range never spans more than `max_points` of them.  The coarsest
+        # rollup which is not wider than that is read instead of the
+        # samples, if any.
+        offset = timegm(time_start.utctimetuple())
+        span = timegm(time_end.utctimetuple()) - offset + (
+            1 if time_end.microsecond else 0)
+        width = max(1, int(ceil(float(span) / max_points)))
+        resolution = choose_resolution(time_start, time_end, max_points)
+        if resolution is None:
+            model = self.sample_model
+            filters = []
+        else:
+            model = self.rollup_model
+            filters = [model.resolution == resolution]
+        time_column = getattr(model, self.time_name)
+        filters += [time_column >= time_start, time_column < time_end]
+        queue_filters = []
+        if queues:
+            queue_filters.append(model.job_queue_id.in_(queues))
+        if no_queue:
+            queue_filters.append(model.job_queue_id == None)
+        if queue_filters:
+            filters.append(or_(*queue_filters))
+
+        # Add up the selected queues for every point in time first, then
+        # aggregate those totals into the buckets
+        samples = select(
+            [time_column.label("time")] +
+            [func.sum(getattr(model, name)).label(name)
+             for name in self.columns]).where(and_(*filters)).\
+            group_by(time_column).alias("samples")
+        bucket = time_bucket(samples.c.time, width, offset).label("bucket")
+        aggregates = []
+        for name in self.columns:
+            if self.averaged:
+                aggregates += [func.avg(samples.c[name]).label(name + "_avg"),
+                               func.min(samples.c[name]).label(name + "_min"),
+                               func.max(samples.c[name]).label(name + "_max")]
+            else:
+                aggregates.append(func.sum(samples.c[name]).label(name))
+        query = select(
+            [bucket, func.count().label("num_samples")] + aggregates).\
+            group_by(bucket).order_by(bucket)
+
+        points = []
+        for row in db.session.execute(query, mapper=model.__mapper__):
+            point = {
+                "time": datetime.utcfromtimestamp(row[0] * width + offset),
+                "num_samples": row[1]}
+            values = iter(row[2:])
+            for name in self.columns:
+                if self.averaged:
+                    point[name] = dict(
+                        (key, float(next(values)))
+                        for key in ("avg", "min", "max"))
+                else:
+                    point[name] = int(next(values))
+            points.append(point)
+
+        return jsonify(start=time_start, end=time_end, resolution=width,
+                       source_resolution=resolution, points=points), OK
+
+
+class AgentCountsAPI(StatisticsAPI):
+    sample_model = AgentCount
+    rollup_model = AgentCountRollup
+    time_name = "counted_time"
+    columns = AGENT_COUNT_COLUMNS
+    has_queues = False
+
+    def get(self):
+        """
+        A ``GET`` to this endpoint will return the number of agents in each
+        state over time, downsampled to at most ``max_points`` points.
+
+        .. http:get:: /api/v1/statistics/agent_counts HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/statistics/agent_counts?max_points=2 HTTP/1.1
+                Accept: application/json
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                {
+                    "start": "2015-04-22T12:00:00",
+                    "end": "2015-04-29T12:00:00",
+                    "resolution": 302400,
+                    "source_resolution": 86400,
+                    "points": [
+                        {
+                            "time": "2015-04-22T12:00:00",
+                            "num_samples": 3,
+                            "num_online": {"avg": 4.0, "min": 2.0, "max": 6.0},
+                            "num_running": {"avg": 2.0, "min": 1.0, "max": 3.0},
+                            "num_offline": {"avg": 0.0, "min": 0.0, "max": 0.0},
+                            "num_disabled": {"avg": 1.0, "min": 1.0, "max": 1.0}
+                        },
+                        ...
+                    ]
+                }
+
+        ``resolution`` is the width of each point in seconds.  When the
+        range is long enough to be read from a rollup its resolution is in
+        ``source_resolution`` and ``min`` and ``max`` are those of the
+        rollup's averages, otherwise ``source_resolution`` is null.
+
+        :qparam start:
+            The beginning of the time range, defaults to seven days before
+            ``end``
+
+        :qparam end:
+            The end of the time range, defaults to now
+
+        :qparam max_points:
+            The maximum number of points to return, defaults to the
+            ``statistics_chart_points`` setting
+
+        :statuscode 200: no error
+        :statuscode 400: one of the url arguments was invalid
+        """
+        return self.statistics()
+
+
+class TaskCountsAPI(StatisticsAPI):
+    sample_model = TaskCount
+    rollup_model = TaskCountRollup
+    time_name = "counted_time"
+    columns = TASK_COUNT_COLUMNS
+
+    def get(self):
+        """
+        A ``GET`` to this endpoint will return the number of tasks in each
+        state over time, downsampled to at most ``max_points`` points.  The
+        response is structured like the one of
+        ``/api/v1/statistics/agent_counts`` with the columns
+        ``total_queued``, ``total_running``, ``total_done`` and
+        ``total_failed``.
+
+        .. http:get:: /api/v1/statistics/task_counts HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/statistics/task_counts?queue=1 HTTP/1.1
+                Accept: application/json
+
+        :qparam start:
+            The beginning of the time range, defaults to seven days before
+            ``end``
+
+        :qparam end:
+            The end of the time range, defaults to now
+
+        :qparam max_points:
+            The maximum number of points to return, defaults to the
+            ``statistics_chart_points`` setting
+
+        :qparam queue:
+            Only count the tasks in the job queue with this id, may be given
+            more than once.  Tasks of all queues are counted by default.
+
+        :qparam no_queue:
+            If true, count the tasks of jobs outside of any queue, in
+            addition to those from ``queue``
+
+        :statuscode 200: no error
+        :statuscode 400: one of the url arguments was invalid
+        """
+        return self.statistics()
+
+
+class TaskEventsAPI(StatisticsAPI):
+    sample_model = TaskEventCount
+    rollup_model = TaskEventCountRollup
+    time_name = "time_start"
+    columns = EVENT_COLUMNS
+    averaged = False
+
+    def get(self):
+        """
+        A ``GET`` to this endpoint will return how many tasks were created,
+        deleted, restarted, started, failed and finished over time,
+        downsampled to at most ``max_points`` points.
+
+        .. http:get:: /api/v1/statistics/task_events HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/statistics/task_events?max_points=2 HTTP/1.1
+                Accept: application/json
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                {
+                    "start": "2015-04-22T12:00:00",
+                    "end": "2015-04-29T12:00:00",
+                    "resolution": 302400,
+                    "source_resolution": 86400,
+                    "points": [
+                        {
+                            "time": "2015-04-22T12:00:00",
+                            "num_samples": 3,
+                            "num_new": 120,
+                            "num_deleted": 0,
+                            "num_restarted": 4,
+                            "num_started": 118,
+                            "num_failed": 2,
+                            "num_done": 110
+                        },
+                        ...
+                    ]
+                }
+
+        :qparam start:
+            The beginning of the time range, defaults to seven days before
+            ``end``
+
+        :qparam end:
+            The end of the time range, defaults to now
+
+        :qparam max_points:
+            The maximum number of points to return, defaults to the
+            ``statistics_chart_points`` setting
+
+        :qparam queue:
+            Only count the events in the job queue with this id, may be
+            given more than once.  Events of all queues are counted by
+            default.
+
+        :qparam no_queue:
+            If true, count the events of jobs outside of any queue, in
+            addition to those from ``queue``
+
+        :statuscode 200: no error
+        :statuscode 400: one of the url arguments was invalid
+        """
+        return self.statistics()
@@ -25,19 +25,18 @@ This module defines an API for managing and querying logs belonging to tasks
 try:
     from httplib import (
       OK, NOT_FOUND, CONFLICT, TEMPORARY_REDIRECT, CREATED, BAD_REQUEST,
-      INTERNAL_SERVER_ERROR)
+      INTERNAL_SERVER_ERROR, PARTIAL_CONTENT, REQUESTED_RANGE_NOT_SATISFIABLE,
+      SERVICE_UNAVAILABLE)
 except ImportError:  # pragma: no cover
     from http.client import (
       OK, NOT_FOUND, CONFLICT, TEMPORARY_REDIRECT, CREATED, BAD_REQUEST,
-      INTERNAL_SERVER_ERROR)
+      INTERNAL_SERVER_ERROR, PARTIAL_CONTENT, REQUESTED_RANGE_NOT_SATISFIABLE,
+      SERVICE_UNAVAILABLE)
 
-from gzip import GzipFile
-from os import makedirs
-from os.path import join, realpath
-from errno import EEXIST
+from os.path import relpath, sep
 
 from flask.views import MethodView
-from flask import g, redirect, send_file, request, Response
+from flask import g, redirect, request, Response
 
 from sqlalchemy.exc import IntegrityError
 
@@ -45,18 +44,44 @@ from pyfarm.core.logger import getLogger
 from pyfarm.master.config import config
 from pyfarm.models.tasklog import TaskLog, TaskTaskLogAssociation
 from pyfarm.models.task import Task
+from pyfarm.models.archive import ArchivedTask, ArchivedTaskLogAssociation
 from pyfarm.master.application import db
-from pyfarm.master.utility import jsonify, validate_with_model, isuuid
+from pyfarm.master.logfiles import tail_offset
+from pyfarm.master.logsearch import log_index
+from pyfarm.master.logstorage import AppendConflict, storage
+from pyfarm.master.utility import (
+    jsonify, validate_with_model, isuuid, get_integer_argument,
+    get_uuid_argument, get_datetime_argument)
+from pyfarm.scheduler.tasks import index_task_logs
 
 logger = getLogger("api.tasklogs")
 
-LOGFILES_DIR = config.get("tasklogs_dir")
+SENDFILE = config.get("tasklog_sendfile")
+ACCEL_REDIRECT_PREFIX = config.get("tasklog_accel_redirect_prefix")
+MAX_SEARCH_RESULTS = 1000
 
-try:
-    makedirs(LOGFILES_DIR)
-except OSError as e:  # pragma: no cover
-    if e.errno != EEXIST:
-        raise
+
+def task_exists(job_id, task_id):
+    """
+    Returns True if the task exists, either among the active tasks or in
+    the archive
+    """
+    if Task.query.filter_by(id=task_id, job_id=job_id).count():
+        return True
+    return ArchivedTask.query.filter_by(id=task_id, job_id=job_id).count() > 0
+
+
+def find_log_association(task_id, attempt, log):
+    """
+    Returns the association between ``log`` and the given attempt of an
+    active or archived task or ``None``
+    """
+    association = TaskTaskLogAssociation.query.filter_by(
+        task_id=task_id, log=log, attempt=attempt).first()
+    if association is None and log.archived:
+        association = ArchivedTaskLogAssociation.query.filter_by(
+            task_id=task_id, task_log_id=log.id, attempt=attempt).first()
+    return association
 
 
 class LogsInTaskAttemptsIndexAPI(MethodView):
@@ -93,17 +118,23 @@ class LogsInTaskAttemptsIndexAPI(MethodView):
         :statuscode 404: the specified task was not found
         """
         task = Task.query.filter_by(id=task_id, job_id=job_id).first()
-        if not task:
+        if task:
+            logs = [item.log for item in TaskTaskLogAssociation.query.filter(
+                TaskTaskLogAssociation.task == task,
+                TaskTaskLogAssociation.attempt == attempt)]
+        elif task_exists(job_id, task_id):
+            log_ids = [
+                log_id for log_id, in db.session.query(
+                    ArchivedTaskLogAssociation.task_log_id).filter_by(
+                        task_id=task_id, attempt=attempt)]
+            logs = TaskLog.query.filter(
+                TaskLog.id.in_(log_ids)).all() if log_ids else []
+        else:
             return jsonify(task_id=task_id, job_id=job_id,
                            error="Specified task not found"), NOT_FOUND
 
-        association_objects = TaskTaskLogAssociation.query.filter(
-            TaskTaskLogAssociation.task == task,
-            TaskTaskLogAssociation.attempt == attempt)
-
         out = []
-        for item in association_objects:
-            log = item.log
+        for log in logs:
             out.append({"identifier": log.identifier,
                         "created_on": log.created_on,
                         "agent_id": str(log.agent_id)})
@@ -162,8 +193,9 @@ class LogsInTaskAttemptsIndexAPI(MethodView):
             return jsonify(task_id=task_id, job_id=job_id,
                            error="Specified task not found"), NOT_FOUND
 
-        path = realpath(join(LOGFILES_DIR, g.json["identifier"]))
-        if not realpath(path).startswith(LOGFILES_DIR):
+        try:
+            storage.check(g.json["identifier"])
+        except ValueError:
             return jsonify(error="Identifier is not acceptable"), BAD_REQUEST
         attempts = 0
         registered = False
@@ -238,8 +270,7 @@ class SingleLogInTaskAttempt(MethodView):
         :statuscode 200: no error
         :statuscode 404: task or logfile not found
         """
-        task = Task.query.filter_by(id=task_id, job_id=job_id).first()
-        if not task:
+        if not task_exists(job_id, task_id):
             return jsonify(task_id=task_id, job_id=job_id,
                            error="Specified task not found"), NOT_FOUND
 
@@ -248,12 +279,9 @@ class SingleLogInTaskAttempt(MethodView):
             return jsonify(task_id=task_id, job_id=job_id,
                            error="Specified log not found"), NOT_FOUND
 
-        association = TaskTaskLogAssociation.query.filter_by(
-            task=task,
-            log=log,
-            attempt=attempt).first()
+        association = find_log_association(task_id, attempt, log)
         if not association:
-            return jsonify(task_id=task.id, log=log.identifier,
+            return jsonify(task_id=task_id, log=log.identifier,
                            error="Specified log not found in task"), NOT_FOUND
 
         return jsonify(log.to_dict(unpack_relationships=False))
@@ -359,15 +387,36 @@ class TaskLogfileAPI(MethodView):
 
                 <Content of the logfile>
 
+        Compressed logs are sent as they are stored, with
+        ``Content-Encoding: gzip``, to clients which accept that encoding
+        and decompressed for all others.  Depending on the
+        ``tasklog_sendfile`` setting whole logs are handed off to a front
+        end proxy through ``X-Sendfile`` or ``X-Accel-Redirect``.
+
+        Parts of a log can be requested with a ``Range`` header (a single
+        byte range, answered with ``206 Partial Content``) or with one of
+        the url arguments below.  Both work for compressed logs too.
+
+        :qparam offset:
+            Only return the log from this byte offset onwards.  Clients
+            following a log can pass the ``X-Log-Size`` of their previous
+            response here.
+
+        :qparam tail:
+            Only return the last this many lines of the log.  The offset
+            they start at is returned in the ``X-Log-Offset`` header.
+
         :statuscode 200: no error
+        :statuscode 206: the requested range of the logfile is returned
         :statuscode 307: The logfile can be found in another location at this
                          point in time. Independent future requests for the same
                          logfile should continue using the original URL
-        :statuscode 400: the specified logfile identifier is not acceptable
+        :statuscode 400: the specified logfile identifier or one of the url
+                         arguments is not acceptable
         :statuscode 404: task or logfile not found
+        :statuscode 416: the requested range is outside of the logfile
         """
-        task = Task.query.filter_by(id=task_id, job_id=job_id).first()
-        if not task:
+        if not task_exists(job_id, task_id):
             return jsonify(task_id=task_id, log=log_identifier,
                            error="Specified task not found"), NOT_FOUND
 
@@ -376,40 +425,90 @@ class TaskLogfileAPI(MethodView):
             return jsonify(task_id=task_id, log=log_identifier,
                            error="Specified log not found"), NOT_FOUND
 
-        association = TaskTaskLogAssociation.query.filter_by(
-            task=task,
-            log=log,
-            attempt=attempt).first()
+        association = find_log_association(task_id, attempt, log)
         if not association:
-            return jsonify(task_id=task.id, log=log.identifier,
+            return jsonify(task_id=task_id, log=log.identifier,
                            error="Specified log not found in task"), NOT_FOUND
 
-        path = realpath(join(LOGFILES_DIR, log_identifier))
-        if not realpath(path).startswith(LOGFILES_DIR):
+        try:
+            logfile = storage.open(log_identifier)
+        except ValueError:
             return jsonify(error="Identifier is not acceptable"), BAD_REQUEST
+        except (IOError, OSError):
+            agent = log.agent
+            if not agent:
+                return (jsonify(
+                    log=log_identifier,
+                    error="Logfile is not available on master and agent "
+                          "is not known"), NOT_FOUND)
+            return redirect(agent.api_url() + "/task_logs/" +
+                            log_identifier, TEMPORARY_REDIRECT)
+
+        offset = get_integer_argument("offset")
+        tail = get_integer_argument("tail")
+        if offset is not None and tail is not None:
+            return (jsonify(error="`offset` and `tail` cannot be combined"),
+                    BAD_REQUEST)
+        if (offset or 0) < 0 or (tail or 0) < 0:
+            return (jsonify(error="`offset` and `tail` must not be negative"),
+                    BAD_REQUEST)
 
-        try:
-            logfile = open(path, "rb")
-            return send_file(logfile)
-        except IOError:
-            try:
-                compressed_logfile = GzipFile("%s.gz" % path, "rb")
-                def logfile_generator():
-                    eof = False
-                    while not eof:
-                        out = compressed_logfile.read(4096) # 4096 == mempage
-                        eof = len(out) == 0
-                        yield out
-                return Response(logfile_generator(), mimetype="text/csv")
-            except IOError:
-                agent = log.agent
-                if not agent:
-                    return (jsonify(
-                        path=path, log=log_identifier,
-                        error="Logfile is not available on master and agent "
-                              "is not known"), NOT_FOUND)
-                return redirect(agent.api_url() + "/task_logs/" +
-                                log_identifier, TEMPORARY_REDIRECT)
+        headers = {"Accept-Ranges": "bytes" if logfile.seekable else "none"}
+        if logfile.size is not None:
+            headers["X-Log-Size"] = str(logfile.size)
+
+        if tail is not None:
+            offset = tail_offset(logfile, tail)
+
+        if offset is not None:
+            headers["X-Log-Offset"] = str(offset)
+            return Response(
+                logfile.read(offset), mimetype="text/csv", headers=headers)
+
+        # We don't send validators, so a conditional range can never match
+        if (logfile.seekable and request.range is not None and
+                request.range.units == "bytes" and
+                len(request.range.ranges) == 1 and
+                "If-Range" not in request.headers):
+            byte_range = request.range.range_for_length(logfile.size)
+            if byte_range is None:
+                headers["Content-Range"] = "bytes */%s" % logfile.size
+                return Response(
+                    status=REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+
+            start, stop = byte_range
+            headers["Content-Range"] = "bytes %s-%s/%s" % (
+                start, stop - 1, logfile.size)
+            headers["Content-Length"] = str(stop - start)
+            return Response(
+                logfile.read(start, stop), status=PARTIAL_CONTENT,
+                mimetype="text/csv", headers=headers)
+
+        if logfile.encoding is not None:
+            headers["Vary"] = "Accept-Encoding"
+
+            # Decompress only for clients which can't do it themselves
+            if not request.accept_encodings[logfile.encoding]:
+                if logfile.size is not None:
+                    headers["Content-Length"] = str(logfile.size)
+                return Response(
+                    logfile.read(), mimetype="text/csv", headers=headers)
+
+            headers["Content-Encoding"] = logfile.encoding
+
+        # Only logs stored in local files can be handed off
+        if logfile.path is not None and SENDFILE == "x-sendfile":
+            headers["X-Sendfile"] = logfile.path
+            return Response(mimetype="text/csv", headers=headers)
+        elif logfile.path is not None and SENDFILE == "x-accel-redirect":
+            headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX + relpath(
+                logfile.path, storage.root).replace(sep, "/")
+            return Response(mimetype="text/csv", headers=headers)
+
+        # Send the stored bytes as they are
+        headers["Content-Length"] = str(logfile.stored_size)
+        return Response(
+            logfile.read_stored(), mimetype="text/csv", headers=headers)
 
     def put(self, job_id, task_id, attempt, log_identifier):
         """
@@ -454,21 +553,224 @@ class TaskLogfileAPI(MethodView):
             return jsonify(task_id=task_id, log=log.identifier,
                            error="Specified log not found in task"), NOT_FOUND
 
-        path = realpath(join(LOGFILES_DIR, log_identifier))
-        if not realpath(path).startswith(LOGFILES_DIR):
+        try:
+            storage.check(log_identifier)
+        except ValueError:
             return jsonify(error="Identifier is not acceptable"), BAD_REQUEST
 
-        logger.info("Writing task log file for task %s, attempt %s to path %s",
-                    task_id, attempt, path)
+        logger.info("Writing task log file %s for task %s, attempt %s",
+                    log_identifier, task_id, attempt)
 
         try:
-            with open(path, "wb+") as log_file:
-                log_file.write(request.data)
+            storage.write(log_identifier, request.data)
         except (IOError, OSError) as e:
             logger.error("Could not write task log file: %s (%s)", e.errno,
                          e.strerror)
-            return (jsonify(error="Could not write file %s to disk: %s"
-                                  % (path, e)),
+            return (jsonify(error="Could not write file %s: %s"
+                                  % (log_identifier, e)),
                     INTERNAL_SERVER_ERROR)
 
+        log.size = len(request.data)
+        log.tail_only = False
+        db.session.add(log)
+        db.session.commit()
+
+        if log_index.enabled:
+            index_task_logs.delay([log_identifier])
+
         return "", CREATED
+
+    def post(self, job_id, task_id, attempt, log_identifier):
+        """
+        A ``POST`` to this endpoint will append the request's body to the
+        specified logfile.  This lets agents upload logs while a task is
+        still running, one chunk at a time.
+
+        .. http:post:: /api/v1/jobs/<job_id>/tasks/<task_id>/attempts/<attempt>/logs/<log_identifier>/logfile?offset=<offset> HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                POST /api/v1/jobs/4/tasks/1300/attempts/5/logs/2014-09-03_10-58-59_4_4ee02475335911e4a935c86000cbf5fb.csv/logfile?offset=1024 HTTP/1.1
+
+                <next chunk of the logfile>
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                {
+                    "size": 1536
+                }
+
+        :qparam offset:
+            Required, the offset in the logfile the chunk starts at.  This
+            has to be the current size of the logfile, which is returned
+            by every append.
+
+        :statuscode 200: the chunk was appended
+        :statuscode 400: the specified logfile identifier or offset is not
+                         acceptable
+        :statuscode 404: task or logfile not found
+        :statuscode 409: the offset does not match the current size of the
+                         logfile (which is included in the response as
+                         ``size``) or the logfile has already been
+                         compressed
+        """
+        task = Task.query.filter_by(id=task_id, job_id=job_id).first()
+        if not task:
+            return jsonify(task_id=task_id, log=log_identifier,
+                           error="Specified task not found"), NOT_FOUND
+
+        log = TaskLog.query.filter_by(identifier=log_identifier).first()
+        if not log:
+            return jsonify(task_id=task_id, log=log_identifier,
+                           error="Specified log not found"), NOT_FOUND
+
+        association = TaskTaskLogAssociation.query.filter_by(
+            task=task,
+            log=log,
+            attempt=attempt).first()
+        if not association:
+            return jsonify(task_id=task_id, log=log.identifier,
+                           error="Specified log not found in task"), NOT_FOUND
+
+        try:
+            storage.check(log_identifier)
+        except ValueError:
+            return jsonify(error="Identifier is not acceptable"), BAD_REQUEST
+
+        offset = get_integer_argument("offset", required=True)
+        if offset < 0:
+            return jsonify(error="`offset` must not be negative"), BAD_REQUEST
+
+        try:
+            size = storage.append(log_identifier, offset, request.get_data())
+        except AppendConflict as e:
+            if e.size is None:
+                return jsonify(error=str(e)), CONFLICT
+            return jsonify(error=str(e), size=e.size), CONFLICT
+        except (IOError, OSError) as e:
+            logger.error("Could not append to task log file: %s (%s)",
+                         e.errno, e.strerror)
+            return (jsonify(error="Could not append to file %s: %s"
+                                  % (log_identifier, e)),
+                    INTERNAL_SERVER_ERROR)
+
+        log.size = size
+        db.session.add(log)
+        db.session.commit()
+
+        return jsonify(size=size), OK
+
+
+class TaskLogSearchAPI(MethodView):
+    def get(self):
+        """
+        A ``GET`` to this endpoint will return the newest task logs which
+        contain a phrase, along with the tasks they belong to
+
+        .. http:get:: /api/v1/tasklogs/search HTTP/1.1
+
+            **Request**
+
+            .. sourcecode:: http
+
+                GET /api/v1/tasklogs/search?q=out%20of%20memory&jobgroup=3 HTTP/1.1
+                Accept: application/json
+
+            **Response**
+
+            .. sourcecode:: http
+
+                HTTP/1.1 200 OK
+                Content-Type: application/json
+
+                [
+                    {
+                        "identifier": "2014-09-03_10-58-59_4_4ee02475335911e4a935c86000cbf5fb.csv",
+                        "id": 148,
+                        "agent_id": "2dc2cb5a-35da-41d6-8864-329c0d7d5391",
+                        "created_on": "2014-09-03T10:59:05.103005",
+                        "offset": 1310720,
+                        "tasks": [
+                            {
+                                "job_id": 4,
+                                "task_id": 1300,
+                                "attempt": 5
+                            }
+                        ]
+                    }
+                ]
+
+        Only logs which have been uploaded in one piece or compressed are
+        indexed.  ``offset`` is where the first chunk of the log which
+        contains the phrase starts, it can be passed on to the logfile
+        endpoint.
+
+        :qparam q:
+            Required, the phrase to search for
+
+        :qparam job:
+            Only return logs of this job
+
+        :qparam jobgroup:
+            Only return logs of jobs in this job group
+
+        :qparam agent:
+            Only return logs created on this agent
+
+        :qparam since:
+            Only return logs created at or after this time
+
+        :qparam until:
+            Only return logs created before this time
+
+        :qparam limit:
+            The maximum number of logs to return, 100 by default
+
+        :statuscode 200: no error
+        :statuscode 400: one of the url arguments was invalid
+        :statuscode 503: searching task logs is not enabled
+        """
+        if not log_index.enabled:
+            return (jsonify(error="Searching task logs is not enabled"),
+                    SERVICE_UNAVAILABLE)
+
+        text = request.args.get("q", "").strip()
+        if not text:
+            return jsonify(error="`q` must not be empty"), BAD_REQUEST
+
+        limit = get_integer_argument("limit", default=100)
+        if not 0 < limit <= MAX_SEARCH_RESULTS:
+            return (jsonify(error="`limit` must be between 1 and %s" %
+                                  MAX_SEARCH_RESULTS), BAD_REQUEST)
+
+        results = log_index.search(
+            text, job_id=get_integer_argument("job"),
+            jobgroup_id=get_integer_argument("jobgroup"),
+            agent_id=get_uuid_argument("agent"),
+            since=get_datetime_argument("since"),
+            until=get_datetime_argument("until"), limit=limit)
+
+        tasks = {}
+        if results:
+            for log_id, task_id, attempt, job_id in db.session.query(
+                    TaskTaskLogAssociation.task_log_id,
+                    TaskTaskLogAssociation.task_id,
+                    TaskTaskLogAssociation.attempt, Task.job_id).\
+                    join(Task, TaskTaskLogAssociation.task_id == Task.id).\
+                    filter(TaskTaskLogAssociation.task_log_id.in_(
+                        [result["id"] for result in results])):
+                tasks.setdefault(log_id, []).append(
+                    {"job_id": job_id, "task_id": task_id,
+                     "attempt": attempt})
+
+        for result in results:
+            result["tasks"] = tasks.get(result["id"], [])
+
+        return jsonify(results), OK
@@ -24,6 +24,8 @@ necessary to run the master.
 
 import os
 from datetime import timedelta
+from threading import Lock
+from time import time
 from multiprocessing.util import register_after_fork
 from uuid import UUID
 
@@ -34,9 +36,12 @@ except ImportError:
 
 from flask import Flask, Blueprint, request, g, abort
 from flask.ext.login import LoginManager
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
 from itsdangerous import URLSafeTimedSerializer
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.expression import SelectBase
 from sqlalchemy import event
 from werkzeug.exceptions import BadRequest
 from werkzeug.routing import BaseConverter, ValidationError
@@ -46,6 +51,7 @@ from pyfarm.core.logger import getLogger
 from pyfarm.master.config import config
 
 POST_METHODS = set(("POST", "PUT"))
+READ_METHODS = set(("GET", "HEAD"))
 IGNORED_MIMETYPES = set((
     "application/x-www-form-urlencoded", "multipart/form-data",
     "application/zip", "text/csv"))
@@ -125,9 +131,16 @@ def get_application(**configuration_keywords):
         "TIMESTAMP_FORMAT": config.get("timestamp_format")
     }
 
+    app_config["SQLALCHEMY_BINDS"] = {}
     if config.get("enable_statistics"):
-        app_config["SQLALCHEMY_BINDS"] = {
-            "statistics": config.get("statistics_database")}
+        app_config["SQLALCHEMY_BINDS"]["statistics"] = \
+            config.get("statistics_database")
+    if config.get("archive_database"):
+        app_config["SQLALCHEMY_BINDS"]["archive"] = \
+            config.get("archive_database")
+    if config.get("read_replica_database"):
+        app_config["SQLALCHEMY_BINDS"]["replica"] = \
+            config.get("read_replica_database")
 
     static_folder = configuration_keywords.pop("static_folder", None)
     if static_folder is None:  # static folder not provided
@@ -152,12 +165,97 @@ def get_application(**configuration_keywords):
     return app
 
 
+class ReplicaLag(object):
+    """
+    Measures how far the read replica lags behind the primary database, at
+    most once every ``read_replica_lag_check_interval`` seconds
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.checked = None
+        self.lag = None
+
+    def measure(self, engine):
+        """
+        Returns the replication lag of ``engine`` in seconds or ``None`` if
+        the replica can't be reached.  Only PostgreSQL reports its lag,
+        other databases are assumed to be up to date.
+        """
+        if engine.dialect.name != "postgresql":
+            return 0
+        try:
+            with engine.connect() as connection:
+                if connection.dialect.server_version_info < (10, ):
+                    received = "pg_last_xlog_receive_location()"
+                    replayed = "pg_last_xlog_replay_location()"
+                else:
+                    received = "pg_last_wal_receive_lsn()"
+                    replayed = "pg_last_wal_replay_lsn()"
+
+                # A replica which replayed everything it received is up to
+                # date, even if the primary has not written anything for a
+                # while and the last replayed transaction is old.  NULL when
+                # the database is not replaying from a primary.
+                lag = connection.execute(
+                    "SELECT CASE WHEN %s = %s THEN 0 "
+                    "ELSE EXTRACT(EPOCH FROM now() - "
+                    "pg_last_xact_replay_timestamp()) END" %
+                    (received, replayed)).scalar()
+        except DBAPIError as e:
+            logger.warning("Cannot reach the read replica: %s", e)
+            return None
+        return max(float(lag or 0), 0)
+
+    def get(self, engine):
+        with self.lock:
+            now = time()
+            if (self.checked is None or now - self.checked >=
+                    config.get("read_replica_lag_check_interval")):
+                self.lag = self.measure(engine)
+                self.checked = now
+            return self.lag
+
+replica_lag = ReplicaLag()
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session which sends reads of the primary database to the read replica
+    (the ``replica`` bind) while ``info["max_replica_lag"]`` is set, see
+    :func:`route_reads`.  Once the session writes anything all further
+    reads go to the primary again so they see what was written.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        bind = super(RoutingSession, self).get_bind(mapper, clause)
+        max_lag = self.info.get("max_replica_lag")
+        if max_lag is None:
+            return bind
+
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["max_replica_lag"] = None
+            return bind
+
+        state = self.app.extensions["sqlalchemy"]
+        if (isinstance(clause, SelectBase) and
+                bind is state.db.get_engine(self.app)):
+            replica = state.db.get_engine(self.app, bind="replica")
+            lag = replica_lag.get(replica)
+            if lag is not None and lag <= max_lag:
+                return replica
+        return bind
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+
 def get_sqlalchemy(app=None, use_native_unicode=True, session_options=None):
     """
     Constructs and returns an instance of :class:`.SQLAlchemy`.  Any keyword
     arguments provided will be passed to the constructor of :class:`.SQLAlchemy`
     """
-    db = SQLAlchemy(
+    db = RoutingSQLAlchemy(
         app=app, use_native_unicode=use_native_unicode,
         session_options=session_options)
 
@@ -253,6 +351,31 @@ def before_request():
         g.error = "Unsupported media type %r" % request.mimetype
         abort(UNSUPPORTED_MEDIA_TYPE)
 
+
+def route_reads():
+    """
+    Global before_request handler which lets ``GET`` requests read from the
+    read replica, if one is configured.  The replication lag tolerated is
+    ``read_replica_max_lag`` or the endpoint's entry in
+    ``read_replica_endpoints``, where ``null`` keeps an endpoint on the
+    primary database.
+    """
+    binds = db.get_app().config.get("SQLALCHEMY_BINDS") or {}
+    if "replica" not in binds or request.method not in READ_METHODS:
+        return
+
+    max_lag = (config.get("read_replica_endpoints") or {}).get(
+        request.endpoint, config.get("read_replica_max_lag"))
+    db.session.info["max_replica_lag"] = max_lag
+
+
+def teardown_route_reads(exception=None):
+    """
+    Global teardown_request handler which sends everything after the
+    request to the primary database again
+    """
+    db.session.info.pop("max_replica_lag", None)
+
 # main object setup (app, api, etc)
 app = get_application()
 api = get_api_blueprint()
@@ -263,6 +386,8 @@ login_serializer = get_login_serializer(app.secret_key)
 # attach the remaining functions to the application object
 app.register_blueprint(api)
 app.before_request_funcs.setdefault(None, []).append(before_request)
+app.before_request_funcs[None].append(route_reads)
+app.teardown_request_funcs.setdefault(None, []).append(teardown_route_reads)
 
 
 class SessionMixin(object):
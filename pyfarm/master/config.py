@@ -61,6 +61,10 @@ class Configuration(_Configuration):
         "pretty_json": ("PYFARM_JSON_PRETTY", read_env_bool),
         "echo_sql": ("PYFARM_SQL_ECHO", read_env_bool),
         "database": ("PYFARM_DATABASE_URI", read_env_no_log),
+        "read_replica_database": (
+            "PYFARM_READ_REPLICA_DATABASE_URI", read_env_no_log),
+        "archive_database": (
+            "PYFARM_ARCHIVE_DATABASE_URI", read_env_no_log),
         "timestamp_format": ("PYFARM_TIMESTAMP_FORMAT", read_env),
         "allow_agents_from_loopback": (
             "PYFARM_DEV_ALLOW_AGENT_LOOPBACK_ADDRESSES", read_env_bool),
@@ -68,12 +72,18 @@ class Configuration(_Configuration):
         "agent_updates_webdir": ("PYFARM_AGENT_UPDATES_WEBDIR", read_env),
         "farm_name": ("PYFARM_FARM_NAME", read_env),
         "tasklogs_dir": ("PYFARM_LOGFILES_DIR", read_env),
+        "tasklog_storage": ("PYFARM_TASKLOG_STORAGE", read_env),
+        "tasklog_storage_url": ("PYFARM_TASKLOG_STORAGE_URL", read_env),
+        "tasklog_search_index": ("PYFARM_TASKLOG_SEARCH_INDEX", read_env),
         "dev_db_drop_all": (
             "PYFARM_DEV_APP_DB_DROP_ALL", env_bool_false),
         "dev_db_create_all": (
             "PYFARM_DEV_APP_DB_CREATE_ALL", env_bool_false),
         "instance_application": ("PYFARM_APP_INSTANCE", env_bool_false),
         "scheduler_broker": ("PYFARM_SCHEDULER_BROKER", read_env),
+        "event_broker_url": ("PYFARM_EVENT_BROKER_URL", read_env),
+        "write_behind_store_url": (
+            "PYFARM_WRITE_BEHIND_STORE_URL", read_env),
         "scheduler_lockfile_base": (
             "PYFARM_SCHEDULER_LOCKFILE_BASE", read_env),
         "transaction_retries": ("PYFARM_TRANSACTION_RETRIES", read_env_int),
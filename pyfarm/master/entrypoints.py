@@ -63,6 +63,12 @@ from pyfarm.models.jobgroup import JobGroup
 from pyfarm.models.statistics.agent_count import AgentCount
 from pyfarm.models.statistics.task_event_count import TaskEventCount
 from pyfarm.models.statistics.task_count import TaskCount
+from pyfarm.models.statistics.collector_runtime import CollectorRuntime
+from pyfarm.models.statistics.rollups import (
+    AgentCountRollup, TaskCountRollup, TaskEventCountRollup)
+from pyfarm.models.change import Change
+from pyfarm.models.archive import (
+    ArchivedJob, ArchivedTask, ArchivedTaskLogAssociation)
 from pyfarm.master.utility import timedelta_format
 
 logger = getLogger("master.entrypoints")
@@ -163,7 +169,8 @@ def load_user_interface(app_instance):
         add_software_version, add_software, remove_software,
         update_version_default_status)
     from pyfarm.master.user_interface.software_version import software_version
-    from pyfarm.master.user_interface.jobgroups import jobgroups
+    from pyfarm.master.user_interface.jobgroups import (
+        jobgroups, rerun_jobgroup, rerun_failed_in_jobgroup)
     from pyfarm.master.user_interface.statistics.index import statistics_index
     from pyfarm.master.user_interface.statistics.agent_counts import (
         agent_counts)
@@ -386,6 +393,12 @@ def load_user_interface(app_instance):
 
     app_instance.add_url_rule("/jobgroups/",
                               "jobgroups_index_ui", jobgroups, methods=("GET", ))
+    app_instance.add_url_rule("/jobgroups/<int:group_id>/rerun",
+                              "rerun_jobgroup_ui", rerun_jobgroup,
+                              methods=("POST", ))
+    app_instance.add_url_rule("/jobgroups/<int:group_id>/rerun_failed_tasks",
+                              "rerun_failed_in_jobgroup_ui",
+                              rerun_failed_in_jobgroup, methods=("POST", ))
 
     app_instance.add_url_rule("/statistics/",
                               "statistics_index_ui", statistics_index,
@@ -416,17 +429,24 @@ def load_api(app_instance, api_instance):
     from pyfarm.master.api.jobs import (
         schema as job_schema, JobIndexAPI, SingleJobAPI, JobTasksIndexAPI,
         JobSingleTaskAPI, JobNotifiedUsersIndexAPI, JobSingleNotifiedUserAPI,
-        TaskFailedOnAgentsIndexAPI, SingleTaskOnAgentFailureAPI)
+        TaskFailedOnAgentsIndexAPI, SingleTaskOnAgentFailureAPI, JobRerunAPI,
+        JobRerunFailedAPI)
     from pyfarm.master.api.jobqueues import (
         schema as jobqueues_schema, JobQueueIndexAPI, SingleJobQueueAPI)
     from pyfarm.master.api.agent_updates import AgentUpdatesAPI
     from pyfarm.master.api.pathmaps import (
         schema as pathmap_schema, PathMapIndexAPI, SinglePathMapAPI)
     from pyfarm.master.api.tasklogs import (
-        LogsInTaskAttemptsIndexAPI, SingleLogInTaskAttempt, TaskLogfileAPI)
+        LogsInTaskAttemptsIndexAPI, SingleLogInTaskAttempt, TaskLogfileAPI,
+        TaskLogSearchAPI)
     from pyfarm.master.api.jobgroups import (
         schema as jobgroups_schema, JobGroupIndexAPI, SingleJobGroupAPI,
-        JobsInJobGroupIndexAPI)
+        JobsInJobGroupIndexAPI, JobGroupRerunAPI, JobGroupRerunFailedAPI)
+    from pyfarm.master.api.changes import ChangesIndexAPI
+    from pyfarm.master.api.events import (
+        FarmEventsAPI, JobEventsAPI, JobGroupEventsAPI)
+    from pyfarm.master.api.statistics import (
+        AgentCountsAPI, TaskCountsAPI, TaskEventsAPI)
 
     # top level types
     api_instance.add_url_rule(
@@ -447,12 +467,27 @@ def load_api(app_instance, api_instance):
     api_instance.add_url_rule(
         "/jobqueues/",
         view_func=JobQueueIndexAPI.as_view("jobqueue_index_api"))
+    api_instance.add_url_rule(
+        "/changes",
+        view_func=ChangesIndexAPI.as_view("changes_index_api"))
+    api_instance.add_url_rule(
+        "/events",
+        view_func=FarmEventsAPI.as_view("farm_events_api"))
     api_instance.add_url_rule(
         "/pathmaps/",
         view_func=PathMapIndexAPI.as_view("pathmap_index_api"))
     api_instance.add_url_rule(
         "/jobgroups/",
         view_func=JobGroupIndexAPI.as_view("jobgroup_index_api"))
+    api_instance.add_url_rule(
+        "/statistics/agent_counts",
+        view_func=AgentCountsAPI.as_view("statistics_agent_counts_api"))
+    api_instance.add_url_rule(
+        "/statistics/task_counts",
+        view_func=TaskCountsAPI.as_view("statistics_task_counts_api"))
+    api_instance.add_url_rule(
+        "/statistics/task_events",
+        view_func=TaskEventsAPI.as_view("statistics_task_events_api"))
 
     # schemas
     api_instance.add_url_rule(
@@ -510,6 +545,18 @@ def load_api(app_instance, api_instance):
     api_instance.add_url_rule(
         "/jobs/<string:job_name>",
         view_func=SingleJobAPI.as_view("single_job_by_string_api"))
+    api_instance.add_url_rule(
+        "/jobs/<int:job_name>/rerun",
+        view_func=JobRerunAPI.as_view("rerun_job_by_id_api"))
+    api_instance.add_url_rule(
+        "/jobs/<string:job_name>/rerun",
+        view_func=JobRerunAPI.as_view("rerun_job_by_string_api"))
+    api_instance.add_url_rule(
+        "/jobs/<int:job_name>/rerun_failed",
+        view_func=JobRerunFailedAPI.as_view("rerun_failed_job_by_id_api"))
+    api_instance.add_url_rule(
+        "/jobs/<string:job_name>/rerun_failed",
+        view_func=JobRerunFailedAPI.as_view("rerun_failed_job_by_string_api"))
 
     api_instance.add_url_rule(
         "/jobqueues/<int:queue_rq>",
@@ -684,11 +731,31 @@ def load_api(app_instance, api_instance):
         "/jobs/<int:job_id>/tasks/<int:task_id>/attempts/<int:attempt>/logs/"
         "<string:log_identifier>/logfile",
         view_func=TaskLogfileAPI.as_view("task_log_file_api"))
+    api_instance.add_url_rule(
+        "/tasklogs/search",
+        view_func=TaskLogSearchAPI.as_view("task_log_search_api"))
 
     # Jobs in job groups
     api_instance.add_url_rule(
         "/jobgroups/<int:group_id>/jobs",
         view_func=JobsInJobGroupIndexAPI.as_view("jobs_in_group_index_api"))
+    api_instance.add_url_rule(
+        "/jobgroups/<int:group_id>/events",
+        view_func=JobGroupEventsAPI.as_view("jobgroup_events_api"))
+    api_instance.add_url_rule(
+        "/jobgroups/<int:group_id>/rerun",
+        view_func=JobGroupRerunAPI.as_view("rerun_jobgroup_api"))
+    api_instance.add_url_rule(
+        "/jobgroups/<int:group_id>/rerun_failed",
+        view_func=JobGroupRerunFailedAPI.as_view("rerun_failed_jobgroup_api"))
+
+    # Job events
+    api_instance.add_url_rule(
+        "/jobs/<int:job_name>/events",
+        view_func=JobEventsAPI.as_view("job_events_by_id_api"))
+    api_instance.add_url_rule(
+        "/jobs/<string:job_name>/events",
+        view_func=JobEventsAPI.as_view("job_events_by_string_api"))
 
     # Software in Agents
     api_instance.add_url_rule(
@@ -755,6 +822,39 @@ def tables():  # pragma: no cover
             logger.info("Tables created or updated")
 
 
+def migrate_task_logs():  # pragma: no cover
+    """
+    Moves existing task logs into the storage configured with
+    ``tasklog_storage``, for instance from the default flat directory to
+    the sharded layout.
+    """
+    from pyfarm.master.logstorage import create_storage, migrate, storage
+
+    parser = ArgumentParser(
+        description="Moves task logs into the configured log storage")
+    parser.add_argument(
+        "--source", choices=("flat", "sharded", "object"), default="flat",
+        help="The storage the logs are currently kept in.  Default: flat")
+    parser.add_argument(
+        "--source-dir", default=config.get("tasklogs_dir"),
+        help="The directory of a flat or sharded source.  Default: "
+             "`tasklogs_dir`")
+    parser.add_argument(
+        "--source-url",
+        help="The object store url of an object source, see "
+             "`tasklog_storage_url`")
+    parser.add_argument(
+        "--keep", action="store_true",
+        help="Copy the logs instead of moving them")
+    args = parser.parse_args()
+
+    source = create_storage(
+        args.source, root=args.source_dir, url=args.source_url,
+        depth=config.get("tasklog_shard_depth"))
+    moved = migrate(source, storage, remove_source=not args.keep)
+    logger.info("Migrated %s task log files", moved)
+
+
 def run_master():  # pragma: no cover
     """Runs :func:`load_master` then runs the application"""
     from pyfarm.master.application import app, api
@@ -0,0 +1,224 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Events
+======
+
+A small publish/subscribe hub which is used to push job and task updates to
+clients using server-sent events.  By default events are only delivered
+within the current process.  When ``event_broker_url`` is set events are
+published through redis instead so every master process receives them.
+
+Changes made by set based statements or by the scheduler are published with
+:meth:`EventHub.publish_on_commit`, so clients never see changes of
+transactions which are rolled back.
+"""
+
+import json
+import threading
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:  # pragma: no cover
+    from queue import Queue, Empty, Full
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from pyfarm.core.logger import getLogger
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.master.utility import default_json_encoder
+
+logger = getLogger("master.events")
+
+# Key in the ``info`` of a session holding the events published during
+# its current transaction
+SESSION_EVENTS = "pyfarm_published_events"
+
+
+class Subscription(object):
+    """
+    A single consumer of events, optionally limited to a job or a job group.
+    Events which arrive while the consumer's queue is full are dropped and
+    :attr:`lost` is set so the consumer knows it has to resynchronize.
+    """
+    def __init__(self, hub, job_id=None, jobgroup_id=None, maxsize=None):
+        self.hub = hub
+        self.job_id = job_id
+        self.jobgroup_id = jobgroup_id
+        self.queue = Queue(
+            maxsize=maxsize or config.get("event_subscriber_queue_size"))
+        self.lost = False
+
+    def matches(self, data):
+        """Returns True if the given event data is of interest to us"""
+        if self.job_id is not None and data.get("job_id") != self.job_id:
+            return False
+        if (self.jobgroup_id is not None and
+                data.get("jobgroup_id") != self.jobgroup_id):
+            return False
+        return True
+
+    def put(self, event_type, data):
+        if not self.matches(data):
+            return
+        try:
+            self.queue.put_nowait((event_type, data))
+        except Full:
+            self.lost = True
+
+    def get(self, timeout):
+        """
+        Returns the next ``(event_type, data)`` tuple or ``None`` if no event
+        arrived within ``timeout`` seconds.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class EventHub(object):
+    """
+    Distributes published events to all matching :class:`Subscription`
+    objects.
+
+    :param str broker_url:
+        If provided, the url of a redis server used to fan events out to
+        all processes.  Without it events only reach subscribers in this
+        process.
+    """
+    def __init__(self, broker_url=None, channel="pyfarm-events"):
+        self.broker_url = broker_url
+        self.channel = channel
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+        self._redis = None
+        self._listener = None
+
+        if broker_url is not None and redis is None:  # pragma: no cover
+            logger.error(
+                "`event_broker_url` is set but the redis module is not "
+                "installed, events will only be delivered in-process")
+            self.broker_url = None
+
+    def subscribe(self, job_id=None, jobgroup_id=None):
+        """Returns a new :class:`Subscription`"""
+        subscription = Subscription(
+            self, job_id=job_id, jobgroup_id=jobgroup_id)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        if self.broker_url is not None:
+            self.start_listener()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, event_type, **data):
+        """
+        Publishes an event.  ``data`` should contain ``job_id`` and
+        ``jobgroup_id`` where applicable so per job and per job group
+        subscriptions can filter on them.
+        """
+        if self.broker_url is not None:
+            message = json.dumps(
+                {"type": event_type, "data": data},
+                default=default_json_encoder)
+            try:
+                self.get_redis().publish(self.channel, message)
+                return
+            except Exception as e:
+                logger.warning(
+                    "Failed to publish event to %s, delivering it "
+                    "in-process only: %s", self.broker_url, e)
+
+        self.dispatch(event_type, data)
+
+    def publish_on_commit(self, event_type, **data):
+        """
+        Publishes an event like :meth:`publish` once the current
+        transaction of the database session commits.  The event is dropped
+        if the transaction is rolled back instead.
+        """
+        db.session.info.setdefault(SESSION_EVENTS, []).append(
+            (self, event_type, data))
+
+    def dispatch(self, event_type, data):
+        """Hands an event to all local subscriptions"""
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event_type, data)
+
+    def get_redis(self):
+        if self._redis is None:
+            self._redis = redis.StrictRedis.from_url(self.broker_url)
+        return self._redis
+
+    def start_listener(self):
+        """Starts the thread which receives events from the broker"""
+        with self.lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(
+                target=self.listen, name="pyfarm-event-listener")
+            self._listener.daemon = True
+            self._listener.start()
+
+    def listen(self):
+        pubsub = self.get_redis().pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            try:
+                event = json.loads(message["data"].decode("utf-8"))
+                self.dispatch(event["type"], event["data"])
+            except Exception as e:  # pragma: no cover
+                logger.error("Failed to handle event %r: %s", message, e)
+
+
+def publish_committed_events(session):
+    """Publishes the events of a committed transaction"""
+    for hub, event_type, data in session.info.pop(SESSION_EVENTS, ()):
+        hub.publish(event_type, **data)
+
+
+def discard_events(session):
+    """Drops the events of a transaction which was rolled back"""
+    session.info.pop(SESSION_EVENTS, None)
+
+
+event.listen(Session, "after_commit", publish_committed_events)
+event.listen(Session, "after_rollback", discard_events)
+
+events = EventHub(broker_url=config.get("event_broker_url"))
@@ -0,0 +1,354 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Log Files
+=========
+
+Reading of task log files with random access.  Logs are stored either as
+plain files, as block compressed gzip files or, for logs compressed by
+older versions, as a single gzip stream.
+
+A block compressed log is a series of independent gzip members which each
+hold up to ``tasklog_block_size`` bytes of the log, so it can still be read
+by any gzip implementation.  Next to it an index file (``<name>.gz.idx``)
+stores the uncompressed and compressed offset of every block.  Reading any
+part of such a log costs one block decompression per block touched.
+"""
+
+import struct
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import closing
+from errno import ENOENT
+from gzip import GzipFile
+from os.path import getsize, isfile
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    from isal import isal_zlib
+except ImportError:  # pragma: no cover
+    isal_zlib = None
+
+from pyfarm.core.logger import getLogger
+from pyfarm.master.config import config
+
+logger = getLogger("master.logfiles")
+
+BLOCK_SIZE = config.get("tasklog_block_size")
+READ_SIZE = 65536
+INDEX_MAGIC = b"PFLOGIDX1\n"
+INDEX_ENTRY = struct.Struct("!QQ")
+
+
+def index_path(path):
+    """Returns the path of the index belonging to compressed log ``path``"""
+    return path + ".idx"
+
+
+def lock_logfile(logfile):
+    """
+    Takes an exclusive lock on the open file ``logfile``, released when it
+    is closed.  This serializes appends to a log with its compression.  On
+    platforms without :mod:`fcntl` this does nothing.
+    """
+    if fcntl is not None:
+        fcntl.flock(logfile.fileno(), fcntl.LOCK_EX)
+
+
+def get_codec(name):
+    """
+    Returns the zlib compatible module implementing the codec ``name``,
+    ``gzip`` or ``isal``.  Both produce gzip data, ``isal`` is several times
+    faster but needs the optional :mod:`isal` module.  Falls back to
+    ``gzip`` if that is not installed.
+    """
+    if name == "gzip":
+        return zlib
+    elif name == "isal":
+        if isal_zlib is None:
+            logger.warning("The isal module is not installed, compressing "
+                           "task logs with zlib instead")
+            return zlib
+        return isal_zlib
+    raise ValueError("Unknown compression codec %r" % name)
+
+
+def compress_block(data, compresslevel=9, codec=zlib):
+    """Returns ``data`` as a single, complete gzip member"""
+    if codec is not zlib:
+        # isal only knows levels 0 to 3
+        compresslevel = min(compresslevel, codec.ISAL_BEST_COMPRESSION)
+    compressor = codec.compressobj(
+        compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(source, compressed, index, block_size=BLOCK_SIZE,
+                    compresslevel=9, codec="gzip"):
+    """
+    Reads the open file ``source`` in blocks of ``block_size`` bytes and
+    writes them in the block compressed format to the open file
+    ``compressed`` and its index to the open file ``index``.  Only one
+    block is held in memory at a time.  Returns the number of uncompressed
+    bytes.
+
+    :param int compresslevel:
+        The compression level, 1 is fastest and 9 compresses best
+
+    :param str codec:
+        The codec to compress with, see :func:`get_codec`
+    """
+    codec = get_codec(codec)
+    entries = []
+    uncompressed_offset = compressed_offset = 0
+
+    while True:
+        block = source.read(block_size)
+        if not block:
+            break
+        member = compress_block(block, compresslevel=compresslevel, codec=codec)
+        compressed.write(member)
+        entries.append((uncompressed_offset, compressed_offset))
+        uncompressed_offset += len(block)
+        compressed_offset += len(member)
+
+    # The last entry marks the end of the file
+    entries.append((uncompressed_offset, compressed_offset))
+    index.write(INDEX_MAGIC)
+    for entry in entries:
+        index.write(INDEX_ENTRY.pack(*entry))
+
+    return uncompressed_offset
+
+
+def compress_logfile(source, destination, block_size=BLOCK_SIZE,
+                     compresslevel=9, codec="gzip"):
+    """
+    Like :func:`compress_stream` but writes the compressed log to the path
+    ``destination`` and its index next to it
+    """
+    with open(destination, "wb") as compressed:
+        with open(index_path(destination), "wb") as index:
+            return compress_stream(
+                source, compressed, index, block_size=block_size,
+                compresslevel=compresslevel, codec=codec)
+
+
+class Logfile(object):
+    """
+    Base class of the log readers.  Subclasses read the stored bytes through
+    :meth:`open_range` so they can be used for logs which are not stored in
+    local files.
+
+    :attr path:
+        The path of the stored file or ``None`` if it is not a local file
+
+    :attr size:
+        The uncompressed size of the log or ``None`` if it is unknown
+
+    :attr stored_size:
+        The number of bytes stored
+    """
+    seekable = True
+    encoding = None
+    read_size = READ_SIZE
+    path = None
+    size = None
+    stored_size = None
+
+    def open_range(self, start, end):
+        """
+        Returns an open file positioned at byte ``start`` of the stored
+        file.  Callers won't read beyond ``end``.
+        """
+        stored = open(self.path, "rb")
+        stored.seek(start)
+        return stored
+
+    def read_stored(self):
+        """Yields the bytes stored, without decompressing them"""
+        with closing(self.open_range(0, self.stored_size)) as stored:
+            position = 0
+            while position < self.stored_size:
+                chunk = stored.read(min(READ_SIZE, self.stored_size - position))
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+
+
+class PlainLogfile(Logfile):
+    """An uncompressed log file"""
+    def __init__(self, path, size=None):
+        self.path = path
+        self.size = self.stored_size = getsize(path) if size is None else size
+
+    def read(self, start=0, end=None):
+        """Yields the bytes between ``start`` and ``end`` in chunks"""
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        with closing(self.open_range(start, end)) as logfile:
+            position = start
+            while position < end:
+                chunk = logfile.read(min(READ_SIZE, end - position))
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+
+
+class BlockGzipLogfile(Logfile):
+    """
+    A block compressed log file with an index.  ``index`` are the contents
+    of the index, it is read from the file next to ``path`` if not given.
+    """
+    encoding = "gzip"
+    read_size = BLOCK_SIZE
+
+    def __init__(self, path, index=None):
+        self.path = path
+        if index is None:
+            with open(index_path(path), "rb") as index_file:
+                index = index_file.read()
+        if not index.startswith(INDEX_MAGIC):
+            raise ValueError("%s is not a log index" % index_path(path))
+
+        entries = [INDEX_ENTRY.unpack_from(index, offset)
+                   for offset in range(len(INDEX_MAGIC), len(index),
+                                       INDEX_ENTRY.size)]
+        self.offsets = [entry[0] for entry in entries]
+        self.compressed_offsets = [entry[1] for entry in entries]
+        self.size = self.offsets[-1]
+        self.stored_size = self.compressed_offsets[-1]
+
+    def read(self, start=0, end=None):
+        """
+        Yields the bytes between ``start`` and ``end``, decompressing only
+        the blocks which contain them
+        """
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+
+        block = bisect_right(self.offsets, start) - 1
+        last = bisect_left(self.offsets, end)
+        with closing(self.open_range(
+                self.compressed_offsets[block],
+                self.compressed_offsets[last])) as compressed:
+            while block < last:
+                member = compressed.read(
+                    self.compressed_offsets[block + 1] -
+                    self.compressed_offsets[block])
+                data = zlib.decompress(member, 16 + zlib.MAX_WBITS)
+                block_start = self.offsets[block]
+                yield data[max(start - block_start, 0):end - block_start]
+                block += 1
+
+
+class GzipLogfile(Logfile):
+    """
+    A log compressed as a single gzip stream.  Its size is unknown up front
+    and every read has to decompress it from the beginning.
+    """
+    seekable = False
+    encoding = "gzip"
+
+    def __init__(self, path, stored_size=None):
+        self.path = path
+        self.stored_size = (
+            getsize(path) if stored_size is None else stored_size)
+
+    def read(self, start=0, end=None):
+        position = 0
+        with closing(self.open_range(0, self.stored_size)) as stored:
+            with GzipFile(fileobj=stored, mode="rb") as logfile:
+                while end is None or position < end:
+                    chunk = logfile.read(READ_SIZE)
+                    if not chunk:
+                        break
+                    chunk_start = position
+                    position += len(chunk)
+                    if position <= start:
+                        continue
+                    stop = None if end is None else end - chunk_start
+                    yield chunk[max(start - chunk_start, 0):stop]
+
+
+def open_logfile(path):
+    """
+    Returns a reader for the log stored under ``path``, which may be
+    uncompressed, block compressed or a plain gzip stream.
+
+    :raises IOError:
+        raised if there is no log stored under ``path``
+    """
+    if isfile(path):
+        return PlainLogfile(path)
+
+    compressed_path = path + ".gz"
+    if isfile(index_path(compressed_path)):
+        return BlockGzipLogfile(compressed_path)
+    if isfile(compressed_path):
+        return GzipLogfile(compressed_path)
+
+    raise IOError(ENOENT, "No log stored under %s" % path)
+
+
+def tail_offset(logfile, lines):
+    """Returns the offset at which the last ``lines`` lines of a log start"""
+    if not logfile.seekable:
+        # Remember where the most recent lines started while reading it all
+        starts = deque([0], maxlen=max(lines, 0) + 1)
+        position = 0
+        for chunk in logfile.read():
+            index = chunk.find(b"\n")
+            while index != -1:
+                starts.append(position + index + 1)
+                index = chunk.find(b"\n", index + 1)
+            position += len(chunk)
+        if lines <= 0:
+            return position
+        if starts[-1] == position:
+            starts.pop()
+        return starts[-lines] if len(starts) >= lines else 0
+
+    if lines <= 0:
+        return logfile.size
+
+    end = logfile.size
+    # A trailing newline ends the last line, it does not start a new one
+    if end and b"".join(logfile.read(end - 1, end)) == b"\n":
+        end -= 1
+
+    found = 0
+    while end > 0:
+        start = max(end - logfile.read_size, 0)
+        chunk = b"".join(logfile.read(start, end))
+        index = chunk.rfind(b"\n")
+        while index != -1:
+            found += 1
+            if found == lines:
+                return start + index + 1
+            index = chunk.rfind(b"\n", 0, index)
+        end = start
+    return 0
@@ -0,0 +1,265 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Log Search
+==========
+
+A full text index over task logs.  The index is kept in an embedded SQLite
+database using its FTS extension, so it works the same no matter which
+database the master itself uses.
+
+Logs are split into chunks of about :data:`CHUNK_SIZE` bytes which end at
+line breaks.  With SQLite 3.43 or newer only the tokens of a chunk are
+stored, not its text, together with the offset it starts at.  Older versions
+can't remove the tokens of a chunk without its text, so there the text is
+kept in the ``chunks`` table which serves as the external content of the
+full text index.  Next to that the index keeps the agent, creation time,
+jobs and job groups of every log so searches can be narrowed down without
+going back to the main database.
+
+The index is disabled unless ``tasklog_search_index`` is set.
+"""
+
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+from pyfarm.core.logger import getLogger
+from pyfarm.master.config import config
+
+logger = getLogger("master.logsearch")
+
+CHUNK_SIZE = 65536
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS logs ("
+    "id INTEGER PRIMARY KEY, identifier TEXT NOT NULL, agent_id TEXT, "
+    "created_on TEXT, size INTEGER)",
+    "CREATE INDEX IF NOT EXISTS logs_created_on ON logs (created_on)",
+    "CREATE INDEX IF NOT EXISTS logs_agent_id ON logs (agent_id, created_on)",
+    "CREATE TABLE IF NOT EXISTS log_jobs ("
+    "log_id INTEGER NOT NULL, job_id INTEGER NOT NULL, jobgroup_id INTEGER, "
+    "PRIMARY KEY (log_id, job_id))",
+    "CREATE INDEX IF NOT EXISTS log_jobs_job_id ON log_jobs (job_id)",
+    "CREATE INDEX IF NOT EXISTS log_jobs_jobgroup_id "
+    "ON log_jobs (jobgroup_id)",
+    # text is only set when the full text index can't delete the tokens of
+    # a chunk on its own
+    "CREATE TABLE IF NOT EXISTS chunks ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, log_id INTEGER NOT NULL, "
+    "offset INTEGER NOT NULL, text TEXT)",
+    "CREATE INDEX IF NOT EXISTS chunks_log_id ON chunks (log_id)")
+
+# The full text index in order of preference, a contentless table which
+# supports deletes and otherwise one using the chunks as external content
+FULL_TEXT_TABLES = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chunk_text "
+    "USING fts5(text, content='', contentless_delete=1)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chunk_text "
+    "USING fts5(text, content='chunks', content_rowid='id')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chunk_text "
+    "USING fts4(content=\"chunks\", text)")
+
+
+def split_chunks(logfile, size=CHUNK_SIZE):
+    """
+    Yields ``(offset, data)`` for the chunks of the log ``logfile``.  Chunks
+    end at a line break unless a single line is longer than ``size``.
+    """
+    offset = 0
+    buffered = b""
+    for data in logfile.read():
+        buffered += data
+        start = 0
+        while len(buffered) - start >= size:
+            end = buffered.rfind(b"\n", start, start + size) + 1
+            if end <= start:
+                end = start + size
+            yield offset + start, buffered[start:end]
+            start = end
+        offset += start
+        buffered = buffered[start:]
+
+    if buffered:
+        yield offset, buffered
+
+
+def format_time(value):
+    return value.strftime(TIME_FORMAT) if value is not None else None
+
+
+class LogIndex(object):
+    """
+    The full text index stored in the SQLite database ``path``, ``None``
+    disables it
+    """
+    def __init__(self, path=None):
+        self.path = None
+        self.store_text = False
+        self.configure(path)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def configure(self, path):
+        """Switches to the index stored in ``path``, creating it if needed"""
+        self.path = path
+        if path is None:
+            return
+
+        with closing(self.connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            for statement in FULL_TEXT_TABLES:
+                try:
+                    connection.execute(statement)
+                    break
+                except sqlite3.OperationalError:
+                    continue
+            connection.commit()
+
+            # The index may have been created by another SQLite version
+            sql, = connection.execute(
+                "SELECT sql FROM sqlite_master "
+                "WHERE name = 'chunk_text'").fetchone()
+            self.store_text = "contentless_delete" not in sql
+
+    def connect(self):
+        # A new connection every time, they can't be shared between threads
+        # or forked processes
+        return sqlite3.connect(self.path, timeout=60)
+
+    def index(self, log_id, identifier, agent_id, created_on, jobs, logfile):
+        """
+        Adds the log to the index, replacing it if it was indexed before
+        with a different size.  Returns ``True`` if the log was indexed.
+
+        :param list jobs:
+            ``(job_id, jobgroup_id)`` for every job the log belongs to
+
+        :param logfile:
+            A reader for the log, see :mod:`pyfarm.master.logfiles`
+        """
+        with closing(self.connect()) as connection:
+            with connection:
+                row = connection.execute(
+                    "SELECT size FROM logs WHERE id = ?",
+                    (log_id, )).fetchone()
+                if (row is not None and logfile.size is not None and
+                        row[0] == logfile.size):
+                    return False
+
+                self.delete(connection, [log_id])
+                size = 0
+                for offset, data in split_chunks(logfile):
+                    text = data.decode("utf-8", "replace")
+                    cursor = connection.execute(
+                        "INSERT INTO chunks (log_id, offset, text) "
+                        "VALUES (?, ?, ?)",
+                        (log_id, offset, text if self.store_text else None))
+                    connection.execute(
+                        "INSERT INTO chunk_text (rowid, text) VALUES (?, ?)",
+                        (cursor.lastrowid, text))
+                    size = offset + len(data)
+
+                connection.execute(
+                    "INSERT INTO logs (id, identifier, agent_id, created_on, "
+                    "size) VALUES (?, ?, ?, ?, ?)",
+                    (log_id, identifier,
+                     str(agent_id) if agent_id is not None else None,
+                     format_time(created_on), size))
+                connection.executemany(
+                    "INSERT OR IGNORE INTO log_jobs (log_id, job_id, "
+                    "jobgroup_id) VALUES (?, ?, ?)",
+                    [(log_id, job_id, jobgroup_id)
+                     for job_id, jobgroup_id in jobs])
+
+        logger.debug("Indexed task log %s, %s bytes", identifier, size)
+        return True
+
+    def delete(self, connection, log_ids):
+        # The tokens have to go first, with external content they are found
+        # through the text of the chunks
+        for statement in ("DELETE FROM chunk_text WHERE rowid IN "
+                          "(SELECT id FROM chunks WHERE log_id = ?)",
+                          "DELETE FROM chunks WHERE log_id = ?",
+                          "DELETE FROM log_jobs WHERE log_id = ?",
+                          "DELETE FROM logs WHERE id = ?"):
+            connection.executemany(
+                statement, [(log_id, ) for log_id in log_ids])
+
+    def remove(self, log_ids):
+        """Removes the given logs from the index"""
+        if not self.enabled or not log_ids:
+            return
+        with closing(self.connect()) as connection:
+            with connection:
+                self.delete(connection, log_ids)
+
+    def search(self, text, job_id=None, jobgroup_id=None, agent_id=None,
+               since=None, until=None, limit=100):
+        """
+        Returns the newest logs containing the phrase ``text``, as a list
+        of dictionaries with the ``id``, ``identifier``, ``agent_id``,
+        ``created_on`` of the log and the ``offset`` of the first chunk
+        which matched.
+        """
+        sql = ["SELECT logs.id, logs.identifier, logs.agent_id, "
+               "logs.created_on, MIN(chunks.offset) FROM chunk_text "
+               "JOIN chunks ON chunks.id = chunk_text.rowid "
+               "JOIN logs ON logs.id = chunks.log_id "
+               "WHERE chunk_text MATCH ?"]
+        parameters = ['"%s"' % text.replace('"', '""')]
+
+        if job_id is not None:
+            sql.append("AND logs.id IN "
+                       "(SELECT log_id FROM log_jobs WHERE job_id = ?)")
+            parameters.append(job_id)
+        if jobgroup_id is not None:
+            sql.append("AND logs.id IN "
+                       "(SELECT log_id FROM log_jobs WHERE jobgroup_id = ?)")
+            parameters.append(jobgroup_id)
+        if agent_id is not None:
+            sql.append("AND logs.agent_id = ?")
+            parameters.append(str(agent_id))
+        if since is not None:
+            sql.append("AND logs.created_on >= ?")
+            parameters.append(format_time(since))
+        if until is not None:
+            sql.append("AND logs.created_on < ?")
+            parameters.append(format_time(until))
+
+        sql.append("GROUP BY logs.id "
+                   "ORDER BY logs.created_on DESC, logs.id DESC LIMIT ?")
+        parameters.append(limit)
+
+        with closing(self.connect()) as connection:
+            rows = connection.execute(" ".join(sql), parameters).fetchall()
+
+        return [{"id": log_id,
+                 "identifier": identifier,
+                 "agent_id": agent_id,
+                 "created_on": (datetime.strptime(created_on, TIME_FORMAT)
+                                if created_on is not None else None),
+                 "offset": offset}
+                for log_id, identifier, agent_id, created_on, offset in rows]
+
+
+log_index = LogIndex(config.get("tasklog_search_index"))
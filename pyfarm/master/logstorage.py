@@ -0,0 +1,719 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Log Storage
+===========
+
+Backends task logs are stored in.  Every log is addressed by its identifier
+and may be stored uncompressed or, once compressed, as a block compressed
+file plus its index (see :mod:`pyfarm.master.logfiles`).
+
+* :class:`FlatFileStorage` keeps all logs in a single directory, the default
+  and the layout used by older versions.
+* :class:`ShardedFileStorage` spreads them over a tree of directories named
+  after the hash of the identifier so no directory grows too large.
+* :class:`ObjectStorage` keeps them in an object store, either S3 through
+  :mod:`boto3` or, for tests and single machine setups, a directory.  Logs
+  which are still written to are kept in local files until compressed.
+
+The backend is chosen with ``tasklog_storage``, :func:`migrate` (run
+through ``pyfarm-migrate-tasklogs``) moves logs between backends.
+"""
+
+import shutil
+from contextlib import closing
+from errno import EEXIST, ENOENT, EXDEV
+from hashlib import sha1
+from os import (
+    O_APPEND, O_CREAT, O_EXCL, O_WRONLY, SEEK_END, fdopen, fstat, listdir,
+    makedirs, remove, rename, open as os_open)
+from os.path import dirname, getsize, isdir, isfile, join, realpath, sep
+from tempfile import SpooledTemporaryFile
+
+try:
+    from urlparse import urlparse
+except ImportError:  # pragma: no cover
+    from urllib.parse import urlparse
+
+try:
+    import boto3
+except ImportError:  # pragma: no cover
+    boto3 = None
+
+from pyfarm.core.logger import getLogger
+from pyfarm.master.config import config
+from pyfarm.master.logfiles import (
+    BLOCK_SIZE, READ_SIZE, BlockGzipLogfile, GzipLogfile, PlainLogfile,
+    compress_logfile, compress_stream, index_path, lock_logfile, open_logfile,
+    tail_offset)
+
+logger = getLogger("master.logstorage")
+
+# The suffixes of the files a single log may be stored as
+SUFFIXES = ("", ".gz", ".gz.idx")
+
+
+class AppendConflict(Exception):
+    """
+    Raised when a chunk can't be appended to a log, ``size`` is the current
+    size of the log if the chunk's offset did not match it
+    """
+    def __init__(self, message, size=None):
+        super(AppendConflict, self).__init__(message)
+        self.size = size
+
+
+def split_suffix(name):
+    """Splits a stored file's name into the log identifier and its suffix"""
+    for suffix in (".gz.idx", ".gz"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)], suffix
+    return name, ""
+
+
+class LogStorage(object):
+    """The interface of the log storage backends"""
+    def check(self, identifier):
+        """
+        :raises ValueError:
+            raised if logs can't be stored under ``identifier``
+        """
+        if (not identifier or identifier in (".", "..") or
+                "/" in identifier or sep in identifier or
+                "\0" in identifier):
+            raise ValueError("Identifier %r is not acceptable" % identifier)
+
+    def open(self, identifier):
+        """
+        Returns a reader for the log, see :mod:`pyfarm.master.logfiles`
+
+        :raises IOError:
+            raised if the log does not exist
+        """
+        raise NotImplementedError
+
+    def write(self, identifier, data):
+        """Stores ``data`` as the uncompressed log, replacing the old one"""
+        raise NotImplementedError
+
+    def append(self, identifier, offset, data):
+        """
+        Appends ``data`` to the uncompressed log, creating it if needed.
+        Returns the new size.
+
+        :raises AppendConflict:
+            raised if ``offset`` is not the current size of the log or the
+            log has already been compressed
+        """
+        raise NotImplementedError
+
+    def compress(self, identifier, compresslevel=9, codec="gzip"):
+        """
+        Compresses the log and removes the uncompressed version.  Returns
+        the size of the compressed log, its
+        :attr:`~pyfarm.master.logfiles.Logfile.stored_size`.
+        """
+        raise NotImplementedError
+
+    def truncate(self, identifier, lines, compresslevel=9, codec="gzip"):
+        """
+        Replaces the log with its last ``lines`` lines, stored compressed.
+        Returns the number of bytes stored afterwards.
+        """
+        logfile = self.open(identifier)
+        tail = b"".join(logfile.read(tail_offset(logfile, lines)))
+        # Readers prefer the uncompressed log, so the tail replaces the old
+        # log for them right away
+        self.write(identifier, tail)
+        return self.compress(
+            identifier, compresslevel=compresslevel, codec=codec)
+
+    def delete(self, identifier):
+        """Removes every stored version of the log"""
+        raise NotImplementedError
+
+    def identifiers(self, compressed=None):
+        """
+        Yields the identifiers of the stored logs.  With ``compressed``
+        ``False`` only logs stored uncompressed, with ``True`` only those
+        stored compressed.  A log being compressed may show up as both.
+        """
+        raise NotImplementedError
+
+    def names(self):
+        """Yields the name of every stored file, in no particular order"""
+        raise NotImplementedError
+
+    def open_stored(self, name):
+        """Returns the stored file ``name`` opened for reading"""
+        raise NotImplementedError
+
+    def store(self, name, stored):
+        """Stores the contents of the open file ``stored`` as ``name``"""
+        raise NotImplementedError
+
+    def remove_stored(self, name):
+        """Removes the stored file ``name``"""
+        raise NotImplementedError
+
+    def filter_names(self, names, compressed):
+        seen = set()
+        for name in names:
+            identifier, suffix = split_suffix(name)
+            if compressed is None:
+                if identifier in seen:
+                    continue
+                seen.add(identifier)
+            elif suffix != (".gz" if compressed else ""):
+                continue
+            yield identifier
+
+
+class FileStorage(LogStorage):
+    """Stores logs as files below ``root``"""
+    def __init__(self, root):
+        self.root = realpath(root)
+        try:
+            makedirs(self.root)
+        except OSError as e:  # pragma: no cover
+            if e.errno != EEXIST:
+                raise
+
+    def relative_path(self, identifier):
+        """Returns the path of the log relative to :attr:`root`"""
+        raise NotImplementedError
+
+    def path(self, identifier):
+        """Returns the path of the uncompressed log"""
+        self.check(identifier)
+        path = realpath(join(self.root, self.relative_path(identifier)))
+        if not path.startswith(self.root + sep):
+            raise ValueError("Identifier %r is not acceptable" % identifier)
+        return path
+
+    def open(self, identifier):
+        return open_logfile(self.path(identifier))
+
+    def create_parent(self, path):
+        try:
+            makedirs(dirname(path))
+        except OSError as e:
+            if e.errno != EEXIST:
+                raise
+
+    def write(self, identifier, data):
+        path = self.path(identifier)
+        self.create_parent(path)
+        with open(path, "wb+") as logfile:
+            logfile.write(data)
+
+    def append(self, identifier, offset, data):
+        path = self.path(identifier)
+        compressed = AppendConflict(
+            "Logfile has already been compressed and cannot be appended to")
+
+        # Only the first chunk may create the log, otherwise a chunk
+        # arriving after compression would start a new uncompressed log
+        created = False
+        try:
+            if offset == 0:
+                self.create_parent(path)
+                try:
+                    descriptor = os_open(path, O_WRONLY | O_APPEND | O_CREAT |
+                                         O_EXCL, 0o644)
+                    created = True
+                except OSError as e:
+                    if e.errno != EEXIST:
+                        raise
+                    descriptor = os_open(path, O_WRONLY | O_APPEND)
+            else:
+                descriptor = os_open(path, O_WRONLY | O_APPEND)
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+            if isfile(path + ".gz"):
+                raise compressed
+            raise AppendConflict(
+                "Chunk starts at offset %s but the logfile does not "
+                "exist" % offset, size=0)
+
+        with fdopen(descriptor, "ab") as logfile:
+            lock_logfile(logfile)
+
+            # The file may have been compressed and removed while we were
+            # waiting for the lock, or compressed before we created it
+            if (fstat(logfile.fileno()).st_nlink == 0 or
+                    isfile(path + ".gz")):
+                if created:
+                    remove(path)
+                raise compressed
+
+            logfile.seek(0, SEEK_END)
+            size = logfile.tell()
+            if offset != size:
+                raise AppendConflict(
+                    "Chunk starts at offset %s but the logfile is %s bytes "
+                    "long" % (offset, size), size=size)
+
+            logfile.write(data)
+        return size + len(data)
+
+    def compress(self, identifier, compresslevel=9, codec="gzip"):
+        path = self.path(identifier)
+        with open(path, "rb") as logfile:
+            # Keep appends out until the uncompressed file is gone
+            lock_logfile(logfile)
+            compress_logfile(logfile, path + ".gz",
+                             compresslevel=compresslevel, codec=codec)
+            try:
+                remove(path)
+            except OSError as e:  # pragma: no cover
+                if e.errno != ENOENT:
+                    raise
+        return getsize(path + ".gz")
+
+    def delete(self, identifier):
+        path = self.path(identifier)
+        for suffix in SUFFIXES:
+            try:
+                remove(path + suffix)
+            except OSError as e:
+                if e.errno != ENOENT:
+                    raise
+
+    def identifiers(self, compressed=None):
+        return self.filter_names(self.names(), compressed)
+
+    def stored_path(self, name):
+        identifier, suffix = split_suffix(name)
+        return self.path(identifier) + suffix
+
+    def open_stored(self, name):
+        return open(self.stored_path(name), "rb")
+
+    def store(self, name, stored):
+        path = self.stored_path(name)
+        self.create_parent(path)
+        with open(path, "wb") as destination:
+            shutil.copyfileobj(stored, destination, READ_SIZE)
+
+    def remove_stored(self, name):
+        remove(self.stored_path(name))
+
+
+class FlatFileStorage(FileStorage):
+    """Stores all logs directly in ``root``"""
+    def relative_path(self, identifier):
+        return identifier
+
+    def names(self):
+        try:
+            for name in listdir(self.root):
+                if isfile(join(self.root, name)):
+                    yield name
+        except OSError as e:  # pragma: no cover
+            if e.errno != ENOENT:
+                raise
+            logger.warning("Log directory %r does not exist", self.root)
+
+
+class ShardedFileStorage(FileStorage):
+    """
+    Stores every log in a subdirectory of ``root`` named after the first
+    bytes of the SHA1 hash of its identifier, ``depth`` levels deep with
+    256 directories per level.  ``ab/cd/<identifier>`` for a depth of 2.
+    """
+    def __init__(self, root, depth=2):
+        super(ShardedFileStorage, self).__init__(root)
+        self.depth = depth
+
+    def relative_path(self, identifier):
+        digest = sha1(identifier.encode("utf-8")).hexdigest()
+        shards = [digest[level * 2:level * 2 + 2]
+                  for level in range(self.depth)]
+        return join(*(shards + [identifier]))
+
+    def names(self):
+        directories = [self.root]
+        for _ in range(self.depth):
+            subdirectories = []
+            for directory in directories:
+                try:
+                    subdirectories.extend(
+                        join(directory, name) for name in listdir(directory)
+                        if len(name) == 2 and isdir(join(directory, name)))
+                except OSError as e:  # pragma: no cover
+                    if e.errno != ENOENT:
+                        raise
+            directories = subdirectories
+
+        for directory in directories:
+            try:
+                for name in listdir(directory):
+                    yield name
+            except OSError as e:  # pragma: no cover
+                if e.errno != ENOENT:
+                    raise
+
+
+class LocalObjectStore(object):
+    """
+    An object store kept in a local directory, each object is a file.  It
+    implements the same interface as :class:`S3ObjectStore` and stands in
+    for it in tests and on single machine setups.
+    """
+    def __init__(self, root):
+        self.root = realpath(root)
+
+    def path(self, key):
+        return join(self.root, *key.split("/"))
+
+    def size(self, key):
+        try:
+            return getsize(self.path(key))
+        except OSError as e:
+            raise IOError(e.errno, "No object stored under %s" % key)
+
+    def open(self, key, start=0, end=None):
+        stored = open(self.path(key), "rb")
+        stored.seek(start)
+        return stored
+
+    def put(self, key, stored):
+        path = self.path(key)
+        try:
+            makedirs(dirname(path))
+        except OSError as e:
+            if e.errno != EEXIST:
+                raise
+        # Write to a temporary name first so readers never see half an object
+        with open(path + ".part", "wb") as destination:
+            shutil.copyfileobj(stored, destination, READ_SIZE)
+        rename(path + ".part", path)
+
+    def delete(self, key):
+        try:
+            remove(self.path(key))
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+
+    def keys(self, prefix=""):
+        directory = self.path(prefix) if prefix else self.root
+        try:
+            names = listdir(directory)
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+            return
+        for name in names:
+            if isfile(join(directory, name)) and not name.endswith(".part"):
+                yield prefix + name
+
+
+class S3ObjectStore(object):
+    """An S3 bucket, or a ``prefix`` in one, accessed through :mod:`boto3`"""
+    def __init__(self, bucket, prefix=""):
+        if boto3 is None:
+            raise RuntimeError(
+                "The boto3 module is required to store task logs in S3")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3")
+
+    def size(self, key):
+        try:
+            return self.client.head_object(
+                Bucket=self.bucket, Key=self.prefix + key)["ContentLength"]
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                raise IOError(ENOENT, "No object stored under %s" % key)
+            raise
+
+    def open(self, key, start=0, end=None):
+        kwargs = {}
+        if start or end is not None:
+            kwargs["Range"] = "bytes=%s-%s" % (
+                start, "" if end is None else end - 1)
+        return self.client.get_object(
+            Bucket=self.bucket, Key=self.prefix + key, **kwargs)["Body"]
+
+    def put(self, key, stored):
+        self.client.upload_fileobj(stored, self.bucket, self.prefix + key)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def keys(self, prefix=""):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+                Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for item in page.get("Contents", ()):
+                yield item["Key"][len(self.prefix):]
+
+
+class ObjectLogfileMixin(object):
+    """Reads the stored bytes of a log from an object store"""
+    def open_range(self, start, end):
+        return self.objects.open(self.key, start, end)
+
+
+class ObjectPlainLogfile(ObjectLogfileMixin, PlainLogfile):
+    def __init__(self, objects, key, size):
+        super(ObjectPlainLogfile, self).__init__(None, size=size)
+        self.objects = objects
+        self.key = key
+
+
+class ObjectBlockGzipLogfile(ObjectLogfileMixin, BlockGzipLogfile):
+    def __init__(self, objects, key, index):
+        super(ObjectBlockGzipLogfile, self).__init__(key, index=index)
+        self.path = None
+        self.objects = objects
+        self.key = key
+
+
+class ObjectGzipLogfile(ObjectLogfileMixin, GzipLogfile):
+    def __init__(self, objects, key, stored_size):
+        super(ObjectGzipLogfile, self).__init__(None, stored_size=stored_size)
+        self.objects = objects
+        self.key = key
+
+
+class ObjectStorage(LogStorage):
+    """
+    Stores logs in an object store, see :class:`LocalObjectStore` for the
+    interface it has to implement.  Objects can't be appended to and
+    rewriting a log for every chunk would make uploading it quadratic, so
+    uncompressed logs, the ones still being written, are kept in
+    a :class:`ShardedFileStorage` in the ``spool`` directory below
+    ``root`` until :meth:`compress` moves them into the object store.
+    """
+    def __init__(self, objects, root, depth=2):
+        self.objects = objects
+        self.root = realpath(root)
+        self.spool = ShardedFileStorage(join(self.root, "spool"), depth=depth)
+
+    def exists(self, key):
+        try:
+            self.objects.size(key)
+        except IOError:
+            return False
+        return True
+
+    def open(self, identifier):
+        self.check(identifier)
+        try:
+            return self.spool.open(identifier)
+        except IOError:
+            pass
+
+        # Uncompressed logs stored before they were spooled locally
+        try:
+            return ObjectPlainLogfile(
+                self.objects, identifier, self.objects.size(identifier))
+        except IOError:
+            pass
+
+        key = identifier + ".gz"
+        try:
+            with closing(self.objects.open(index_path(key))) as index:
+                return ObjectBlockGzipLogfile(self.objects, key, index.read())
+        except (IOError, OSError):
+            pass
+
+        try:
+            return ObjectGzipLogfile(self.objects, key, self.objects.size(key))
+        except IOError:
+            raise IOError(ENOENT, "No log stored under %s" % identifier)
+
+    def write(self, identifier, data):
+        self.check(identifier)
+        self.spool.write(identifier, data)
+
+    def append(self, identifier, offset, data):
+        self.check(identifier)
+        compressed = AppendConflict(
+            "Logfile has already been compressed and cannot be appended to")
+
+        # A first chunk must not start a new log in the spool next to the
+        # compressed one, see FileStorage.append for the later chunks
+        if offset == 0 and self.exists(identifier + ".gz"):
+            raise compressed
+        try:
+            return self.spool.append(identifier, offset, data)
+        except AppendConflict as e:
+            if e.size == 0 and self.exists(identifier + ".gz"):
+                raise compressed
+            raise
+
+    def compress(self, identifier, compresslevel=9, codec="gzip"):
+        self.check(identifier)
+        key = identifier + ".gz"
+        path = self.spool.path(identifier)
+        if not isfile(path):
+            return self.compress_object(
+                identifier, compresslevel=compresslevel, codec=codec)
+
+        # The compressed files stay in the spool until they are uploaded,
+        # which keeps appends out and readers served in the meantime
+        stored_size = self.spool.compress(
+            identifier, compresslevel=compresslevel, codec=codec)
+        # The index goes last, it marks the compressed log complete
+        for name in (key, index_path(key)):
+            with open(self.spool.stored_path(name), "rb") as stored:
+                self.objects.put(name, stored)
+        for name in (key, index_path(key)):
+            self.spool.remove_stored(name)
+        return stored_size
+
+    def compress_object(self, identifier, compresslevel=9, codec="gzip"):
+        """Compresses a log which is stored uncompressed as an object"""
+        with SpooledTemporaryFile(BLOCK_SIZE) as compressed:
+            with SpooledTemporaryFile(BLOCK_SIZE) as index:
+                with closing(self.objects.open(identifier)) as logfile:
+                    compress_stream(logfile, compressed, index,
+                                    compresslevel=compresslevel, codec=codec)
+                stored_size = compressed.tell()
+                compressed.seek(0)
+                index.seek(0)
+                # The index goes last, it marks the compressed log complete
+                self.objects.put(identifier + ".gz", compressed)
+                self.objects.put(index_path(identifier + ".gz"), index)
+        self.objects.delete(identifier)
+        return stored_size
+
+    def delete(self, identifier):
+        self.check(identifier)
+        self.spool.delete(identifier)
+        for suffix in SUFFIXES:
+            self.objects.delete(identifier + suffix)
+
+    def names(self):
+        for name in self.spool.names():
+            yield name
+        for name in self.objects.keys():
+            yield name
+
+    def identifiers(self, compressed=None):
+        return self.filter_names(self.names(), compressed)
+
+    def open_stored(self, name):
+        try:
+            return self.spool.open_stored(name)
+        except IOError:
+            return self.objects.open(name)
+
+    def store(self, name, stored):
+        if split_suffix(name)[1]:
+            self.objects.put(name, stored)
+        else:
+            self.spool.store(name, stored)
+
+    def remove_stored(self, name):
+        try:
+            self.spool.remove_stored(name)
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+            self.objects.delete(name)
+
+
+def create_storage(kind, root=None, url=None, depth=2):
+    """
+    Creates a log storage backend
+
+    :param str kind:
+        ``flat``, ``sharded`` or ``object``
+
+    :param str root:
+        The directory the file backends store logs in, for ``object`` the
+        directory logs which are still written to are kept in
+
+    :param str url:
+        For ``object``, the object store to use.  ``s3://<bucket>/<prefix>``
+        or ``file://<directory>`` for :class:`LocalObjectStore`.
+
+    :param int depth:
+        The number of directory levels of ``sharded``, and of the
+        directory of ``object``
+    """
+    if kind == "flat":
+        return FlatFileStorage(root)
+    elif kind == "sharded":
+        return ShardedFileStorage(root, depth=depth)
+    elif kind == "object":
+        parsed = urlparse(url or "")
+        if parsed.scheme == "s3":
+            prefix = parsed.path.lstrip("/")
+            if prefix and not prefix.endswith("/"):
+                prefix += "/"
+            return ObjectStorage(
+                S3ObjectStore(parsed.netloc, prefix), root, depth=depth)
+        elif parsed.scheme == "file":
+            return ObjectStorage(
+                LocalObjectStore(parsed.netloc + parsed.path), root,
+                depth=depth)
+        raise ValueError("Unsupported object store url %r" % url)
+    raise ValueError("Unknown log storage %r" % kind)
+
+
+def migrate(source, destination, remove_source=True):
+    """
+    Moves every log stored in ``source`` to ``destination``.  Between two
+    file backends files are renamed where possible, otherwise copied.
+    Returns the number of files moved.
+    """
+    moved = 0
+    for name in list(source.names()):
+        identifier, _ = split_suffix(name)
+        try:
+            destination.check(identifier)
+        except ValueError:
+            logger.warning("Not migrating %r, its name is not acceptable",
+                           name)
+            continue
+
+        renamed = False
+        if (remove_source and isinstance(source, FileStorage) and
+                isinstance(destination, FileStorage)):
+            path = destination.stored_path(name)
+            destination.create_parent(path)
+            try:
+                rename(source.stored_path(name), path)
+                renamed = True
+            except OSError as e:
+                if e.errno != EXDEV:
+                    raise
+
+        if not renamed:
+            with closing(source.open_stored(name)) as stored:
+                destination.store(name, stored)
+            if remove_source:
+                source.remove_stored(name)
+        moved += 1
+
+        if moved % 10000 == 0:
+            logger.info("Migrated %s task log files", moved)
+
+    return moved
+
+
+storage = create_storage(
+    config.get("tasklog_storage"), root=config.get("tasklogs_dir"),
+    url=config.get("tasklog_storage_url"),
+    depth=config.get("tasklog_shard_depth"))
@@ -0,0 +1,187 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Task Events
+===========
+
+Counts task events, such as tasks being created, started or deleted, for
+the statistics.  Instead of inserting a :class:`.TaskEventCount` row for
+every single event, each process adds up its events per job queue and
+writes one row per queue every ``task_event_flush_interval`` seconds.
+
+Events are only added up once the transaction of the session they were
+counted in commits, so events of transactions which are rolled back are
+never counted.
+
+Pending counts are lost if a process crashes, so the interval is also the
+bound on how many seconds of events can go missing.  They are written when
+the process shuts down normally.  With an interval of ``0`` every event is
+added to the current session immediately, as before.
+"""
+
+import atexit
+import threading
+from datetime import datetime
+from time import sleep
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from pyfarm.core.logger import getLogger
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+
+logger = getLogger("master.taskevents")
+
+EVENT_COLUMNS = ("num_new", "num_deleted", "num_restarted", "num_started",
+                 "num_failed", "num_done")
+
+# The key in the ``info`` of a session under which events are kept until
+# its transaction commits
+SESSION_EVENTS = "pyfarm_task_events"
+
+
+class TaskEventAccumulator(object):
+    """
+    Adds up task events per job queue until they are written by
+    :meth:`flush`.
+
+    :param float flush_interval:
+        How often, in seconds, a background thread writes the pending
+        counts to the database.  With ``0`` events are not accumulated.
+    """
+    def __init__(self, flush_interval=0):
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.time_start = None
+        self._flusher = None
+        self.lock = threading.Lock()
+        self.flusher_lock = threading.Lock()
+
+    def count(self, job_queue_id, **events):
+        """
+        Counts ``events``, keyword arguments named after the columns of
+        :class:`.TaskEventCount` such as ``num_started=1``, for the queue
+        ``job_queue_id`` once the current transaction commits.  Does
+        nothing unless ``enable_statistics`` is set.
+        """
+        if not config.get("enable_statistics"):
+            return
+        unknown = set(events) - set(EVENT_COLUMNS)
+        if unknown:
+            raise ValueError("Unknown task events: %s" % ", ".join(unknown))
+
+        if not self.flush_interval:
+            task_event_count = TaskEventCount(job_queue_id=job_queue_id,
+                                              **events)
+            task_event_count.time_start = datetime.utcnow()
+            task_event_count.time_end = datetime.utcnow()
+            db.session.add(task_event_count)
+            return
+
+        db.session.info.setdefault(SESSION_EVENTS, []).append(
+            (self, job_queue_id, events))
+
+    def add(self, job_queue_id, events):
+        """Adds ``events`` of a committed transaction to the pending counts"""
+        with self.lock:
+            if self.time_start is None:
+                self.time_start = datetime.utcnow()
+            counts = self.pending.setdefault(
+                job_queue_id, dict((name, 0) for name in EVENT_COLUMNS))
+            for name, value in events.items():
+                counts[name] += value
+
+        self.start_flusher()
+
+    def flush(self):
+        """
+        Writes one :class:`.TaskEventCount` row per queue with pending
+        events in its own transaction.  Returns the number of rows written.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            time_start, self.time_start = self.time_start, None
+        if not pending:
+            return 0
+
+        time_end = datetime.utcnow()
+        rows = []
+        for job_queue_id, counts in pending.items():
+            row = dict(counts)
+            row.update(job_queue_id=job_queue_id, time_start=time_start,
+                       time_end=time_end)
+            rows.append(row)
+
+        try:
+            engine = db.get_engine(db.get_app(), bind="statistics")
+            with engine.begin() as connection:
+                connection.execute(TaskEventCount.__table__.insert(), rows)
+
+        except Exception as e:
+            logger.error("Failed to write task event counts for %s queues, "
+                         "will retry: %s", len(rows), e)
+            with self.lock:
+                for job_queue_id, counts in pending.items():
+                    merged = self.pending.setdefault(
+                        job_queue_id, dict((name, 0) for name in EVENT_COLUMNS))
+                    for name, value in counts.items():
+                        merged[name] += value
+                if self.time_start is None or time_start < self.time_start:
+                    self.time_start = time_start
+            return 0
+
+        logger.debug("Wrote task event counts for %s queues", len(rows))
+        return len(rows)
+
+    def start_flusher(self):
+        """Starts the thread which periodically calls :meth:`flush`"""
+        with self.flusher_lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(
+                target=self.flush_periodically, name="pyfarm-task-events")
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def flush_periodically(self):
+        while self.flush_interval:
+            sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:  # pragma: no cover
+                logger.error("Failed to flush task event counts: %s", e)
+
+
+def add_committed_events(session):
+    """Hands the events counted in a committed transaction on"""
+    for accumulator, job_queue_id, events in session.info.pop(
+            SESSION_EVENTS, ()):
+        accumulator.add(job_queue_id, events)
+
+
+def discard_events(session):
+    """Drops the events counted in a transaction which was rolled back"""
+    session.info.pop(SESSION_EVENTS, None)
+
+event.listen(Session, "after_commit", add_committed_events)
+event.listen(Session, "after_rollback", discard_events)
+
+task_events = TaskEventAccumulator(
+    flush_interval=config.get("task_event_flush_interval"))
+atexit.register(task_events.flush)
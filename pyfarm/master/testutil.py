@@ -159,6 +159,15 @@ class BaseTestCase(TestCase):
     def setup_database(self):
         db.create_all()
 
+        # Count task events in the test's own session so they can be
+        # checked right away and never outlive the tables they belong to.
+        from pyfarm.master.taskevents import task_events
+        task_events.pending.clear()
+        task_events.time_start = None
+        self.addCleanup(setattr, task_events, "flush_interval",
+                        task_events.flush_interval)
+        task_events.flush_interval = 0
+
     def teardown_database(self):
         db.session.remove()
         db.drop_all()
@@ -15,24 +15,28 @@
 # limitations under the License.
 
 try:
-    from httplib import BAD_REQUEST
+    from httplib import BAD_REQUEST, NOT_FOUND, SEE_OTHER
 except ImportError:  # pragma: no cover
-    from http.client import BAD_REQUEST
+    from http.client import BAD_REQUEST, NOT_FOUND, SEE_OTHER
 
-from flask import render_template, request
+from flask import render_template, request, redirect, url_for, flash
 
 from sqlalchemy import func, or_, and_, distinct, desc, asc
 
+from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState, AgentState
+from pyfarm.scheduler.tasks import assign_tasks
 
 from pyfarm.master.application import db
-from pyfarm.models.job import Job
+from pyfarm.models.job import Job, rerun_jobs
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.task import Task
 from pyfarm.models.agent import Agent
 from pyfarm.models.user import User
 from pyfarm.models.jobgroup import JobGroup
 
+logger = getLogger("ui.jobgroups")
+
 
 def jobgroups():
     agent_count_query = db.session.query(
@@ -234,3 +238,42 @@ def jobgroups():
                            jobs_by_group=jobs_by_group, filters=filters,
                            order_dir=order_dir, order_by=order_by,
                            users=users_query, jobtypes=jobtypes_query)
+
+
+def rerun_jobs_in_group(group_id, failed_only):
+    jobgroup = JobGroup.query.filter_by(id=group_id).first()
+    if not jobgroup:
+        return (render_template(
+                    "pyfarm/error.html",
+                    error="Job group %s not found" % group_id),
+                NOT_FOUND)
+
+    job_ids = [job_id for job_id, in
+               db.session.query(Job.id).filter_by(job_group_id=group_id)]
+    rerun_jobs(job_ids, failed_only=failed_only)
+    db.session.commit()
+    assign_tasks.delay()
+
+    if failed_only:
+        logger.info("Failed tasks from job group %s (id: %s) are being rerun "
+                    "by request from %s",
+                    jobgroup.title, jobgroup.id, request.remote_addr)
+        flash("Failed tasks in job group %s will be run again." %
+              jobgroup.title)
+    else:
+        logger.info("Job group %s (id: %s) is being rerun by request from %s",
+                    jobgroup.title, jobgroup.id, request.remote_addr)
+        flash("Jobs in job group %s will be run again." % jobgroup.title)
+
+    if "next" in request.args:
+        return redirect(request.args.get("next"), SEE_OTHER)
+    else:
+        return redirect(url_for("jobgroups_index_ui"), SEE_OTHER)
+
+
+def rerun_jobgroup(group_id):
+    return rerun_jobs_in_group(group_id, False)
+
+
+def rerun_failed_in_jobgroup(group_id):
+    return rerun_jobs_in_group(group_id, True)
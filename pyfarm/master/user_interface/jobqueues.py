@@ -104,10 +104,6 @@ def jobqueue_create():
         if request.form["weight"] != "":
             jobqueue.weight = request.form["weight"]
 
-        db.session.add(jobqueue)
-        db.session.flush()
-
-        jobqueue.fullpath = jobqueue.path()
         db.session.add(jobqueue)
         db.session.commit()
 
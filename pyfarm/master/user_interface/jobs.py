@@ -32,7 +32,7 @@ from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState, _WorkState, AgentState
 from pyfarm.scheduler.tasks import delete_job, stop_task, assign_tasks
 from pyfarm.models.job import (
-    Job, JobDependency, JobTagAssociation, JobNotifiedUser)
+    Job, JobDependency, JobTagAssociation, JobNotifiedUser, rerun_jobs)
 from pyfarm.models.tag import Tag, JobTagRequirement
 from pyfarm.models.task import Task
 from pyfarm.models.agent import Agent
@@ -213,16 +213,20 @@ def jobs():
 
     filters["no_queue"] = ("no_queue" in request.args and
                            request.args["no_queue"].lower() == "true")
+    filters["subqueues"] = ("subqueues" in request.args and
+                            request.args["subqueues"].lower() == "true")
     if "q" in request.args or filters["no_queue"]:
         jobqueue_ids = request.args.getlist("q")
         jobqueue_ids = [int(x) for x in jobqueue_ids]
+        filters["q"] = jobqueue_ids
+        if filters["subqueues"]:
+            jobqueue_ids = JobQueue.subtree_ids(jobqueue_ids)
         if filters["no_queue"]:
             jobs_query = jobs_query.filter(or_(
                 Job.job_queue_id.in_(jobqueue_ids),
                 Job.job_queue_id == None))
         else:
             jobs_query = jobs_query.filter(JobQueue.id.in_(jobqueue_ids))
-        filters["q"] = jobqueue_ids
 
     if "p" in request.args:
         priorities = request.args.getlist("p")
@@ -509,16 +513,18 @@ def rerun_single_job(job_id):
 def rerun_multiple_jobs():
     job_ids = request.form.getlist("job_id")
 
+    jobs = Job.query.filter(Job.id.in_(job_ids)).all()
+    found_ids = set(str(job.id) for job in jobs)
     for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
+        if job_id not in found_ids:
             return (render_template(
                         "pyfarm/error.html", error="Job %s not found" % job_id),
                     NOT_FOUND)
-        job.rerun()
+
+    for job in jobs:
         logger.info("Job %s (job id: %s) is being rerun by request from %s",
                     job.title, job.id, request.remote_addr)
-
+    rerun_jobs([job.id for job in jobs])
     db.session.commit()
     assign_tasks.delay()
 
@@ -555,18 +561,20 @@ def rerun_failed_in_job(job_id):
 def rerun_failed_in_multiple_jobs():
     job_ids = request.form.getlist("job_id")
 
+    jobs = Job.query.filter(Job.id.in_(job_ids)).all()
+    found_ids = set(str(job.id) for job in jobs)
     for job_id in job_ids:
-        job = Job.query.filter_by(id=job_id).first()
-        if not job:
+        if job_id not in found_ids:
             return (render_template(
                         "pyfarm/error.html", error="Job %s not found" % job_id),
                     NOT_FOUND)
 
+    for job in jobs:
         logger.info("Failed tasks from job %s (job id: %s) are being rerun by "
                     "request from %s",
                     job.title, job.id, request.remote_addr)
-        job.rerun_failed()
-        db.session.commit()
+    rerun_jobs([job.id for job in jobs], failed_only=True)
+    db.session.commit()
 
     assign_tasks.delay()
 
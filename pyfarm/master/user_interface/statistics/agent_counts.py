@@ -21,15 +21,24 @@ from datetime import timedelta, datetime
 from flask import render_template, request
 
 from pyfarm.models.statistics.agent_count import AgentCount
+from pyfarm.models.statistics.rollups import (
+    AgentCountRollup, choose_resolution, samples_after)
+from pyfarm.master.config import config
 
 
 def agent_counts():
     days_back = int(request.args.get("days_back", 7))
-    time_back = timedelta(days=days_back)
+    points = int(request.args.get(
+        "points", config.get("statistics_chart_points")))
+    time_end = datetime.utcnow()
+    time_start = time_end - timedelta(days=days_back)
 
-    agent_count_query = AgentCount.query.order_by(
-        AgentCount.counted_time).filter(
-            AgentCount.counted_time > datetime.utcnow() - time_back)
+    # Long time ranges are read from the coarsest rollup that still fills
+    # the chart instead of every single sample
+    resolution = choose_resolution(time_start, time_end, points)
+    model = AgentCount if resolution is None else AgentCountRollup
+    agent_count_query = samples_after(
+        model.counted_time, time_start, resolution)
 
     online_agent_counts = []
     running_agent_counts = []
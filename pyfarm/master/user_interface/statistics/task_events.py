@@ -26,6 +26,8 @@ from pyfarm.core.logger import getLogger
 from pyfarm.models.jobqueue import JobQueue
 from pyfarm.models.statistics.task_event_count import TaskEventCount
 from pyfarm.models.statistics.task_count import TaskCount
+from pyfarm.models.statistics.rollups import (
+    TaskCountRollup, TaskEventCountRollup, choose_resolution, samples_after)
 from pyfarm.master.config import config
 from pyfarm.master.application import db
 
@@ -105,15 +107,23 @@ def task_events():
         consolidate_interval = timedelta(minutes=minutes_resolution)
 
     days_back = int(request.args.get("days_back", 7))
-    time_back = timedelta(days=days_back)
-
-    task_event_count_query = TaskEventCount.query.order_by(
-        TaskEventCount.time_start).filter(
-            TaskEventCount.time_start > datetime.utcnow() - time_back)
-
-    task_count_query = TaskCount.query.order_by(
-        TaskCount.counted_time).filter(
-            TaskCount.counted_time > datetime.utcnow() - time_back)
+    time_end = datetime.utcnow()
+    time_start = time_end - timedelta(days=days_back)
+
+    # Read the coarsest rollup which still has at least one bucket for
+    # every point drawn, instead of every single sample
+    points = int((time_end - time_start).total_seconds() /
+                 consolidate_interval.total_seconds())
+    resolution = choose_resolution(time_start, time_end, points)
+    if resolution is None:
+        event_model, count_model = TaskEventCount, TaskCount
+    else:
+        event_model, count_model = TaskEventCountRollup, TaskCountRollup
+
+    task_event_count_query = samples_after(
+        event_model.time_start, time_start, resolution)
+    task_count_query = samples_after(
+        count_model.counted_time, time_start, resolution)
 
     jobqueue_ids = []
     no_queue = ("no_queue" in request.args and
@@ -123,16 +133,16 @@ def task_events():
         jobqueue_ids = [int(x) for x in jobqueue_ids]
         if no_queue:
             task_event_count_query = task_event_count_query.filter(or_(
-                TaskEventCount.job_queue_id.in_(jobqueue_ids),
-                TaskEventCount.job_queue_id == None))
+                event_model.job_queue_id.in_(jobqueue_ids),
+                event_model.job_queue_id == None))
             task_count_query = task_count_query.filter(or_(
-                TaskCount.job_queue_id.in_(jobqueue_ids),
-                TaskCount.job_queue_id == None))
+                count_model.job_queue_id.in_(jobqueue_ids),
+                count_model.job_queue_id == None))
         else:
             task_event_count_query = task_event_count_query.filter(
-                TaskEventCount.job_queue_id.in_(jobqueue_ids))
+                event_model.job_queue_id.in_(jobqueue_ids))
             task_count_query = task_count_query.filter(
-                TaskCount.job_queue_id.in_(jobqueue_ids))
+                count_model.job_queue_id.in_(jobqueue_ids))
 
     tasks_new = []
     tasks_deleted = []
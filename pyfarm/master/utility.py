@@ -22,6 +22,7 @@ General utility which are not view or tool specific
 """
 
 import json
+from hashlib import sha1
 from functools import wraps, partial
 from datetime import datetime
 from decimal import Decimal
@@ -30,10 +31,12 @@ from datetime import timedelta
 
 try:
     from httplib import (
-        responses, BAD_REQUEST, INTERNAL_SERVER_ERROR, UNSUPPORTED_MEDIA_TYPE)
+        responses, OK, NOT_MODIFIED, BAD_REQUEST, INTERNAL_SERVER_ERROR,
+        UNSUPPORTED_MEDIA_TYPE)
 except ImportError:
     from http.client import (
-        responses, BAD_REQUEST, INTERNAL_SERVER_ERROR, UNSUPPORTED_MEDIA_TYPE)
+        responses, OK, NOT_MODIFIED, BAD_REQUEST, INTERNAL_SERVER_ERROR,
+        UNSUPPORTED_MEDIA_TYPE)
 
 try:
     from UserDict import UserDict
@@ -267,6 +270,71 @@ def validate_json(validator, json_types=(dict, )):
     return wrapper
 
 
+def conditional_get(freshness):
+    """
+    Decorator which adds ``ETag`` and ``Last-Modified`` headers to ``GET``
+    and ``HEAD`` responses and answers ``If-None-Match`` or
+    ``If-Modified-Since`` requests with ``304 Not Modified`` without ever
+    calling the decorated view.  Requests using any other method are passed
+    through unchanged so the decorator may be used on individual methods or
+    in :attr:`MethodView.decorators`.
+
+    :param callable freshness:
+        Called with the keyword arguments of the view.  It should cheaply
+        return a tuple of ``(parts, last_modified)`` where ``parts`` is any
+        json serializable object which changes whenever the document
+        would change (typically row versions and update times) and
+        ``last_modified`` is a :class:`datetime` or ``None``.  Returning
+        ``None`` disables conditional handling for this request, which is
+        useful when the requested object does not exist.
+    """
+    def wrapper(func):
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            if (not inside_request() or
+                    request.method not in ("GET", "HEAD")):
+                return func(*args, **kwargs)
+
+            state = freshness(**kwargs)
+            if state is None:
+                return func(*args, **kwargs)
+
+            parts, last_modified = state
+            etag = sha1(
+                dumps([parts, sorted(request.args.items(multi=True))]
+                      ).encode("utf-8")
+            ).hexdigest()
+
+            # HTTP dates don't carry microseconds
+            if last_modified is not None:
+                last_modified = last_modified.replace(microsecond=0)
+
+            # If-None-Match takes precedence over If-Modified-Since when
+            # both are present (RFC 7232, section 6)
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            elif (request.if_modified_since is not None and
+                    last_modified is not None):
+                not_modified = last_modified <= request.if_modified_since
+            else:
+                not_modified = False
+
+            if not_modified:
+                response = current_app.response_class(status=NOT_MODIFIED)
+            else:
+                response = current_app.make_response(func(*args, **kwargs))
+                if response.status_code != OK:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapped
+    return wrapper
+
+
 def validate_with_model(model, type_checks=None, ignore=None,
                         ignore_missing=None, disallow=None):
     """
@@ -532,6 +600,16 @@ def get_request_argument(argument, default=None, required=False, types=None):
         abort(BAD_REQUEST)
 
 
+def parse_datetime(value):
+    """Parses a timestamp as produced by :meth:`datetime.isoformat`"""
+    for format_ in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(value, format_)
+        except ValueError:
+            pass
+    raise ValueError("Cannot parse %r as a datetime" % value)
+
+
 def isuuid(value):
     """
     Returns True if ``value`` is a :class:`UUID` object
@@ -561,3 +639,4 @@ get_ipaddr_argument = partial(
     get_request_argument,
     types=lambda value: Agent.validate_ipv4_address("remote_addr",  value))
 get_uuid_argument = partial(get_request_argument, types=UUID)
+get_datetime_argument = partial(get_request_argument, types=parse_datetime)
@@ -0,0 +1,321 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Write Behind
+============
+
+A buffer for columns which are written far more often than anything else,
+such as agent heartbeats and task progress.  Instead of committing every
+single update, new values are kept in a store and written to the database
+in batches.  While a value is pending it is applied to every instance
+loaded through the ORM so readers always see the newest value.
+
+The buffer is disabled unless ``write_behind_store_url`` is set, in which
+case updates are written through immediately as before.  ``memory://``
+keeps pending values in the current process which is only correct with a
+single master process and no separate scheduler.  A ``redis://`` url
+shares them between all master and scheduler processes.
+"""
+
+import json
+import threading
+from datetime import datetime
+from time import sleep
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+from sqlalchemy import DateTime, bindparam, event
+from sqlalchemy.orm.attributes import set_committed_value
+
+from pyfarm.core.enums import STRING_TYPES
+from pyfarm.core.logger import getLogger
+from pyfarm.models.agent import Agent
+from pyfarm.models.change import record_bulk_updates
+from pyfarm.models.task import Task
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.master.utility import parse_datetime
+
+logger = getLogger("master.writebehind")
+
+
+class MemoryStore(object):
+    """Keeps pending values in a dictionary in the current process"""
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def update(self, name, object_id, fields):
+        with self.lock:
+            self.pending.setdefault((name, object_id), {}).update(fields)
+
+    def get(self, name, object_id):
+        with self.lock:
+            return dict(self.pending.get((name, object_id), {}))
+
+    def discard(self, name, object_id, column):
+        with self.lock:
+            fields = self.pending.get((name, object_id))
+            if fields is not None:
+                fields.pop(column, None)
+                if not fields:
+                    del self.pending[(name, object_id)]
+
+    def take(self):
+        """Removes and returns all pending values"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+
+class RedisStore(object):
+    """
+    Keeps pending values in redis, one hash per object plus a set of the
+    objects which have pending values.
+    """
+    def __init__(self, url, prefix="pyfarm-write-behind"):
+        self.redis = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+        self.dirty = prefix + ":dirty"
+
+    def key(self, name, object_id):
+        return "%s:%s:%s" % (self.prefix, name, object_id)
+
+    def update(self, name, object_id, fields):
+        key = self.key(name, object_id)
+        pipeline = self.redis.pipeline()
+        for column, value in fields.items():
+            pipeline.hset(key, column, json.dumps(value, default=encode))
+        pipeline.sadd(self.dirty, key)
+        pipeline.execute()
+
+    def get(self, name, object_id):
+        return decode_hash(self.redis.hgetall(self.key(name, object_id)))
+
+    def discard(self, name, object_id, column):
+        self.redis.hdel(self.key(name, object_id), column)
+
+    def take(self):
+        pending = {}
+        for key in self.redis.smembers(self.dirty):
+            pipeline = self.redis.pipeline(transaction=True)
+            pipeline.hgetall(key)
+            pipeline.delete(key)
+            pipeline.srem(self.dirty, key)
+            fields = decode_hash(pipeline.execute()[0])
+            if fields:
+                _, name, object_id = key.decode("utf-8").rsplit(":", 2)
+                pending[(name, object_id)] = fields
+        return pending
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def decode_hash(values):
+    return dict(
+        (column.decode("utf-8"), json.loads(value.decode("utf-8")))
+        for column, value in values.items())
+
+
+class WriteBehindBuffer(object):
+    """
+    Buffers writes to the columns registered through :meth:`track`.
+
+    :param str store_url:
+        ``memory://``, the url of a redis server or ``None`` to disable
+        buffering
+
+    :param float flush_interval:
+        How often, in seconds, a background thread writes pending values to
+        the database.  With ``0`` values are only written when
+        :meth:`flush` is called.
+    """
+    def __init__(self, store_url=None, flush_interval=0):
+        self.tracked = {}
+        self.names = {}
+        self.store = None
+        self.flush_interval = 0
+        self._flusher = None
+        self.lock = threading.Lock()
+        self.flusher_lock = threading.Lock()
+        self.configure(store_url, flush_interval)
+
+    @property
+    def enabled(self):
+        return self.store is not None
+
+    def configure(self, store_url, flush_interval=0):
+        """(Re)creates the store pending values are kept in"""
+        self.flush_interval = flush_interval
+        if store_url is None:
+            self.store = None
+        elif store_url == "memory://":
+            self.store = MemoryStore()
+        elif redis is None:  # pragma: no cover
+            logger.error(
+                "`write_behind_store_url` is set but the redis module is not "
+                "installed, updates will be written through immediately")
+            self.store = None
+        else:
+            self.store = RedisStore(store_url)
+
+    def track(self, model, name, columns):
+        """
+        Buffers writes to ``columns`` of ``model`` when they are made
+        through :meth:`set`.  Writes made through the ORM directly still
+        take effect immediately and drop pending values for the column.
+        """
+        self.tracked[model] = (name, tuple(columns))
+        self.names[name] = model
+        event.listen(model, "load", self.apply_pending)
+        event.listen(model, "refresh", self.apply_pending)
+        for column in columns:
+            event.listen(getattr(model, column), "set", self.discard_pending)
+
+    def set(self, instance, **fields):
+        """
+        Sets ``fields`` on ``instance``.  If buffering is enabled the values
+        are written to the store and the instance itself is not marked as
+        modified, otherwise the attributes are simply set.
+        """
+        if not self.enabled or instance.id is None:
+            for column, value in fields.items():
+                setattr(instance, column, value)
+            return
+
+        name, _ = self.tracked[type(instance)]
+        self.store.update(name, str(instance.id), fields)
+        for column, value in fields.items():
+            set_committed_value(instance, column, value)
+
+        if self.flush_interval:
+            self.start_flusher()
+
+    def pending(self, model, object_id):
+        """Returns the values pending for the given object"""
+        if not self.enabled:
+            return {}
+        name, _ = self.tracked[model]
+        return self.decode(model, self.store.get(name, str(object_id)))
+
+    def apply_pending(self, instance, *_):
+        if instance.id is None:
+            return
+        for column, value in self.pending(type(instance), instance.id).items():
+            set_committed_value(instance, column, value)
+
+    def discard_pending(self, instance, value, oldvalue, initiator):
+        if self.enabled and instance.id is not None:
+            name, _ = self.tracked[type(instance)]
+            self.store.discard(name, str(instance.id), initiator.key)
+
+    def decode(self, model, fields):
+        """Converts values which went through json back to their types"""
+        table = model.__table__
+        for column, value in fields.items():
+            if (isinstance(value, STRING_TYPES) and
+                    isinstance(table.c[column].type, DateTime)):
+                fields[column] = parse_datetime(value)
+        return fields
+
+    def flush(self):
+        """
+        Writes all pending values to the database using one batched
+        ``UPDATE`` per model and set of columns.  Returns the number of
+        rows updated.
+        """
+        if not self.enabled:
+            return 0
+
+        with self.lock:
+            pending = self.store.take()
+            if not pending:
+                return 0
+
+            groups = {}
+            for (name, object_id), fields in pending.items():
+                model = self.names[name]
+                fields = self.decode(model, fields)
+                try:
+                    object_id = int(object_id)
+                except ValueError:
+                    pass
+                key = (model, tuple(sorted(fields)))
+                groups.setdefault(key, []).append((object_id, fields))
+
+            try:
+                with db.engine.begin() as connection:
+                    for (model, columns), updates in groups.items():
+                        table = model.__table__
+                        statement = table.update().where(
+                            table.c.id == bindparam("_id")).values(
+                                dict((column, bindparam("_" + column))
+                                     for column in columns))
+                        rows = []
+                        for object_id, fields in updates:
+                            row = {"_id": object_id}
+                            for column, value in fields.items():
+                                row["_" + column] = value
+                            rows.append(row)
+                        connection.execute(statement, rows)
+                        record_bulk_updates(connection, model, updates)
+
+            except Exception as e:
+                logger.error("Failed to write %s buffered updates, will "
+                             "retry: %s", len(pending), e)
+                for (name, object_id), fields in pending.items():
+                    # Don't overwrite values which arrived in the meantime
+                    newer = self.store.get(name, object_id)
+                    fields.update(newer)
+                    self.store.update(name, object_id, fields)
+                return 0
+
+        logger.debug("Wrote %s buffered updates", len(pending))
+        return len(pending)
+
+    def start_flusher(self):
+        """Starts the thread which periodically calls :meth:`flush`"""
+        with self.flusher_lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(
+                target=self.flush_periodically, name="pyfarm-write-behind")
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def flush_periodically(self):
+        while self.flush_interval:
+            sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:  # pragma: no cover
+                logger.error("Failed to flush buffered updates: %s", e)
+
+
+write_behind = WriteBehindBuffer(
+    store_url=config.get("write_behind_store_url"),
+    flush_interval=config.get("write_behind_flush_interval"))
+write_behind.track(Agent, "agent", ("last_heard_from", "free_ram",
+                                    "last_polled"))
+write_behind.track(Task, "task", ("progress",))
@@ -25,7 +25,7 @@ import re
 import uuid
 from datetime import datetime
 
-from sqlalchemy import or_
+from sqlalchemy import or_, event
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.orm import validates
 from netaddr import AddrFormatError, IPAddress
@@ -35,8 +35,10 @@ from pyfarm.core.enums import (
 from pyfarm.master.config import config
 from pyfarm.master.application import db
 from pyfarm.models.core.functions import repr_ip
+from pyfarm.models.change import track_changes
 from pyfarm.models.core.mixins import (
-    ValidatePriorityMixin, UtilityMixins, ReprMixin, ValidateWorkStateMixin)
+    ValidatePriorityMixin, UtilityMixins, ReprMixin, ValidateWorkStateMixin,
+    VersionedMixin)
 from pyfarm.models.core.types import (
     id_column, IPv4Address, IDTypeAgent, IDTypeWork, UseAgentAddressEnum,
     OperatingSystemEnum, AgentStateEnum, MACAddress)
@@ -122,6 +124,7 @@ class AgentTaggingMixin(object):
 class AgentMacAddress(db.Model):
     __tablename__ = config.get("table_agent_mac_address")
     __table_args__ = (UniqueConstraint("agent_id", "mac_address"), )
+    VERSION_PARENTS = ("agent", )
 
     agent_id = db.Column(
         IDTypeAgent,
@@ -133,7 +136,7 @@ class AgentMacAddress(db.Model):
 
 
 class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
-            UtilityMixins, ReprMixin):
+            VersionedMixin, UtilityMixins, ReprMixin):
     """
     Stores information about an agent include its network address,
     state, allocation configuration, etc.
@@ -157,6 +160,8 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         "cpus", "ram", "free_ram")
     REPR_CONVERT_COLUMN = {"remote_ip": repr_ip}
     URL_TEMPLATE = config.get("agent_api_url_template")
+    DICT_CONVERT_COLUMN = dict(
+        VersionedMixin.DICT_CONVERT_COLUMN, inventory_hash=NotImplemented)
 
     MIN_PORT = config.get("agent_min_port")
     MAX_PORT = config.get("agent_max_port")
@@ -277,6 +282,14 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         db.DateTime,
         doc="Time we last tried to contact the agent")
 
+    inventory_hash = db.Column(
+        db.String(40),
+        nullable=True,
+        doc="Hash of the hardware inventory (mac addresses, gpus, disks "
+            "and tags) the agent last reported.  Used to skip updating "
+            "those relationships when nothing changed.  Reset to NULL "
+            "whenever one of the relationships is modified.")
+
     # Max allocation of the two primary resources which `1.0` is 100%
     # allocation.  For `cpu_allocation` 100% allocation typically means
     # one task per cpu.
@@ -516,3 +529,19 @@ class Agent(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     def validate_remote_ip(self, key, value):
         """Validates the remote_ip column"""
         return self.validate_ipv4_address(key, value)
+
+
+track_changes(
+    Agent, "agent",
+    ("state", "hostname", "remote_ip", "port", "ram", "cpus",
+     "restart_requested", "upgrade_to", "version"))
+
+
+def invalidate_inventory_hash(target, value, initiator):
+    target.inventory_hash = None
+
+
+for relationship in (Agent.tags, Agent.gpus, Agent.mac_addresses,
+                     Agent.disks):
+    event.listen(relationship, "append", invalidate_inventory_hash)
+    event.listen(relationship, "remove", invalidate_inventory_hash)
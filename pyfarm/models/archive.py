@@ -0,0 +1,194 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Archive Models
+==============
+
+Models for finished jobs and tasks which have been moved out of the job and
+task tables, see :func:`pyfarm.scheduler.archive_tasks.archive_finished_jobs`.
+Archived jobs and tasks are read only.  Besides a few columns to look them
+up by, they only keep the document the api returned for them at the time
+they were archived.
+
+The archive tables are stored in ``archive_database`` if it is set, so they
+don't reference any of the other tables.
+"""
+
+from json import loads
+
+from sqlalchemy.schema import Index, PrimaryKeyConstraint
+
+from pyfarm.core.enums import STRING_TYPES
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.models.core.types import IDTypeWork, WorkStateEnum
+
+__all__ = ("ArchivedJob", "ArchivedTask", "ArchivedTaskLogAssociation",
+           "find_archived_job")
+
+ARCHIVE_BIND = "archive" if config.get("archive_database") else None
+
+
+class ArchivedDocumentMixin(object):
+    """Stores the api document of an archived job or task"""
+    document = db.Column(
+        db.UnicodeText,
+        nullable=False,
+        doc="The api document of the job or task when it was archived, "
+            "as json")
+
+    def to_document(self):
+        """
+        Returns the stored api document, marked with ``"archived": True``
+        """
+        document = loads(self.document)
+        document["archived"] = True
+        return document
+
+
+class ArchivedJob(db.Model, ArchivedDocumentMixin):
+    """A finished job which has been moved out of the jobs table"""
+    __bind_key__ = ARCHIVE_BIND
+    __tablename__ = config.get("table_archived_job")
+    __table_args__ = (
+        Index("ix_%s_title" % __tablename__, "title"),
+        Index("ix_%s_time_finished" % __tablename__, "time_finished"),
+        Index("ix_%s_delete_after" % __tablename__, "delete_after"))
+
+    # No foreign keys, because these tables may be stored in a separate db
+    id = db.Column(
+        IDTypeWork,
+        primary_key=True, autoincrement=False,
+        doc="The id the job had in the jobs table")
+
+    title = db.Column(
+        db.String(config.get("jobtitle_max_length")),
+        nullable=False,
+        doc="The title of the job.  Unlike active jobs, several archived "
+            "jobs may share a title.")
+
+    state = db.Column(
+        WorkStateEnum,
+        nullable=True,
+        doc="The state the job finished in")
+
+    job_queue_id = db.Column(
+        IDTypeWork,
+        nullable=True,
+        doc="The id of the job queue the job was in")
+
+    job_group_id = db.Column(
+        IDTypeWork,
+        nullable=True,
+        doc="The id of the job group the job belonged to")
+
+    time_finished = db.Column(
+        db.DateTime,
+        nullable=True,
+        doc="The time the job finished")
+
+    time_archived = db.Column(
+        db.DateTime,
+        nullable=False,
+        doc="The time the job was archived")
+
+    autodelete_time = db.Column(
+        db.Integer,
+        nullable=True,
+        doc="If not None, the archived job is deleted this number of "
+            "seconds after it finished, like an active job would be.")
+
+    delete_after = db.Column(
+        db.DateTime,
+        nullable=True,
+        doc="The time after which the archived job is deleted, derived "
+            "from :attr:`time_finished` and :attr:`autodelete_time` when "
+            "it is archived")
+
+
+class ArchivedTask(db.Model, ArchivedDocumentMixin):
+    """A task of an archived job"""
+    __bind_key__ = ARCHIVE_BIND
+    __tablename__ = config.get("table_archived_task")
+    __table_args__ = (
+        Index("ix_%s_job_id_frame" % __tablename__, "job_id", "frame"), )
+
+    id = db.Column(
+        IDTypeWork,
+        primary_key=True, autoincrement=False,
+        doc="The id the task had in the tasks table")
+
+    job_id = db.Column(
+        IDTypeWork,
+        nullable=False,
+        doc="The id of the archived job this task belongs to")
+
+    frame = db.Column(
+        db.Numeric(10, 4),
+        nullable=False,
+        doc="The frame of the task")
+
+    state = db.Column(
+        WorkStateEnum,
+        nullable=True,
+        doc="The state the task finished in")
+
+
+class ArchivedTaskLogAssociation(db.Model):
+    """
+    An association between an archived task and one of its logs.  The
+    logs themselves stay in the task logs table, flagged with
+    :attr:`.TaskLog.archived` so they are not cleaned up as orphans.
+    """
+    __bind_key__ = ARCHIVE_BIND
+    __tablename__ = config.get("table_archived_task_log_assoc")
+    __table_args__ = (
+        PrimaryKeyConstraint("task_log_id", "task_id", "attempt"),
+        Index("ix_%s_task_id" % __tablename__, "task_id"))
+
+    task_log_id = db.Column(
+        db.Integer,
+        doc="The id of the task log")
+
+    task_id = db.Column(
+        IDTypeWork,
+        doc="The id of the archived task")
+
+    attempt = db.Column(
+        db.Integer,
+        autoincrement=False,
+        doc="The attempt number for the given task log")
+
+    state = db.Column(
+        WorkStateEnum,
+        nullable=True,
+        doc="The state of the work being performed")
+
+
+def find_archived_job(job_name):
+    """
+    Returns the archived job with the given id or title or ``None``.  Of
+    several archived jobs sharing a title, the one archived last is
+    returned.
+    """
+    query = ArchivedJob.query
+    if isinstance(job_name, STRING_TYPES):
+        query = query.filter_by(title=job_name).order_by(
+            ArchivedJob.time_archived.desc(), ArchivedJob.id.desc())
+    else:
+        query = query.filter_by(id=job_name)
+    return query.first()
@@ -0,0 +1,321 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Change Model
+============
+
+Model and session hooks recording a monotonically increasing sequence of
+changes to jobs, tasks and agents.  Clients can use this sequence through
+the change feed api to update incrementally instead of rescanning whole
+collections.
+
+Sequence numbers are handed out when a transaction commits rather than when
+its changes are inserted.  Each committing transaction reserves its numbers
+by updating the single row of :class:`ChangeSequence`, which it keeps locked
+until the commit is done.  A transaction which commits later therefore
+always receives larger sequence numbers, so a client which has seen a
+sequence number can never miss a smaller one committed afterwards.
+"""
+
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import event, inspect, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from pyfarm.core.enums import STRING_TYPES
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.models.core.types import JSONDict
+
+__all__ = ("Change", "ChangeSequence", "track_changes",
+           "record_bulk_updates", "record_bulk_deletes")
+
+# Maps model classes to the name they are published under in the
+# change feed and the columns whose new values are included in deltas.
+# Populated by :func:`track_changes`.
+TRACKED_MODELS = {}
+
+# Set in the ``info`` of a connection which inserted changes that still
+# need sequence numbers when its transaction commits
+PENDING_CHANGES = "pyfarm_pending_changes"
+
+
+class Change(db.Model):
+    """
+    A single insert, update or delete of a tracked row.  The ``seq``
+    column is the change sequence number, it is set when the transaction
+    which recorded the change commits.
+    """
+    __tablename__ = config.get("table_change")
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True, autoincrement=True)
+
+    seq = db.Column(
+        db.Integer,
+        nullable=True, unique=True,
+        doc="The sequence number of this change, null until the "
+            "transaction which recorded it commits")
+
+    time = db.Column(
+        db.DateTime,
+        nullable=False, default=datetime.utcnow, index=True,
+        doc="The time this change was recorded")
+
+    type = db.Column(
+        db.String(16),
+        nullable=False,
+        doc="The kind of object which changed, ``job``, ``task`` "
+            "or ``agent``")
+
+    object_id = db.Column(
+        db.String(36),
+        nullable=False,
+        doc="The id of the object which changed")
+
+    action = db.Column(
+        db.String(8),
+        nullable=False,
+        doc="``insert``, ``update`` or ``delete``")
+
+    fields = db.Column(
+        JSONDict,
+        nullable=True,
+        doc="For updates, the new values of the tracked columns "
+            "which changed")
+
+    def to_dict(self):
+        return {
+            "seq": self.seq,
+            "time": self.time.isoformat(),
+            "type": self.type,
+            "id": self.object_id,
+            "action": self.action,
+            "fields": self.fields or {}}
+
+
+class ChangeSequence(db.Model):
+    """
+    Single row table holding the last sequence number handed out to a
+    :class:`Change`.  Updating the row locks it until the end of the
+    transaction which serializes the assignment of sequence numbers in
+    commit order.
+    """
+    __tablename__ = config.get("table_change_sequence")
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    value = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The last sequence number handed out")
+
+    purged = db.Column(
+        db.Integer,
+        nullable=False, default=0,
+        doc="The highest sequence number removed from the change feed. "
+            "Sequence numbers have gaps so clients which have seen less "
+            "than this may have missed changes.")
+
+
+def create_change_sequence(target, connection, **kwargs):
+    """Inserts the single row of :class:`ChangeSequence`"""
+    connection.execute(target.insert(), {"id": 1, "value": 0, "purged": 0})
+
+
+event.listen(ChangeSequence.__table__, "after_create", create_change_sequence)
+
+
+def json_value(value):
+    """Converts a column value into something json can serialize"""
+    if value is None or isinstance(value, (bool, int, float) + STRING_TYPES):
+        return value
+    elif isinstance(value, datetime):
+        return value.isoformat()
+    elif isinstance(value, Decimal):
+        return float(value)
+    else:
+        return str(value)
+
+
+def track_changes(model, name, columns):
+    """
+    Records inserts, updates and deletes of ``model`` in the change feed.
+
+    :param model:
+        The model class to track
+
+    :param str name:
+        The name the model is published under in the change feed
+
+    :param tuple columns:
+        The columns whose new values are included in the deltas for updates.
+        Updates which don't touch any of these columns are not recorded.
+    """
+    TRACKED_MODELS[model] = (name, columns)
+
+
+def record_changes(session, flush_context):
+    """
+    Inserts a :class:`Change` row for every tracked object in the flush
+    being processed.  This runs inside the same transaction as the flush
+    so changes are only visible once the transaction commits.
+    """
+    rows = []
+    now = datetime.utcnow()
+
+    for action, instances in (("insert", session.new),
+                              ("update", session.dirty),
+                              ("delete", session.deleted)):
+        for instance in instances:
+            tracked = TRACKED_MODELS.get(type(instance))
+            if tracked is None:
+                continue
+
+            name, columns = tracked
+            fields = None
+
+            if action == "update":
+                state = inspect(instance)
+                fields = {}
+                for column in columns:
+                    history = state.attrs[column].history
+                    if history.added:
+                        fields[column] = json_value(history.added[0])
+                    elif history.deleted:
+                        fields[column] = None
+
+                if not fields:
+                    continue
+
+            rows.append({
+                "time": now, "type": name,
+                "object_id": str(instance.id),
+                "action": action, "fields": fields})
+
+    if rows:
+        connection = session.connection(mapper=Change.__mapper__)
+        connection.execute(Change.__table__.insert(), rows)
+        connection.info[PENDING_CHANGES] = True
+
+
+event.listen(Session, "after_flush", record_changes)
+
+
+def record_bulk_updates(connection, model, updates):
+    """
+    Inserts :class:`Change` rows for updates which were issued directly
+    against the table of ``model`` and therefore bypassed
+    :func:`record_changes`.
+
+    :param connection:
+        The connection the updates were executed on, so the changes are
+        committed together with them
+
+    :param list updates:
+        ``(object_id, fields)`` tuples with the new column values
+    """
+    tracked = TRACKED_MODELS.get(model)
+    if tracked is None:
+        return
+
+    name, columns = tracked
+    rows = []
+    now = datetime.utcnow()
+    for object_id, fields in updates:
+        fields = dict(
+            (column, json_value(value)) for column, value in fields.items()
+            if column in columns)
+        if fields:
+            rows.append({
+                "time": now, "type": name, "object_id": str(object_id),
+                "action": "update", "fields": fields})
+
+    if rows:
+        connection.execute(Change.__table__.insert(), rows)
+        connection.info[PENDING_CHANGES] = True
+
+
+def record_bulk_deletes(connection, model, object_ids):
+    """
+    Inserts :class:`Change` rows for deletes which were issued directly
+    against the table of ``model`` and therefore bypassed
+    :func:`record_changes`.
+
+    :param connection:
+        The connection the deletes were executed on, so the changes are
+        committed together with them
+
+    :param list object_ids:
+        The ids of the deleted rows
+    """
+    tracked = TRACKED_MODELS.get(model)
+    if tracked is None:
+        return
+
+    name, _ = tracked
+    now = datetime.utcnow()
+    rows = [{"time": now, "type": name, "object_id": str(object_id),
+             "action": "delete", "fields": None}
+            for object_id in object_ids]
+    if rows:
+        connection.execute(Change.__table__.insert(), rows)
+        connection.info[PENDING_CHANGES] = True
+
+
+def assign_sequence_numbers(connection):
+    """
+    Gives the changes inserted by the transaction of ``connection``, which
+    is about to commit, the next sequence numbers in the order they were
+    inserted.
+    """
+    if not connection.info.pop(PENDING_CHANGES, False):
+        return
+
+    # Only changes of this transaction are both visible and unnumbered,
+    # every committed change already has its sequence number
+    table = Change.__table__
+    first_id, last_id = connection.execute(
+        select([func.min(table.c.id), func.max(table.c.id)]).where(
+            table.c.seq == None)).first()
+    if first_id is None:
+        return
+
+    # Ids may have gaps from concurrent transactions, reserving the whole
+    # range keeps the order of the changes without counting them
+    reserved = last_id - first_id + 1
+    sequence = ChangeSequence.__table__
+    connection.execute(
+        sequence.update().where(sequence.c.id == 1).values(
+            value=sequence.c.value + reserved))
+    last_seq = connection.execute(
+        select([sequence.c.value]).where(sequence.c.id == 1)).scalar()
+    connection.execute(
+        table.update().where(table.c.seq == None).values(
+            seq=table.c.id + (last_seq - reserved - first_id + 1)))
+
+
+def discard_sequence_numbers(connection):
+    """Forgets about changes which were rolled back"""
+    connection.info.pop(PENDING_CHANGES, None)
+
+
+event.listen(Engine, "commit", assign_sequence_numbers)
+event.listen(Engine, "rollback", discard_sequence_numbers)
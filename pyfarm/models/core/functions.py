@@ -26,6 +26,11 @@ from uuid import UUID
 from datetime import datetime
 from textwrap import dedent
 
+from sqlalchemy.exc import CompileError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.types import DateTime, Integer
+
 from pyfarm.core.enums import STRING_TYPES
 from pyfarm.master.application import db
 from pyfarm.master.config import config
@@ -192,4 +197,95 @@ def repr_enum(value, enum=None):
             return repr(key)
 
     raise KeyError(
-        "%s does not map to a key in %s" % (repr(value), enum.__class__))
\ No newline at end of file
+        "%s does not map to a key in %s" % (repr(value), enum.__class__))
+
+
+def like_prefix(column, prefix):
+    """
+    SQL expression matching values of ``column`` which start with
+    ``prefix``.  Unlike ``column.startswith(prefix)`` the wildcards ``%``
+    and ``_`` in ``prefix`` are matched literally.
+    """
+    for character in ("\\", "%", "_"):
+        prefix = prefix.replace(character, "\\" + character)
+    return column.like(prefix + "%", escape="\\")
+
+
+class time_bucket(FunctionElement):
+    """
+    SQL expression for the number of the ``seconds`` long interval since
+    the unix epoch that the naive UTC timestamp ``column`` falls into.
+    Grouping by it puts rows into fixed, aligned time buckets.
+    ``time_bucket(column, 1)`` is the timestamp in seconds since the epoch.
+
+    With ``offset`` the intervals are counted from ``offset`` seconds after
+    the epoch instead, ``column`` must not be before that.
+    """
+    type = Integer()
+    name = "time_bucket"
+
+    def __init__(self, column, seconds, offset=0):
+        self.seconds = int(seconds)
+        self.offset = int(offset)
+        super(time_bucket, self).__init__(column)
+
+
+class bucket_time(FunctionElement):
+    """
+    SQL expression for the naive UTC timestamp at which the bucket
+    ``bucket`` of :class:`time_bucket` with the same ``seconds`` begins
+    """
+    type = DateTime()
+    name = "bucket_time"
+
+    def __init__(self, bucket, seconds):
+        self.seconds = int(seconds)
+        super(bucket_time, self).__init__(bucket)
+
+
+@compiles(time_bucket)
+@compiles(bucket_time)
+def compile_time_bucket(element, compiler, **kwargs):
+    raise CompileError(
+        "%s is not supported by %s" % (element.name, compiler.dialect.name))
+
+
+@compiles(time_bucket, "sqlite")
+def compile_time_bucket_sqlite(element, compiler, **kwargs):
+    return "((CAST(strftime('%%s', %s) AS INTEGER) - %d) / %d)" % (
+        compiler.process(element.clauses, **kwargs), element.offset,
+        element.seconds)
+
+
+@compiles(time_bucket, "postgresql")
+def compile_time_bucket_postgresql(element, compiler, **kwargs):
+    return "((CAST(FLOOR(EXTRACT(EPOCH FROM %s)) AS BIGINT) - %d) / %d)" % (
+        compiler.process(element.clauses, **kwargs), element.offset,
+        element.seconds)
+
+
+@compiles(time_bucket, "mysql")
+def compile_time_bucket_mysql(element, compiler, **kwargs):
+    return "((TIMESTAMPDIFF(SECOND, '1970-01-01', %s) - %d) DIV %d)" % (
+        compiler.process(element.clauses, **kwargs), element.offset,
+        element.seconds)
+
+
+@compiles(bucket_time, "sqlite")
+def compile_bucket_time_sqlite(element, compiler, **kwargs):
+    # Matches the format SQLAlchemy stores datetimes in on SQLite, so the
+    # results compare correctly with stored values
+    return "(datetime((%s) * %d, 'unixepoch') || '.000000')" % (
+        compiler.process(element.clauses, **kwargs), element.seconds)
+
+
+@compiles(bucket_time, "postgresql")
+def compile_bucket_time_postgresql(element, compiler, **kwargs):
+    return "(to_timestamp((%s) * %d) AT TIME ZONE 'UTC')" % (
+        compiler.process(element.clauses, **kwargs), element.seconds)
+
+
+@compiles(bucket_time, "mysql")
+def compile_bucket_time_mysql(element, compiler, **kwargs):
+    return "DATE_ADD('1970-01-01', INTERVAL (%s) * %d SECOND)" % (
+        compiler.process(element.clauses, **kwargs), element.seconds)
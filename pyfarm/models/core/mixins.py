@@ -23,13 +23,16 @@ Module containing mixins which can be used by multiple models.
 
 from datetime import datetime
 from collections import namedtuple
+from itertools import chain
 
 try:
     from httplib import INTERNAL_SERVER_ERROR
 except ImportError:
     from http.client import INTERNAL_SERVER_ERROR
 
-from sqlalchemy.orm import validates, class_mapper
+from sqlalchemy import Column, Integer, DateTime, event, literal_column
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import Session, validates, class_mapper
 
 from pyfarm.core.enums import _WorkState, Values, PY2
 from pyfarm.core.logger import getLogger
@@ -114,6 +117,66 @@ class WorkStateChangedMixin(object):
             target.time_finished = datetime.utcnow()
 
 
+class VersionedMixin(object):
+    """
+    Mixin which adds a ``row_version`` counter and a ``time_updated``
+    timestamp to a model.  Both are bumped on every ``UPDATE`` of the row,
+    including bulk updates issued through :meth:`Query.update`, and are
+    what the REST api uses to produce ``ETag`` and ``Last-Modified``
+    headers.
+
+    :const tuple VERSION_PARENTS:
+        Names of many-to-one relationships on *other* models whose
+        target should be considered modified when a row of that model
+        is inserted, updated or deleted.  This is used for child rows,
+        such as disks or notified users, which are rendered as part of
+        the parent's document.
+
+    The columns are excluded from :meth:`UtilityMixins.to_dict` so this
+    mixin must come before :class:`UtilityMixins` in a model's bases.
+    """
+    DICT_CONVERT_COLUMN = {
+        "row_version": NotImplemented,
+        "time_updated": NotImplemented}
+
+    @declared_attr
+    def row_version(cls):
+        return Column(
+            Integer,
+            nullable=False, default=1,
+            onupdate=literal_column("row_version") + 1,
+            doc="Incremented every time this row is updated")
+
+    @declared_attr
+    def time_updated(cls):
+        return Column(
+            DateTime,
+            default=datetime.utcnow, onupdate=datetime.utcnow,
+            doc="The last time this row was inserted or updated")
+
+
+def touch_versioned_rows(session, flush_context, instances):
+    """
+    Ensures that rows using :class:`VersionedMixin` get a new version if
+    only one of their relationships changed, or if one of their child rows
+    listed in ``VERSION_PARENTS`` was added, changed or removed.
+    """
+    now = datetime.utcnow()
+    for instance in chain(session.new, session.dirty, session.deleted):
+        for name in getattr(instance, "VERSION_PARENTS", ()):
+            parent = getattr(instance, name, None)
+            if (isinstance(parent, VersionedMixin) and
+                    parent not in session.deleted):
+                parent.time_updated = now
+
+    for instance in session.dirty:
+        if (isinstance(instance, VersionedMixin) and
+                session.is_modified(instance)):
+            instance.time_updated = now
+
+event.listen(Session, "before_flush", touch_versioned_rows)
+
+
 class UtilityMixins(object):
     """
     Mixins which can be used to produce dictionaries
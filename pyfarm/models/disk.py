@@ -36,6 +36,7 @@ class AgentDisk(db.Model, UtilityMixins, ReprMixin):
     usage information.
     """
     __tablename__ =  config.get("table_agent_disk")
+    VERSION_PARENTS = ("agent", )
 
     id = id_column(db.Integer)
 
@@ -22,7 +22,7 @@ Models and interface classes related to jobs.
 
 """
 
-from datetime import datetime
+from datetime import timedelta
 
 try:
     import pwd
@@ -33,18 +33,20 @@ from sys import maxsize
 
 from sqlalchemy import event, distinct, or_, and_
 from sqlalchemy.orm import validates
+from sqlalchemy.schema import Index
 
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState, DBWorkState, _WorkState, AgentState
 from pyfarm.master.application import db
 from pyfarm.master.config import config
+from pyfarm.master.taskevents import task_events
 from pyfarm.models.core.functions import work_columns
 from pyfarm.models.core.types import JSONDict, IDTypeWork
 
 from pyfarm.models.core.mixins import (
     ValidatePriorityMixin, WorkStateChangedMixin, ReprMixin,
-    ValidateWorkStateMixin, UtilityMixins)
-from pyfarm.models.statistics.task_event_count import TaskEventCount
+    ValidateWorkStateMixin, UtilityMixins, VersionedMixin)
+from pyfarm.models.change import track_changes, record_bulk_updates
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.task import Task
 
@@ -54,10 +56,12 @@ try:
 except NameError:
   range_ = range
 
-__all__ = ("Job", )
+__all__ = ("Job", "rerun_jobs")
 
 logger = getLogger("models.job")
 
+RERUN_BATCH_SIZE = config.get("rerun_batch_size")
+
 
 JobTagAssociation = db.Table(
     config.get("table_job_tag_assoc"),
@@ -100,6 +104,7 @@ class JobNotifiedUser(db.Model):
     events pertaining to jobs.
     """
     __tablename__ = config.get("table_job_notified_users")
+    VERSION_PARENTS = ("job", )
 
     user_id = db.Column(
         db.Integer,
@@ -136,12 +141,24 @@ class JobNotifiedUser(db.Model):
 
 
 class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
-          WorkStateChangedMixin, ReprMixin, UtilityMixins):
+          WorkStateChangedMixin, ReprMixin, VersionedMixin, UtilityMixins):
     """
     Defines the attributes and environment for a job.  Individual commands
     are kept track of by :class:`Task`
     """
     __tablename__ = config.get("table_job")
+    __table_args__ = (
+        # Jobs in a given state per queue, used by the scheduler
+        Index("ix_%s_job_queue_id_state" % __tablename__,
+              "job_queue_id", "state"),
+        # Finished jobs, used when archiving old jobs
+        Index("ix_%s_state_time_finished" % __tablename__,
+              "state", "time_finished"),
+        # Finished jobs, used when deleting old jobs
+        Index("ix_%s_state_delete_after" % __tablename__,
+              "state", "delete_after"))
+    DICT_CONVERT_COLUMN = dict(
+        VersionedMixin.DICT_CONVERT_COLUMN, delete_after=NotImplemented)
     REPR_COLUMNS = ("id", "state", "project")
     REPR_CONVERT_COLUMN = {"state": repr}
     STATE_ENUM = list(WorkState) + [None]
@@ -336,6 +353,15 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         doc="If not None, this job will be automatically deleted this "
             "number of seconds after it finishes.")
 
+    delete_after = db.Column(
+        db.DateTime,
+        nullable=True, default=None,
+        doc="The time after which this job will be deleted automatically.  "
+            "This is derived from :attr:`time_finished` and "
+            ":attr:`autodelete_time` whenever either of them changes, so "
+            "expired jobs can be found with an index instead of computing "
+            "the date for every finished job.")
+
     #
     # Relationships
     #
@@ -407,17 +433,24 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
     def paused(self):
         return self.state == WorkState.PAUSED
 
+    def unfinished_tasks(self):
+        """
+        Returns a query for the tasks of this job which are neither done
+        nor failed
+        """
+        return db.session.query(Task).filter(
+            Task.job == self,
+            or_(Task.state == None, and_(
+                Task.state != WorkState.DONE,
+                Task.state != WorkState.FAILED)))
+
     def update_state(self):
         # Import here instead of at the top of the file to avoid a circular
         # import
         from pyfarm.scheduler.tasks import send_job_completion_mail
         from pyfarm.models.agent import Agent
 
-        num_active_tasks = db.session.query(Task).\
-            filter(Task.job == self,
-                   or_(Task.state == None, and_(
-                            Task.state != WorkState.DONE,
-                            Task.state != WorkState.FAILED))).count()
+        num_active_tasks = self.unfinished_tasks().count()
         if num_active_tasks == 0:
             num_failed_tasks = db.session.query(Task).filter(
                 Task.job == self,
@@ -575,70 +608,21 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
             if self.state != WorkState.RUNNING:
                 self.state = None
 
-        if config.get("enable_statistics"):
-            task_event_count = TaskEventCount(num_new=num_created,
-                                              job_queue_id=self.job_queue_id)
-            task_event_count.time_start = datetime.utcnow()
-            task_event_count.time_end = datetime.utcnow()
-            db.session.add(task_event_count)
+        task_events.count(self.job_queue_id, num_new=num_created)
 
     def rerun(self):
         """
         Makes this job rerun all its task.  Tasks that are currently running are
-        left untouched.
+        left untouched.  See :func:`rerun_jobs`.
         """
-        num_restarted = 0
-        for task in self.tasks:
-            if task.state != _WorkState.RUNNING and task.state is not None:
-                task.state = None
-                task.agent = None
-                task.failures = 0
-                db.session.add(task)
-                num_restarted += 1
-
-        self.completion_notify_sent = False
-        self.update_state()
-        db.session.add(self)
-
-        if config.get("enable_statistics"):
-            task_event_count = TaskEventCount(job_queue_id=self.job_queue_id,
-                                              num_restarted=num_restarted)
-            task_event_count.time_start = datetime.utcnow()
-            task_event_count.time_end = datetime.utcnow()
-            db.session.add(task_event_count)
-            db.session.commit()
-
-        for child in self.children:
-            child.rerun()
+        rerun_jobs([self.id])
 
     def rerun_failed(self):
         """
         Makes this job rerun all its failed tasks.  Tasks that are done or are
-        currently running are left untouched
+        currently running are left untouched.  See :func:`rerun_jobs`.
         """
-        num_restarted = 0
-        for task in self.tasks:
-            if task.state == _WorkState.FAILED:
-                task.state = None
-                task.agent = None
-                task.failures = 0
-                db.session.add(task)
-                num_restarted += 1
-
-        self.completion_notify_sent = False
-        self.update_state()
-        db.session.add(self)
-
-
-        if config.get("enable_statistics"):
-            task_event_count = TaskEventCount(job_queue_id=self.job_queue_id,
-                                              num_restarted=num_restarted)
-            task_event_count.time_start = datetime.utcnow()
-            task_event_count.time_end = datetime.utcnow()
-            db.session.commit()
-
-        for child in self.children:
-            child.rerun_failed()
+        rerun_jobs([self.id], failed_only=True)
 
     @validates("ram", "cpus")
     def validate_resource(self, key, value):
@@ -663,4 +647,102 @@ class Job(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
         if value < 0.0 or value > 1.0:
             raise ValueError("Progress must be between 0.0 and 1.0")
 
+    @staticmethod
+    def time_finished_changed(target, new_value, old_value, initiator):
+        """updates :attr:`delete_after` for the new finishing time"""
+        if new_value is None or target.autodelete_time is None:
+            target.delete_after = None
+        else:
+            target.delete_after = new_value + timedelta(
+                seconds=target.autodelete_time)
+
+    @staticmethod
+    def autodelete_time_changed(target, new_value, old_value, initiator):
+        """updates :attr:`delete_after` for the new autodelete time"""
+        if new_value is None or target.time_finished is None:
+            target.delete_after = None
+        else:
+            target.delete_after = target.time_finished + timedelta(
+                seconds=new_value)
+
 event.listen(Job.state, "set", Job.state_changed)
+event.listen(Job.time_finished, "set", Job.time_finished_changed)
+event.listen(Job.autodelete_time, "set", Job.autodelete_time_changed)
+
+
+def rerun_jobs(job_ids, failed_only=False):
+    """
+    Makes the given jobs and all of their children run again.  Their
+    finished tasks, or only the failed ones if ``failed_only`` is set, are
+    reset with set based updates of ``rerun_batch_size`` tasks each
+    instead of one object at a time.  Tasks which are currently running
+    are left untouched.  Resetting a task only clears its state, agent and
+    failures, none of the :class:`.Task` state listeners apply to that.
+
+    The changes are left uncommitted.  Returns the number of tasks which
+    will be run again.
+    """
+    from pyfarm.master.events import events
+
+    job_ids = set(job_ids)
+    new_job_ids = set(job_ids)
+    while new_job_ids:
+        new_job_ids = set(
+            child_id for child_id, in db.session.query(
+                JobDependency.c.childid).filter(
+                    JobDependency.c.parentid.in_(new_job_ids))) - job_ids
+        job_ids.update(new_job_ids)
+
+    if failed_only:
+        restart = Task.state == WorkState.FAILED
+    else:
+        restart = and_(Task.state != None, Task.state != WorkState.RUNNING)
+
+    num_restarted = {}
+    task_ids = []
+    for task_id, job_id, job_group_id, job_queue_id, progress, attempts in \
+            db.session.query(
+                Task.id, Task.job_id, Job.job_group_id, Job.job_queue_id,
+                Task.progress, Task.attempts).\
+            join(Job, Task.job_id == Job.id).\
+            filter(Task.job_id.in_(job_ids), restart):
+        task_ids.append(task_id)
+        num_restarted[job_queue_id] = num_restarted.get(job_queue_id, 0) + 1
+        events.publish_on_commit(
+            "task", task_id=task_id, job_id=job_id, jobgroup_id=job_group_id,
+            state="queued", progress=progress, agent_id=None,
+            attempts=attempts, failures=0)
+
+    reset = {"state": None, "agent_id": None, "failures": 0}
+    for start in range_(0, len(task_ids), RERUN_BATCH_SIZE):
+        batch = task_ids[start:start + RERUN_BATCH_SIZE]
+        Task.query.filter(Task.id.in_(batch)).update(
+            reset, synchronize_session=False)
+        record_bulk_updates(
+            db.session.connection(mapper=Task.__mapper__), Task,
+            [(task_id, reset) for task_id in batch])
+
+    # The bulk updates bypassed the tasks already loaded into the session
+    for instance in list(db.session.identity_map.values()):
+        if isinstance(instance, Task):
+            db.session.expire(instance)
+
+    for job in Job.query.filter(Job.id.in_(job_ids)):
+        job.completion_notify_sent = False
+        job.update_state()
+        db.session.add(job)
+        events.publish_on_commit(
+            "job", job_id=job.id, jobgroup_id=job.job_group_id,
+            state=str(job.state) if job.state else "queued")
+
+    for job_queue_id, count in num_restarted.items():
+        task_events.count(job_queue_id, num_restarted=count)
+
+    logger.info("Rerunning %s tasks in %s jobs", len(task_ids), len(job_ids))
+    return len(task_ids)
+
+
+track_changes(
+    Job, "job",
+    ("state", "priority", "weight", "title", "job_queue_id", "job_group_id",
+     "time_started", "time_finished", "to_be_deleted", "hidden"))
@@ -26,13 +26,16 @@ from sys import maxsize
 from functools import reduce
 from logging import DEBUG
 
-from sqlalchemy import event, distinct, or_, and_
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy import event, distinct, or_, and_, func, inspect, literal
+from sqlalchemy.orm import aliased, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.schema import Index, UniqueConstraint
 
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState, _WorkState, AgentState
 from pyfarm.master.application import db
 from pyfarm.master.config import config
+from pyfarm.models.core.functions import like_prefix
 from pyfarm.models.core.mixins import UtilityMixins, ReprMixin
 from pyfarm.models.core.types import id_column, IDTypeWork
 from pyfarm.models.agent import Agent
@@ -51,7 +54,9 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
     distribution of computing capacity to jobs.
     """
     __tablename__ = config.get("table_job_queue")
-    __table_args__ = (UniqueConstraint("parent_jobqueue_id", "name"),)
+    __table_args__ = (
+        UniqueConstraint("parent_jobqueue_id", "name"),
+        Index("ix_%s_fullpath" % __tablename__, "fullpath", mysql_length=255))
 
     REPR_COLUMNS = ("id", "name")
 
@@ -103,12 +108,12 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
 
     fullpath = db.Column(
         db.String(config.get("max_queue_path_length")),
-        doc="The path of this jobqueue.  This column is a "
-            "database denormalization.  It is technically "
+        doc="The path of this jobqueue, like `/parent/child`.  This "
+            "column is a database denormalization.  It is technically "
             "redundant, but faster to access than recursively "
-            "querying all parent queues.  If set to NULL, the "
-            "path must be computed by recursively querying "
-            "the parent queues.")
+            "querying all parent queues.  It is set when a queue is "
+            "inserted and updated, for the queue and all queues below "
+            "it, when a queue is renamed or moved.")
 
     #
     # Relationship
@@ -120,19 +125,77 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
         doc="Relationship between this queue its parent")
 
     def path(self):
-        # Import here instead of at the top to break circular dependency
-        from pyfarm.scheduler.tasks import cache_jobqueue_path
-
+        """
+        Returns the path of this queue.  Only queues which were not yet
+        written to the database, or were written before :attr:`fullpath`
+        was maintained, have to query their parent queues for it.
+        """
         if self.fullpath:
             return self.fullpath
         else:
-            cache_jobqueue_path.delay(self.id)
             path = "/%s" % (self.name or "")
             if self.parent:
                 return self.parent.path() + path
             else:
                 return path
 
+    @classmethod
+    def by_path(cls, path):
+        """
+        Returns the queue with the path ``path``, which may be given with or
+        without the leading slash, or ``None`` if there is no such queue
+        """
+        path = "/" + path.strip("/")
+        queue = cls.query.filter_by(fullpath=path).first()
+        if queue is None and cls.has_missing_paths():
+            for name in path.split("/")[1:]:
+                queue = cls.query.filter_by(
+                    parent_jobqueue_id=queue.id if queue else None,
+                    name=name).first()
+                if queue is None:
+                    break
+        return queue
+
+    @classmethod
+    def has_missing_paths(cls):
+        """
+        Returns True if there are queues which were written before
+        :attr:`fullpath` was maintained and are still waiting for
+        :func:`.backfill_jobqueue_paths`.  Those can only be found by
+        walking down the tree of queues.
+        """
+        return db.session.query(cls.id).filter(
+            cls.fullpath == None).first() is not None
+
+    @classmethod
+    def subtree_ids(cls, queue_ids):
+        """
+        Returns a query for the ids of the queues ``queue_ids`` and of all
+        queues below them.  The queues below are found by the prefix of
+        their :attr:`fullpath`, which can use its index, unless some paths
+        are still missing.
+        """
+        queue_ids = list(queue_ids)
+        # Aliased, so the query can be used inside of queries which join
+        # the queues themselves
+        queue = aliased(cls)
+
+        if cls.has_missing_paths():
+            subtree = set(queue_ids)
+            parents = subtree
+            while parents:
+                parents = set(
+                    id_ for id_, in db.session.query(cls.id).filter(
+                        cls.parent_jobqueue_id.in_(parents))) - subtree
+                subtree |= parents
+            return db.session.query(queue.id).filter(queue.id.in_(subtree))
+
+        conditions = [queue.id.in_(queue_ids)]
+        for path, in db.session.query(cls.fullpath).filter(
+                cls.id.in_(queue_ids), cls.fullpath != None):
+            conditions.append(like_prefix(queue.fullpath, path + "/"))
+        return db.session.query(queue.id).filter(or_(*conditions))
+
     def child_queues_sorted(self):
         """
         Return child queues sorted by number of currently assigned agents with
@@ -202,6 +265,25 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
         if self.parent:
             self.parent.clear_assigned_counts()
 
+    def runnable_jobs(self, jobtype_version_ids, ram):
+        """
+        Returns a query for the jobs directly in this queue which are
+        queued or running, whose parents are done, which are of one of the
+        jobtype versions ``jobtype_version_ids`` and need at most ``ram``
+        """
+        # Import down here instead of at the top to avoid circular import
+        from pyfarm.models.job import Job
+
+        return Job.query.filter(or_(Job.state == WorkState.RUNNING,
+                                    Job.state == None),
+                                Job.job_queue_id == self.id,
+                                ~Job.parents.any(or_(
+                                    Job.state == None,
+                                    Job.state != WorkState.DONE)),
+                                Job.jobtype_version_id.in_(
+                                    jobtype_version_ids),
+                                Job.ram <= ram)
+
     def get_job_for_agent(self, agent, unwanted_job_ids=None):
         # Import down here instead of at the top to avoid circular import
         from pyfarm.models.job import Job
@@ -211,15 +293,7 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
             return None
 
         available_ram = agent.ram if USE_TOTAL_RAM else agent.free_ram
-        child_jobs = Job.query.filter(or_(Job.state == WorkState.RUNNING,
-                                          Job.state == None),
-                                      Job.job_queue_id == self.id,
-                                      ~Job.parents.any(or_(
-                                          Job.state == None,
-                                          Job.state != WorkState.DONE)),
-                                      Job.jobtype_version_id.in_(
-                                            supported_types),
-                                      Job.ram <= available_ram).all()
+        child_jobs = self.runnable_jobs(supported_types, available_ram).all()
         child_jobs = [x for x in child_jobs if
                       (agent.satisfies_job_requirements(x) and
                        x.id not in unwanted_job_ids)]
@@ -315,4 +389,65 @@ class JobQueue(db.Model, UtilityMixins, ReprMixin):
                 raise ValueError("Cannot have two jobqueues named %r at the "
                                  "top level" % target.name)
 
+    @staticmethod
+    def parent_path(connection, parent_id):
+        """Returns the path of the queue ``parent_id`` using ``connection``"""
+        table = JobQueue.__table__
+        row = connection.execute(
+            table.select().where(table.c.id == parent_id)).first()
+        if row.fullpath:
+            return row.fullpath
+        elif row.parent_jobqueue_id is None:
+            return "/" + row.name
+        else:
+            return (JobQueue.parent_path(connection, row.parent_jobqueue_id) +
+                    "/" + row.name)
+
+    @staticmethod
+    def set_fullpath(mapper, connection, target):
+        state = inspect(target)
+        if state.has_identity and not any(
+                state.attrs[name].history.has_changes()
+                for name in ("name", "parent_jobqueue_id", "parent")):
+            return
+
+        # A parent inserted in the same flush already has its path
+        parent = target.__dict__.get("parent")
+        if parent is not None and parent.fullpath:
+            path = parent.fullpath
+        elif target.parent_jobqueue_id is not None:
+            path = JobQueue.parent_path(connection, target.parent_jobqueue_id)
+        else:
+            path = ""
+
+        if state.has_identity:
+            target.previous_fullpath = state.committed_state.get(
+                "fullpath", target.fullpath)
+        target.fullpath = path + "/" + target.name
+
+    @staticmethod
+    def update_descendant_paths(mapper, connection, target):
+        previous = target.__dict__.pop("previous_fullpath", None)
+        if not previous or previous == target.fullpath:
+            return
+
+        table = JobQueue.__table__
+        prefix = previous + "/"
+        connection.execute(
+            table.update().where(
+                like_prefix(table.c.fullpath, prefix)).values(
+                    fullpath=literal(target.fullpath) +
+                    func.substr(table.c.fullpath, len(previous) + 1)))
+
+        # Queues which are already loaded would otherwise keep the old path
+        for instance in list(object_session(target).identity_map.values()):
+            if (isinstance(instance, JobQueue) and instance.fullpath and
+                    instance.fullpath.startswith(prefix)):
+                set_committed_value(
+                    instance, "fullpath",
+                    target.fullpath + instance.fullpath[len(previous):])
+
 event.listen(JobQueue, "before_insert", JobQueue.top_level_unique_check)
+event.listen(JobQueue, "before_insert", JobQueue.set_fullpath)
+event.listen(JobQueue, "before_update", JobQueue.set_fullpath)
+event.listen(JobQueue, "after_update", JobQueue.update_descendant_paths)
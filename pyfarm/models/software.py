@@ -121,6 +121,7 @@ class JobSoftwareRequirement(db.Model, UtilityMixins):
     __tablename__ = config.get("table_job_software_req")
     __table_args__ = (
         UniqueConstraint("software_id", "job_id"), )
+    VERSION_PARENTS = ("job", )
 
     id = id_column()
 
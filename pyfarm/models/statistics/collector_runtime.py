@@ -0,0 +1,63 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+CollectorRuntime Model
+======================
+
+Model describing how long one run of a statistics collector took, so the
+cost of gathering statistics can itself be watched
+"""
+
+from datetime import datetime
+
+from sqlalchemy.schema import Index
+
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+
+from pyfarm.models.core.types import id_column
+
+
+class CollectorRuntime(db.Model):
+    __bind_key__ = 'statistics'
+    __tablename__ = config.get("table_statistics_collector_runtime")
+    __table_args__ = (
+        Index("ix_%s_collector_counted_time" % __tablename__,
+              "collector", "counted_time"), )
+
+    id = id_column(db.Integer)
+
+    collector = db.Column(
+        db.String(64),
+        nullable=False,
+        doc="The name of the collector, for example `count_tasks`")
+
+    counted_time = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        doc="The point in time at which the collector ran")
+
+    runtime = db.Column(
+        db.Float,
+        nullable=False,
+        doc="The number of seconds the collector took")
+
+    num_samples = db.Column(
+        db.Integer,
+        nullable=False,
+        doc="The number of samples the collector stored")
@@ -0,0 +1,240 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Ambient Entertainment GmbH & Co. KG
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rollup Models
+=============
+
+Models holding the agent counts, task counts and task event counts rolled
+up into fixed, aligned time buckets of the resolutions configured in
+``statistics_rollups``.  All resolutions of a kind share one table and are
+told apart by :attr:`resolution`, which is the length of the buckets in
+seconds.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy.schema import Index
+
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+
+from pyfarm.models.core.types import id_column
+
+ROLLUPS = [
+    (int(timedelta(**rollup["resolution"]).total_seconds()),
+     timedelta(**rollup["retention"]) if rollup["retention"] else None)
+    for rollup in config.get("statistics_rollups")]
+
+
+def choose_resolution(time_start, time_end, points):
+    """
+    Returns the coarsest rollup resolution, in seconds, which still has
+    at least ``points`` buckets between ``time_start`` and ``time_end`` and
+    whose retention reaches back to ``time_start``.  Returns ``None`` when
+    no rollup is fine enough, in which case the samples themselves should
+    be read.
+
+    :param int points:
+        The number of points the data is drawn with, usually the width of
+        a chart
+    """
+    seconds = (time_end - time_start).total_seconds()
+    now = datetime.utcnow()
+    chosen = None
+    for resolution, retention in sorted(ROLLUPS):
+        if retention is not None and now - retention > time_start:
+            continue
+        if seconds / resolution >= points:
+            chosen = resolution
+    return chosen
+
+
+def samples_after(time_column, time_start, resolution=None):
+    """
+    Returns a query for the samples, in order of ``time_column``, which
+    were taken after ``time_start``.  For a rollup ``resolution`` selects
+    the buckets of that length.
+
+    :param time_column:
+        The time column of the model to query, for instance
+        ``TaskCount.counted_time``
+    """
+    model = time_column.class_
+    query = model.query.order_by(time_column).filter(time_column > time_start)
+    if resolution is not None:
+        query = query.filter(model.resolution == resolution)
+    return query
+
+
+class AgentCountRollup(db.Model):
+    __bind_key__ = 'statistics'
+    __tablename__ = config.get("table_statistics_agent_count_rollup")
+
+    resolution = db.Column(
+        db.Integer,
+        primary_key=True,
+        nullable=False,
+        autoincrement=False,
+        doc="The length of the bucket in seconds")
+
+    counted_time = db.Column(
+        db.DateTime,
+        primary_key=True,
+        nullable=False,
+        autoincrement=False,
+        doc="The point in time at which the bucket begins")
+
+    num_samples = db.Column(
+        db.Integer,
+        nullable=False,
+        doc="The number of :class:`.AgentCount` samples in the bucket")
+
+    num_online = db.Column(
+        db.Float,
+        nullable=False,
+        doc="The average number of agents in state `online`")
+
+    num_running = db.Column(
+        db.Float,
+        nullable=False,
+        doc="The average number of agents in state `running`")
+
+    num_offline = db.Column(
+        db.Float,
+        nullable=False,
+        doc="The average number of agents in state `offline`")
+
+    num_disabled = db.Column(
+        db.Float,
+        nullable=False,
+        doc="The average number of agents in state `disabled`")
+
+
+class TaskCountRollup(db.Model):
+    __bind_key__ = 'statistics'
+    __tablename__ = config.get("table_statistics_task_count_rollup")
+    __table_args__ = (
+        Index("ix_%s_resolution_counted_time" % __tablename__,
+              "resolution", "counted_time"), )
+
+    id = id_column(db.Integer)
+
+    resolution = db.Column(
+        db.Integer,
+        nullable=False,
+        doc="The length of the bucket in seconds")
+
+    counted_time = db.Column(
+        db.DateTime,
+        nullable=False,
+        doc="The point in time at which the bucket begins")
+
+    # No foreign key reference, because this table is stored in a separate db
+    # Code reading it will have to check for referential integrity manually.
+    job_queue_id = db.Column(
+        db.Integer,
+        nullable=True,
+        doc="ID of the jobqueue these stats refer to")
+
+    num_samples = db.Column(
+        db.Integer,
+        nullable=False,
+        doc="The number of :class:`.TaskCount` samples in the bucket")
+
+    total_queued = db.Column(
+        db.Float,
+        nullable=False,
+        doc="Average number of queued tasks")
+
+    total_running = db.Column(
+        db.Float,
+        nullable=False,
+        doc="Average number of running tasks")
+
+    total_done = db.Column(
+        db.Float,
+        nullable=False,
+        doc="Average number of done tasks")
+
+    total_failed = db.Column(
+        db.Float,
+        nullable=False,
+        doc="Average number of failed tasks")
+
+
+class TaskEventCountRollup(db.Model):
+    __bind_key__ = 'statistics'
+    __tablename__ = config.get("table_statistics_task_event_count_rollup")
+    __table_args__ = (
+        Index("ix_%s_resolution_time_start" % __tablename__,
+              "resolution", "time_start"), )
+
+    id = id_column(db.Integer)
+
+    resolution = db.Column(
+        db.Integer,
+        nullable=False,
+        doc="The length of the bucket in seconds")
+
+    time_start = db.Column(
+        db.DateTime,
+        nullable=False,
+        doc="The point in time at which the bucket begins")
+
+    # No foreign key reference, because this table is stored in a separate db
+    # Code reading it will have to check for referential integrity manually.
+    job_queue_id = db.Column(
+        db.Integer,
+        nullable=True,
+        doc="ID of the jobqueue these stats refer to")
+
+    num_new = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        doc="Number of tasks that were newly created during the bucket")
+
+    num_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        doc="Number of tasks that were deleted during the bucket")
+
+    num_restarted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        doc="Number of tasks that were restarted during the bucket")
+
+    num_started = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        doc="Number of tasks that work was started on during the bucket")
+
+    num_failed = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        doc="Number of tasks that failed during the bucket")
+
+    num_done = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        doc="Number of tasks that were finished successfully during the "
+            "bucket")
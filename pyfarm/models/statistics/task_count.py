@@ -24,6 +24,8 @@ point in time
 
 from datetime import datetime
 
+from sqlalchemy.schema import Index
+
 from pyfarm.master.application import db
 from pyfarm.master.config import config
 
@@ -33,6 +35,8 @@ from pyfarm.models.core.types import id_column
 class TaskCount(db.Model):
     __bind_key__ = 'statistics'
     __tablename__ = config.get("table_statistics_task_count")
+    __table_args__ = (
+        Index("ix_%s_counted_time" % __tablename__, "counted_time"), )
 
     id = id_column(db.Integer)
 
@@ -24,6 +24,8 @@ period
 
 from datetime import datetime
 
+from sqlalchemy.schema import Index
+
 from pyfarm.master.application import db
 from pyfarm.master.config import config
 
@@ -33,6 +35,10 @@ from pyfarm.models.core.types import id_column
 class TaskEventCount(db.Model):
     __bind_key__ = 'statistics'
     __tablename__ = config.get("table_statistics_task_event_count")
+    __table_args__ = (
+        Index("ix_%s_job_queue_id_time_start" % __tablename__,
+              "job_queue_id", "time_start"),
+        Index("ix_%s_time_start" % __tablename__, "time_start"))
 
     id = id_column(db.Integer)
 
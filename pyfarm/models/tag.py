@@ -56,6 +56,7 @@ class JobTagRequirement(db.Model, UtilityMixins):
     """
     __tablename__ = config.get("table_job_tag_req")
     __table_args__ = (UniqueConstraint("tag_id", "job_id"), )
+    VERSION_PARENTS = ("job", )
 
     id = id_column()
 
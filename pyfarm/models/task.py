@@ -25,6 +25,7 @@ from functools import partial
 from datetime import datetime
 
 from sqlalchemy import event
+from sqlalchemy.schema import Index
 
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import WorkState, _WorkState
@@ -32,8 +33,10 @@ from pyfarm.master.application import db
 from pyfarm.master.config import config
 from pyfarm.models.core.types import IDTypeAgent, IDTypeWork
 from pyfarm.models.core.functions import work_columns, repr_enum
+from pyfarm.models.change import track_changes
 from pyfarm.models.core.mixins import (
-    ValidatePriorityMixin, UtilityMixins, ReprMixin, ValidateWorkStateMixin)
+    ValidatePriorityMixin, UtilityMixins, ReprMixin, ValidateWorkStateMixin,
+    VersionedMixin)
 
 __all__ = ("Task", )
 
@@ -41,12 +44,17 @@ logger = getLogger("models.task")
 
 
 class Task(db.Model, ValidatePriorityMixin, ValidateWorkStateMixin,
-           UtilityMixins, ReprMixin):
+           VersionedMixin, UtilityMixins, ReprMixin):
     """
     Defines a task which a child of a :class:`Job`.  This table represents
     rows which contain the individual work unit(s) for a job.
     """
     __tablename__ = config.get("table_task")
+    __table_args__ = (
+        # The tasks of a job or agent in a given state, used by the
+        # scheduler and when updating the state of jobs
+        Index("ix_%s_job_id_state" % __tablename__, "job_id", "state"),
+        Index("ix_%s_agent_id_state" % __tablename__, "agent_id", "state"))
     STATE_ENUM = list(WorkState) + [None]
     STATE_DEFAULT = None
     REPR_COLUMNS = ("id", "state", "frame", "project")
@@ -226,3 +234,9 @@ event.listen(Task.agent_id, "set", Task.log_assign_change)
 event.listen(Task.state, "set", Task.reset_agent_if_failed_and_retry,
              retval=True)
 event.listen(Task.time_started, "set", Task.reset_finished_time)
+# Progress is left out on purpose, agents report it far too often for the
+# change feed and clients can fetch it for the tasks they display
+track_changes(
+    Task, "task",
+    ("state", "priority", "agent_id", "attempts", "failures",
+     "last_error", "time_started", "time_finished", "hidden"))
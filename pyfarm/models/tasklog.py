@@ -82,6 +82,10 @@ class TaskLog(db.Model, UtilityMixins, ReprMixin):
     """Table which represents a single task log entry"""
     __tablename__ = config.get("table_task_log")
     __table_args__ = (UniqueConstraint("identifier"),)
+    DICT_CONVERT_COLUMN = dict(
+        UtilityMixins.DICT_CONVERT_COLUMN,
+        size=NotImplemented, tail_only=NotImplemented,
+        archived=NotImplemented)
 
     id = id_column(db.Integer)
 
@@ -101,6 +105,27 @@ class TaskLog(db.Model, UtilityMixins, ReprMixin):
         default=datetime.utcnow,
         doc="The time when this log was created")
 
+    size = db.Column(
+        db.BigInteger,
+        nullable=True,
+        doc="The number of bytes stored for this log, compressed or not.  "
+            "Zero once the log has been evicted, NULL if not known yet.")
+
+    tail_only = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        doc="If True only the last lines of this log have been kept, see "
+            "the ``tasklog_retention`` settings")
+
+    archived = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        doc="If True this log belongs to archived tasks, see "
+            ":mod:`pyfarm.models.archive`.  Archived logs are not cleaned "
+            "up as orphans.")
+
     #
     # Relationships
     #
@@ -0,0 +1,242 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tasks For The Archive
+---------------------
+
+This module contains the celery tasks moving finished jobs out of the job
+and task tables into the archive, see :mod:`pyfarm.models.archive`.  This
+keeps the tables the scheduler and the web UI query bounded by the work in
+flight instead of by the history of the farm.
+"""
+
+from datetime import datetime, timedelta
+from logging import DEBUG
+from time import time
+
+from sqlalchemy import or_
+
+from pyfarm.core.logger import getLogger
+from pyfarm.core.enums import WorkState
+
+from pyfarm.models.archive import (
+    ArchivedJob, ArchivedTask, ArchivedTaskLogAssociation)
+from pyfarm.models.change import record_bulk_deletes
+from pyfarm.models.job import (
+    Job, JobDependency, JobNotifiedUser, JobTagAssociation)
+from pyfarm.models.software import JobSoftwareRequirement
+from pyfarm.models.tag import JobTagRequirement
+from pyfarm.models.task import Task
+from pyfarm.models.tasklog import TaskLog, TaskTaskLogAssociation
+
+from pyfarm.master.api.jobs import job_document, task_document
+from pyfarm.master.config import config
+from pyfarm.master.application import db
+from pyfarm.master.utility import dumps
+
+from pyfarm.scheduler.celery_app import celery_app
+from pyfarm.scheduler.tasks import delete_tasks
+
+try:
+    range_ = xrange  # pylint: disable=undefined-variable
+except NameError:  # pragma: no cover
+    range_ = range
+
+logger = getLogger("pf.scheduler.archive_tasks")
+# TODO Get logger configuration from pyfarm config
+logger.setLevel(DEBUG)
+
+ARCHIVE_JOBS_AFTER = config.get("archive_jobs_after")
+if ARCHIVE_JOBS_AFTER is not None:
+    ARCHIVE_JOBS_AFTER = timedelta(**ARCHIVE_JOBS_AFTER)
+ARCHIVE_BATCH_SIZE = config.get("archive_batch_size")
+FINISHED_STATES = (WorkState.DONE, WorkState.FAILED)
+
+
+def archivable_jobs(cutoff):
+    """
+    Returns a query for the jobs which finished before ``cutoff`` and can
+    be archived.  Jobs with children are kept until their children have
+    been archived, so the documents of the children still list them as
+    parents.
+    """
+    return Job.query.filter(
+        Job.state.in_(FINISHED_STATES),
+        Job.time_finished < cutoff,
+        Job.to_be_deleted == False,
+        ~Job.children.any(),
+        ~Job.tasks.any(or_(Task.state == None,
+                           ~Task.state.in_(FINISHED_STATES))))
+
+
+def delete_archived_jobs(job_ids):
+    """
+    Deletes archived jobs, their tasks and log associations.  Returns the
+    ids of the logs the deleted tasks were associated with.
+    """
+    archived_task_ids = db.session.query(ArchivedTask.id).filter(
+        ArchivedTask.job_id.in_(job_ids))
+    log_ids = set(
+        log_id for log_id, in db.session.query(
+            ArchivedTaskLogAssociation.task_log_id).filter(
+                ArchivedTaskLogAssociation.task_id.in_(archived_task_ids)))
+    ArchivedTaskLogAssociation.query.filter(
+        ArchivedTaskLogAssociation.task_id.in_(archived_task_ids)).delete(
+            synchronize_session=False)
+    ArchivedTask.query.filter(ArchivedTask.job_id.in_(job_ids)).delete(
+        synchronize_session=False)
+    ArchivedJob.query.filter(ArchivedJob.id.in_(job_ids)).delete(
+        synchronize_session=False)
+    return log_ids
+
+
+def delete_jobs(job_ids):
+    """
+    Deletes jobs which no longer have tasks with set based statements,
+    together with the rows referencing them
+    """
+    for model, column in ((JobNotifiedUser, JobNotifiedUser.job_id),
+                          (JobSoftwareRequirement,
+                           JobSoftwareRequirement.job_id),
+                          (JobTagRequirement, JobTagRequirement.job_id)):
+        model.query.filter(column.in_(job_ids)).delete(
+            synchronize_session=False)
+    db.session.execute(JobTagAssociation.delete().where(
+        JobTagAssociation.c.job_id.in_(job_ids)))
+    db.session.execute(JobDependency.delete().where(
+        or_(JobDependency.c.parentid.in_(job_ids),
+            JobDependency.c.childid.in_(job_ids))))
+    Job.query.filter(Job.id.in_(job_ids)).delete(synchronize_session=False)
+    record_bulk_deletes(
+        db.session.connection(mapper=Job.__mapper__), Job, job_ids)
+
+
+def archive_jobs(jobs, now):
+    """
+    Copies ``jobs``, their tasks and the associations of those tasks with
+    their logs into the archive, then deletes them from the active tables.
+    The archive is written first, in its own transaction, so an
+    interruption at worst leaves a copy behind which the next run replaces.
+    """
+    job_ids = [job.id for job in jobs]
+    task_ids = db.session.query(Task.id).filter(Task.job_id.in_(job_ids))
+    tasks = Task.query.filter(Task.job_id.in_(job_ids)).all()
+    task_id_list = [task.id for task in tasks]
+    associations = TaskTaskLogAssociation.query.filter(
+        TaskTaskLogAssociation.task_id.in_(task_ids)).all()
+
+    delete_archived_jobs(job_ids)
+    for job in jobs:
+        # Jobs without tasks can't normally exist, the api rejects them
+        document = job_document(job) or job.to_dict(
+            unpack_relationships=False)
+        delete_after = None
+        if job.time_finished is not None and job.autodelete_time is not None:
+            delete_after = job.time_finished + timedelta(
+                seconds=job.autodelete_time)
+        db.session.add(ArchivedJob(
+            id=job.id, title=job.title, state=job.state,
+            job_queue_id=job.job_queue_id, job_group_id=job.job_group_id,
+            time_finished=job.time_finished, time_archived=now,
+            autodelete_time=job.autodelete_time, delete_after=delete_after,
+            document=dumps(document)))
+    for task in tasks:
+        db.session.add(ArchivedTask(
+            id=task.id, job_id=task.job_id, frame=task.frame,
+            state=task.state, document=dumps(task_document(task))))
+    for association in associations:
+        db.session.add(ArchivedTaskLogAssociation(
+            task_log_id=association.task_log_id,
+            task_id=association.task_id, attempt=association.attempt,
+            state=association.state))
+    db.session.commit()
+
+    TaskLog.query.filter(TaskLog.id.in_(
+        db.session.query(TaskTaskLogAssociation.task_log_id).filter(
+            TaskTaskLogAssociation.task_id.in_(task_ids)))).update(
+                {"archived": True}, synchronize_session=False)
+    for start in range_(0, len(task_id_list), ARCHIVE_BATCH_SIZE):
+        delete_tasks(task_id_list[start:start + ARCHIVE_BATCH_SIZE])
+    delete_jobs(job_ids)
+    db.session.commit()
+
+    # The rows are gone, drop the objects which were loaded for them
+    for instance in jobs + tasks + associations:
+        db.session.expunge(instance)
+
+
+def release_task_logs(log_ids):
+    """
+    Clears :attr:`.TaskLog.archived` of the given logs unless other archived
+    tasks still use them, so the orphaned log cleanup removes them
+    """
+    log_ids = sorted(log_ids)
+    for start in range_(0, len(log_ids), ARCHIVE_BATCH_SIZE):
+        batch = set(log_ids[start:start + ARCHIVE_BATCH_SIZE])
+        batch.difference_update(
+            log_id for log_id, in db.session.query(
+                ArchivedTaskLogAssociation.task_log_id).filter(
+                    ArchivedTaskLogAssociation.task_log_id.in_(batch)))
+        if batch:
+            TaskLog.query.filter(TaskLog.id.in_(batch)).update(
+                {"archived": False}, synchronize_session=False)
+    db.session.commit()
+
+
+def purge_archived_jobs(now):
+    """
+    Deletes the archived jobs which are past their ``autodelete_time``,
+    like :func:`pyfarm.scheduler.tasks.autodelete_old_jobs` does for
+    active jobs.  Returns the number of jobs deleted.
+    """
+    expired = [
+        job_id for job_id, in db.session.query(ArchivedJob.id).filter(
+            ArchivedJob.delete_after < now)]
+
+    for start in range_(0, len(expired), ARCHIVE_BATCH_SIZE):
+        log_ids = delete_archived_jobs(
+            expired[start:start + ARCHIVE_BATCH_SIZE])
+        db.session.commit()
+        release_task_logs(log_ids)
+    return len(expired)
+
+
+@celery_app.task(ignore_results=True)
+def archive_finished_jobs():
+    """
+    Moves the jobs which finished more than ``archive_jobs_after`` ago, with
+    their tasks and log associations, into the archive in batches of
+    ``archive_batch_size`` jobs.  Archived jobs past their
+    ``autodelete_time`` are deleted.
+    """
+    db.session.rollback()
+    started = time()
+    now = datetime.utcnow()
+
+    archived = 0
+    if ARCHIVE_JOBS_AFTER is not None:
+        while True:
+            jobs = archivable_jobs(now - ARCHIVE_JOBS_AFTER).order_by(
+                Job.time_finished, Job.id).limit(ARCHIVE_BATCH_SIZE).all()
+            if not jobs:
+                break
+            archive_jobs(jobs, now)
+            archived += len(jobs)
+
+    purged = purge_archived_jobs(now)
+    logger.info("Archived %s jobs and deleted %s archived jobs in %.2f "
+                "seconds", archived, purged, time() - started)
@@ -34,7 +34,8 @@ from pyfarm.master.config import config
 celery_app = Celery(
     "pyfarm.tasks",
     broker=config.get("scheduler_broker"),
-    include=["pyfarm.scheduler.tasks", "pyfarm.scheduler.statistics_tasks"])
+    include=["pyfarm.scheduler.tasks", "pyfarm.scheduler.statistics_tasks",
+             "pyfarm.scheduler.archive_tasks"])
 
 celery_app.conf.CELERYBEAT_SCHEDULE = {
     "periodically_poll_agents": {
@@ -57,12 +58,35 @@ celery_app.conf.CELERYBEAT_SCHEDULE = {
         "task": "pyfarm.scheduler.tasks.compress_task_logs",
         "schedule": timedelta(**config.get("compress_log_interval"))
     },
+    "periodically_apply_task_log_retention": {
+        "task": "pyfarm.scheduler.tasks.apply_task_log_retention",
+        "schedule": timedelta(**config.get("tasklog_retention_interval"))
+    },
+    "periodically_archive_finished_jobs": {
+        "task": "pyfarm.scheduler.archive_tasks.archive_finished_jobs",
+        "schedule": timedelta(**config.get("archive_interval")),
+    },
     "periodically_execute_deletions": {
         "task": "pyfarm.scheduler.tasks.delete_to_be_deleted_jobs",
         "schedule": timedelta(**config.get("delete_job_interval")),
+    },
+    "periodically_clean_change_feed": {
+        "task": "pyfarm.scheduler.tasks.clean_up_change_feed",
+        "schedule": timedelta(**config.get("change_feed_cleanup_interval")),
+    },
+    "periodically_backfill_jobqueue_paths": {
+        "task": "pyfarm.scheduler.tasks.backfill_jobqueue_paths",
+        "schedule": timedelta(**config.get("jobqueue_backfill_interval")),
     }
 }
 
+if config.get("write_behind_store_url"):
+    celery_app.conf.CELERYBEAT_SCHEDULE["periodically_flush_write_behind"] = {
+        "task": "pyfarm.scheduler.tasks.flush_write_behind",
+        "schedule": timedelta(
+            seconds=config.get("write_behind_flush_interval"))
+        }
+
 if config.get("enable_statistics"):
     celery_app.conf.CELERYBEAT_SCHEDULE["periodically_count_agents"] = {
         "task": "pyfarm.scheduler.statistics_tasks.count_agents",
@@ -80,6 +104,12 @@ if config.get("enable_statistics"):
         "schedule": timedelta(**config.get(
             "task_count_interval"))
         }
+    celery_app.conf.CELERYBEAT_SCHEDULE\
+        ["periodically_rollup_statistics"] = {
+        "task": "pyfarm.scheduler.statistics_tasks.rollup_statistics",
+        "schedule": timedelta(**config.get(
+            "statistics_rollup_interval"))
+        }
 
 if __name__ == '__main__':
     celery_app.start()
@@ -22,19 +22,27 @@ This module contains various celery tasks for gathering runtime statistics
 about the farm.
 """
 
+from calendar import timegm
 from datetime import datetime, timedelta
 from logging import DEBUG
+from time import time
+
+from sqlalchemy import and_, func, literal, or_, select
 
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import AgentState, WorkState
 
 from pyfarm.models.agent import Agent
+from pyfarm.models.core.functions import time_bucket, bucket_time
 from pyfarm.models.jobqueue import JobQueue
 from pyfarm.models.task import Task
 from pyfarm.models.job import Job
 from pyfarm.models.statistics.agent_count import AgentCount
 from pyfarm.models.statistics.task_event_count import TaskEventCount
 from pyfarm.models.statistics.task_count import TaskCount
+from pyfarm.models.statistics.collector_runtime import CollectorRuntime
+from pyfarm.models.statistics.rollups import (
+    ROLLUPS, AgentCountRollup, TaskCountRollup, TaskEventCountRollup)
 
 from pyfarm.master.config import config
 from pyfarm.master.application import db
@@ -45,20 +53,47 @@ logger = getLogger("pf.scheduler.statistics_tasks")
 # TODO Get logger configuration from pyfarm config
 logger.setLevel(DEBUG)
 
+CONSOLIDATE_INTERVAL = timedelta(**config.get(
+    "task_event_count_consolidate_interval"))
+CONSOLIDATE_BATCH_SIZE = config.get("task_event_consolidate_batch_size")
+EVENT_COLUMNS = ("num_new", "num_deleted", "num_restarted", "num_started",
+                 "num_failed", "num_done")
+ALL_QUEUES = object()
+ROLLUP_LOOKBACK = timedelta(**config.get("statistics_rollup_lookback"))
+AGENT_COUNT_COLUMNS = ("num_online", "num_running", "num_offline",
+                       "num_disabled")
+TASK_COUNT_COLUMNS = ("total_queued", "total_running", "total_done",
+                      "total_failed")
+
+
+def record_collector_runtime(collector, counted_time, started, num_samples):
+    """
+    Adds a :class:`.CollectorRuntime` sample for a collector which began
+    at ``started``, as returned by :func:`time.time`
+    """
+    runtime = time() - started
+    db.session.add(CollectorRuntime(collector=collector,
+                                    counted_time=counted_time,
+                                    runtime=runtime,
+                                    num_samples=num_samples))
+    logger.debug("%s stored %s samples in %.3f seconds",
+                 collector, num_samples, runtime)
+
 
 @celery_app.task(ignore_result=True)
 def count_agents():
     logger.debug("Counting known agents now")
-    num_online = Agent.query.filter_by(state=AgentState.ONLINE).count()
-    num_offline = Agent.query.filter_by(state=AgentState.OFFLINE).count()
-    num_running = Agent.query.filter_by(state=AgentState.RUNNING).count()
-    num_disabled = Agent.query.filter_by(state=AgentState.DISABLED).count()
-
-    agent_count = AgentCount(counted_time=datetime.utcnow(),
-                             num_online=num_online,
-                             num_offline=num_offline,
-                             num_running=num_running,
-                             num_disabled=num_disabled)
+    started = time()
+    counted_time = datetime.utcnow()
+
+    counts = dict(db.session.query(Agent.state, func.count(Agent.id)).\
+        group_by(Agent.state))
+
+    agent_count = AgentCount(counted_time=counted_time,
+                             num_online=counts.get(AgentState.ONLINE, 0),
+                             num_offline=counts.get(AgentState.OFFLINE, 0),
+                             num_running=counts.get(AgentState.RUNNING, 0),
+                             num_disabled=counts.get(AgentState.DISABLED, 0))
     logger.info("Counted agents at %s: Online: %s, Offline: %s, Running: %s, "
                 "Disabled: %s",
                 agent_count.counted_time,
@@ -68,119 +103,254 @@ def count_agents():
                 agent_count.num_disabled)
 
     db.session.add(agent_count)
+    record_collector_runtime("count_agents", counted_time, started, 1)
     db.session.commit()
 
+def pending_task_event_buckets(max_id, job_queue_id=ALL_QUEUES):
+    """
+    Returns the buckets of ``task_event_count_consolidate_interval`` which
+    contain task event counts that have not been consolidated yet, as a
+    dictionary of sets of bucket numbers keyed by job queue id.  Only rows
+    up to ``max_id`` and buckets which have already ended are considered.
+    """
+    seconds = int(CONSOLIDATE_INTERVAL.total_seconds())
+    bucket = time_bucket(TaskEventCount.time_start, seconds)
+    current_bucket = timegm(datetime.utcnow().utctimetuple()) // seconds
+
+    query = db.session.query(TaskEventCount.job_queue_id, bucket).filter(
+        TaskEventCount.id <= max_id,
+        bucket < current_bucket,
+        time_bucket(TaskEventCount.time_end, 1) -
+        time_bucket(TaskEventCount.time_start, 1) < seconds).distinct()
+    if job_queue_id is not ALL_QUEUES:
+        query = query.filter(TaskEventCount.job_queue_id == job_queue_id)
+
+    buckets = {}
+    for job_queue_id_, bucket_number in query:
+        buckets.setdefault(job_queue_id_, set()).add(bucket_number)
+    return buckets
+
+
+def consolidate_task_event_buckets(buckets, max_id):
+    """
+    Replaces all task event counts up to ``max_id`` in ``buckets``, as
+    returned by :func:`pending_task_event_buckets`, with one count per
+    queue and bucket.  This is done with a grouped ``INSERT ... SELECT``
+    followed by a ``DELETE`` of the same rows, neither of which load the
+    rows.  Buckets which already hold a consolidated count are merged with
+    it, so running this again after an interruption is harmless.  The
+    changes are left uncommitted.
+    """
+    seconds = int(CONSOLIDATE_INTERVAL.total_seconds())
+    bucket = time_bucket(TaskEventCount.time_start, seconds)
+    selected = and_(
+        TaskEventCount.id <= max_id,
+        or_(*[and_(TaskEventCount.job_queue_id == job_queue_id,
+                   bucket.in_(sorted(bucket_numbers)))
+              for job_queue_id, bucket_numbers in buckets.items()]))
+
+    consolidated = select(
+        [TaskEventCount.job_queue_id,
+         bucket_time(bucket, seconds),
+         bucket_time(bucket + 1, seconds)] +
+        [func.sum(getattr(TaskEventCount, name)) for name in EVENT_COLUMNS]
+        ).where(selected).group_by(TaskEventCount.job_queue_id, bucket)
+    db.session.execute(
+        TaskEventCount.__table__.insert().from_select(
+            ["job_queue_id", "time_start", "time_end"] + list(EVENT_COLUMNS),
+            consolidated),
+        mapper=TaskEventCount.__mapper__)
+    TaskEventCount.query.filter(selected).delete(synchronize_session=False)
+
+
+def consolidate_task_event_counts(job_queue_id=ALL_QUEUES):
+    """
+    Consolidates the task event counts of all queues, or only of
+    ``job_queue_id``, into buckets of
+    ``task_event_count_consolidate_interval``.  Queues are processed in
+    batches of ``task_event_consolidate_batch_size`` with one transaction
+    per batch.
+    """
+    max_id = db.session.query(func.max(TaskEventCount.id)).scalar()
+    if max_id is None:
+        return
+
+    buckets = pending_task_event_buckets(max_id, job_queue_id)
+    job_queue_ids = sorted(buckets, key=lambda id_: (id_ is not None, id_))
+    for start in range(0, len(job_queue_ids), CONSOLIDATE_BATCH_SIZE):
+        batch = job_queue_ids[start:start + CONSOLIDATE_BATCH_SIZE]
+        consolidate_task_event_buckets(
+            dict((id_, buckets[id_]) for id_ in batch), max_id)
+        db.session.commit()
+    logger.debug("Consolidated task events in %s buckets of %s queues",
+                 sum(len(numbers) for numbers in buckets.values()),
+                 len(job_queue_ids))
+
+
 @celery_app.task(ignore_result=True)
 def consolidate_task_events():
     logger.debug("Consolidating task events now")
+    db.session.rollback()
+    consolidate_task_event_counts()
 
-    queues_query = JobQueue.query
-
-    for job_queue in queues_query:
-        consolidate_task_events_for_queue.delay(job_queue.id)
-    consolidate_task_events_for_queue.delay(None)
 
 @celery_app.task(ignore_result=True)
 def count_tasks():
+    """
+    Stores one :class:`.TaskCount` sample per job queue, plus one for the
+    jobs outside of any queue.  All samples come from a single query
+    grouped by queue and task state and are inserted in bulk.
+    """
     logger.debug("Counting tasks in all queues now")
+    started = time()
+    counted_time = datetime.utcnow()
+
+    counts = {}
+    for job_queue_id in [None] + [
+            job_queue_id for job_queue_id, in db.session.query(JobQueue.id)]:
+        counts[job_queue_id] = {}
+    for job_queue_id, state, count in db.session.query(
+            Job.job_queue_id, Task.state, func.count(Task.id)).\
+            select_from(Task).join(Job, Task.job_id == Job.id).\
+            group_by(Job.job_queue_id, Task.state):
+        counts.setdefault(job_queue_id, {})[state] = count
 
-    job_queues_ids = db.session.query(JobQueue.id).all()
-
-    for job_queue_id in job_queues_ids + [None]:
-        task_count = TaskCount(job_queue_id=job_queue_id)
-        task_count.total_queued = Task.query.filter(
-            Task.job.has(Job.job_queue_id == job_queue_id),
-            Task.state == None).count()
-        task_count.total_running = Task.query.filter(
-            Task.job.has(Job.job_queue_id == job_queue_id),
-            Task.state == WorkState.RUNNING).count()
-        task_count.total_done = Task.query.filter(
-            Task.job.has(Job.job_queue_id == job_queue_id),
-            Task.state == WorkState.DONE).count()
-        task_count.total_failed = Task.query.filter(
-            Task.job.has(Job.job_queue_id == job_queue_id),
-            Task.state == WorkState.FAILED).count()
-
-        db.session.add(task_count)
+    samples = []
+    for job_queue_id, queue_counts in counts.items():
+        samples.append({
+            "counted_time": counted_time,
+            "job_queue_id": job_queue_id,
+            "total_queued": queue_counts.get(None, 0),
+            "total_running": queue_counts.get(WorkState.RUNNING, 0),
+            "total_done": queue_counts.get(WorkState.DONE, 0),
+            "total_failed": queue_counts.get(WorkState.FAILED, 0)})
+    if samples:
+        db.session.execute(TaskCount.__table__.insert(), samples,
+                           mapper=TaskCount.__mapper__)
 
+    record_collector_runtime("count_tasks", counted_time, started,
+                             len(samples))
     db.session.commit()
 
 @celery_app.task(ignore_result=True)
 def consolidate_task_events_for_queue(job_queue_id):
     logger.debug("Consolidating task events for queue %s now", job_queue_id)
+    db.session.rollback()
+    consolidate_task_event_counts(job_queue_id)
+
+
+def rebuild_rollups(rollup_model, sample_model, time_name, columns,
+                    averaged, resolution, finer_resolution, now):
+    """
+    Rebuilds the buckets of ``resolution`` seconds in ``rollup_model``
+    which ended before ``now`` and are not older than
+    ``statistics_rollup_lookback`` before the latest bucket, or all of
+    them if there is none yet.  They are built from ``sample_model``, or
+    from the rollups of ``finer_resolution`` when it is not ``None``,
+    using a grouped ``INSERT ... SELECT`` after deleting the old buckets.
+    ``columns`` are averaged, weighted by the number of samples, when
+    ``averaged`` is set and summed otherwise.  Returns the number of
+    buckets rebuilt, the changes are left uncommitted.
+    """
+    if finer_resolution is None:
+        source = sample_model
+        source_filter = []
+    else:
+        source = rollup_model
+        source_filter = [rollup_model.resolution == finer_resolution]
+    source_time = getattr(source, time_name)
+    rollup_time = getattr(rollup_model, time_name)
+
+    latest = db.session.query(func.max(rollup_time)).filter(
+        rollup_model.resolution == resolution).scalar()
+    if latest is None:
+        latest = db.session.query(func.min(source_time)).filter(
+            *source_filter).scalar()
+        if latest is None:
+            return 0
+    else:
+        latest -= ROLLUP_LOOKBACK
+    start = datetime.utcfromtimestamp(
+        timegm(latest.utctimetuple()) // resolution * resolution)
+    end = datetime.utcfromtimestamp(
+        timegm(now.utctimetuple()) // resolution * resolution)
+    if start >= end:
+        return 0
 
-    consolidate_interval = timedelta(**config.get(
-        "task_event_count_consolidate_interval"))
-
-    def add_task_count(consolidation_count, event_count, last_count):
-        consolidation_count.num_new += event_count.num_new
-        consolidation_count.num_deleted += event_count.num_deleted
-        consolidation_count.num_restarted += event_count.num_restarted
-        consolidation_count.num_started += event_count.num_started
-        consolidation_count.num_failed += event_count.num_failed
-        consolidation_count.num_done += event_count.num_done
-
-    event_counts_query = TaskEventCount.query.filter_by(
-        job_queue_id=job_queue_id).order_by(TaskEventCount.time_start)
-
-    last_count = None
-    open_consolidation_count = None
-    for event_count in event_counts_query:
-        # If current count is not consolidated yet
-        if event_count.time_end - event_count.time_start < consolidate_interval:
-            if not open_consolidation_count:
-                open_consolidation_count = TaskEventCount(
-                    job_queue_id=job_queue_id,
-                    num_new=0,
-                    num_deleted=0,
-                    num_restarted=0,
-                    num_started=0,
-                    num_failed=0,
-                    num_done=0)
-                open_consolidation_count.time_start = event_count.time_start
-                open_consolidation_count.time_end = (event_count.time_start +
-                                                     consolidate_interval)
-                add_task_count(open_consolidation_count, event_count,
-                               last_count)
-                db.session.delete(event_count)
-            else:
-                # We know the event count does not fall into the period of the
-                # next already existing consolidated count, because we sorted
-                # the query by time_start, so the other consolidated count
-                # would have come up before this unconsolidated one.
-                while (event_count.time_start >
-                       open_consolidation_count.time_end):
-                    db.session.add(open_consolidation_count)
-                    new_consolidation_count = TaskEventCount(
-                        job_queue_id=job_queue_id,
-                        num_new=0,
-                        num_deleted=0,
-                        num_restarted=0,
-                        num_started=0,
-                        num_failed=0,
-                        num_done=0)
-                    new_consolidation_count.time_start = (
-                        open_consolidation_count.time_end)
-                    new_consolidation_count.time_end = (
-                        new_consolidation_count.time_start +
-                        consolidate_interval)
-                    open_consolidation_count = new_consolidation_count
-                add_task_count(open_consolidation_count, event_count,
-                               last_count)
-                db.session.delete(event_count)
+    bucket = time_bucket(source_time, resolution)
+    group_by = [bucket]
+    insert_columns = ["resolution", time_name]
+    selected = [literal(resolution), bucket_time(bucket, resolution)]
+    if hasattr(sample_model, "job_queue_id"):
+        group_by.append(source.job_queue_id)
+        insert_columns.append("job_queue_id")
+        selected.append(source.job_queue_id)
+    if averaged:
+        insert_columns.append("num_samples")
+        if finer_resolution is None:
+            num_samples = func.count()
+            selected.append(num_samples)
+            selected += [func.avg(getattr(source, name)) for name in columns]
         else:
-            if not open_consolidation_count:
-                open_consolidation_count = event_count
-            else:
-                if event_count.time_start < open_consolidation_count.time_end:
-                    add_task_count(open_consolidation_count, event_count,
-                               last_count)
-                    db.session.delete(event_count)
-                else:
-                    db.session.add(open_consolidation_count)
-                    open_consolidation_count = event_count
-
-    if open_consolidation_count:
-        db.session.add(open_consolidation_count)
+            num_samples = func.sum(source.num_samples)
+            selected.append(num_samples)
+            selected += [
+                func.sum(getattr(source, name) * source.num_samples) /
+                num_samples for name in columns]
+    else:
+        selected += [func.sum(getattr(source, name)) for name in columns]
+    insert_columns += list(columns)
 
-    db.session.commit()
+    rollup_model.query.filter(
+        rollup_model.resolution == resolution,
+        rollup_time >= start,
+        rollup_time < end).delete(synchronize_session=False)
+    result = db.session.execute(
+        rollup_model.__table__.insert().from_select(
+            insert_columns,
+            select(selected).where(
+                and_(source_time >= start, source_time < end,
+                     *source_filter)).group_by(*group_by)),
+        mapper=rollup_model.__mapper__)
+    return result.rowcount
+
+
+def update_rollups(now=None):
+    """
+    Brings the rollups of all resolutions in ``statistics_rollups`` up to
+    date, from the finest to the coarsest, and then deletes those older
+    than their retention.  One transaction is used for each kind of
+    statistic.
+    """
+    now = now or datetime.utcnow()
+    for rollup_model, sample_model, time_name, columns, averaged in (
+            (AgentCountRollup, AgentCount, "counted_time",
+             AGENT_COUNT_COLUMNS, True),
+            (TaskCountRollup, TaskCount, "counted_time",
+             TASK_COUNT_COLUMNS, True),
+            (TaskEventCountRollup, TaskEventCount, "time_start",
+             EVENT_COLUMNS, False)):
+        finer_resolution = None
+        for resolution, retention in sorted(ROLLUPS):
+            num_buckets = rebuild_rollups(
+                rollup_model, sample_model, time_name, columns, averaged,
+                resolution, finer_resolution, now)
+            logger.debug("Rebuilt %s buckets of %s seconds in %s",
+                         num_buckets, resolution, rollup_model.__tablename__)
+            finer_resolution = resolution
+
+        rollup_time = getattr(rollup_model, time_name)
+        for resolution, retention in ROLLUPS:
+            if retention is not None:
+                rollup_model.query.filter(
+                    rollup_model.resolution == resolution,
+                    rollup_time < now - retention).delete(
+                        synchronize_session=False)
+        db.session.commit()
+
+
+@celery_app.task(ignore_result=True)
+def rollup_statistics():
+    logger.debug("Rolling up statistics now")
+    db.session.rollback()
+    update_rollups()
@@ -28,15 +28,16 @@ from json import dumps
 from smtplib import SMTP
 from email.mime.text import MIMEText
 from time import time, sleep
-from os.path import isfile, join
-from os import remove, listdir
-from errno import ENOENT
-from gzip import GzipFile
 from uuid import UUID
+from itertools import islice
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 
-from sqlalchemy import or_, desc
+from sqlalchemy import or_, desc, func, bindparam
 from sqlalchemy.exc import InvalidRequestError
 
+from celery.signals import worker_process_shutdown
+
 import requests
 from requests.exceptions import ConnectionError, Timeout
 # Workaround for https://github.com/kennethreitz/requests/issues/2204
@@ -49,7 +50,6 @@ from lockfile import LockFile, AlreadyLocked
 from pyfarm.core.logger import getLogger
 from pyfarm.core.enums import (
     AgentState, _AgentState, WorkState, _WorkState, UseAgentAddress)
-from pyfarm.models.statistics.task_event_count import TaskEventCount
 from pyfarm.models.software import (
     Software, SoftwareVersion, JobSoftwareRequirement,
     JobTypeSoftwareRequirement)
@@ -61,11 +61,18 @@ from pyfarm.models.jobqueue import JobQueue
 from pyfarm.models.jobtype import JobType, JobTypeVersion
 from pyfarm.models.gpu import GPU
 from pyfarm.models.disk import AgentDisk
-from pyfarm.models.agent import Agent, AgentTagAssociation
+from pyfarm.models.agent import Agent, AgentTagAssociation, FailedTaskInAgent
 from pyfarm.models.user import User, Role
 from pyfarm.models.jobgroup import JobGroup
+from pyfarm.models.change import (
+    Change, ChangeSequence, record_bulk_updates, record_bulk_deletes)
 from pyfarm.master.application import db
+from pyfarm.master.events import events
+from pyfarm.master.logsearch import log_index
+from pyfarm.master.logstorage import split_suffix, storage
 from pyfarm.master.utility import default_json_encoder
+from pyfarm.master.writebehind import write_behind
+from pyfarm.master.taskevents import task_events
 from pyfarm.master.config import config
 
 from pyfarm.scheduler.celery_app import celery_app
@@ -86,10 +93,20 @@ POLL_IDLE_AGENTS_INTERVAL = timedelta(**config.get("poll_idle_agents_interval"))
 POLL_OFFLINE_AGENTS_INTERVAL = \
     timedelta(**config.get("poll_offline_agents_interval"))
 SCHEDULER_LOCKFILE_BASE = config.get("scheduler_lockfile_base")
-LOGFILES_DIR = config.get("tasklogs_dir")
 TRANSACTION_RETRIES = config.get("transaction_retries")
 AGENT_REQUEST_TIMEOUT = config.get("agent_request_timeout")
 BASE_URL = config.get("base_url")
+CHANGE_FEED_RETENTION = timedelta(**config.get("change_feed_retention"))
+CLEANUP_BATCH_SIZE = config.get("orphaned_log_cleanup_batch_size")
+COMPRESSION_CODEC = config.get("tasklog_compression_codec")
+COMPRESSION_LEVEL = config.get("tasklog_compression_level")
+COMPRESSION_WORKERS = config.get("tasklog_compression_workers")
+COMPRESSION_BATCH_SIZE = config.get("tasklog_compression_batch_size")
+TASKLOG_QUOTA = config.get("tasklog_quota")
+RETENTION_BATCH_SIZE = config.get("tasklog_retention_batch_size")
+DELETE_BATCH_SIZE = config.get("delete_job_batch_size")
+BACKFILL_BATCH_SIZE = config.get("autodelete_backfill_batch_size")
+JOBQUEUE_BACKFILL_BATCH_SIZE = config.get("jobqueue_backfill_batch_size")
 
 # Email settings
 SMTP_SERVER = config.get("smtp_server")
@@ -104,6 +121,35 @@ DEFAULT_DELETE_SUBJECT = Template(config.get("deleted_subject"))
 DEFAULT_DELETE_BODY = Template(config.get("deleted_body"))
 OUR_FARM_NAME = config.get("farm_name")
 
+# How long task logs are kept uncompressed (``raw``), then compressed
+# (``compressed``, ``None`` for forever) and how many lines of them are kept
+# after that (``tail_lines``), see ``tasklog_retention``
+RetentionPolicy = namedtuple(
+    "RetentionPolicy", ("raw", "compressed", "tail_lines"))
+
+
+def parse_retention_policy(policy):
+    """
+    Returns the :class:`RetentionPolicy` for a policy from the config,
+    settings it does not set are taken from ``tasklog_retention``
+    """
+    settings = dict(config.get("tasklog_retention"))
+    settings.update(policy or {})
+    compressed = settings.get("compressed")
+    return RetentionPolicy(
+        raw=timedelta(**(settings.get("raw") or {})),
+        compressed=None if compressed is None else timedelta(**compressed),
+        tail_lines=settings.get("tail_lines") or 0)
+
+DEFAULT_RETENTION = parse_retention_policy(None)
+JOBQUEUE_RETENTION = dict(
+    (path.strip("/"), parse_retention_policy(policy)) for path, policy
+    in (config.get("tasklog_retention_jobqueues") or {}).items())
+JOBTYPE_RETENTION = dict(
+    (name, parse_retention_policy(policy)) for name, policy
+    in (config.get("tasklog_retention_jobtypes") or {}).items())
+
+
 def send_email(to, message):
     """
     Configures and instance of :class:`SMTP` and sends a message to the
@@ -431,10 +477,20 @@ def assign_tasks_to_agent(agent_id):
                                             agent.hostname, agent.id, task.id,
                                             task.frame, job.title, job.id)
                                 db.session.add(task)
+                                events.publish_on_commit(
+                                    "task", task_id=task.id, job_id=job.id,
+                                    jobgroup_id=job.job_group_id,
+                                    state="assigned", progress=task.progress,
+                                    agent_id=agent.id, attempts=task.attempts,
+                                    failures=task.failures)
 
                             if job.state != _WorkState.RUNNING:
                                 job.state = WorkState.RUNNING
                                 db.session.add(job)
+                                events.publish_on_commit(
+                                    "job", job_id=job.id,
+                                    jobgroup_id=job.job_group_id,
+                                    state="running")
                             job.clear_assigned_counts()
                             db.session.commit()
                             assigned_job = True
@@ -556,7 +612,7 @@ def poll_agent(self, agent_id):
 
         if ("farm_name" in status_json and
             status_json["farm_name"] != OUR_FARM_NAME):
-            agent.last_polled = datetime.utcnow()
+            write_behind.set(agent, last_polled=datetime.utcnow())
             db.session.add(agent)
             db.session.commit()
             raise ValueError(
@@ -565,7 +621,7 @@ def poll_agent(self, agent_id):
                      OUR_FARM_NAME))
 
         agent.state = status_json["state"]
-        agent.free_ram = status_json["free_ram"]
+        write_behind.set(agent, free_ram=status_json["free_ram"])
 
         tasks_response = requests.get(
             agent.api_url() + "/tasks/",
@@ -590,7 +646,7 @@ def poll_agent(self, agent_id):
                            self.request.retries,
                            self.max_retries,
                            e)
-            agent.last_polled = datetime.utcnow()
+            write_behind.set(agent, last_polled=datetime.utcnow())
             db.session.add(agent)
             db.session.commit()
             self.retry(exc=e)
@@ -598,7 +654,7 @@ def poll_agent(self, agent_id):
             logger.error("Could not contact agent %s, (id %s), marking as "
                          "offline", agent.hostname, agent.id)
             agent.state = AgentState.OFFLINE
-            agent.last_polled = datetime.utcnow()
+            write_behind.set(agent, last_polled=datetime.utcnow())
             tasks_query = Task.query.filter(
                 Task.agent == agent,
                 Task.state == WorkState.RUNNING)
@@ -644,38 +700,42 @@ def poll_agent(self, agent_id):
                     logger.warning("Superfluous task %s not found in db",
                                    task_id)
 
-        agent.last_heard_from = datetime.utcnow()
+        write_behind.set(agent, last_heard_from=datetime.utcnow())
         db.session.add(agent)
         db.session.commit()
 
 
-@celery_app.task(ignore_results=True)
-def poll_agents():
-    db.session.rollback()
-    idle_agents_to_poll_query = Agent.query.filter(
+def agents_to_poll(busy):
+    """
+    Returns a query for the agents which are running tasks, or with
+    ``busy`` false those which are idle, and have not been heard from
+    for longer than ``poll_busy_agents_interval`` or
+    ``poll_idle_agents_interval`` respectively
+    """
+    interval = POLL_BUSY_AGENTS_INTERVAL if busy else POLL_IDLE_AGENTS_INTERVAL
+    has_tasks = Agent.tasks.any(or_(Task.state == None,
+                                    Task.state == WorkState.RUNNING))
+    query = Agent.query.filter(
         Agent.state != AgentState.OFFLINE,
-        Agent.state != AgentState.DISABLED,
         or_(Agent.last_heard_from == None,
-            Agent.last_heard_from +
-                POLL_IDLE_AGENTS_INTERVAL < datetime.utcnow()),
-        ~Agent.tasks.any(or_(Task.state == None,
-                             Task.state == WorkState.RUNNING)),
+            Agent.last_heard_from + interval < datetime.utcnow()),
+        has_tasks if busy else ~has_tasks,
         Agent.use_address != UseAgentAddress.PASSIVE)
+    if not busy:
+        query = query.filter(Agent.state != AgentState.DISABLED)
+    return query
 
-    for agent in idle_agents_to_poll_query:
+
+@celery_app.task(ignore_results=True)
+def poll_agents():
+    db.session.rollback()
+    # The queries below filter on columns which may have buffered updates
+    write_behind.flush()
+    for agent in agents_to_poll(busy=False):
         logger.debug("Polling idle agent %s", agent.hostname)
         poll_agent.delay(agent.id)
 
-    busy_agents_to_poll_query = Agent.query.filter(
-        Agent.state != AgentState.OFFLINE,
-        or_(Agent.last_heard_from == None,
-            Agent.last_heard_from +
-                POLL_BUSY_AGENTS_INTERVAL < datetime.utcnow()),
-        Agent.tasks.any(or_(Task.state == None,
-                            Task.state == WorkState.RUNNING)),
-        Agent.use_address != UseAgentAddress.PASSIVE)
-
-    for agent in busy_agents_to_poll_query:
+    for agent in agents_to_poll(busy=True):
         logger.debug("Polling busy agent %s", agent.hostname)
         poll_agent.delay(agent.id)
 
@@ -919,13 +979,8 @@ def delete_task(self, task_id):
     job.update_state()
     db.session.commit()
 
-    if config.get("enable_statistics"):
-        task_event_count = TaskEventCount(job_queue_id=job.job_queue_id,
-                                          num_deleted=1)
-        task_event_count.time_start = datetime.utcnow()
-        task_event_count.time_end = datetime.utcnow()
-        db.session.add(task_event_count)
-        db.session.commit()
+    task_events.count(job.job_queue_id, num_deleted=1)
+    db.session.commit()
 
     retries = TRANSACTION_RETRIES
     done = False
@@ -967,7 +1022,7 @@ def delete_task(self, task_id):
     if job_deleted and job_group:
         if job_group.jobs.count() == 0:
             logger.info("Job group %s (id %s) has no jobs left, deleting",
-                        job_group.name, job_group.id)
+                        job_group.title, job_group.id)
             db.session.delete(job_group)
             db.session.commit()
 
@@ -1064,155 +1119,531 @@ def delete_to_be_deleted_jobs():
     db.session.commit()
 
 
+def delete_tasks(task_ids):
+    """
+    Deletes tasks with set based statements, together with their log
+    associations and the records of agents they failed on, and publishes
+    their deletion once the transaction commits.  Returns the number of
+    tasks deleted.
+    """
+    if not task_ids:
+        return 0
+    for task_id, job_id, job_group_id in db.session.query(
+            Task.id, Task.job_id, Job.job_group_id).\
+            join(Job, Task.job_id == Job.id).filter(Task.id.in_(task_ids)):
+        events.publish_on_commit(
+            "task", task_id=task_id, job_id=job_id, jobgroup_id=job_group_id,
+            state="deleted")
+    TaskTaskLogAssociation.query.filter(
+        TaskTaskLogAssociation.task_id.in_(task_ids)).delete(
+            synchronize_session=False)
+    db.session.execute(FailedTaskInAgent.delete().where(
+        FailedTaskInAgent.c.task_id.in_(task_ids)))
+    deleted = Task.query.filter(Task.id.in_(task_ids)).delete(
+        synchronize_session=False)
+    record_bulk_deletes(
+        db.session.connection(mapper=Task.__mapper__), Task, task_ids)
+    return deleted
+
+
+def record_deleted_tasks(job_queue_id, num_deleted):
+    """Records the deletion of ``num_deleted`` tasks in the statistics"""
+    if not num_deleted:
+        return
+    task_events.count(job_queue_id, num_deleted=num_deleted)
+    db.session.commit()
+
+
+def finalize_deleted_job(job_id):
+    """
+    Deletes a job which is marked for deletion and has no tasks left,
+    notifies its users and deletes its job group if it has no jobs left.
+    Returns True if the job was deleted.
+    """
+    job = Job.query.filter_by(id=job_id).first()
+    if job is None or not job.to_be_deleted:
+        return False
+    if db.session.query(Task.query.filter_by(job=job).exists()).scalar():
+        return False
+
+    logger.info("Job %s (%s) is marked for deletion and has no tasks left, "
+                "deleting it from the database now.", job.id, job.title)
+    job_group = job.group
+    notified_users = JobNotifiedUser.query.filter(
+        JobNotifiedUser.job == job,
+        JobNotifiedUser.on_deletion == True).all()
+    to = [x.user.email for x in notified_users if x.user.email]
+    send_job_deletion_mail.delay(job.id, job.jobtype_version.jobtype.name,
+                                 job.title, to)
+    events.publish_on_commit(
+        "job", job_id=job.id, jobgroup_id=job.job_group_id, state="deleted")
+    db.session.delete(job)
+    db.session.commit()
+
+    if job_group and job_group.jobs.count() == 0:
+        logger.info("Job group %s (id %s) has no jobs left, deleting",
+                    job_group.title, job_group.id)
+        db.session.delete(job_group)
+        db.session.commit()
+    return True
+
+
 @celery_app.task(ignore_results=True)
 def delete_job(job_id):
+    """
+    Deletes a job which is marked for deletion.  Its tasks which are not
+    running on an agent are deleted right away, in set based batches of
+    ``delete_job_batch_size``.  The running tasks are handed to
+    :func:`delete_tasks_on_agent`, one celery task per agent, and the job
+    itself is deleted once no tasks are left.
+    """
     db.session.rollback()
     job = Job.query.filter_by(id=job_id).one()
     if not job.to_be_deleted:
         logger.warning("Not deleting job %s, it is not marked for deletion.",
                        job.id)
         return
+    job_queue_id = job.job_queue_id
 
-    job_group = job.group
-
-    tasks_query = Task.query.filter_by(job=job)
-    async_deletes = 0
+    unfinished = or_(Task.state == None,
+                     ~Task.state.in_([WorkState.DONE, WorkState.FAILED]))
     immediate_deletes = 0
-    for task in tasks_query:
-        if task.agent and task.state not in [_WorkState.DONE, _WorkState.FAILED]:
-            delete_task.delay(task.id)
-            async_deletes += 1
-        else:
-            db.session.delete(task)
-            immediate_deletes += 1
-
-    if async_deletes == 0:
-        logger.info("Job %s (%s) is marked for deletion and has no tasks "
-                    "that require asynchronous deletion. Deleting it now.",
-                    job.id, job.title)
-        # Notify users about deletion
-        notified_users = JobNotifiedUser.query.filter(
-            JobNotifiedUser.job == job,
-            JobNotifiedUser.on_deletion == True).all()
-        to = [x.user.email for x in notified_users if x.user.email]
-        send_job_deletion_mail.delay(job.id, job.jobtype_version.jobtype.name,
-                                     job.title, to)
-        db.session.delete(job)
+    while True:
+        task_ids = [
+            task_id for task_id, in db.session.query(Task.id).filter(
+                Task.job_id == job_id,
+                or_(Task.agent_id == None, ~unfinished)).\
+            limit(DELETE_BATCH_SIZE)]
+        if not task_ids:
+            break
+        immediate_deletes += delete_tasks(task_ids)
+        db.session.commit()
+    record_deleted_tasks(job_queue_id, immediate_deletes)
 
-    db.session.commit()
+    # Only the tasks which are left, tasks which finished in the meantime
+    # have been deleted above already
+    tasks_on_agents = {}
+    for task_id, agent_id in db.session.query(Task.id, Task.agent_id).filter(
+            Task.job_id == job_id):
+        tasks_on_agents.setdefault(agent_id, []).append(task_id)
 
-    if async_deletes == 0 and job_group:
-        if job_group.jobs.count() == 0:
-            logger.info("Job group %s (id %s) has no jobs left, deleting",
-                        job_group.name, job_group.id)
-            db.session.delete(job_group)
-            db.session.commit()
+    async_deletes = sum(len(task_ids) for task_ids in tasks_on_agents.values())
+    logger.info("Deleted %s tasks of job %s, %s tasks on %s agents are "
+                "deleted asynchronously", immediate_deletes, job_id,
+                async_deletes, len(tasks_on_agents))
+
+    for agent_id, task_ids in tasks_on_agents.items():
+        delete_tasks_on_agent.delay(agent_id, job_id, task_ids)
+
+    if not tasks_on_agents:
+        finalize_deleted_job(job_id)
+
+
+@celery_app.task(ignore_results=True, bind=True)
+def delete_tasks_on_agent(self, agent_id, job_id, task_ids):
+    """
+    Asks an agent to stop tasks of a job which is being deleted, over a
+    single connection, then deletes the tasks it stopped.  The tasks the
+    agent could not stop are retried, once the retries are used up the
+    agent is marked offline and they are deleted anyway.  The job is
+    deleted afterwards if this was the last agent still running tasks of
+    it.
+    """
+    db.session.rollback()
+    agent = Agent.query.filter_by(id=agent_id).first()
+    hostname = agent.hostname if agent is not None else None
+    job_queue_id = db.session.query(Job.job_queue_id).filter(
+        Job.id == job_id).scalar()
+
+    stopped = []
+    not_stopped = []
+    error = None
+    if agent is None:
+        stopped = list(task_ids)
+    else:
+        session = requests.Session()
+        agent_url = agent.api_url()
+        for task_id in task_ids:
+            try:
+                response = session.delete(
+                    "%s/tasks/%s" % (agent_url, task_id),
+                    headers={"User-Agent": USERAGENT},
+                    timeout=AGENT_REQUEST_TIMEOUT)
+            # Catching ProtocolError here is a work around for
+            # https://github.com/kennethreitz/requests/issues/2204
+            except (ConnectionError, ProtocolError, Timeout) as e:
+                logger.warning("Caught %s while trying to stop task %s on "
+                               "agent %s (id %s): %s", type(e).__name__,
+                               task_id, hostname, agent_id, e)
+                not_stopped.append(task_id)
+                error = e
+                continue
+
+            if response.status_code not in [requests.codes.accepted,
+                                            requests.codes.ok,
+                                            requests.codes.no_content,
+                                            requests.codes.not_found]:
+                logger.error("Unexpected return code on stopping task %s on "
+                             "agent %s (id %s): %s", task_id, hostname,
+                             agent_id, response.status_code)
+                not_stopped.append(task_id)
+                error = ValueError("Unexpected return code %s" %
+                                   response.status_code)
+                continue
+            stopped.append(task_id)
+
+    if not_stopped and self.request.retries >= self.max_retries:
+        logger.error("Could not stop %s tasks of job %s on agent %s (id %s), "
+                     "marking it as offline and deleting them anyway",
+                     len(not_stopped), job_id, hostname, agent_id)
+        agent.state = AgentState.OFFLINE
+        db.session.add(agent)
+        stopped.extend(not_stopped)
+        not_stopped = []
 
-    if immediate_deletes and config.get("enable_statistics"):
-        task_event_count = TaskEventCount(job_queue_id=job.job_queue_id,
-                                          num_deleted=immediate_deletes)
-        task_event_count.time_start = datetime.utcnow()
-        task_event_count.time_end = datetime.utcnow()
-        db.session.add(task_event_count)
+    deleted = 0
+    for start in range_(0, len(stopped), DELETE_BATCH_SIZE):
+        deleted += delete_tasks(stopped[start:start + DELETE_BATCH_SIZE])
         db.session.commit()
+    record_deleted_tasks(job_queue_id, deleted)
+    logger.info("Stopped and deleted %s tasks of job %s on agent %s (id %s)",
+                len(stopped), job_id, hostname, agent_id)
+
+    if not_stopped:
+        logger.warning("Could not stop %s tasks of job %s on agent %s "
+                       "(id %s), retry %s of %s", len(not_stopped), job_id,
+                       hostname, agent_id, self.request.retries,
+                       self.max_retries)
+        self.retry(args=(agent_id, job_id, not_stopped), exc=error)
+
+    finalize_deleted_job(job_id)
 
 
 @celery_app.task(ignore_results=True)
 def clean_up_orphaned_task_logs():
+    """
+    Removes task logs which no longer belong to any task, active or
+    archived, and stored log files without a task log.  Both are done in batches of
+    ``orphaned_log_cleanup_batch_size``, with one query per batch.
+    """
     db.session.rollback()
+    started = time()
+
+    removed_logs = 0
+    while True:
+        orphaned_ids = [
+            log_id for log_id, in db.session.query(TaskLog.id).filter(
+                ~TaskLog.task_associations.any(),
+                TaskLog.archived == False).limit(CLEANUP_BATCH_SIZE)]
+        if not orphaned_ids:
+            break
+        TaskLog.query.filter(TaskLog.id.in_(orphaned_ids)).delete(
+            synchronize_session=False)
+        db.session.commit()
+        log_index.remove(orphaned_ids)
+        removed_logs += len(orphaned_ids)
+    logger.info("Removed %s orphaned task logs in %.2f seconds",
+                removed_logs, time() - started)
+
+    scan_started = time()
+    scanned = removed_files = 0
+    names = storage.names()
+    while True:
+        batch = list(islice(names, CLEANUP_BATCH_SIZE))
+        if not batch:
+            break
+        scanned += len(batch)
+        identifiers = set(split_suffix(name)[0] for name in batch)
+
+        known = set(
+            identifier for identifier, in db.session.query(
+                TaskLog.identifier).filter(
+                    TaskLog.identifier.in_(identifiers)))
+        db.session.rollback()
+        for identifier in sorted(identifiers - known):
+            logger.debug("Deleting log file %s", identifier)
+            try:
+                storage.delete(identifier)
+            except ValueError:
+                logger.warning("Not deleting log file %r, its name is not "
+                               "acceptable", identifier)
+                continue
+            removed_files += 1
+
+        logger.info("Scanned %s stored log files, deleted %s orphaned logs, "
+                    "%.0f files per second", scanned, removed_files,
+                    scanned / max(time() - scan_started, 0.001))
+
+    logger.info("Finished cleaning up task logs in %.2f seconds: removed %s "
+                "orphaned task logs and %s orphaned log files out of %s "
+                "stored files", time() - started, removed_logs, removed_files,
+                scanned)
+
+
+def backfill_delete_after():
+    """
+    Sets :attr:`.Job.delete_after` for finished jobs with an autodelete
+    time which don't have it yet, such as jobs which finished before the
+    column existed.  Works through the jobs in batches of
+    ``autodelete_backfill_batch_size`` and returns their number.
+    """
+    table = Job.__table__
+    statement = table.update().where(table.c.id == bindparam("_id")).values(
+        delete_after=bindparam("_delete_after"))
+    backfilled = 0
+    last_id = 0
+
+    while True:
+        rows = db.session.query(
+            Job.id, Job.time_finished, Job.autodelete_time).filter(
+                Job.state == WorkState.DONE,
+                Job.delete_after == None,
+                Job.autodelete_time != None,
+                Job.time_finished != None,
+                Job.id > last_id).order_by(Job.id).\
+            limit(BACKFILL_BATCH_SIZE).all()
+        if not rows:
+            break
+
+        db.session.execute(statement, [
+            {"_id": job_id,
+             "_delete_after":
+                 time_finished + timedelta(seconds=autodelete_time)}
+            for job_id, time_finished, autodelete_time in rows])
+        db.session.commit()
+        last_id = rows[-1][0]
+        backfilled += len(rows)
 
-    orphaned_task_logs = TaskLog.query.filter(
-        ~TaskLog.task_associations.any()).all()
-    for log in orphaned_task_logs:
-        logger.info("Removing orphaned task log %s" % log.identifier)
-        db.session.delete(log)
-    db.session.commit()
+    if backfilled:
+        logger.info("Set the autodelete time of %s finished jobs", backfilled)
+    return backfilled
 
-    try:
-        tasklog_files = [f for f in listdir(LOGFILES_DIR)\
-                         if isfile(join(LOGFILES_DIR, f))]
-
-        for filepath in tasklog_files:
-            uncompressed_name = filepath
-            if filepath.endswith(".gz"):
-                uncompressed_name = filepath[0:-3]
-            referencing_count = TaskLog.query.filter(
-                or_(TaskLog.identifier == filepath,
-                    TaskLog.identifier == uncompressed_name)).count()
-            if not referencing_count:
-                logger.info("Deleting log file %s", join(LOGFILES_DIR, filepath))
-                try:
-                    remove(join(LOGFILES_DIR, filepath))
-                except OSError as e:
-                    if e.errno != ENOENT:
-                        raise
-    except OSError as e:
-        if e.errno != ENOENT:
-            raise
-        logger.warning("Log directory %r does not exist", LOGFILES_DIR)
+
+def expired_jobs(*columns):
+    """
+    Returns a query for ``columns`` of the jobs which are done, past their
+    :attr:`.Job.delete_after` time and not yet marked for deletion
+    """
+    return db.session.query(*columns).filter(
+        Job.state == WorkState.DONE,
+        Job.delete_after < datetime.utcnow(),
+        Job.to_be_deleted == False)
 
 
 @celery_app.task(ignore_results=True)
 def autodelete_old_jobs():
+    """
+    Marks the jobs which are done and past their :attr:`.Job.delete_after`
+    time for deletion with a single update and queues their deletion.
+    Jobs already marked for deletion are left to
+    :func:`delete_to_be_deleted_jobs`.
+    """
     db.session.rollback()
+    backfill_delete_after()
 
-    finished_jobs_query = Job.query.filter(
-        Job.state != None,
-        Job.state == WorkState.DONE,
-        Job.time_finished != None,
-        Job.autodelete_time != None)
-
-    job_ids_to_delete = []
-    for job in finished_jobs_query:
-        # I haven't figured out yet how to do this test as part of the filter
-        if (job.time_finished + timedelta(seconds=job.autodelete_time) <
-            datetime.utcnow()):
-            logger.info("Deleting job %s (id %s). It was finished on %s UTC, "
-                        "which is more than %s ago", job.title, job.id,
-                        job.time_finished,
-                        timedelta(seconds=job.autodelete_time))
-            job.to_be_deleted = True
-            db.session.add(job)
-            job_ids_to_delete.append(job.id)
+    job_ids_to_delete = [job_id for job_id, in expired_jobs(Job.id)]
+    if not job_ids_to_delete:
+        return
 
+    Job.query.filter(Job.id.in_(job_ids_to_delete)).update(
+        {"to_be_deleted": True}, synchronize_session=False)
+    record_bulk_updates(
+        db.session.connection(mapper=Job.__mapper__), Job,
+        [(job_id, {"to_be_deleted": True}) for job_id in job_ids_to_delete])
     db.session.commit()
+    logger.info("Deleting %s jobs which were finished longer than their "
+                "autodelete time ago", len(job_ids_to_delete))
 
     for job_id in job_ids_to_delete:
         delete_job.delay(job_id)
 
 
 @celery_app.task(ignore_results=True)
-def compress_task_logs():
+def clean_up_change_feed():
+    """
+    Deletes entries from the change feed which are older than
+    ``change_feed_retention``.  Clients asking for changes which have been
+    removed receive a 410 and have to refetch the collections they follow.
+    """
     db.session.rollback()
+    cutoff = datetime.utcnow() - CHANGE_FEED_RETENTION
+    purged = db.session.query(func.max(Change.seq)).filter(
+        Change.time < cutoff).scalar()
+    if purged is None:
+        return
 
-    try:
-        uncompressed_tasklogs = [f for f in listdir(LOGFILES_DIR)\
-                                 if (isfile(join(LOGFILES_DIR, f)) and
-                                     not f.endswith(".gz"))]
-
-        for tasklog in uncompressed_tasklogs:
-            compress_task_log.delay(tasklog)
-    except OSError as e:
-        if e.errno != ENOENT:
-            raise
-        logger.warning("Log directory %r does not exist", LOGFILES_DIR)
+    # Changes are numbered when they commit, not when they are recorded, so
+    # delete by sequence number to never leave holes below the watermark
+    deleted = Change.query.filter(Change.seq <= purged).delete(
+        synchronize_session=False)
+    ChangeSequence.query.filter(
+        ChangeSequence.id == 1, ChangeSequence.purged < purged).update(
+        {"purged": purged}, synchronize_session=False)
+    db.session.commit()
+    logger.debug("Deleted %s change feed entries older than %s",
+                 deleted, cutoff)
 
 
 @celery_app.task(ignore_results=True)
-def compress_task_log(tasklog_name):
+def flush_write_behind():
+    """
+    Writes buffered updates of agent heartbeats and task progress to the
+    database, see :mod:`pyfarm.master.writebehind`.
+    """
+    write_behind.flush()
+
+
+@worker_process_shutdown.connect
+def flush_task_events(**kwargs):
+    """
+    Writes the task events counted by a worker process before it exits,
+    see :mod:`pyfarm.master.taskevents`
+    """
+    task_events.flush()
+
+
+def active_task_logs(*columns):
+    """
+    Returns a query for ``columns`` of the logs which are still being
+    written to, those of the current attempt of unfinished tasks
+    """
+    return db.session.query(*columns).\
+        join(TaskTaskLogAssociation,
+             TaskTaskLogAssociation.task_log_id == TaskLog.id).\
+        join(Task, TaskTaskLogAssociation.task_id == Task.id).\
+        filter(TaskTaskLogAssociation.attempt == Task.attempts,
+               or_(Task.state == None,
+                   ~Task.state.in_([WorkState.DONE, WorkState.FAILED])))
+
+
+def task_log_retention(jobqueue_path, jobtype_name):
+    """
+    Returns the retention policy for the logs of a job.  The policy of its
+    job type comes first, then the one of its queue or the closest parent
+    queue with one, then ``tasklog_retention``.
+    """
+    if jobtype_name in JOBTYPE_RETENTION:
+        return JOBTYPE_RETENTION[jobtype_name]
+    path = (jobqueue_path or "").strip("/")
+    while path:
+        if path in JOBQUEUE_RETENTION:
+            return JOBQUEUE_RETENTION[path]
+        path = path.rpartition("/")[0]
+    return DEFAULT_RETENTION
+
+
+def task_log_policies(log_ids, jobqueue_paths):
+    """
+    Returns the retention policies of the given logs by their id.  Logs
+    without any task are left out.  ``jobqueue_paths`` caches the paths of
+    job queues across calls.
+    """
+    policies = {}
+    if not JOBQUEUE_RETENTION and not JOBTYPE_RETENTION:
+        return policies
+
+    for log_id, jobqueue_id, jobtype_name in db.session.query(
+            TaskTaskLogAssociation.task_log_id, Job.job_queue_id,
+            JobType.name).\
+            join(Task, TaskTaskLogAssociation.task_id == Task.id).\
+            join(Job, Task.job_id == Job.id).\
+            join(JobTypeVersion, Job.jobtype_version_id == JobTypeVersion.id).\
+            join(JobType, JobTypeVersion.jobtype_id == JobType.id).\
+            filter(TaskTaskLogAssociation.task_log_id.in_(log_ids)):
+        if log_id in policies:
+            continue
+        if jobqueue_id is not None and jobqueue_id not in jobqueue_paths:
+            jobqueue_paths[jobqueue_id] = JobQueue.query.filter_by(
+                id=jobqueue_id).one().path()
+        policies[log_id] = task_log_retention(
+            jobqueue_paths.get(jobqueue_id), jobtype_name)
+    return policies
+
+
+def retention_policies():
+    """Returns every configured retention policy"""
+    return ([DEFAULT_RETENTION] + list(JOBQUEUE_RETENTION.values()) +
+            list(JOBTYPE_RETENTION.values()))
+
+
+def recent_task_logs(now):
+    """
+    Returns the identifiers of the logs which are still within the ``raw``
+    period of their retention policy and should not be compressed yet
+    """
+    longest = max(policy.raw for policy in retention_policies())
+    if not longest:
+        return set()
+
+    logs = db.session.query(
+        TaskLog.id, TaskLog.identifier, TaskLog.created_on).filter(
+            TaskLog.created_on > now - longest).all()
+    recent = set()
+    jobqueue_paths = {}
+    for start in range_(0, len(logs), RETENTION_BATCH_SIZE):
+        batch = logs[start:start + RETENTION_BATCH_SIZE]
+        policies = task_log_policies(
+            [log_id for log_id, _, _ in batch], jobqueue_paths)
+        for log_id, identifier, created_on in batch:
+            policy = policies.get(log_id, DEFAULT_RETENTION)
+            if created_on > now - policy.raw:
+                recent.add(identifier)
+    return recent
+
+
+def update_task_log_sizes(rows):
+    """
+    Stores the sizes of several logs in one statement.  ``rows`` are
+    dictionaries with the ``log_id``, ``size`` and ``tail_only`` of a log.
+    """
+    if not rows:
+        return
+    table = TaskLog.__table__
+    db.session.execute(
+        table.update().where(table.c.id == bindparam("log_id")).values(
+            size=bindparam("log_size"),
+            tail_only=bindparam("log_tail_only")),
+        [{"log_id": row["log_id"], "log_size": row["size"],
+          "log_tail_only": row["tail_only"]} for row in rows])
+    db.session.commit()
+
+
+@celery_app.task(ignore_results=True)
+def compress_task_logs():
+    """
+    Compresses the uncompressed task logs which are no longer being written
+    to, that is all logs except those of the current attempt of unfinished
+    tasks and those still within the ``raw`` period of their retention
+    policy.  The logs are handed to :func:`compress_task_log_batch` in
+    batches of ``tasklog_compression_batch_size``.
+    """
+    db.session.rollback()
+
+    skipped_logs = set(
+        identifier for identifier, in active_task_logs(TaskLog.identifier))
+    skipped_logs.update(recent_task_logs(datetime.utcnow()))
     db.session.rollback()
 
+    uncompressed_tasklogs = [
+        identifier for identifier in storage.identifiers(compressed=False)
+        if identifier not in skipped_logs]
+
+    for start in range_(
+            0, len(uncompressed_tasklogs), COMPRESSION_BATCH_SIZE):
+        compress_task_log_batch.delay(
+            uncompressed_tasklogs[start:start + COMPRESSION_BATCH_SIZE])
+
+
+def compress_log(tasklog_name):
+    """
+    Compresses a single task log, streaming it through the configured codec
+    one block at a time.  Returns the size of the compressed log.
+    """
     try:
-        path = join(LOGFILES_DIR, tasklog_name)
-        with open(path, "rb") as logfile:
-            logger.debug("Compressing tasklog file %s", path)
-            compressed_logfile = GzipFile("%s.gz" % path, "wb")
-            compressed_logfile.write(logfile.read())
-        try:
-            remove(join(LOGFILES_DIR, path))
-        except OSError as e:
-            if e.errno != ENOENT:
-                raise
+        logger.debug("Compressing tasklog file %s", tasklog_name)
+        return storage.compress(
+            tasklog_name, compresslevel=COMPRESSION_LEVEL,
+            codec=COMPRESSION_CODEC)
     except IOError as e:
         logger.error("Could not compress tasklog file %s: %s: %s",
                      tasklog_name, type(e).__name__, e)
@@ -1220,14 +1651,288 @@ def compress_task_log(tasklog_name):
 
 
 @celery_app.task(ignore_results=True)
-def cache_jobqueue_path(jobqueue_id):
+def compress_task_log(tasklog_name):
     db.session.rollback()
+    size = compress_log(tasklog_name)
+    TaskLog.query.filter_by(identifier=tasklog_name).update(
+        {"size": size}, synchronize_session=False)
+    db.session.commit()
 
-    jobqueue = JobQueue.query.filter_by(id=jobqueue_id).one()
-    jobqueue.fullpath = jobqueue.path()
 
-    db.session.add(jobqueue)
-    db.session.commit()
+@celery_app.task(ignore_results=True)
+def compress_task_log_batch(tasklog_names):
+    """
+    Compresses several task logs in parallel.  This uses threads rather
+    than processes, compression releases the GIL and celery's worker
+    processes are not allowed to start child processes.
+    """
+    db.session.rollback()
+
+    def compress(tasklog_name):
+        try:
+            return tasklog_name, compress_log(tasklog_name)
+        except IOError:
+            return tasklog_name, None
+
+    pool = ThreadPool(max(min(COMPRESSION_WORKERS, len(tasklog_names)), 1))
+    try:
+        sizes = dict(pool.map(compress, tasklog_names))
+    finally:
+        pool.close()
+        pool.join()
+
+    compressed = [name for name in tasklog_names if sizes[name] is not None]
+    logger.info("Compressed %s task logs, %s failed",
+                len(compressed), len(tasklog_names) - len(compressed))
+
+    if compressed:
+        table = TaskLog.__table__
+        db.session.execute(
+            table.update().where(
+                table.c.identifier == bindparam("log_identifier")).values(
+                    size=bindparam("log_size")),
+            [{"log_identifier": name, "log_size": sizes[name]}
+             for name in compressed])
+        db.session.commit()
+
+    if log_index.enabled:
+        index_task_logs.delay(compressed)
+
+
+def fill_in_task_log_sizes():
+    """
+    Looks up the stored size of the finished logs whose size is not known
+    yet, logs which are missing get a size of zero.  Returns the number of
+    logs updated.
+    """
+    filled = 0
+    last_id = 0
+    while True:
+        batch = db.session.query(TaskLog.id, TaskLog.identifier).filter(
+            TaskLog.size == None,
+            TaskLog.id > last_id,
+            ~TaskLog.id.in_(active_task_logs(TaskLog.id))).\
+            order_by(TaskLog.id).limit(RETENTION_BATCH_SIZE).all()
+        if not batch:
+            return filled
+        last_id = batch[-1][0]
+
+        rows = []
+        for log_id, identifier in batch:
+            try:
+                size = storage.open(identifier).stored_size
+            except (IOError, OSError, ValueError):
+                size = 0
+            rows.append({"log_id": log_id, "size": size, "tail_only": False})
+        update_task_log_sizes(rows)
+        filled += len(rows)
+
+
+def expire_task_logs(now):
+    """
+    Replaces the logs which are past the ``compressed`` period of their
+    retention policy with their tail or deletes them.  Returns the number
+    of bytes reclaimed.
+    """
+    expiring = [policy.raw + policy.compressed
+                for policy in retention_policies()
+                if policy.compressed is not None]
+    if not expiring:
+        return 0
+
+    reclaimed = 0
+    last_id = 0
+    jobqueue_paths = {}
+    while True:
+        batch = db.session.query(
+            TaskLog.id, TaskLog.identifier, TaskLog.created_on,
+            TaskLog.size).filter(
+                TaskLog.id > last_id,
+                TaskLog.created_on < now - min(expiring),
+                TaskLog.tail_only == False,
+                TaskLog.size > 0,
+                ~TaskLog.id.in_(active_task_logs(TaskLog.id))).\
+            order_by(TaskLog.id).limit(RETENTION_BATCH_SIZE).all()
+        if not batch:
+            return reclaimed
+        last_id = batch[-1][0]
+        policies = task_log_policies(
+            [log_id for log_id, _, _, _ in batch], jobqueue_paths)
+
+        rows = []
+        removed = []
+        truncated = []
+        for log_id, identifier, created_on, size in batch:
+            policy = policies.get(log_id, DEFAULT_RETENTION)
+            if (policy.compressed is None or
+                    created_on >= now - policy.raw - policy.compressed):
+                continue
+            try:
+                if policy.tail_lines:
+                    new_size = storage.truncate(
+                        identifier, policy.tail_lines,
+                        compresslevel=COMPRESSION_LEVEL,
+                        codec=COMPRESSION_CODEC)
+                else:
+                    storage.delete(identifier)
+                    new_size = 0
+            except (IOError, OSError, ValueError) as e:
+                logger.warning("Could not expire task log %s: %s",
+                               identifier, e)
+                continue
+            rows.append({"log_id": log_id, "size": new_size,
+                         "tail_only": bool(policy.tail_lines)})
+            if policy.tail_lines:
+                truncated.append(identifier)
+            else:
+                removed.append(log_id)
+            reclaimed += max(size - new_size, 0)
+        update_task_log_sizes(rows)
+
+        log_index.remove(removed)
+        if truncated and log_index.enabled:
+            index_task_logs.delay(truncated)
+
+
+def evict_task_logs():
+    """
+    Deletes the oldest finished logs until all logs fit into
+    ``tasklog_quota`` again.  Returns the number of bytes reclaimed.
+    """
+    total = db.session.query(func.sum(TaskLog.size)).scalar() or 0
+    reclaimed = 0
+    while total > TASKLOG_QUOTA:
+        batch = db.session.query(
+            TaskLog.id, TaskLog.identifier, TaskLog.size).filter(
+                TaskLog.size > 0,
+                ~TaskLog.id.in_(active_task_logs(TaskLog.id))).\
+            order_by(TaskLog.created_on, TaskLog.id).\
+            limit(RETENTION_BATCH_SIZE).all()
+
+        evicted = []
+        for log_id, identifier, size in batch:
+            if total <= TASKLOG_QUOTA:
+                break
+            try:
+                storage.delete(identifier)
+            except (IOError, OSError) as e:
+                logger.warning("Could not evict task log %s: %s",
+                               identifier, e)
+                continue
+            except ValueError:
+                # Nothing can be stored under this identifier anyway
+                pass
+            evicted.append(log_id)
+            total -= size
+            reclaimed += size
+
+        if not evicted:
+            logger.warning("Task logs take up %s bytes, more than the quota "
+                           "of %s bytes, but no more logs can be evicted",
+                           total, TASKLOG_QUOTA)
+            break
+        update_task_log_sizes(
+            [{"log_id": log_id, "size": 0, "tail_only": False}
+             for log_id in evicted])
+        log_index.remove(evicted)
+    return reclaimed
+
+
+@celery_app.task(ignore_results=True)
+def apply_task_log_retention():
+    """
+    Enforces the task log retention policies and ``tasklog_quota``.  Logs
+    past the ``compressed`` period of their policy are cut down to their
+    tail or deleted, then the oldest finished logs are evicted until the
+    remaining ones fit into the quota.  Logs which are still being written
+    to are never touched.
+    """
+    db.session.rollback()
+    started = time()
+    now = datetime.utcnow()
+
+    filled = fill_in_task_log_sizes()
+    if filled:
+        logger.info("Looked up the size of %s task logs", filled)
+
+    expired = expire_task_logs(now)
+    evicted = 0
+    if TASKLOG_QUOTA is not None:
+        evicted = evict_task_logs()
+
+    logger.info("Applied task log retention in %.2f seconds: reclaimed %s "
+                "bytes from expired logs and %s bytes to stay within the "
+                "quota", time() - started, expired, evicted)
+
+
+@celery_app.task(ignore_results=True)
+def index_task_logs(tasklog_names):
+    """Adds the given task logs to the full text search index"""
+    db.session.rollback()
+    if not log_index.enabled:
+        return
+
+    logs = TaskLog.query.filter(TaskLog.identifier.in_(tasklog_names)).all()
+    jobs = {}
+    for log_id, job_id, jobgroup_id in db.session.query(
+            TaskTaskLogAssociation.task_log_id, Job.id, Job.job_group_id).\
+            join(Task, TaskTaskLogAssociation.task_id == Task.id).\
+            join(Job, Task.job_id == Job.id).\
+            filter(TaskTaskLogAssociation.task_log_id.in_(
+                [log.id for log in logs])).distinct():
+        jobs.setdefault(log_id, []).append((job_id, jobgroup_id))
+
+    indexed = 0
+    for log in logs:
+        try:
+            logfile = storage.open(log.identifier)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("Cannot index task log %s: %s", log.identifier, e)
+            continue
+        indexed += log_index.index(
+            log.id, log.identifier, log.agent_id, log.created_on,
+            jobs.get(log.id, []), logfile)
+
+    logger.info("Indexed %s of %s task logs", indexed, len(tasklog_names))
+
+
+@celery_app.task(ignore_results=True)
+def backfill_jobqueue_paths():
+    """
+    Sets :attr:`.JobQueue.fullpath` for queues which don't have it yet,
+    such as queues which were written before the column was maintained.
+    Works through the queues in batches of ``jobqueue_backfill_batch_size``
+    and returns their number.
+    """
+    db.session.rollback()
+    table = JobQueue.__table__
+    statement = table.update().where(table.c.id == bindparam("_id")).values(
+        fullpath=bindparam("_fullpath"))
+    backfilled = 0
+    last_id = 0
+
+    while True:
+        rows = db.session.query(JobQueue.id).filter(
+                JobQueue.fullpath == None,
+                JobQueue.id > last_id).order_by(JobQueue.id).\
+            limit(JOBQUEUE_BACKFILL_BATCH_SIZE).all()
+        if not rows:
+            break
+
+        jobqueue_ids = [jobqueue_id for jobqueue_id, in rows]
+
+        connection = db.session.connection(mapper=JobQueue.__mapper__)
+        db.session.execute(statement, [
+            {"_id": jobqueue_id,
+             "_fullpath": JobQueue.parent_path(connection, jobqueue_id)}
+            for jobqueue_id in jobqueue_ids])
+        db.session.commit()
+        last_id = jobqueue_ids[-1]
+        backfilled += len(jobqueue_ids)
+
+    if backfilled:
+        logger.info("Set the path of %s job queues", backfilled)
+    return backfilled
 
 
 @celery_app.task(ignore_results=True, bind=True)
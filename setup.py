@@ -98,7 +98,9 @@ setup(
     entry_points={
         "console_scripts": [
             "pyfarm-master = pyfarm.master.entrypoints:run_master",
-            "pyfarm-tables = pyfarm.master.entrypoints:tables"]},
+            "pyfarm-tables = pyfarm.master.entrypoints:tables",
+            "pyfarm-migrate-tasklogs = "
+            "pyfarm.master.entrypoints:migrate_task_logs"]},
     install_requires=install_requires,
     url="https://github.com/pyfarm/pyfarm-master",
     license="Apache v2.0",
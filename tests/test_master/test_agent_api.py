@@ -18,16 +18,16 @@
 import uuid
 
 try:
-    from httplib import CREATED, NO_CONTENT
+    from httplib import CREATED, NO_CONTENT, NOT_MODIFIED
 except ImportError:
-    from http.client import CREATED, NO_CONTENT
+    from http.client import CREATED, NO_CONTENT, NOT_MODIFIED
 
 # test class must be loaded first
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
 from pyfarm.master.utility import dumps
-from pyfarm.master.application import get_api_blueprint
+from pyfarm.master.application import get_api_blueprint, db
 from pyfarm.master.entrypoints import load_api
 from pyfarm.models.agent import Agent
 
@@ -258,6 +258,144 @@ class TestAgentAPI(BaseTestCase):
         response4 = self.client.get("/api/v1/agents/%s" % id)
         self.assert_not_found(response4)
 
+    def test_agent_conditional_get(self):
+        agent_id = uuid.uuid4()
+        response1 = self.client.post(
+            "/api/v1/agents/",
+            content_type="application/json",
+            data=dumps({
+                "id": agent_id,
+                "cpus": 16,
+                "free_ram": 133,
+                "hostname": "testagent5",
+                "remote_ip": "10.0.200.6",
+                "port": 64994,
+                "ram": 2048,
+                "state": "running"}))
+        self.assert_created(response1)
+
+        response2 = self.client.get("/api/v1/agents/%s" % agent_id)
+        self.assert_ok(response2)
+        etag = response2.headers["ETag"]
+        last_modified = response2.headers["Last-Modified"]
+
+        response3 = self.client.get(
+            "/api/v1/agents/%s" % agent_id,
+            headers={"If-None-Match": etag})
+        self.assert_status(response3, NOT_MODIFIED)
+        self.assertEqual(response3.data, b"")
+        self.assertEqual(response3.headers["ETag"], etag)
+
+        response4 = self.client.get(
+            "/api/v1/agents/%s" % agent_id,
+            headers={"If-Modified-Since": last_modified})
+        self.assert_status(response4, NOT_MODIFIED)
+
+        response5 = self.client.post(
+            "/api/v1/agents/%s" % agent_id,
+            content_type="application/json",
+            data=dumps({"free_ram": 1024}))
+        self.assert_ok(response5)
+
+        response6 = self.client.get(
+            "/api/v1/agents/%s" % agent_id,
+            headers={"If-None-Match": etag})
+        self.assert_ok(response6)
+        self.assertNotEqual(response6.headers["ETag"], etag)
+        self.assertEqual(response6.json["free_ram"], 1024)
+
+    def test_agent_conditional_get_unknown(self):
+        response1 = self.client.get(
+            "/api/v1/agents/%s" % uuid.uuid4(),
+            headers={"If-None-Match": "*"})
+        self.assert_not_found(response1)
+        self.assertNotIn("ETag", response1.headers)
+
+    def test_agent_reregister_unchanged_inventory(self):
+        agent_id = uuid.uuid4()
+        agent_data = {
+            "id": agent_id,
+            "cpus": 16,
+            "free_ram": 133,
+            "hostname": "testagent6",
+            "remote_ip": "10.0.200.7",
+            "port": 64994,
+            "ram": 2048,
+            "mac_addresses": ["00:11:22:33:44:55"],
+            "gpus": ["GPU A", "GPU B"],
+            "disks": [{"mountpoint": "/", "size": 1000, "free": 500}]}
+        response1 = self.client.post(
+            "/api/v1/agents/",
+            content_type="application/json",
+            data=dumps(agent_data))
+        self.assert_created(response1)
+        agent = Agent.query.filter_by(id=agent_id).first()
+        inventory_hash = agent.inventory_hash
+        self.assertIsNotNone(inventory_hash)
+        disk_ids = [disk.id for disk in agent.disks]
+
+        agent_data["disks"][0]["free"] = 400
+        response2 = self.client.post(
+            "/api/v1/agents/",
+            content_type="application/json",
+            data=dumps(agent_data))
+        self.assert_ok(response2)
+
+        response3 = self.client.get("/api/v1/agents/%s" % agent_id)
+        self.assert_ok(response3)
+        self.assertEqual(
+            sorted(gpu["fullname"] for gpu in response3.json["gpus"]),
+            ["GPU A", "GPU B"])
+        self.assertEqual(len(response3.json["disks"]), 1)
+        self.assertEqual(response3.json["disks"][0]["free"], 400)
+
+        agent = Agent.query.filter_by(id=agent_id).first()
+        self.assertEqual(agent.inventory_hash, inventory_hash)
+        self.assertEqual([disk.id for disk in agent.disks], disk_ids)
+
+    def test_agent_update_changed_inventory(self):
+        agent_id = uuid.uuid4()
+        response1 = self.client.post(
+            "/api/v1/agents/",
+            content_type="application/json",
+            data=dumps({
+                "id": agent_id,
+                "cpus": 16,
+                "free_ram": 133,
+                "hostname": "testagent7",
+                "remote_ip": "10.0.200.8",
+                "port": 64994,
+                "ram": 2048,
+                "gpus": ["GPU A"]}))
+        self.assert_created(response1)
+        inventory_hash = Agent.query.filter_by(id=agent_id).first(
+            ).inventory_hash
+
+        response2 = self.client.post(
+            "/api/v1/agents/%s" % agent_id,
+            content_type="application/json",
+            data=dumps({"gpus": ["GPU A", "GPU B"], "tags": ["a", "b"]}))
+        self.assert_ok(response2)
+        self.assertEqual(sorted(response2.json["tags"]), ["a", "b"])
+
+        agent = Agent.query.filter_by(id=agent_id).first()
+        self.assertNotEqual(agent.inventory_hash, inventory_hash)
+        self.assertEqual(
+            sorted(gpu.fullname for gpu in agent.gpus), ["GPU A", "GPU B"])
+
+        # Changing tags outside of the agent's own updates has to
+        # invalidate the stored hash so the next update is applied again
+        agent.tags.remove(agent.tags.filter_by(tag="b").first())
+        self.assertIsNone(agent.inventory_hash)
+        db.session.commit()
+
+        response3 = self.client.post(
+            "/api/v1/agents/%s" % agent_id,
+            content_type="application/json",
+            data=dumps({"gpus": ["GPU A", "GPU B"], "tags": ["a", "b"]}))
+        self.assert_ok(response3)
+        self.assertEqual(sorted(response3.json["tags"]), ["a", "b"])
+
 
 class TestAgentAPIFilter(BaseTestCase):
     def setup_app(self):
@@ -0,0 +1,266 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import uuid
+from datetime import datetime
+
+try:
+    from httplib import GONE
+except ImportError:
+    from http.client import GONE
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.utility import dumps
+from pyfarm.master.application import get_api_blueprint, db
+from pyfarm.master.entrypoints import load_api
+from pyfarm.master.api import changes as changes_api
+from pyfarm.models.change import Change, PENDING_CHANGES
+from pyfarm.models.task import Task
+from pyfarm.scheduler import tasks
+
+
+class TestChangesAPI(BaseTestCase):
+    def setup_app(self):
+        super(TestChangesAPI, self).setup_app()
+        self.api = get_api_blueprint()
+        self.app.register_blueprint(self.api)
+        load_api(self.app, self.api)
+
+    def create_agent(self):
+        agent_id = uuid.uuid4()
+        response = self.client.post(
+            "/api/v1/agents/",
+            content_type="application/json",
+            data=dumps({
+                "id": agent_id,
+                "cpus": 16,
+                "free_ram": 133,
+                "hostname": "testagent1",
+                "remote_ip": "10.0.200.1",
+                "port": 64994,
+                "ram": 2048,
+                "state": "online"}))
+        self.assert_created(response)
+        return str(agent_id)
+
+    def create_job(self):
+        response1 = self.client.post(
+            "/api/v1/jobtypes/",
+            content_type="application/json",
+            data=dumps({
+                "name": "TestJobType",
+                "description": "Jobtype for testing inserts and queries",
+                "max_batch": 1,
+                "code": "dummy code"}))
+        self.assert_created(response1)
+
+        response2 = self.client.post(
+            "/api/v1/jobs/",
+            content_type="application/json",
+            data=dumps({
+                "start": 1.0,
+                "end": 2.0,
+                "title": "Test Job",
+                "jobtype": "TestJobType",
+                "data": {"foo": "bar"},
+                "software_requirements": []}))
+        self.assert_created(response2)
+        return response2.json["id"]
+
+    def test_changes_without_since(self):
+        response1 = self.client.get("/api/v1/changes")
+        self.assert_ok(response1)
+        self.assertEqual(
+            response1.json, {"last_seq": 0, "more": False, "changes": []})
+
+        self.create_agent()
+        response2 = self.client.get("/api/v1/changes")
+        self.assert_ok(response2)
+        self.assertEqual(response2.json["last_seq"], 1)
+        self.assertEqual(response2.json["changes"], [])
+
+    def test_changes_agent(self):
+        agent_id = self.create_agent()
+
+        response1 = self.client.post(
+            "/api/v1/agents/%s" % agent_id,
+            content_type="application/json",
+            data=dumps({"state": "running"}))
+        self.assert_ok(response1)
+
+        response2 = self.client.get("/api/v1/changes?since=0")
+        self.assert_ok(response2)
+        changes = response2.json["changes"]
+        self.assertEqual(len(changes), 2)
+        self.assertEqual(response2.json["last_seq"], changes[-1]["seq"])
+        self.assertLess(changes[0]["seq"], changes[1]["seq"])
+        self.assertEqual(
+            [(c["type"], c["id"], c["action"]) for c in changes],
+            [("agent", agent_id, "insert"), ("agent", agent_id, "update")])
+        self.assertEqual(changes[1]["fields"], {"state": "running"})
+
+        response3 = self.client.get(
+            "/api/v1/changes?since=%s" % changes[-1]["seq"])
+        self.assert_ok(response3)
+        self.assertEqual(response3.json["changes"], [])
+        self.assertEqual(response3.json["last_seq"], changes[-1]["seq"])
+
+    def test_changes_task_update(self):
+        job_id = self.create_job()
+        response1 = self.client.get("/api/v1/changes")
+        last_seq = response1.json["last_seq"]
+
+        response2 = self.client.get("/api/v1/jobs/%s/tasks/" % job_id)
+        task_id = response2.json[0]["id"]
+
+        response3 = self.client.post(
+            "/api/v1/jobs/%s/tasks/%s" % (job_id, task_id),
+            content_type="application/json",
+            data=dumps({"priority": 5}))
+        self.assert_ok(response3)
+
+        response4 = self.client.get(
+            "/api/v1/changes?since=%s&type=task" % last_seq)
+        self.assert_ok(response4)
+        changes = response4.json["changes"]
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]["type"], "task")
+        self.assertEqual(changes[0]["id"], str(task_id))
+        self.assertEqual(changes[0]["fields"], {"priority": 5})
+
+    def test_changes_task_progress_not_tracked(self):
+        job_id = self.create_job()
+        last_seq = self.client.get("/api/v1/changes").json["last_seq"]
+        task_id = self.client.get(
+            "/api/v1/jobs/%s/tasks/" % job_id).json[0]["id"]
+
+        task = Task.query.filter_by(id=task_id).one()
+        task.progress = 0.5
+        db.session.commit()
+
+        response = self.client.get("/api/v1/changes?since=%s" % last_seq)
+        self.assert_ok(response)
+        self.assertEqual(response.json["changes"], [])
+
+    def test_changes_type_filter_and_limit(self):
+        self.create_job()
+
+        response1 = self.client.get("/api/v1/changes?since=0&type=task")
+        self.assert_ok(response1)
+        self.assertEqual(
+            set((c["type"], c["action"]) for c in response1.json["changes"]),
+            set([("task", "insert")]))
+        self.assertEqual(len(response1.json["changes"]), 2)
+
+        response2 = self.client.get("/api/v1/changes?since=0&limit=1")
+        self.assert_ok(response2)
+        self.assertTrue(response2.json["more"])
+        self.assertEqual(len(response2.json["changes"]), 1)
+        self.assertEqual(response2.json["last_seq"],
+                         response2.json["changes"][0]["seq"])
+
+    def test_changes_bad_arguments(self):
+        self.assert_bad_request(self.client.get("/api/v1/changes?since=a"))
+        self.assert_bad_request(
+            self.client.get("/api/v1/changes?since=0&type=foo"))
+        self.assert_bad_request(
+            self.client.get("/api/v1/changes?since=0&limit=0"))
+        self.assert_bad_request(
+            self.client.get("/api/v1/changes?since=0&wait=-1"))
+
+    def test_changes_gone(self):
+        agent_id = self.create_agent()
+        for state in ("running", "online", "running"):
+            response = self.client.post(
+                "/api/v1/agents/%s" % agent_id,
+                content_type="application/json",
+                data=dumps({"state": state}))
+            self.assert_ok(response)
+
+        changes = Change.query.order_by(Change.seq).all()
+        for change in changes[:2]:
+            change.time = datetime(2015, 1, 1)
+        purged = changes[1].seq
+        db.session.commit()
+        tasks.clean_up_change_feed()
+        self.assertEqual(Change.query.count(), 2)
+
+        self.assert_status(
+            self.client.get("/api/v1/changes?since=%s" % (purged - 1)), GONE)
+        response = self.client.get("/api/v1/changes?since=%s" % purged)
+        self.assert_ok(response)
+        self.assertEqual(len(response.json["changes"]), 2)
+
+    def test_changes_gone_sequence_gaps(self):
+        agent_id = self.create_agent()
+        response = self.client.post(
+            "/api/v1/agents/%s" % agent_id,
+            content_type="application/json",
+            data=dumps({"state": "running"}))
+        self.assert_ok(response)
+
+        # Nothing was cleaned up yet, so a gap below the oldest change
+        # does not mean that changes are missing
+        Change.query.update({"seq": Change.seq + 10})
+        db.session.commit()
+        response = self.client.get("/api/v1/changes?since=0")
+        self.assert_ok(response)
+        self.assertEqual(len(response.json["changes"]), 2)
+
+    def test_changes_wait_timeout(self):
+        self.addCleanup(setattr, changes_api, "MAX_WAIT", changes_api.MAX_WAIT)
+        changes_api.MAX_WAIT = 1
+        start = time.time()
+        response = self.client.get("/api/v1/changes?since=0&wait=30")
+        self.assert_ok(response)
+        self.assertEqual(response.json["changes"], [])
+        self.assertLess(time.time() - start, 5)
+
+    def test_changes_wait_disabled(self):
+        self.addCleanup(setattr, changes_api, "MAX_WAIT", changes_api.MAX_WAIT)
+        changes_api.MAX_WAIT = 0
+        start = time.time()
+        response = self.client.get("/api/v1/changes?since=0&wait=30")
+        self.assert_ok(response)
+        self.assertLess(time.time() - start, 1)
+
+    def test_changes_numbered_in_commit_order(self):
+        # A transaction which inserted its change first but commits last
+        # has to end up with the larger sequence number
+        table = Change.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.insert(), {
+                "id": 50, "time": datetime.utcnow(), "type": "job",
+                "object_id": "2", "action": "delete"})
+            connection.info[PENDING_CHANGES] = True
+        with db.engine.begin() as connection:
+            connection.execute(table.insert(), [
+                {"id": 10, "time": datetime.utcnow(), "type": "job",
+                 "object_id": "1", "action": "delete"},
+                {"id": 12, "time": datetime.utcnow(), "type": "job",
+                 "object_id": "3", "action": "delete"}])
+            connection.info[PENDING_CHANGES] = True
+
+        response = self.client.get("/api/v1/changes?since=0")
+        self.assert_ok(response)
+        self.assertEqual(
+            [(c["id"], c["seq"]) for c in response.json["changes"]],
+            [("2", 1), ("1", 2), ("3", 4)])
+        self.assertEqual(response.json["last_seq"], 4)
@@ -0,0 +1,192 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.utility import dumps
+from pyfarm.master.application import db, get_api_blueprint
+from pyfarm.master.entrypoints import load_api
+from pyfarm.master.events import EventHub, events
+from pyfarm.models.job import Job, rerun_jobs
+from pyfarm.scheduler.tasks import delete_job
+
+
+def parse_event(chunk):
+    if isinstance(chunk, bytes):
+        chunk = chunk.decode("utf-8")
+    lines = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+    return lines["event"], json.loads(lines["data"])
+
+
+class TestEventHub(BaseTestCase):
+    def test_filtering(self):
+        hub = EventHub()
+        everything = hub.subscribe()
+        job = hub.subscribe(job_id=1)
+        jobgroup = hub.subscribe(jobgroup_id=2)
+
+        hub.publish("job", job_id=1, jobgroup_id=None, state="running")
+        hub.publish("job", job_id=3, jobgroup_id=2, state="done")
+
+        self.assertEqual(everything.get(0)[1]["job_id"], 1)
+        self.assertEqual(everything.get(0)[1]["job_id"], 3)
+        self.assertIsNone(everything.get(0))
+        self.assertEqual(job.get(0)[1]["job_id"], 1)
+        self.assertIsNone(job.get(0))
+        self.assertEqual(jobgroup.get(0)[1]["job_id"], 3)
+        self.assertIsNone(jobgroup.get(0))
+
+    def test_unsubscribe(self):
+        hub = EventHub()
+        with hub.subscribe() as subscription:
+            self.assertIn(subscription, hub.subscriptions)
+        self.assertNotIn(subscription, hub.subscriptions)
+
+    def test_publish_on_commit(self):
+        hub = EventHub()
+        subscription = hub.subscribe()
+
+        hub.publish_on_commit("job", job_id=1)
+        self.assertIsNone(subscription.get(0))
+        db.session.commit()
+        self.assertEqual(subscription.get(0), ("job", {"job_id": 1}))
+
+        hub.publish_on_commit("job", job_id=2)
+        db.session.rollback()
+        db.session.commit()
+        self.assertIsNone(subscription.get(0))
+
+    def test_overflow(self):
+        hub = EventHub()
+        subscription = hub.subscribe()
+        subscription.queue.maxsize = 1
+        hub.publish("job", job_id=1)
+        self.assertFalse(subscription.lost)
+        hub.publish("job", job_id=2)
+        self.assertTrue(subscription.lost)
+
+
+class TestEventsAPI(BaseTestCase):
+    def setup_app(self):
+        super(TestEventsAPI, self).setup_app()
+        self.api = get_api_blueprint()
+        self.app.register_blueprint(self.api)
+        load_api(self.app, self.api)
+
+    def create_job(self):
+        response1 = self.client.post(
+            "/api/v1/jobtypes/",
+            content_type="application/json",
+            data=dumps({
+                "name": "TestJobType",
+                "description": "Jobtype for testing inserts and queries",
+                "max_batch": 1,
+                "code": "dummy code"}))
+        self.assert_created(response1)
+
+        response2 = self.client.post(
+            "/api/v1/jobs/",
+            content_type="application/json",
+            data=dumps({
+                "start": 1.0,
+                "end": 1.0,
+                "title": "Test Job",
+                "jobtype": "TestJobType",
+                "data": {"foo": "bar"},
+                "software_requirements": []}))
+        self.assert_created(response2)
+        job_id = response2.json["id"]
+
+        response3 = self.client.get("/api/v1/jobs/%s/tasks/" % job_id)
+        self.assert_ok(response3)
+        return job_id, response3.json[0]["id"]
+
+    def test_job_events(self):
+        job_id, task_id = self.create_job()
+
+        response1 = self.client.get(
+            "/api/v1/jobs/%s/events" % job_id, buffered=False)
+        self.assert_ok(response1)
+        self.assertEqual(response1.mimetype, "text/event-stream")
+        stream = iter(response1.response)
+        self.assertTrue(next(stream).startswith(b"retry:"))
+
+        response2 = self.client.post(
+            "/api/v1/jobs/%s/tasks/%s" % (job_id, task_id),
+            content_type="application/json",
+            data=dumps({"state": "done", "progress": 1.0}))
+        self.assert_ok(response2)
+
+        event_type, data = parse_event(next(stream))
+        self.assertEqual(event_type, "task")
+        self.assertEqual(data["task_id"], task_id)
+        self.assertEqual(data["job_id"], job_id)
+        self.assertEqual(data["state"], "done")
+        self.assertEqual(data["progress"], 1.0)
+
+        event_type, data = parse_event(next(stream))
+        self.assertEqual(event_type, "job")
+        self.assertEqual(data, {
+            "job_id": job_id, "jobgroup_id": None, "state": "done"})
+
+        response1.close()
+        self.assertEqual(events.subscriptions, set())
+
+    def test_job_events_closed_before_start(self):
+        job_id, _ = self.create_job()
+        response = self.client.get(
+            "/api/v1/jobs/%s/events" % job_id, buffered=False)
+        self.assert_ok(response)
+        response.close()
+        self.assertEqual(events.subscriptions, set())
+
+    def test_job_events_rerun_and_delete(self):
+        job_id, task_id = self.create_job()
+        response = self.client.post(
+            "/api/v1/jobs/%s/tasks/%s" % (job_id, task_id),
+            content_type="application/json",
+            data=dumps({"state": "done", "progress": 1.0}))
+        self.assert_ok(response)
+
+        with events.subscribe(job_id=job_id) as subscription:
+            rerun_jobs([job_id])
+            self.assertIsNone(subscription.get(0))
+            db.session.commit()
+            event_type, data = subscription.get(0)
+            self.assertEqual(event_type, "task")
+            self.assertEqual(data["task_id"], task_id)
+            self.assertEqual(data["state"], "queued")
+            self.assertEqual(subscription.get(0), ("job", {
+                "job_id": job_id, "jobgroup_id": None, "state": "queued"}))
+
+            Job.query.filter_by(id=job_id).update({"to_be_deleted": True})
+            db.session.commit()
+            delete_job(job_id)
+            self.assertEqual(subscription.get(0), ("task", {
+                "task_id": task_id, "job_id": job_id, "jobgroup_id": None,
+                "state": "deleted"}))
+            self.assertEqual(subscription.get(0), ("job", {
+                "job_id": job_id, "jobgroup_id": None, "state": "deleted"}))
+
+    def test_job_events_unknown_job(self):
+        self.assert_not_found(self.client.get("/api/v1/jobs/42/events"))
+
+    def test_jobgroup_events_unknown_group(self):
+        self.assert_not_found(self.client.get("/api/v1/jobgroups/42/events"))
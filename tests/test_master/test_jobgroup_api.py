@@ -21,10 +21,13 @@ from json import dumps
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
-from pyfarm.master.application import get_api_blueprint
+from pyfarm.core.enums import WorkState
+from pyfarm.master.application import db, get_api_blueprint
 from pyfarm.master.config import config
 from pyfarm.master.entrypoints import load_api
+from pyfarm.models.job import Job
 from pyfarm.models.jobgroup import JobGroup
+from pyfarm.models.task import Task
 
 
 jobtype_code = """from pyfarm.jobtypes.core.jobtype import JobType
@@ -232,3 +235,60 @@ class TestJobGroupAPI(BaseTestCase):
 
         delete_response = self.client.delete( "/api/v1/jobgroups/%s" % id)
         self.assert_conflict(delete_response)
+
+    def test_jobgroup_rerun(self):
+        jobtype_name, jobtype_id = self.create_a_jobtype()
+        id = self.create_a_jobgroup(jobtype_name)
+
+        job_ids = []
+        for title in ("Test Job", "Test Child Job"):
+            job_post_response = self.client.post(
+                "/api/v1/jobs/",
+                content_type="application/json",
+                data=dumps({
+                        "start": 1.0,
+                        "end": 3.0,
+                        "title": title,
+                        "jobtype": jobtype_name,
+                        "data": {"foo": "bar"},
+                        "job_group_id": id
+                        }))
+            self.assert_created(job_post_response)
+            job_ids.append(job_post_response.json["id"])
+
+        # Only the parent is in the group, the child is rerun with it
+        child = Job.query.filter_by(id=job_ids[1]).one()
+        child.job_group_id = None
+        child.parents.append(Job.query.filter_by(id=job_ids[0]).one())
+        db.session.add(child)
+        states = [WorkState.DONE, WorkState.FAILED, WorkState.RUNNING,
+                  WorkState.FAILED, WorkState.DONE, WorkState.DONE]
+        tasks = Task.query.order_by(Task.job_id, Task.frame).all()
+        for task, state in zip(tasks, states):
+            Task.query.filter_by(id=task.id).update(
+                {"state": state, "attempts": 1, "failures": 1})
+        db.session.commit()
+
+        response1 = self.client.post("/api/v1/jobgroups/%s/rerun_failed" % id)
+        self.assert_ok(response1)
+        self.assertEqual(response1.json, {"restarted": 2})
+        tasks = Task.query.order_by(Task.job_id, Task.frame).all()
+        self.assertEqual([task.state for task in tasks],
+                         [WorkState.DONE, None, WorkState.RUNNING,
+                          None, WorkState.DONE, WorkState.DONE])
+        self.assertEqual([task.failures for task in tasks],
+                         [1, 0, 1, 0, 1, 1])
+
+        response2 = self.client.post("/api/v1/jobgroups/%s/rerun" % id)
+        self.assert_ok(response2)
+        self.assertEqual(response2.json, {"restarted": 3})
+        tasks = Task.query.order_by(Task.job_id, Task.frame).all()
+        self.assertEqual([task.state for task in tasks],
+                         [None, None, WorkState.RUNNING, None, None, None])
+        self.assertEqual(
+            [job.state for job in Job.query.order_by(Job.id)],
+            [None, None])
+
+    def test_jobgroup_rerun_unknown(self):
+        response = self.client.post("/api/v1/jobgroups/42/rerun")
+        self.assert_not_found(response)
@@ -17,10 +17,16 @@
 
 import uuid
 
+try:
+    from httplib import NOT_MODIFIED
+except ImportError:
+    from http.client import NOT_MODIFIED
+
 # test class must be loaded first
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
+from pyfarm.core.enums import WorkState
 from pyfarm.master.utility import dumps
 from pyfarm.master.application import get_api_blueprint
 from pyfarm.master.config import config
@@ -28,6 +34,8 @@ from pyfarm.master.entrypoints import load_api
 from pyfarm.master.application import db
 from pyfarm.models.user import User
 from pyfarm.models.job import Job
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.task import Task
 
 jobtype_code = """from pyfarm.jobtypes.core.jobtype import JobType
 
@@ -560,6 +568,48 @@ class TestJobAPI(BaseTestCase):
                     }))
         self.assert_not_found(response1)
 
+    def test_job_post_in_queue(self):
+        jobtype_name, _ = self.create_a_jobtype()
+        top = JobQueue(name="Top")
+        nested = JobQueue(name="Nested", parent=top)
+        db.session.add_all([top, nested])
+        db.session.commit()
+
+        for jobqueue in ("Top/Nested", "/Top/Nested"):
+            response1 = self.client.post(
+                "/api/v1/jobs/",
+                content_type="application/json",
+                data=dumps({
+                        "start": 1.0,
+                        "end": 2.0,
+                        "title": "Test Job %s" % jobqueue,
+                        "jobtype": jobtype_name,
+                        "jobqueue": jobqueue,
+                        "data": {"foo": "bar"}
+                        }))
+            self.assert_created(response1)
+            self.assertEqual(response1.json["jobqueue"], "/Top/Nested")
+
+        response2 = self.client.post(
+            "/api/v1/jobs/",
+            content_type="application/json",
+            data=dumps({
+                    "start": 1.0,
+                    "end": 2.0,
+                    "title": "Test Job",
+                    "jobtype": jobtype_name,
+                    "jobqueue": "Nested",
+                    "data": {"foo": "bar"}
+                    }))
+        self.assert_not_found(response2)
+
+        response3 = self.client.get(
+            "/api/v1/jobs/?jobqueue=/Top/Nested")
+        self.assert_ok(response3)
+        self.assertEqual(len(response3.json), 2)
+        self.assert_not_found(self.client.get(
+            "/api/v1/jobs/?jobqueue=/Top/Nested&jobqueue=/Nested"))
+
     def test_jobs_list(self):
         response1 = self.client.post(
             "/api/v1/jobtypes/",
@@ -1026,6 +1076,37 @@ class TestJobAPI(BaseTestCase):
         else:
             self.assert_not_found(response4)
 
+    def test_job_rerun(self):
+        jobtypename, jobtype_id = self.create_a_jobtype()
+        jobname, id = self.create_a_job(jobtypename)
+        job = Job.query.filter_by(id=id).one()
+        Task.query.filter_by(job_id=id).update(
+            {"state": WorkState.FAILED, "attempts": 1, "failures": 1})
+        job.state = WorkState.FAILED
+        db.session.add(job)
+        db.session.commit()
+
+        response1 = self.client.post("/api/v1/jobs/%s/rerun_failed" % id)
+        self.assert_ok(response1)
+        self.assertEqual(response1.json, {"restarted": 2})
+
+        response2 = self.client.get("/api/v1/jobs/%s" % id)
+        self.assert_ok(response2)
+        self.assertEqual(response2.json["state"], "queued")
+
+        response3 = self.client.get("/api/v1/jobs/%s/tasks/" % id)
+        self.assert_ok(response3)
+        self.assertEqual([(task["state"], task["failures"], task["attempts"])
+                          for task in response3.json],
+                         [("queued", 0, 1), ("queued", 0, 1)])
+
+        response4 = self.client.post("/api/v1/jobs/%s/rerun" % jobname)
+        self.assert_ok(response4)
+        self.assertEqual(response4.json, {"restarted": 0})
+
+        response5 = self.client.post("/api/v1/jobs/Unknown%20Job/rerun")
+        self.assert_not_found(response5)
+
     def test_job_get_tasks(self):
         response1 = self.client.post(
             "/api/v1/jobtypes/",
@@ -1674,3 +1755,139 @@ class TestJobAPI(BaseTestCase):
             "/api/v1/jobs/%s/tasks/%s/failed_on_agents/" % (job_id, task_id))
         self.assert_ok(failed_on_agents_response)
         self.assertEqual(failed_on_agents_response.json, [])
+
+    def test_jobs_list_conditional_get(self):
+        jobtype_name, jobtype_id = self.create_a_jobtype()
+        job_name, job_id = self.create_a_job(jobtype_name)
+
+        response1 = self.client.get("/api/v1/jobs/")
+        self.assert_ok(response1)
+        etag = response1.headers["ETag"]
+
+        response2 = self.client.get(
+            "/api/v1/jobs/", headers={"If-None-Match": etag})
+        self.assert_status(response2, NOT_MODIFIED)
+        self.assertEqual(response2.data, b"")
+
+        # different filters produce different documents
+        response3 = self.client.get(
+            "/api/v1/jobs/?title=Test", headers={"If-None-Match": etag})
+        self.assert_ok(response3)
+        self.assertNotEqual(response3.headers["ETag"], etag)
+
+        response4 = self.client.post(
+            "/api/v1/jobs/",
+            content_type="application/json",
+            data=dumps({
+                "start": 1.0,
+                "end": 2.0,
+                "title": "Test Job 2",
+                "jobtype": jobtype_name,
+                "data": {"foo": "bar"},
+                "software_requirements": []}))
+        self.assert_created(response4)
+
+        response5 = self.client.get(
+            "/api/v1/jobs/", headers={"If-None-Match": etag})
+        self.assert_ok(response5)
+        self.assertEqual(len(response5.json), 2)
+
+    def test_jobs_list_conditional_get_tasks(self):
+        jobtype_name, jobtype_id = self.create_a_jobtype()
+        job_name, job_id = self.create_a_job(jobtype_name)
+        agent_id = uuid.uuid4()
+        response1 = self.client.post(
+            "/api/v1/agents/",
+            content_type="application/json",
+            data=dumps({
+                "id": agent_id,
+                "cpus": 16,
+                "hostname": "testagent1",
+                "remote_ip": "10.0.200.1",
+                "port": 64994,
+                "ram": 2048,
+                "free_ram": 2048,
+                "state": "online"}))
+        self.assert_created(response1)
+
+        response2 = self.client.get("/api/v1/jobs/")
+        self.assert_ok(response2)
+        etag = response2.headers["ETag"]
+
+        # Only the assignment of tasks shows up in the list, other changes
+        # to tasks don't invalidate it
+        task = Task.query.filter_by(job_id=job_id).first()
+        task.progress = 0.5
+        db.session.commit()
+        response3 = self.client.get(
+            "/api/v1/jobs/", headers={"If-None-Match": etag})
+        self.assert_status(response3, NOT_MODIFIED)
+
+        task.agent_id = agent_id
+        db.session.commit()
+        response4 = self.client.get(
+            "/api/v1/jobs/", headers={"If-None-Match": etag})
+        self.assert_ok(response4)
+        self.assertEqual(response4.json[0]["state"], "assigned")
+
+    def test_job_conditional_get_task_update(self):
+        jobtype_name, jobtype_id = self.create_a_jobtype()
+        job_name, job_id = self.create_a_job(jobtype_name)
+
+        response1 = self.client.get("/api/v1/jobs/%s" % job_id)
+        self.assert_ok(response1)
+        job_etag = response1.headers["ETag"]
+        self.assertIn("Last-Modified", response1.headers)
+
+        response2 = self.client.get("/api/v1/jobs/%s/tasks/" % job_id)
+        self.assert_ok(response2)
+        tasks_etag = response2.headers["ETag"]
+        task_id = response2.json[0]["id"]
+
+        response3 = self.client.get("/api/v1/jobs/%s/tasks/%s" %
+                                    (job_id, task_id))
+        self.assert_ok(response3)
+        task_etag = response3.headers["ETag"]
+
+        for url, etag in (
+                ("/api/v1/jobs/%s" % job_id, job_etag),
+                ("/api/v1/jobs/%s/tasks/" % job_id, tasks_etag),
+                ("/api/v1/jobs/%s/tasks/%s" % (job_id, task_id), task_etag)):
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assert_status(response, NOT_MODIFIED)
+
+        response4 = self.client.post(
+            "/api/v1/jobs/%s/tasks/%s" % (job_id, task_id),
+            content_type="application/json",
+            data=dumps({"state": "running"}))
+        self.assert_ok(response4)
+
+        for url, etag in (
+                ("/api/v1/jobs/%s" % job_id, job_etag),
+                ("/api/v1/jobs/%s/tasks/" % job_id, tasks_etag),
+                ("/api/v1/jobs/%s/tasks/%s" % (job_id, task_id), task_etag)):
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assert_ok(response)
+            self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_job_conditional_get_unknown(self):
+        response1 = self.client.get(
+            "/api/v1/jobs/42", headers={"If-None-Match": "*"})
+        self.assert_not_found(response1)
+
+    def test_job_conditional_get_task_wrong_job(self):
+        jobtype_name, jobtype_id = self.create_a_jobtype()
+        job_name, job_id = self.create_a_job(jobtype_name)
+
+        response1 = self.client.get("/api/v1/jobs/%s/tasks/" % job_id)
+        self.assert_ok(response1)
+        task_id = response1.json[0]["id"]
+
+        response2 = self.client.get(
+            "/api/v1/jobs/%s/tasks/%s" % (job_id + 1, task_id),
+            headers={"If-None-Match": "*"})
+        self.assert_not_found(response2)
+
+        response3 = self.client.get(
+            "/api/v1/jobs/%s/tasks/%s" % (job_id + 1, task_id))
+        self.assert_not_found(response3)
@@ -0,0 +1,129 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import zlib
+from gzip import GzipFile
+from io import BytesIO
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.logfiles import (
+    BlockGzipLogfile, GzipLogfile, PlainLogfile, compress_block,
+    compress_logfile, get_codec, open_logfile, tail_offset)
+
+log_data = b"".join(b"%d,log line number %d\n" % (i, i) for i in range(1000))
+
+
+class TestLogfiles(BaseTestCase):
+    def setUp(self):
+        super(TestLogfiles, self).setUp()
+        self.directory = mkdtemp()
+        self.path = join(self.directory, "test.csv")
+
+    def tearDown(self):
+        rmtree(self.directory)
+        super(TestLogfiles, self).tearDown()
+
+    def write_plain(self):
+        with open(self.path, "wb") as logfile:
+            logfile.write(log_data)
+
+    def write_block_gzip(self):
+        size = compress_logfile(
+            BytesIO(log_data), self.path + ".gz", block_size=1000)
+        self.assertEqual(size, len(log_data))
+
+    def write_gzip(self):
+        with GzipFile(self.path + ".gz", "wb") as logfile:
+            logfile.write(log_data)
+
+    def test_open_logfile(self):
+        self.assertRaises(IOError, open_logfile, self.path)
+        self.write_gzip()
+        self.assertIsInstance(open_logfile(self.path), GzipLogfile)
+        self.write_block_gzip()
+        self.assertIsInstance(open_logfile(self.path), BlockGzipLogfile)
+        self.write_plain()
+        self.assertIsInstance(open_logfile(self.path), PlainLogfile)
+
+    def test_block_gzip_is_gzip(self):
+        self.write_block_gzip()
+        with GzipFile(self.path + ".gz", "rb") as logfile:
+            self.assertEqual(logfile.read(), log_data)
+
+    def test_read_ranges(self):
+        for index, write in enumerate((self.write_plain,
+                                       self.write_block_gzip,
+                                       self.write_gzip)):
+            self.path = join(self.directory, "test%s.csv" % index)
+            write()
+            logfile = open_logfile(self.path)
+            self.assertEqual(b"".join(logfile.read()), log_data)
+            for start, end in ((0, 10), (995, 2005), (1000, 2000),
+                               (len(log_data) - 5, len(log_data) + 10),
+                               (3000, None), (len(log_data), None)):
+                self.assertEqual(
+                    b"".join(logfile.read(start, end)), log_data[start:end])
+
+    def test_block_gzip_reads_only_needed_blocks(self):
+        self.write_block_gzip()
+        logfile = open_logfile(self.path)
+        self.assertEqual(len(list(logfile.read(1500, 2500))), 2)
+        self.assertEqual(len(list(logfile.read(1000, 2000))), 1)
+
+    def test_tail_offset(self):
+        lines = log_data.splitlines(True)
+        for index, write in enumerate((self.write_plain,
+                                       self.write_block_gzip,
+                                       self.write_gzip)):
+            self.path = join(self.directory, "test%s.csv" % index)
+            write()
+            logfile = open_logfile(self.path)
+            for count in (0, 1, 3, 100, 999, 1000, 5000):
+                offset = tail_offset(logfile, count)
+                expected = b"".join(lines[-count:]) if count else b""
+                self.assertEqual(log_data[offset:], expected)
+
+    def test_tail_offset_without_trailing_newline(self):
+        with open(self.path, "wb") as logfile:
+            logfile.write(b"a\nb\nc")
+        logfile = open_logfile(self.path)
+        self.assertEqual(tail_offset(logfile, 1), 4)
+        self.assertEqual(tail_offset(logfile, 2), 2)
+        self.assertEqual(tail_offset(logfile, 5), 0)
+
+    def test_compress_levels(self):
+        for level in (1, 6, 9):
+            block = compress_block(log_data, compresslevel=level)
+            self.assertEqual(zlib.decompress(block, 16 + zlib.MAX_WBITS),
+                             log_data)
+
+    def test_codecs(self):
+        self.assertIs(get_codec("gzip"), zlib)
+        self.assertRaises(ValueError, get_codec, "lz4")
+        for codec in ("gzip", "isal"):
+            with open(self.path, "wb") as logfile:
+                logfile.write(log_data)
+            with open(self.path, "rb") as logfile:
+                compress_logfile(logfile, self.path + ".gz", block_size=1000,
+                                 compresslevel=6, codec=codec)
+            with GzipFile(self.path + ".gz", "rb") as logfile:
+                self.assertEqual(logfile.read(), log_data)
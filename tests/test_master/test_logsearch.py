@@ -0,0 +1,123 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+from contextlib import closing
+from datetime import datetime, timedelta
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.logsearch import LogIndex, split_chunks
+from pyfarm.master.logstorage import FlatFileStorage
+
+log_data = b"".join(b"%d,log line number %d\n" % (i, i) for i in range(1000))
+
+
+class TestLogIndex(BaseTestCase):
+    def setUp(self):
+        super(TestLogIndex, self).setUp()
+        self.directory = mkdtemp()
+        self.storage = FlatFileStorage(join(self.directory, "logs"))
+        self.index = LogIndex(join(self.directory, "index.sqlite"))
+        self.agent_id = uuid.uuid4()
+        self.now = datetime.utcnow()
+
+    def tearDown(self):
+        rmtree(self.directory)
+        super(TestLogIndex, self).tearDown()
+
+    def add_log(self, log_id, data, jobs=((1, None), ), agent_id=None,
+                age=timedelta()):
+        identifier = "test%s.csv" % log_id
+        self.storage.write(identifier, data)
+        return self.index.index(
+            log_id, identifier, agent_id or self.agent_id, self.now - age,
+            jobs, self.storage.open(identifier))
+
+    def search(self, text, **kwargs):
+        return [result["id"] for result in self.index.search(text, **kwargs)]
+
+    def test_split_chunks(self):
+        self.storage.write("test.csv", log_data)
+        chunks = list(split_chunks(self.storage.open("test.csv"), size=1000))
+        self.assertEqual(b"".join(data for _, data in chunks), log_data)
+        for offset, data in chunks:
+            self.assertLessEqual(len(data), 1000)
+            self.assertTrue(data.endswith(b"\n"))
+            self.assertEqual(log_data[offset:offset + len(data)], data)
+
+    def test_split_chunks_long_line(self):
+        self.storage.write("test.csv", b"x" * 2500)
+        chunks = list(split_chunks(self.storage.open("test.csv"), size=1000))
+        self.assertEqual([offset for offset, _ in chunks], [0, 1000, 2000])
+
+    def test_search(self):
+        self.assertTrue(self.add_log(
+            1, log_data + b"1000,Error: out of memory\n"))
+        self.add_log(2, b"0,out of disk space\n1,memory is fine\n")
+        self.add_log(3, b"0,ran out of memory again\n", age=timedelta(days=1))
+
+        self.assertEqual(self.search("out of memory"), [1, 3])
+        self.assertEqual(self.search("Out Of Memory", limit=1), [1])
+        self.assertEqual(self.search("memory"), [2, 1, 3])
+        self.assertEqual(self.search("segmentation fault"), [])
+        self.assertEqual(self.search('quote " in it'), [])
+
+        result = self.index.search("out of memory")[0]
+        self.assertEqual(result["identifier"], "test1.csv")
+        self.assertEqual(result["agent_id"], str(self.agent_id))
+        self.assertEqual(result["created_on"], self.now)
+        self.assertEqual(
+            log_data[result["offset"]:result["offset"] + 1], b"0")
+
+    def test_search_filters(self):
+        other_agent = uuid.uuid4()
+        self.add_log(1, b"0,out of memory\n", jobs=[(1, 10)])
+        self.add_log(2, b"0,out of memory\n", jobs=[(2, 10), (3, None)],
+                     agent_id=other_agent)
+        self.add_log(3, b"0,out of memory\n", jobs=[(4, None)],
+                     age=timedelta(days=8))
+
+        self.assertEqual(self.search("memory", job_id=3), [2])
+        self.assertEqual(self.search("memory", jobgroup_id=10), [2, 1])
+        self.assertEqual(self.search("memory", agent_id=other_agent), [2])
+        self.assertEqual(
+            self.search("memory", since=self.now - timedelta(days=7)), [2, 1])
+        self.assertEqual(
+            self.search("memory", until=self.now - timedelta(days=7)), [3])
+
+    def test_reindex_and_remove(self):
+        self.add_log(1, b"0,out of memory\n")
+        self.assertFalse(self.add_log(1, b"0,out of memory\n"))
+        self.assertTrue(self.add_log(1, b"0,out of disk space\n"))
+        self.assertEqual(self.search("memory"), [])
+        self.assertEqual(self.search("disk"), [1])
+
+        self.index.remove([1])
+        self.assertEqual(self.search("disk"), [])
+
+        # The tokens of removed chunks are gone from the full text index
+        # too, not just hidden by the join with the chunks
+        with closing(self.index.connect()) as connection:
+            for text in ("memory", "disk"):
+                self.assertEqual(connection.execute(
+                    "SELECT COUNT(*) FROM chunk_text WHERE chunk_text "
+                    "MATCH ?", (text, )).fetchone(), (0, ))
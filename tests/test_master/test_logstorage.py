@@ -0,0 +1,212 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from io import BytesIO
+from os import listdir
+from os.path import isfile, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.logstorage import (
+    AppendConflict, FlatFileStorage, ObjectStorage, ShardedFileStorage,
+    create_storage, migrate)
+
+log_data = b"".join(b"%d,log line number %d\n" % (i, i) for i in range(1000))
+
+
+class TestLogStorage(BaseTestCase):
+    def setUp(self):
+        super(TestLogStorage, self).setUp()
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.directory)
+        super(TestLogStorage, self).tearDown()
+
+    def storages(self):
+        return (
+            FlatFileStorage(join(self.directory, "flat")),
+            ShardedFileStorage(join(self.directory, "sharded")),
+            create_storage(
+                "object", root=join(self.directory, "object-spool"),
+                url="file://" + join(self.directory, "objects")))
+
+    def test_check(self):
+        for storage in self.storages():
+            for identifier in ("", ".", "..", "../foo", "foo/bar", "a\0b"):
+                self.assertRaises(ValueError, storage.check, identifier)
+                self.assertRaises(ValueError, storage.open, identifier)
+            storage.check("2014-09-03_10-58-59_4_4ee02475.csv")
+
+    def test_sharded_layout(self):
+        storage = ShardedFileStorage(self.directory, depth=2)
+        self.assertEqual(
+            storage.path("foo.csv"),
+            join(self.directory, "22", "b8", "foo.csv"))
+        storage.write("foo.csv", log_data)
+        self.assertTrue(isfile(join(self.directory, "22", "b8", "foo.csv")))
+        self.assertEqual(listdir(self.directory), ["22"])
+
+    def test_write_and_read(self):
+        for storage in self.storages():
+            self.assertRaises(IOError, storage.open, "test.csv")
+            storage.write("test.csv", log_data)
+            logfile = storage.open("test.csv")
+            self.assertEqual(logfile.size, len(log_data))
+            self.assertEqual(b"".join(logfile.read(10, 2000)),
+                             log_data[10:2000])
+            self.assertEqual(b"".join(logfile.read_stored()), log_data)
+
+    def test_append(self):
+        for storage in self.storages():
+            self.assertEqual(storage.append("test.csv", 0, log_data[:100]),
+                             100)
+            with self.assertRaises(AppendConflict) as context:
+                storage.append("test.csv", 50, log_data[100:])
+            self.assertEqual(context.exception.size, 100)
+            self.assertEqual(
+                storage.append("test.csv", 100, log_data[100:]),
+                len(log_data))
+            self.assertEqual(
+                b"".join(storage.open("test.csv").read()), log_data)
+
+            storage.compress("test.csv")
+            with self.assertRaises(AppendConflict) as context:
+                storage.append("test.csv", len(log_data), b"more")
+            self.assertIsNone(context.exception.size)
+
+            # Neither a late chunk nor a new first chunk may start a new
+            # uncompressed log next to the compressed one
+            with self.assertRaises(AppendConflict) as context:
+                storage.append("test.csv", 0, b"more")
+            self.assertIsNone(context.exception.size)
+            self.assertEqual(
+                sorted(storage.names()), ["test.csv.gz", "test.csv.gz.idx"])
+
+    def test_append_missing(self):
+        for storage in self.storages():
+            with self.assertRaises(AppendConflict) as context:
+                storage.append("test.csv", 100, b"more")
+            self.assertEqual(context.exception.size, 0)
+            self.assertEqual(list(storage.names()), [])
+
+    def test_compress(self):
+        for storage in self.storages():
+            storage.write("plain.csv", log_data)
+            storage.write("compressed.csv", log_data)
+            storage.compress("compressed.csv", compresslevel=1)
+            logfile = storage.open("compressed.csv")
+            self.assertEqual(logfile.encoding, "gzip")
+            self.assertEqual(b"".join(logfile.read(500, 5000)),
+                             log_data[500:5000])
+            self.assertEqual(
+                sorted(storage.identifiers()),
+                ["compressed.csv", "plain.csv"])
+            self.assertEqual(
+                list(storage.identifiers(compressed=False)), ["plain.csv"])
+            self.assertEqual(
+                list(storage.identifiers(compressed=True)),
+                ["compressed.csv"])
+
+            storage.delete("compressed.csv")
+            self.assertRaises(IOError, storage.open, "compressed.csv")
+            self.assertEqual(list(storage.identifiers()), ["plain.csv"])
+
+    def test_object_storage_reads_ranges(self):
+        storage = create_storage(
+            "object", root=join(self.directory, "object-spool"),
+            url="file://" + join(self.directory, "objects"))
+        self.assertIsInstance(storage, ObjectStorage)
+        storage.write("test.csv", log_data)
+        storage.compress("test.csv")
+        logfile = storage.open("test.csv")
+        self.assertIsNone(logfile.path)
+        opened = []
+        open_range = logfile.open_range
+        logfile.open_range = lambda start, end: (
+            opened.append((start, end)) or open_range(start, end))
+        self.assertEqual(b"".join(logfile.read(10, 20)), log_data[10:20])
+        self.assertEqual(opened, [(0, logfile.stored_size)])
+
+    def test_object_storage_spools_appends(self):
+        storage = create_storage(
+            "object", root=join(self.directory, "object-spool"),
+            url="file://" + join(self.directory, "objects"))
+        storage.append("test.csv", 0, log_data[:100])
+        storage.append("test.csv", 100, log_data[100:])
+        self.assertEqual(list(storage.objects.keys()), [])
+        self.assertEqual(list(storage.names()), ["test.csv"])
+
+        storage.compress("test.csv")
+        self.assertEqual(list(storage.spool.names()), [])
+        self.assertEqual(
+            sorted(storage.objects.keys()),
+            ["test.csv.gz", "test.csv.gz.idx"])
+        self.assertEqual(b"".join(storage.open("test.csv").read()), log_data)
+
+    def test_object_storage_unspooled_log(self):
+        storage = create_storage(
+            "object", root=join(self.directory, "object-spool"),
+            url="file://" + join(self.directory, "objects"))
+        storage.objects.put("test.csv", BytesIO(log_data))
+        self.assertEqual(b"".join(storage.open("test.csv").read()), log_data)
+        storage.compress("test.csv")
+        self.assertEqual(
+            sorted(storage.names()), ["test.csv.gz", "test.csv.gz.idx"])
+        self.assertEqual(b"".join(storage.open("test.csv").read()), log_data)
+
+    def test_migrate(self):
+        flat, sharded, objects = self.storages()
+        flat.write("plain.csv", log_data)
+        flat.write("compressed.csv", log_data)
+        flat.compress("compressed.csv")
+
+        self.assertEqual(migrate(flat, sharded), 3)
+        self.assertEqual(list(flat.names()), [])
+        self.assertEqual(migrate(sharded, objects, remove_source=False), 3)
+        self.assertEqual(len(list(sharded.names())), 3)
+
+        for storage in (sharded, objects):
+            for identifier in ("plain.csv", "compressed.csv"):
+                self.assertEqual(
+                    b"".join(storage.open(identifier).read()), log_data)
+
+    def test_create_storage(self):
+        self.assertIsInstance(
+            create_storage("flat", root=self.directory), FlatFileStorage)
+        storage = create_storage("sharded", root=self.directory, depth=3)
+        self.assertEqual(storage.depth, 3)
+        self.assertRaises(ValueError, create_storage, "tape")
+        self.assertRaises(
+            ValueError, create_storage, "object", url="ftp://example.com/")
+
+    def test_truncate(self):
+        for storage in self.storages():
+            storage.write("test.csv", log_data)
+            size = storage.compress("test.csv")
+            self.assertEqual(size, storage.open("test.csv").stored_size)
+
+            size = storage.truncate("test.csv", 10)
+            logfile = storage.open("test.csv")
+            self.assertEqual(logfile.encoding, "gzip")
+            self.assertEqual(size, logfile.stored_size)
+            self.assertEqual(b"".join(logfile.read()),
+                             b"".join(log_data.splitlines(True)[-10:]))
+            self.assertEqual(list(storage.identifiers()), ["test.csv"])
@@ -0,0 +1,146 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.utility import dumps
+from pyfarm.master.application import (
+    app, db, get_api_blueprint, route_reads, teardown_route_reads,
+    replica_lag)
+from pyfarm.master.config import config
+from pyfarm.master.entrypoints import load_api
+from pyfarm.models.tag import Tag
+
+
+class TestReadReplica(BaseTestCase):
+    def setup_app(self):
+        super(TestReadReplica, self).setup_app()
+        self.api = get_api_blueprint()
+        self.app.register_blueprint(self.api)
+        load_api(self.app, self.api)
+        self.app.before_request(route_reads)
+        self.app.teardown_request(teardown_route_reads)
+
+    def setup_database(self):
+        super(TestReadReplica, self).setup_database()
+        # The replica is a separate, empty database so it's easy to tell
+        # where a read went
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+        binds = app.config["SQLALCHEMY_BINDS"]
+        self.addCleanup(app.config.__setitem__, "SQLALCHEMY_BINDS", binds)
+        app.config["SQLALCHEMY_BINDS"] = dict(
+            binds, replica="sqlite:///" + join(self.directory, "replica.db"))
+        self.addCleanup(self.dispose_replica)
+
+        self.replica = db.get_engine(app, bind="replica")
+        db.Model.metadata.create_all(
+            bind=self.replica, tables=db.get_tables_for_bind())
+
+        tag = Tag(tag="primary")
+        db.session.add(tag)
+        db.session.commit()
+        self.tag_id = tag.id
+
+    def dispose_replica(self):
+        connectors = app.extensions["sqlalchemy"].connectors
+        connector = connectors.pop("replica", None)
+        if connector is not None:
+            connector.get_engine().dispose()
+
+    def set_config(self, key, value):
+        self.addCleanup(config.__setitem__, key, config[key])
+        config[key] = value
+
+    def tags(self):
+        response = self.client.get("/api/v1/tags/")
+        self.assert_ok(response)
+        return [tag["tag"] for tag in response.json]
+
+    def test_get_reads_from_replica(self):
+        self.assertEqual(self.tags(), [])
+        # Nothing after the request is routed to the replica
+        self.assertEqual(
+            [tag.tag for tag in Tag.query], ["primary"])
+
+    def test_endpoint_on_primary(self):
+        self.set_config("read_replica_endpoints", {"api.tag_index_api": None})
+        self.assertEqual(self.tags(), ["primary"])
+
+    def test_replica_lagging(self):
+        self.set_config("read_replica_max_lag", 10)
+        self.addCleanup(setattr, replica_lag, "lag", replica_lag.lag)
+        self.addCleanup(setattr, replica_lag, "checked", replica_lag.checked)
+        replica_lag.checked = float("inf")
+        replica_lag.lag = 60
+        self.assertEqual(self.tags(), ["primary"])
+        replica_lag.lag = 5
+        self.assertEqual(self.tags(), [])
+
+    def test_measure_postgresql(self):
+        statements = []
+
+        class Result(object):
+            def scalar(self):
+                return 2.5
+
+        class Connection(object):
+            def __init__(self, version):
+                self.dialect = type(
+                    "Dialect", (object, ), {"server_version_info": version})
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, statement):
+                statements.append(statement)
+                return Result()
+
+        for version, function in (((9, 6), "pg_last_xlog_replay_location()"),
+                                  ((12, 4), "pg_last_wal_replay_lsn()")):
+            engine = type("Engine", (object, ), {
+                "dialect": type("Dialect", (object, ), {"name": "postgresql"}),
+                "connect": lambda self, version=version: Connection(version)})
+            self.assertEqual(replica_lag.measure(engine()), 2.5)
+            self.assertIn(function, statements[-1])
+
+    def test_writes_go_to_primary(self):
+        response = self.client.post(
+            "/api/v1/tags/", content_type="application/json",
+            data=dumps({"tag": "new"}))
+        self.assert_created(response)
+        self.assertEqual(Tag.query.filter_by(tag="new").count(), 1)
+        self.assertEqual(self.tags(), [])
+
+    def test_reads_after_write_go_to_primary(self):
+        db.session.info["max_replica_lag"] = 10
+        self.addCleanup(teardown_route_reads)
+        self.assertEqual(Tag.query.count(), 0)
+
+        db.session.add(Tag(tag="new"))
+        db.session.flush()
+        self.assertIsNone(db.session.info["max_replica_lag"])
+        self.assertEqual(
+            sorted(tag.tag for tag in Tag.query), ["new", "primary"])
@@ -0,0 +1,160 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import get_api_blueprint, db
+from pyfarm.master.entrypoints import load_api
+from pyfarm.models.statistics.agent_count import AgentCount
+from pyfarm.models.statistics.task_count import TaskCount
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.scheduler.statistics_tasks import update_rollups
+
+
+class TestStatisticsAPI(BaseTestCase):
+    def setup_app(self):
+        super(TestStatisticsAPI, self).setup_app()
+        self.api = get_api_blueprint()
+        self.app.register_blueprint(self.api)
+        load_api(self.app, self.api)
+
+    def setup_database(self):
+        super(TestStatisticsAPI, self).setup_database()
+        now = datetime.utcnow()
+        self.day = datetime(now.year, now.month, now.day) - timedelta(days=2)
+
+    def get(self, endpoint, start, end, **arguments):
+        arguments.update(start=start.isoformat(), end=end.isoformat())
+        return self.client.get(
+            "/api/v1/statistics/%s" % endpoint, query_string=arguments)
+
+    def add_agent_count(self, seconds, num_online):
+        db.session.add(AgentCount(
+            counted_time=self.day + timedelta(seconds=seconds),
+            num_online=num_online, num_running=1, num_offline=0,
+            num_disabled=0))
+
+    def test_agent_counts(self):
+        for seconds, num_online in ((0, 2), (10, 4), (70, 6)):
+            self.add_agent_count(seconds, num_online)
+        db.session.commit()
+
+        response = self.get("agent_counts", self.day,
+                            self.day + timedelta(minutes=10), max_points=20)
+        self.assert_ok(response)
+        self.assertEqual(response.json["resolution"], 30)
+        self.assertIsNone(response.json["source_resolution"])
+        self.assertEqual(
+            [(point["time"], point["num_samples"], point["num_online"],
+              point["num_running"]["avg"])
+             for point in response.json["points"]],
+            [(self.day.isoformat(), 2,
+              {"avg": 3.0, "min": 2.0, "max": 4.0}, 1.0),
+             ((self.day + timedelta(seconds=60)).isoformat(), 1,
+              {"avg": 6.0, "min": 6.0, "max": 6.0}, 1.0)])
+
+    def test_agent_counts_unaligned_start(self):
+        for seconds, num_online in ((7, 2), (36, 4), (40, 6), (66, 8)):
+            self.add_agent_count(seconds, num_online)
+        db.session.commit()
+
+        start = self.day + timedelta(seconds=7)
+        response = self.get("agent_counts", start,
+                            start + timedelta(seconds=60), max_points=2)
+        self.assert_ok(response)
+        self.assertEqual(response.json["resolution"], 30)
+        self.assertEqual(
+            [(point["time"], point["num_samples"])
+             for point in response.json["points"]],
+            [(start.isoformat(), 2),
+             ((start + timedelta(seconds=30)).isoformat(), 2)])
+
+    def test_agent_counts_from_rollups(self):
+        for hours, num_online in ((0, 2), (0.5, 4), (1, 6), (25, 8)):
+            self.add_agent_count(hours * 3600, num_online)
+        db.session.commit()
+        update_rollups(now=self.day + timedelta(days=1, hours=1))
+
+        response = self.get("agent_counts", self.day,
+                            self.day + timedelta(days=1), max_points=24)
+        self.assert_ok(response)
+        self.assertEqual(response.json["resolution"], 3600)
+        self.assertEqual(response.json["source_resolution"], 3600)
+        self.assertEqual(
+            [(point["num_samples"], point["num_online"]["avg"])
+             for point in response.json["points"]],
+            [(1, 3.0), (1, 6.0)])
+
+    def test_task_counts_by_queue(self):
+        for job_queue_id, total_queued in ((None, 1), (1, 2), (2, 4)):
+            for seconds in (0, 10):
+                db.session.add(TaskCount(
+                    counted_time=self.day + timedelta(seconds=seconds),
+                    job_queue_id=job_queue_id,
+                    total_queued=total_queued * (seconds + 1),
+                    total_running=0, total_done=0, total_failed=0))
+        db.session.commit()
+
+        end = self.day + timedelta(seconds=20)
+        for arguments, expected in (
+                ({}, {"avg": 42.0, "min": 7.0, "max": 77.0}),
+                ({"queue": 1}, {"avg": 12.0, "min": 2.0, "max": 22.0}),
+                ({"queue": 1, "no_queue": "true"},
+                 {"avg": 18.0, "min": 3.0, "max": 33.0}),
+                ({"no_queue": "true"},
+                 {"avg": 6.0, "min": 1.0, "max": 11.0})):
+            response = self.get("task_counts", self.day, end, max_points=1,
+                                **arguments)
+            self.assert_ok(response)
+            self.assertEqual(
+                [point["total_queued"] for point in response.json["points"]],
+                [expected])
+
+    def test_task_events(self):
+        for seconds, job_queue_id, num_new in (
+                (0, None, 1), (10, 1, 2), (70, None, 4)):
+            event_count = TaskEventCount(
+                job_queue_id=job_queue_id, num_new=num_new, num_done=1)
+            event_count.time_start = self.day + timedelta(seconds=seconds)
+            event_count.time_end = event_count.time_start
+            db.session.add(event_count)
+        db.session.commit()
+
+        response = self.get("task_events", self.day,
+                            self.day + timedelta(minutes=2), max_points=4)
+        self.assert_ok(response)
+        self.assertEqual(
+            [(point["num_samples"], point["num_new"], point["num_done"])
+             for point in response.json["points"]],
+            [(2, 3, 2), (1, 4, 1)])
+
+    def test_invalid_arguments(self):
+        end = self.day + timedelta(hours=1)
+        self.assert_bad_request(self.get("task_events", end, self.day))
+        self.assert_bad_request(
+            self.get("task_events", self.day, end, max_points=0))
+        self.assert_bad_request(
+            self.get("task_events", self.day, end, max_points=10 ** 6))
+        self.assert_bad_request(
+            self.get("task_counts", self.day, end, queue="foo"))
+        self.assert_bad_request(
+            self.get("agent_counts", self.day, end, queue=1))
+        self.assert_bad_request(self.client.get(
+            "/api/v1/statistics/agent_counts?start=yesterday"))
@@ -16,14 +16,36 @@
 # limitations under the License.
 
 import uuid
+from datetime import datetime, timedelta
+from gzip import GzipFile
+from io import BytesIO
+from os.path import isfile, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+try:
+    from httplib import (
+        PARTIAL_CONTENT, REQUESTED_RANGE_NOT_SATISFIABLE, CONFLICT,
+        SERVICE_UNAVAILABLE, TEMPORARY_REDIRECT)
+except ImportError:
+    from http.client import (
+        PARTIAL_CONTENT, REQUESTED_RANGE_NOT_SATISFIABLE, CONFLICT,
+        SERVICE_UNAVAILABLE, TEMPORARY_REDIRECT)
 
 # test class must be loaded first
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
 from pyfarm.master.utility import dumps
-from pyfarm.master.application import get_api_blueprint
+from pyfarm.master.application import get_api_blueprint, db
 from pyfarm.master.entrypoints import load_api
+from pyfarm.scheduler import tasks
+from pyfarm.scheduler.tasks import compress_task_log, compress_task_log_batch
+from pyfarm.master.api import tasklogs
+from pyfarm.master.logsearch import log_index
+from pyfarm.master.logstorage import storage
+from pyfarm.models.task import Task
+from pyfarm.models.tasklog import TaskLog
 
 
 dummy_log = """1,test log entry
@@ -402,3 +424,369 @@ class TestTaskLogsAPI(BaseTestCase):
             "/api/v1/jobs/%s/tasks/%s/attempts/1/logs/"
             "testlogidentifier-neveruploaded/logfile" % (job_id, task_id))
         self.assert_not_found(response2)
+
+    def upload_log(self, identifier, data):
+        job_id, task_id, agent_id = self.make_objects()
+        response1 = self.client.post(
+            "/api/v1/jobs/%s/tasks/%s/attempts/1/logs/" % (job_id, task_id),
+            content_type="application/json",
+            data=dumps({"identifier": identifier, "agent_id": agent_id}))
+        self.assert_created(response1)
+
+        storage.delete(identifier)
+        self.addCleanup(storage.delete, identifier)
+
+        url = ("/api/v1/jobs/%s/tasks/%s/attempts/1/logs/%s/logfile" %
+               (job_id, task_id, identifier))
+        response2 = self.client.put(url, content_type="text/csv", data=data)
+        self.assert_created(response2)
+        return url
+
+    def test_task_logs_download_logfile_partial(self):
+        log = "".join("%s,line %s\n" % (i, i) for i in range(100))
+        url = self.upload_log("testlogidentifier-partial", log)
+
+        for compressed in (False, True):
+            if compressed:
+                compress_task_log("testlogidentifier-partial")
+
+            response1 = self.client.get(url, headers={"Range": "bytes=10-19"})
+            self.assert_status(response1, PARTIAL_CONTENT)
+            self.assertEqual(response1.data.decode(), log[10:20])
+            self.assertEqual(response1.headers["Content-Range"],
+                             "bytes 10-19/%s" % len(log))
+
+            response2 = self.client.get(url, headers={"Range": "bytes=-5"})
+            self.assert_status(response2, PARTIAL_CONTENT)
+            self.assertEqual(response2.data.decode(), log[-5:])
+
+            response3 = self.client.get(
+                url, headers={"Range": "bytes=%s-" % (len(log) + 1)})
+            self.assert_status(response3, REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.assertEqual(response3.headers["Content-Range"],
+                             "bytes */%s" % len(log))
+
+            response4 = self.client.get(url + "?tail=3")
+            self.assert_ok(response4)
+            self.assertEqual(response4.data.decode(),
+                             "97,line 97\n98,line 98\n99,line 99\n")
+            self.assertEqual(int(response4.headers["X-Log-Offset"]),
+                             len(log) - len(response4.data))
+            self.assertEqual(int(response4.headers["X-Log-Size"]), len(log))
+
+            response5 = self.client.get(url + "?offset=%s" % (len(log) - 11))
+            self.assert_ok(response5)
+            self.assertEqual(response5.data.decode(), "99,line 99\n")
+
+            response6 = self.client.get(url)
+            self.assert_ok(response6)
+            self.assertEqual(response6.data.decode(), log)
+            self.assertEqual(response6.headers["Accept-Ranges"], "bytes")
+
+    def test_task_logs_download_logfile_bad_arguments(self):
+        url = self.upload_log("testlogidentifier-arguments", dummy_log)
+        self.assert_bad_request(self.client.get(url + "?tail=1&offset=1"))
+        self.assert_bad_request(self.client.get(url + "?tail=-1"))
+        self.assert_bad_request(self.client.get(url + "?offset=a"))
+
+    def test_task_logs_append_logfile(self):
+        url = self.upload_log("testlogidentifier-append", "")
+
+        response1 = self.client.post(
+            url + "?offset=0", content_type="text/csv", data="1,first\n")
+        self.assert_ok(response1)
+        self.assertEqual(response1.json, {"size": 8})
+
+        response2 = self.client.post(
+            url + "?offset=8", content_type="text/csv", data="2,second\n")
+        self.assert_ok(response2)
+        self.assertEqual(response2.json, {"size": 17})
+        db.session.expire_all()
+        self.assertEqual(
+            TaskLog.query.filter_by(
+                identifier="testlogidentifier-append").one().size, 17)
+
+        # overlap, for instance a retried chunk
+        response3 = self.client.post(
+            url + "?offset=8", content_type="text/csv", data="2,second\n")
+        self.assert_status(response3, CONFLICT)
+        self.assertEqual(response3.json["size"], 17)
+
+        # gap
+        response4 = self.client.post(
+            url + "?offset=20", content_type="text/csv", data="4,fourth\n")
+        self.assert_status(response4, CONFLICT)
+        self.assertEqual(response4.json["size"], 17)
+
+        response5 = self.client.get(url)
+        self.assert_ok(response5)
+        self.assertEqual(response5.data.decode(), "1,first\n2,second\n")
+
+        compress_task_log("testlogidentifier-append")
+        response6 = self.client.post(
+            url + "?offset=17", content_type="text/csv", data="3,third\n")
+        self.assert_status(response6, CONFLICT)
+
+    def test_task_logs_append_logfile_bad_offset(self):
+        url = self.upload_log("testlogidentifier-append-offset", "")
+        self.assert_bad_request(
+            self.client.post(url, content_type="text/csv", data="1,first\n"))
+        self.assert_bad_request(
+            self.client.post(url + "?offset=-1", content_type="text/csv",
+                             data="1,first\n"))
+
+    def test_task_logs_download_compressed_logfile(self):
+        url = self.upload_log("testlogidentifier-encoding", dummy_log)
+
+        response1 = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assert_ok(response1)
+        self.assertNotIn("Content-Encoding", response1.headers)
+        self.assertEqual(response1.data.decode(), dummy_log)
+
+        compress_task_log("testlogidentifier-encoding")
+
+        response2 = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assert_ok(response2)
+        self.assertEqual(response2.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response2.headers["Vary"], "Accept-Encoding")
+        with GzipFile(fileobj=BytesIO(response2.data)) as logfile:
+            self.assertEqual(logfile.read().decode(), dummy_log)
+
+        response3 = self.client.get(
+            url, headers={"Accept-Encoding": "gzip;q=0, identity"})
+        self.assert_ok(response3)
+        self.assertNotIn("Content-Encoding", response3.headers)
+        self.assertEqual(response3.data.decode(), dummy_log)
+
+    def test_task_logs_download_logfile_sendfile(self):
+        url = self.upload_log("testlogidentifier-sendfile", dummy_log)
+        path = storage.path("testlogidentifier-sendfile")
+
+        self.addCleanup(setattr, tasklogs, "SENDFILE", tasklogs.SENDFILE)
+        tasklogs.SENDFILE = "x-sendfile"
+        response1 = self.client.get(url)
+        self.assert_ok(response1)
+        self.assertEqual(response1.headers["X-Sendfile"], path)
+        self.assertEqual(response1.data, b"")
+
+        compress_task_log("testlogidentifier-sendfile")
+        tasklogs.SENDFILE = "x-accel-redirect"
+        response2 = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assert_ok(response2)
+        self.assertEqual(
+            response2.headers["X-Accel-Redirect"],
+            tasklogs.ACCEL_REDIRECT_PREFIX +
+            storage.relative_path("testlogidentifier-sendfile") + ".gz")
+        self.assertEqual(response2.headers["Content-Encoding"], "gzip")
+
+        # Partial reads are never handed off
+        response3 = self.client.get(url + "?tail=1")
+        self.assert_ok(response3)
+        self.assertNotIn("X-Accel-Redirect", response3.headers)
+        self.assertEqual(response3.data.decode(), "2,another test log entry\n")
+
+    def test_task_logs_compress_batch(self):
+        url = self.upload_log("testlogidentifier-batch", dummy_log)
+        path = storage.path("testlogidentifier-batch")
+
+        # A missing log must not keep the others from being compressed
+        compress_task_log_batch(["testlogidentifier-batch-missing",
+                                 "testlogidentifier-batch"])
+        self.assertFalse(isfile(path))
+        self.assertTrue(isfile(path + ".gz.idx"))
+        response = self.client.get(url)
+        self.assert_ok(response)
+        self.assertEqual(response.data.decode(), dummy_log)
+
+    def test_task_logs_compress_skips_unfinished_tasks(self):
+        url = self.upload_log("testlogidentifier-running", dummy_log)
+        task_id = int(url.split("/")[6])
+        task = Task.query.filter_by(id=task_id).first()
+        task.state = "running"
+        task.attempts = 1
+        db.session.add(task)
+        db.session.commit()
+
+        batches = []
+        self.addCleanup(setattr, compress_task_log_batch, "delay",
+                        compress_task_log_batch.delay)
+        compress_task_log_batch.delay = batches.append
+        tasks.compress_task_logs()
+        queued = [name for batch in batches for name in batch]
+        self.assertNotIn("testlogidentifier-running", queued)
+
+        task.state = "done"
+        db.session.add(task)
+        db.session.commit()
+        del batches[:]
+        tasks.compress_task_logs()
+        queued = [name for batch in batches for name in batch]
+        self.assertIn("testlogidentifier-running", queued)
+
+    def test_task_logs_clean_up_orphans(self):
+        url = self.upload_log("testlogidentifier-kept", dummy_log)
+        compress_task_log("testlogidentifier-kept")
+        for index in range(5):
+            identifier = "testlogidentifier-orphan%s" % index
+            storage.write(identifier, b"orphan")
+            self.addCleanup(storage.delete, identifier)
+        orphan = TaskLog(identifier="testlogidentifier-unassociated")
+        db.session.add(orphan)
+        db.session.commit()
+
+        self.addCleanup(setattr, tasks, "CLEANUP_BATCH_SIZE",
+                        tasks.CLEANUP_BATCH_SIZE)
+        tasks.CLEANUP_BATCH_SIZE = 2
+        tasks.clean_up_orphaned_task_logs()
+
+        self.assertEqual(
+            TaskLog.query.filter_by(
+                identifier="testlogidentifier-unassociated").count(), 0)
+        self.assertEqual(list(storage.identifiers()),
+                         ["testlogidentifier-kept"])
+        response = self.client.get(url)
+        self.assert_ok(response)
+        self.assertEqual(response.data.decode(), dummy_log)
+
+    def test_task_logs_search(self):
+        self.assert_status(
+            self.client.get("/api/v1/tasklogs/search?q=memory"),
+            SERVICE_UNAVAILABLE)
+
+        directory = mkdtemp()
+        self.addCleanup(rmtree, directory)
+        self.addCleanup(log_index.configure, log_index.path)
+        log_index.configure(join(directory, "index.sqlite"))
+
+        url = self.upload_log(
+            "testlogidentifier-search", "1,Error: out of memory\n")
+        job_id, task_id = [int(part) for part in url.split("/")[4:7:2]]
+        tasks.index_task_logs(["testlogidentifier-search"])
+
+        response1 = self.client.get(
+            "/api/v1/tasklogs/search?q=out+of+memory&job=%s" % job_id)
+        self.assert_ok(response1)
+        self.assertEqual(len(response1.json), 1)
+        self.assertEqual(response1.json[0]["identifier"],
+                         "testlogidentifier-search")
+        self.assertEqual(response1.json[0]["offset"], 0)
+        self.assertEqual(response1.json[0]["tasks"], [
+            {"job_id": job_id, "task_id": task_id, "attempt": 1}])
+
+        response2 = self.client.get(
+            "/api/v1/tasklogs/search?q=out+of+memory&job=%s" % (job_id + 1))
+        self.assert_ok(response2)
+        self.assertEqual(response2.json, [])
+
+        self.assert_bad_request(self.client.get("/api/v1/tasklogs/search"))
+        self.assert_bad_request(
+            self.client.get("/api/v1/tasklogs/search?q=memory&since=monday"))
+        self.assert_bad_request(
+            self.client.get("/api/v1/tasklogs/search?q=memory&limit=0"))
+
+    def set_retention(self, name, value):
+        self.addCleanup(setattr, tasks, name, getattr(tasks, name))
+        setattr(tasks, name, value)
+
+    def test_task_logs_compress_skips_recent_logs(self):
+        self.upload_log("testlogidentifier-recent", dummy_log)
+        self.set_retention("DEFAULT_RETENTION", tasks.RetentionPolicy(
+            raw=timedelta(hours=1), compressed=None, tail_lines=0))
+
+        batches = []
+        self.addCleanup(setattr, compress_task_log_batch, "delay",
+                        compress_task_log_batch.delay)
+        compress_task_log_batch.delay = batches.append
+        tasks.compress_task_logs()
+        self.assertEqual(batches, [])
+
+        log = TaskLog.query.filter_by(
+            identifier="testlogidentifier-recent").one()
+        log.created_on = datetime.utcnow() - timedelta(hours=2)
+        db.session.add(log)
+        db.session.commit()
+        tasks.compress_task_logs()
+        self.assertEqual(batches, [["testlogidentifier-recent"]])
+
+    def test_task_logs_retention_policies(self):
+        week = tasks.RetentionPolicy(timedelta(), timedelta(days=7), 0)
+        month = tasks.RetentionPolicy(timedelta(), timedelta(days=30), 10)
+        self.set_retention("JOBQUEUE_RETENTION", {"Renders": week})
+        self.set_retention("JOBTYPE_RETENTION", {"Nuke": month})
+
+        self.assertEqual(
+            tasks.task_log_retention("/Renders/Dailies", "Maya"), week)
+        self.assertEqual(tasks.task_log_retention("/Renders", "Maya"), week)
+        self.assertEqual(
+            tasks.task_log_retention("/Renders/Dailies", "Nuke"), month)
+        self.assertEqual(tasks.task_log_retention("/RendersOld", "Maya"),
+                         tasks.DEFAULT_RETENTION)
+        self.assertEqual(tasks.task_log_retention(None, "Maya"),
+                         tasks.DEFAULT_RETENTION)
+
+    def test_task_logs_retention_keeps_tail(self):
+        log_data = "".join("%s,line %s\n" % (i, i) for i in range(1000))
+        url = self.upload_log("testlogidentifier-tail", log_data)
+        compress_task_log_batch(["testlogidentifier-tail"])
+        log = TaskLog.query.filter_by(
+            identifier="testlogidentifier-tail").one()
+        self.assertEqual(log.size,
+                         storage.open("testlogidentifier-tail").stored_size)
+
+        self.set_retention("JOBTYPE_RETENTION", {
+            "TestJobType": tasks.RetentionPolicy(
+                raw=timedelta(hours=1), compressed=timedelta(days=7),
+                tail_lines=10)})
+        tasks.apply_task_log_retention()
+        response1 = self.client.get(url)
+        self.assert_ok(response1)
+        self.assertEqual(response1.data.decode(), log_data)
+
+        log.created_on = datetime.utcnow() - timedelta(days=8)
+        db.session.add(log)
+        db.session.commit()
+        tasks.apply_task_log_retention()
+
+        response2 = self.client.get(url)
+        self.assert_ok(response2)
+        self.assertEqual(response2.data.decode(),
+                         "".join(log_data.splitlines(True)[-10:]))
+        log = TaskLog.query.filter_by(
+            identifier="testlogidentifier-tail").one()
+        self.assertTrue(log.tail_only)
+        self.assertEqual(log.size,
+                         storage.open("testlogidentifier-tail").stored_size)
+
+    def test_task_logs_quota(self):
+        url = self.upload_log("testlogidentifier-old", dummy_log)
+        new_url = url.replace("testlogidentifier-old", "testlogidentifier-new")
+        response1 = self.client.post(
+            url.rsplit("/", 2)[0] + "/", content_type="application/json",
+            data=dumps({"identifier": "testlogidentifier-new"}))
+        self.assert_created(response1)
+        self.addCleanup(storage.delete, "testlogidentifier-new")
+        self.assert_created(self.client.put(
+            new_url, content_type="text/csv", data=dummy_log))
+
+        old = TaskLog.query.filter_by(identifier="testlogidentifier-old").one()
+        old.created_on = datetime.utcnow() - timedelta(days=1)
+        old.size = None
+        db.session.add(old)
+        db.session.commit()
+
+        self.set_retention("TASKLOG_QUOTA", len(dummy_log) * 2)
+        tasks.apply_task_log_retention()
+        self.assertEqual(
+            TaskLog.query.filter_by(
+                identifier="testlogidentifier-old").one().size,
+            len(dummy_log))
+        self.assert_ok(self.client.get(url))
+
+        self.set_retention("TASKLOG_QUOTA", len(dummy_log))
+        tasks.apply_task_log_retention()
+        self.assertEqual(
+            TaskLog.query.filter_by(
+                identifier="testlogidentifier-old").one().size, 0)
+        # The master no longer has the log and points to the agent
+        self.assert_status(self.client.get(url), TEMPORARY_REDIRECT)
+        self.assert_ok(self.client.get(new_url))
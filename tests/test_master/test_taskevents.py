@@ -0,0 +1,97 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import db
+from pyfarm.master.taskevents import TaskEventAccumulator
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+
+
+class TestTaskEventAccumulator(BaseTestCase):
+    def setUp(self):
+        super(TestTaskEventAccumulator, self).setUp()
+        # Flushed by hand, this keeps the background thread from starting
+        self.task_events = TaskEventAccumulator(flush_interval=3600)
+        self.task_events.start_flusher = lambda: None
+
+    def test_count_without_interval(self):
+        task_events = TaskEventAccumulator()
+        task_events.count(1, num_new=2)
+        db.session.commit()
+        self.assertEqual(
+            [(count.job_queue_id, count.num_new)
+             for count in TaskEventCount.query], [(1, 2)])
+        self.assertEqual(task_events.pending, {})
+
+    def test_count_unknown_event(self):
+        with self.assertRaises(ValueError):
+            self.task_events.count(None, num_foo=1)
+
+    def test_count_waits_for_commit(self):
+        self.task_events.count(1, num_new=2)
+        self.assertEqual(self.task_events.pending, {})
+        db.session.commit()
+        self.assertEqual(self.task_events.pending[1]["num_new"], 2)
+
+    def test_count_rollback(self):
+        self.task_events.count(1, num_new=2)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(self.task_events.pending, {})
+
+    def test_flush(self):
+        self.assertEqual(self.task_events.flush(), 0)
+        self.task_events.count(None, num_new=3)
+        self.task_events.count(None, num_started=1, num_new=1)
+        self.task_events.count(1, num_deleted=5)
+        db.session.commit()
+        self.assertEqual(TaskEventCount.query.count(), 0)
+
+        self.assertEqual(self.task_events.flush(), 2)
+        self.assertEqual(self.task_events.pending, {})
+        counts = sorted(
+            TaskEventCount.query, key=lambda count: count.job_queue_id or 0)
+        self.assertEqual(
+            [(count.job_queue_id, count.num_new, count.num_started,
+              count.num_deleted) for count in counts],
+            [(None, 4, 1, 0), (1, 0, 0, 5)])
+        self.assertEqual(counts[0].time_start, counts[1].time_start)
+        self.assertLessEqual(counts[0].time_start, counts[0].time_end)
+
+    def test_flush_failure_keeps_counts(self):
+        self.task_events.count(1, num_done=2)
+        db.session.commit()
+        time_start = self.task_events.time_start
+        insert = TaskEventCount.__table__.insert
+        self.addCleanup(setattr, TaskEventCount.__table__, "insert", insert)
+
+        def failing_insert():
+            raise RuntimeError("database unavailable")
+        TaskEventCount.__table__.insert = failing_insert
+
+        self.assertEqual(self.task_events.flush(), 0)
+        self.task_events.count(1, num_done=1)
+        db.session.commit()
+        self.assertEqual(self.task_events.pending[1]["num_done"], 3)
+        self.assertEqual(self.task_events.time_start, time_start)
+
+        TaskEventCount.__table__.insert = insert
+        self.assertEqual(self.task_events.flush(), 1)
+        self.assertEqual(
+            [count.num_done for count in TaskEventCount.query], [3])
@@ -0,0 +1,175 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+
+try:
+    from httplib import NOT_MODIFIED
+except ImportError:
+    from http.client import NOT_MODIFIED
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.utility import dumps
+from pyfarm.master.application import get_api_blueprint, db
+from pyfarm.master.entrypoints import load_api
+from pyfarm.master.writebehind import write_behind
+from pyfarm.models.agent import Agent
+from pyfarm.models.task import Task
+from pyfarm.models.change import Change
+
+
+class TestWriteBehind(BaseTestCase):
+    def setup_app(self):
+        super(TestWriteBehind, self).setup_app()
+        self.api = get_api_blueprint()
+        self.app.register_blueprint(self.api)
+        load_api(self.app, self.api)
+
+    def setUp(self):
+        super(TestWriteBehind, self).setUp()
+        write_behind.configure("memory://")
+
+    def tearDown(self):
+        write_behind.configure(None)
+        super(TestWriteBehind, self).tearDown()
+
+    def create_agent(self):
+        agent_id = uuid.uuid4()
+        response = self.client.post(
+            "/api/v1/agents/",
+            content_type="application/json",
+            data=dumps({
+                "id": agent_id,
+                "cpus": 16,
+                "free_ram": 133,
+                "hostname": "testagent1",
+                "remote_ip": "10.0.200.1",
+                "port": 64994,
+                "ram": 2048,
+                "state": "online"}))
+        self.assert_created(response)
+        return agent_id
+
+    def stored_free_ram(self, agent_id):
+        # Column queries don't go through the buffer
+        return db.session.query(Agent.free_ram).filter(
+            Agent.id == agent_id).scalar()
+
+    def test_agent_heartbeat_buffered(self):
+        agent_id = self.create_agent()
+
+        response1 = self.client.get("/api/v1/agents/%s" % agent_id)
+        self.assert_ok(response1)
+        etag = response1.headers["ETag"]
+
+        response2 = self.client.post(
+            "/api/v1/agents/%s" % agent_id,
+            content_type="application/json",
+            data=dumps({"free_ram": 512}))
+        self.assert_ok(response2)
+        self.assertEqual(response2.json["free_ram"], 512)
+        self.assertEqual(self.stored_free_ram(agent_id), 133)
+
+        response3 = self.client.get(
+            "/api/v1/agents/%s" % agent_id, headers={"If-None-Match": etag})
+        self.assert_ok(response3)
+        self.assertEqual(response3.json["free_ram"], 512)
+
+        self.assertEqual(write_behind.flush(), 1)
+        self.assertEqual(self.stored_free_ram(agent_id), 512)
+        self.assertEqual(write_behind.pending(Agent, agent_id), {})
+
+        response4 = self.client.get(
+            "/api/v1/agents/%s" % agent_id, headers={"If-None-Match": etag})
+        self.assert_ok(response4)
+        self.assertEqual(response4.json["free_ram"], 512)
+
+        response5 = self.client.get(
+            "/api/v1/agents/%s" % agent_id,
+            headers={"If-None-Match": response4.headers["ETag"]})
+        self.assert_status(response5, NOT_MODIFIED)
+
+    def test_orm_write_discards_pending(self):
+        agent_id = self.create_agent()
+        agent = Agent.query.filter_by(id=agent_id).first()
+        write_behind.set(agent, free_ram=512)
+        self.assertIn("free_ram", write_behind.pending(Agent, agent_id))
+
+        agent.free_ram = 1024
+        db.session.commit()
+        self.assertEqual(write_behind.pending(Agent, agent_id), {})
+        self.assertEqual(write_behind.flush(), 0)
+        self.assertEqual(self.stored_free_ram(agent_id), 1024)
+
+    def test_task_progress_buffered(self):
+        response1 = self.client.post(
+            "/api/v1/jobtypes/",
+            content_type="application/json",
+            data=dumps({
+                "name": "TestJobType",
+                "description": "Jobtype for testing inserts and queries",
+                "max_batch": 1,
+                "code": "dummy code"}))
+        self.assert_created(response1)
+        response2 = self.client.post(
+            "/api/v1/jobs/",
+            content_type="application/json",
+            data=dumps({
+                "start": 1.0,
+                "end": 1.0,
+                "title": "Test Job",
+                "jobtype": "TestJobType",
+                "data": {"foo": "bar"},
+                "software_requirements": []}))
+        self.assert_created(response2)
+        job_id = response2.json["id"]
+        task_id = self.client.get(
+            "/api/v1/jobs/%s/tasks/" % job_id).json[0]["id"]
+        last_change = db.session.query(db.func.max(Change.id)).scalar()
+
+        response3 = self.client.post(
+            "/api/v1/jobs/%s/tasks/%s" % (job_id, task_id),
+            content_type="application/json",
+            data=dumps({"progress": 0.5}))
+        self.assert_ok(response3)
+        self.assertEqual(response3.json["progress"], 0.5)
+        self.assertEqual(
+            db.session.query(Task.progress).filter(
+                Task.id == task_id).scalar(), 0.0)
+
+        response4 = self.client.get(
+            "/api/v1/jobs/%s/tasks/%s" % (job_id, task_id))
+        self.assert_ok(response4)
+        self.assertEqual(response4.json["progress"], 0.5)
+
+        self.assertEqual(write_behind.flush(), 1)
+        self.assertEqual(
+            db.session.query(Task.progress).filter(
+                Task.id == task_id).scalar(), 0.5)
+        # progress is not published in the change feed
+        self.assertEqual(
+            Change.query.filter(Change.id > last_change).count(), 0)
+
+    def test_disabled_writes_through(self):
+        agent_id = self.create_agent()
+        write_behind.configure(None)
+        agent = Agent.query.filter_by(id=agent_id).first()
+        write_behind.set(agent, free_ram=512)
+        db.session.commit()
+        self.assertEqual(self.stored_free_ram(agent_id), 512)
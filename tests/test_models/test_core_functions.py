@@ -16,15 +16,16 @@
 
 from uuid import uuid4
 
-from sqlalchemy import Column, Integer, DateTime
+from sqlalchemy import Column, Integer, DateTime, literal, select
 
 # test class must be loaded first
 from pyfarm.master.testutil import BaseTestCase
 BaseTestCase.build_environment()
 
 from pyfarm.models.core.types import IDTypeWork, WorkStateEnum
+from pyfarm.master.application import db
 from pyfarm.models.core.functions import (
-    modelfor, getuuid, work_columns, split_and_extend)
+    modelfor, getuuid, work_columns, split_and_extend, like_prefix)
 
 
 class Foo(object):
@@ -80,3 +81,17 @@ class TestFunctionsModule(BaseTestCase):
             set(["a", "a.b", "a.b.c", "a.b.c.d"]))
         self.assertIsNone(split_and_extend(None))
 
+    def test_like_prefix(self):
+        for value, prefix, expected in (
+                ("a/b", "a/", True),
+                ("ab", "a/", False),
+                ("a%/b", "a%/", True),
+                ("ab/b", "a%/", False),
+                ("a_/b", "a_/", True),
+                ("ab/b", "a_/", False),
+                ("a\\/b", "a\\/", True),
+                ("a/b", "a\\/", False)):
+            self.assertEqual(
+                db.session.execute(select(
+                    [like_prefix(literal(value), prefix)])).scalar(),
+                expected, (value, prefix))
@@ -28,6 +28,7 @@ from pyfarm.master.application import db
 from pyfarm.models.software import Software, SoftwareVersion
 from pyfarm.models.tag import Tag
 from pyfarm.models.agent import Agent
+from pyfarm.models.disk import AgentDisk
 
 try:
     from itertools import product
@@ -229,6 +230,38 @@ class TestAgentModel(AgentTestCase, BaseTestCase):
 
             db.session.rollback()
 
+    def test_row_version(self):
+        agent = next(self.models(limit=1))
+        db.session.add(agent)
+        db.session.commit()
+        self.assertEqual(agent.row_version, 1)
+        first_update = agent.time_updated
+
+        agent.free_ram = 1
+        db.session.commit()
+        self.assertEqual(agent.row_version, 2)
+        self.assertGreaterEqual(agent.time_updated, first_update)
+
+        Agent.query.filter_by(id=agent.id).update(
+            {"free_ram": 2}, synchronize_session=False)
+        db.session.commit()
+        db.session.refresh(agent)
+        self.assertEqual(agent.row_version, 3)
+
+    def test_row_version_child_rows(self):
+        agent = next(self.models(limit=1))
+        db.session.add(agent)
+        db.session.commit()
+
+        disk = AgentDisk(agent=agent, mountpoint="/", size=10, free=5)
+        db.session.add(disk)
+        db.session.commit()
+        self.assertEqual(agent.row_version, 2)
+
+        db.session.delete(disk)
+        db.session.commit()
+        self.assertEqual(agent.row_version, 3)
+
     def test_api_url_remote(self):
         model = Agent(
             hostname="foo", port=12345, remote_ip="10.56.0.1",
@@ -21,7 +21,7 @@ relationships.
 
 from textwrap import dedent
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy.exc import DatabaseError
 
 # test class must be loaded first
@@ -221,3 +221,18 @@ class TestJobEventsAndValidation(BaseTestCase):
         self.assertIsNone(model.time_started)
         model.state = WorkState.RUNNING
         self.assertIsInstance(model.time_started, datetime)
+
+    def test_delete_after(self):
+        model = Job()
+        model.state = WorkState.DONE
+        self.assertIsNone(model.delete_after)
+        model.autodelete_time = 3600
+        self.assertEqual(model.delete_after,
+                         model.time_finished + timedelta(hours=1))
+        model.state = WorkState.RUNNING
+        self.assertIsNone(model.delete_after)
+        model.state = WorkState.DONE
+        self.assertEqual(model.delete_after,
+                         model.time_finished + timedelta(hours=1))
+        model.autodelete_time = None
+        self.assertIsNone(model.delete_after)
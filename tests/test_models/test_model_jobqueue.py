@@ -0,0 +1,113 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2014 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import db
+from pyfarm.models.jobqueue import JobQueue
+
+
+class TestJobQueue(BaseTestCase):
+    def setup_database(self):
+        super(TestJobQueue, self).setup_database()
+        self.top = JobQueue(name="top")
+        self.middle = JobQueue(name="middle", parent=self.top)
+        self.bottom = JobQueue(name="bottom", parent=self.middle)
+        # A sibling whose name is matched by "m%" and "_iddle"
+        self.sibling = JobQueue(name="m%_iddle", parent=self.top)
+        db.session.add_all([self.top, self.middle, self.bottom, self.sibling])
+        db.session.commit()
+
+    def paths(self):
+        db.session.expire_all()
+        return sorted(queue.fullpath for queue in JobQueue.query)
+
+    def test_fullpath_on_insert(self):
+        self.assertEqual(self.bottom.fullpath, "/top/middle/bottom")
+        queue = JobQueue(name="other", parent_jobqueue_id=self.middle.id)
+        db.session.add(queue)
+        db.session.commit()
+        self.assertEqual(queue.fullpath, "/top/middle/other")
+        self.assertEqual(queue.path(), "/top/middle/other")
+        self.assertEqual(
+            JobQueue(name="new", parent=self.bottom).path(),
+            "/top/middle/bottom/new")
+
+    def test_rename_updates_descendants(self):
+        self.middle.name = "center"
+        db.session.add(self.middle)
+        db.session.commit()
+        # Loaded queues are updated too, not only the rows
+        self.assertEqual(self.bottom.fullpath, "/top/center/bottom")
+        self.assertEqual(
+            self.paths(),
+            ["/top", "/top/center", "/top/center/bottom", "/top/m%_iddle"])
+
+        self.top.name = "root"
+        db.session.add(self.top)
+        db.session.commit()
+        self.assertEqual(
+            self.paths(),
+            ["/root", "/root/center", "/root/center/bottom",
+             "/root/m%_iddle"])
+
+    def test_move_updates_descendants(self):
+        self.middle.parent = self.sibling
+        db.session.add(self.middle)
+        db.session.commit()
+        self.assertEqual(
+            self.paths(),
+            ["/top", "/top/m%_iddle", "/top/m%_iddle/middle",
+             "/top/m%_iddle/middle/bottom"])
+
+    def test_by_path(self):
+        for path in ("/top/middle", "top/middle", "top/middle/"):
+            self.assertEqual(JobQueue.by_path(path).id, self.middle.id)
+        self.assertIsNone(JobQueue.by_path("/middle"))
+        self.assertEqual(JobQueue.by_path("top/m%_iddle").id, self.sibling.id)
+
+    def test_subtree_ids(self):
+        self.assertEqual(
+            sorted(id_ for id_, in JobQueue.subtree_ids([self.middle.id])),
+            sorted([self.middle.id, self.bottom.id]))
+        self.assertEqual(
+            sorted(id_ for id_, in JobQueue.subtree_ids([self.sibling.id])),
+            [self.sibling.id])
+        self.assertEqual(
+            JobQueue.subtree_ids([self.top.id]).count(), 4)
+        self.assertEqual(JobQueue.subtree_ids([]).count(), 0)
+
+    def clear_paths(self):
+        JobQueue.query.filter(JobQueue.id != self.top.id).update(
+            {"fullpath": None}, synchronize_session=False)
+        db.session.commit()
+
+    def test_by_path_missing_paths(self):
+        self.clear_paths()
+        self.assertEqual(JobQueue.by_path("top/middle").id, self.middle.id)
+        self.assertEqual(
+            JobQueue.by_path("/top/middle/bottom").id, self.bottom.id)
+        self.assertIsNone(JobQueue.by_path("/top/bottom"))
+
+    def test_subtree_ids_missing_paths(self):
+        self.clear_paths()
+        self.assertEqual(
+            sorted(id_ for id_, in JobQueue.subtree_ids([self.middle.id])),
+            sorted([self.middle.id, self.bottom.id]))
+        self.assertEqual(
+            JobQueue.subtree_ids([self.top.id]).count(), 4)
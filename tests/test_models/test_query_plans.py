@@ -0,0 +1,141 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Checks that the hottest queries of the scheduler and the web UI are
+answered through an index.  The queries are built by the same functions
+the code uses.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import db
+from pyfarm.models.agent import Agent
+from pyfarm.models.job import Job
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.task import Task
+from pyfarm.models.statistics.agent_count import AgentCount
+from pyfarm.models.statistics.rollups import samples_after
+from pyfarm.models.statistics.task_count import TaskCount
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.scheduler.archive_tasks import archivable_jobs
+from pyfarm.scheduler.tasks import agents_to_poll, expired_jobs
+
+
+class explain(Executable, ClauseElement):
+    """Asks the database how it would execute ``statement``"""
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(explain)
+def compile_explain(element, compiler, **kwargs):
+    if compiler.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    return prefix + compiler.process(element.statement, **kwargs)
+
+
+class TestQueryPlans(BaseTestCase):
+    def query_plan(self, query, model):
+        mapper = model.__mapper__
+        dialect = db.session.get_bind(mapper=mapper).dialect.name
+        if dialect not in ("sqlite", "postgresql"):
+            self.skipTest("Query plans are only checked on SQLite and "
+                          "PostgreSQL")
+        if dialect == "postgresql":
+            # The test tables are tiny, scanning them would always be cheaper
+            db.session.execute("SET LOCAL enable_seqscan = off", mapper=mapper)
+        rows = db.session.execute(
+            explain(query.statement), mapper=mapper).fetchall()
+        return "\n".join(str(row[-1]) for row in rows)
+
+    def assert_uses_index(self, query, model, index):
+        plan = self.query_plan(query, model)
+        self.assertIn(index, plan, "%s is not used:\n%s" % (index, plan))
+
+    def test_tasks_by_job_and_state(self):
+        jobtype_version = JobTypeVersion(
+            jobtype=JobType(name="TestJobType", description="for testing"),
+            version=1, classname="Foobar", code="dummy code".encode("utf-8"))
+        job = Job(title="Test Job", jobtype_version=jobtype_version)
+        db.session.add(job)
+        db.session.commit()
+        self.assert_uses_index(
+            job.unfinished_tasks(), Task,
+            "ix_%s_job_id_state" % Task.__tablename__)
+
+    def test_tasks_by_agent_and_state(self):
+        self.assert_uses_index(
+            agents_to_poll(busy=True), Agent,
+            "ix_%s_agent_id_state" % Task.__tablename__)
+
+    def test_jobs_by_queue_and_state(self):
+        queue = JobQueue(name="Test Queue")
+        db.session.add(queue)
+        db.session.commit()
+        self.assert_uses_index(
+            queue.runnable_jobs([1, 2], 1024), Job,
+            "ix_%s_job_queue_id_state" % Job.__tablename__)
+
+    def test_finished_jobs(self):
+        self.assert_uses_index(
+            archivable_jobs(datetime.utcnow()), Job,
+            "ix_%s_state_time_finished" % Job.__tablename__)
+
+    def test_expired_jobs(self):
+        self.assert_uses_index(
+            expired_jobs(Job.id), Job,
+            "ix_%s_state_delete_after" % Job.__tablename__)
+
+    def test_task_event_counts(self):
+        time_start = datetime.utcnow() - timedelta(days=7)
+
+        # The task events statistics page, filtered by queue
+        query = samples_after(TaskEventCount.time_start, time_start).filter(
+            TaskEventCount.job_queue_id.in_([1]))
+        self.assert_uses_index(
+            query, TaskEventCount,
+            "ix_%s_job_queue_id_time_start" % TaskEventCount.__tablename__)
+
+        # The task events statistics page
+        self.assert_uses_index(
+            samples_after(TaskEventCount.time_start, time_start),
+            TaskEventCount,
+            "ix_%s_time_start" % TaskEventCount.__tablename__)
+
+    def test_task_counts(self):
+        self.assert_uses_index(
+            samples_after(
+                TaskCount.counted_time,
+                datetime.utcnow() - timedelta(days=7)),
+            TaskCount, "ix_%s_counted_time" % TaskCount.__tablename__)
+
+    def test_agent_counts(self):
+        # counted_time is the primary key
+        query = samples_after(
+            AgentCount.counted_time, datetime.utcnow() - timedelta(days=7))
+        plan = self.query_plan(query, AgentCount)
+        self.assertIn("index", plan.lower(), plan)
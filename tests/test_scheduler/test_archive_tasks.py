@@ -0,0 +1,229 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.core.enums import WorkState
+from pyfarm.master.utility import dumps
+from pyfarm.master.application import db, get_api_blueprint
+from pyfarm.master.entrypoints import load_api
+from pyfarm.models.archive import (
+    ArchivedJob, ArchivedTask, ArchivedTaskLogAssociation)
+from pyfarm.models.change import Change
+from pyfarm.models.job import Job, JobTagAssociation
+from pyfarm.models.tag import Tag, JobTagRequirement
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.task import Task
+from pyfarm.models.tasklog import TaskLog, TaskTaskLogAssociation
+from pyfarm.scheduler import archive_tasks
+from pyfarm.scheduler.tasks import clean_up_orphaned_task_logs
+
+
+class TestArchiveTasks(BaseTestCase):
+    def setup_app(self):
+        super(TestArchiveTasks, self).setup_app()
+        self.api = get_api_blueprint()
+        self.app.register_blueprint(self.api)
+        load_api(self.app, self.api)
+
+    def setup_database(self):
+        super(TestArchiveTasks, self).setup_database()
+        self.addCleanup(setattr, archive_tasks, "ARCHIVE_JOBS_AFTER",
+                        archive_tasks.ARCHIVE_JOBS_AFTER)
+        archive_tasks.ARCHIVE_JOBS_AFTER = timedelta(days=7)
+
+        jobtype = JobType(name="TestJobType", description="for testing")
+        self.jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="dummy code".encode("utf-8"))
+        db.session.add(self.jobtype_version)
+        db.session.commit()
+
+    def create_job(self, title, finished_days_ago=10, state=WorkState.DONE):
+        job = Job(title=title, jobtype_version=self.jobtype_version,
+                  data={"foo": "bar"})
+        for frame in (1, 2):
+            task = Task(job=job, frame=frame, attempts=1)
+            task.state = state
+            db.session.add(task)
+        log = TaskLog(identifier="%s.csv" % title)
+        db.session.add(TaskTaskLogAssociation(
+            task=task, log=log, attempt=1, state=state))
+        job.state = state
+        if finished_days_ago is not None:
+            job.time_finished = (
+                datetime.utcnow() - timedelta(days=finished_days_ago))
+        db.session.add(job)
+        db.session.commit()
+        return job.id, task.id
+
+    def test_archive_finished_job(self):
+        job_id, task_id = self.create_job("Old Job")
+        response1 = self.client.get("/api/v1/jobs/%s" % job_id)
+        self.assert_ok(response1)
+
+        archive_tasks.archive_finished_jobs()
+
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual(Task.query.count(), 0)
+        self.assertEqual(TaskTaskLogAssociation.query.count(), 0)
+        self.assertEqual(ArchivedJob.query.count(), 1)
+        self.assertEqual(ArchivedTask.query.count(), 2)
+        self.assertEqual(ArchivedTaskLogAssociation.query.count(), 1)
+
+        for job_name in (job_id, "Old%20Job"):
+            response2 = self.client.get("/api/v1/jobs/%s" % job_name)
+            self.assert_ok(response2)
+            self.assertTrue(response2.json.pop("archived"))
+            self.assertEqual(response2.json, response1.json)
+
+        response3 = self.client.get("/api/v1/jobs/%s/tasks/" % job_id)
+        self.assert_ok(response3)
+        self.assertEqual([task["frame"] for task in response3.json], [1, 2])
+        self.assertTrue(all(task["archived"] for task in response3.json))
+
+        response4 = self.client.get(
+            "/api/v1/jobs/%s/tasks/%s" % (job_id, task_id))
+        self.assert_ok(response4)
+        self.assertEqual(response4.json["id"], task_id)
+        self.assertEqual(response4.json["job"]["title"], "Old Job")
+        self.assertTrue(response4.json["archived"])
+
+        # Archived jobs are read only
+        response5 = self.client.post(
+            "/api/v1/jobs/%s" % job_id, content_type="application/json",
+            data=dumps({"priority": 10}))
+        self.assert_not_found(response5)
+
+    def test_archive_keeps_task_logs(self):
+        job_id, task_id = self.create_job("Old Job")
+        archive_tasks.archive_finished_jobs()
+        clean_up_orphaned_task_logs()
+
+        log = TaskLog.query.filter_by(identifier="Old Job.csv").one()
+        self.assertTrue(log.archived)
+
+        response1 = self.client.get(
+            "/api/v1/jobs/%s/tasks/%s/attempts/1/logs/" % (job_id, task_id))
+        self.assert_ok(response1)
+        self.assertEqual([item["identifier"] for item in response1.json],
+                         ["Old Job.csv"])
+
+        response2 = self.client.get(
+            "/api/v1/jobs/%s/tasks/%s/attempts/1/logs/Old Job.csv" %
+            (job_id, task_id))
+        self.assert_ok(response2)
+        self.assertEqual(response2.json["id"], log.id)
+
+        response3 = self.client.get(
+            "/api/v1/jobs/%s/tasks/%s/attempts/2/logs/Old Job.csv" %
+            (job_id, task_id))
+        self.assert_not_found(response3)
+
+    def test_archive_skips_unfinished_jobs(self):
+        self.create_job("Recent Job", finished_days_ago=1)
+        self.create_job("Running Job", finished_days_ago=None,
+                        state=WorkState.RUNNING)
+        parent_id, _ = self.create_job("Parent Job")
+        child_id, _ = self.create_job(
+            "Child Job", finished_days_ago=None, state=WorkState.RUNNING)
+        child = Job.query.filter_by(id=child_id).one()
+        child.parents.append(Job.query.filter_by(id=parent_id).one())
+        db.session.add(child)
+        db.session.commit()
+
+        archive_tasks.archive_finished_jobs()
+        self.assertEqual(ArchivedJob.query.count(), 0)
+        self.assertEqual(Job.query.count(), 4)
+
+        # Once the child is gone, its parent is archived too
+        child = Job.query.filter_by(id=child_id).one()
+        for task in child.tasks:
+            task.state = WorkState.DONE
+            db.session.add(task)
+        child.state = WorkState.DONE
+        child.time_finished = datetime.utcnow() - timedelta(days=8)
+        db.session.add(child)
+        db.session.commit()
+
+        archive_tasks.archive_finished_jobs()
+        self.assertEqual(
+            sorted(job.title for job in ArchivedJob.query),
+            ["Child Job", "Parent Job"])
+        archived_child = ArchivedJob.query.filter_by(id=child_id).one()
+        self.assertEqual(
+            [parent["id"] for parent in
+             archived_child.to_document()["parents"]], [parent_id])
+
+    def test_archive_deletes_job_associations(self):
+        job_id, _ = self.create_job("Old Job")
+        job = Job.query.filter_by(id=job_id).one()
+        tag = Tag(tag="linux")
+        job.tags.append(tag)
+        db.session.add(JobTagRequirement(job=job, tag=tag))
+        db.session.add(job)
+        db.session.commit()
+
+        archive_tasks.archive_finished_jobs()
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual(JobTagRequirement.query.count(), 0)
+        self.assertEqual(
+            db.session.query(JobTagAssociation).count(), 0)
+        self.assertEqual(Tag.query.count(), 1)
+        self.assertEqual(
+            Change.query.filter_by(
+                type="job", object_id=str(job_id), action="delete").count(),
+            1)
+
+    def test_archive_replaces_partial_copies(self):
+        job_id, _ = self.create_job("Old Job")
+        db.session.add(ArchivedJob(
+            id=job_id, title="Old Job", time_archived=datetime.utcnow(),
+            document="{}"))
+        db.session.commit()
+
+        archive_tasks.archive_finished_jobs()
+        self.assertEqual(ArchivedJob.query.count(), 1)
+        self.assertEqual(
+            ArchivedJob.query.one().to_document()["title"], "Old Job")
+
+    def test_archive_autodelete(self):
+        job_id, _ = self.create_job("Old Job")
+        job = Job.query.filter_by(id=job_id).one()
+        job.autodelete_time = 3600 * 24 * 30
+        db.session.add(job)
+        db.session.commit()
+        archive_tasks.archive_finished_jobs()
+        self.assertEqual(ArchivedJob.query.count(), 1)
+
+        archived_job = ArchivedJob.query.one()
+        self.assertEqual(archived_job.delete_after,
+                         archived_job.time_finished + timedelta(days=30))
+        archived_job.delete_after = datetime.utcnow() - timedelta(days=1)
+        db.session.add(archived_job)
+        db.session.commit()
+        archive_tasks.archive_finished_jobs()
+        self.assertEqual(ArchivedJob.query.count(), 0)
+        self.assertEqual(ArchivedTask.query.count(), 0)
+        self.assertEqual(ArchivedTaskLogAssociation.query.count(), 0)
+        self.assert_not_found(self.client.get("/api/v1/jobs/%s" % job_id))
+
+        clean_up_orphaned_task_logs()
+        self.assertEqual(TaskLog.query.count(), 0)
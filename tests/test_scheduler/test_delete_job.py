@@ -0,0 +1,278 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+from datetime import datetime, timedelta
+
+from requests.exceptions import ConnectionError
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.core.enums import AgentState, WorkState
+from pyfarm.master.application import db
+from pyfarm.master.config import config
+from pyfarm.models.agent import Agent
+from pyfarm.models.change import Change
+from pyfarm.models.job import Job
+from pyfarm.models.jobgroup import JobGroup
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.models.task import Task
+from pyfarm.models.tasklog import TaskLog, TaskTaskLogAssociation
+from pyfarm.scheduler import tasks
+
+
+class FakeSession(object):
+    """
+    Records the requests made instead of sending them, requests for the
+    urls in ``unreachable`` fail
+    """
+    unreachable = ()
+
+    def __init__(self):
+        self.deleted = []
+        FakeSession.sessions.append(self)
+
+    def delete(self, url, **kwargs):
+        if url in self.unreachable:
+            raise ConnectionError("agent unreachable")
+        self.deleted.append(url)
+        return type("Response", (object, ), {"status_code": 204})()
+
+
+class TestDeleteJob(BaseTestCase):
+    def setup_database(self):
+        super(TestDeleteJob, self).setup_database()
+        self.queued = []
+        self.mails = []
+        for name, value in (("DELETE_BATCH_SIZE", 4), ):
+            self.addCleanup(setattr, tasks, name, getattr(tasks, name))
+            setattr(tasks, name, value)
+        self.addCleanup(setattr, tasks.delete_tasks_on_agent, "delay",
+                        tasks.delete_tasks_on_agent.delay)
+        tasks.delete_tasks_on_agent.delay = \
+            lambda *args: self.queued.append(args)
+        self.addCleanup(setattr, tasks.send_job_deletion_mail, "delay",
+                        tasks.send_job_deletion_mail.delay)
+        tasks.send_job_deletion_mail.delay = \
+            lambda *args: self.mails.append(args)
+
+        jobtype = JobType(name="TestJobType", description="for testing")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="dummy code".encode("utf-8"))
+        self.group = JobGroup(title="Test Group", main_jobtype=jobtype)
+        self.job = Job(title="Test Job", jobtype_version=jobtype_version,
+                       group=self.group, to_be_deleted=True)
+        self.agents = [
+            Agent(hostname="agent%s" % i, id=uuid.uuid4(), ram=32,
+                  free_ram=32, cpus=1, port=50000) for i in range(2)]
+        db.session.add_all(self.agents)
+        db.session.add(self.job)
+        for frame in range(10):
+            task = Task(job=self.job, frame=frame, attempts=0)
+            if frame == 0:
+                task.state = WorkState.DONE
+                task.agent = self.agents[0]
+                task.failed_in_agents.append(self.agents[1])
+                db.session.add(TaskTaskLogAssociation(
+                    task=task, log=TaskLog(identifier="log0"), attempt=1))
+            db.session.add(task)
+        db.session.commit()
+
+    def assign(self, frames, agent):
+        for task in Task.query.filter(Task.frame.in_(frames)):
+            task.agent = agent
+            task.state = WorkState.RUNNING
+            db.session.add(task)
+        db.session.commit()
+
+    def test_delete_job_without_running_tasks(self):
+        job_id = self.job.id
+        group_id = self.group.id
+        tasks.delete_job(job_id)
+
+        self.assertEqual(Task.query.count(), 0)
+        self.assertEqual(TaskTaskLogAssociation.query.count(), 0)
+        self.assertEqual(Job.query.filter_by(id=job_id).count(), 0)
+        self.assertEqual(JobGroup.query.filter_by(id=group_id).count(), 0)
+        self.assertEqual(self.queued, [])
+        self.assertEqual(len(self.mails), 1)
+        self.assertEqual(
+            Change.query.filter_by(type="task", action="delete").count(), 10)
+        if config.get("enable_statistics"):
+            self.assertEqual(
+                [count.num_deleted for count in TaskEventCount.query], [10])
+
+    def test_delete_job_groups_running_tasks_per_agent(self):
+        self.assign([1, 2, 3], self.agents[0])
+        self.assign([4], self.agents[1])
+        job_id = self.job.id
+        tasks.delete_job(job_id)
+
+        self.assertEqual(
+            sorted(task.frame for task in Task.query), [1, 2, 3, 4])
+        self.assertEqual(
+            sorted((agent_id, job_id_, len(task_ids))
+                   for agent_id, job_id_, task_ids in self.queued),
+            sorted([(self.agents[0].id, job_id, 3),
+                    (self.agents[1].id, job_id, 1)]))
+        self.assertEqual(self.mails, [])
+        if config.get("enable_statistics"):
+            self.assertEqual(
+                [count.num_deleted for count in TaskEventCount.query], [6])
+
+        self.addCleanup(setattr, tasks.requests, "Session",
+                        tasks.requests.Session)
+        tasks.requests.Session = FakeSession
+        FakeSession.sessions = []
+        for args in sorted(self.queued, key=lambda args: len(args[2])):
+            tasks.delete_tasks_on_agent(*args)
+
+        self.assertEqual(Task.query.count(), 0)
+        self.assertEqual(Job.query.filter_by(id=job_id).count(), 0)
+        self.assertEqual(len(self.mails), 1)
+        self.assertEqual(
+            sorted(len(session.deleted) for session in FakeSession.sessions),
+            [1, 3])
+        if config.get("enable_statistics"):
+            self.assertEqual(
+                sum(count.num_deleted for count in TaskEventCount.query), 10)
+
+    def test_delete_tasks_on_agent_unreachable(self):
+        self.assign([1, 2, 3], self.agents[0])
+        job_id = self.job.id
+        tasks.delete_job(job_id)
+        (agent_id, _, task_ids), = self.queued
+        url = "%s/tasks/%s" % (self.agents[0].api_url(), task_ids[0])
+
+        self.addCleanup(setattr, tasks.requests, "Session",
+                        tasks.requests.Session)
+        tasks.requests.Session = FakeSession
+        FakeSession.sessions = []
+        self.addCleanup(setattr, FakeSession, "unreachable", ())
+        FakeSession.unreachable = (url, )
+
+        # The other tasks are still stopped and only they are deleted
+        with self.assertRaises(ConnectionError):
+            tasks.delete_tasks_on_agent(agent_id, job_id, task_ids)
+        self.assertEqual(len(FakeSession.sessions[0].deleted), 2)
+        self.assertEqual([task.id for task in Task.query], [task_ids[0]])
+        self.assertEqual(Job.query.filter_by(id=job_id).count(), 1)
+
+        # Once the retries are used up the agent is given up on
+        self.addCleanup(setattr, tasks.delete_tasks_on_agent, "max_retries",
+                        tasks.delete_tasks_on_agent.max_retries)
+        tasks.delete_tasks_on_agent.max_retries = 0
+        tasks.delete_tasks_on_agent(agent_id, job_id, [task_ids[0]])
+        self.assertEqual(Task.query.count(), 0)
+        self.assertEqual(Job.query.filter_by(id=job_id).count(), 0)
+        self.assertEqual(
+            Agent.query.filter_by(id=agent_id).one().state,
+            AgentState.OFFLINE)
+
+    def test_delete_job_task_finishing_during_delete(self):
+        self.assign([1, 2], self.agents[0])
+        original_delete_tasks = tasks.delete_tasks
+        self.addCleanup(setattr, tasks, "delete_tasks", original_delete_tasks)
+
+        def delete_tasks(task_ids):
+            # frame 1 finishes while the first batch is being deleted
+            Task.query.filter_by(frame=1).update(
+                {"state": WorkState.DONE}, synchronize_session=False)
+            tasks.delete_tasks = original_delete_tasks
+            return original_delete_tasks(task_ids)
+
+        tasks.delete_tasks = delete_tasks
+        tasks.delete_job(self.job.id)
+
+        self.assertEqual([task.frame for task in Task.query], [2])
+        self.assertEqual(
+            [(agent_id, len(task_ids))
+             for agent_id, _, task_ids in self.queued],
+            [(self.agents[0].id, 1)])
+        if config.get("enable_statistics"):
+            self.assertEqual(
+                [count.num_deleted for count in TaskEventCount.query], [9])
+
+    def test_autodelete_old_jobs(self):
+        self.addCleanup(setattr, tasks.delete_job, "delay",
+                        tasks.delete_job.delay)
+        deleted = []
+        tasks.delete_job.delay = deleted.append
+
+        self.job.to_be_deleted = False
+        self.job.state = WorkState.DONE
+        self.job.autodelete_time = 3600
+        recent = Job(title="Recent Job", group=self.group,
+                     jobtype_version=self.job.jobtype_version,
+                     autodelete_time=3600)
+        recent.state = WorkState.DONE
+        db.session.add_all([self.job, recent])
+        db.session.commit()
+
+        tasks.autodelete_old_jobs()
+        self.assertEqual(deleted, [])
+
+        self.job.time_finished = datetime.utcnow() - timedelta(hours=2)
+        db.session.add(self.job)
+        db.session.commit()
+        tasks.autodelete_old_jobs()
+        self.assertEqual(deleted, [self.job.id])
+        self.assertTrue(Job.query.filter_by(id=self.job.id).one().to_be_deleted)
+        self.assertFalse(Job.query.filter_by(id=recent.id).one().to_be_deleted)
+
+        # Jobs already marked are not queued again
+        tasks.autodelete_old_jobs()
+        self.assertEqual(deleted, [self.job.id])
+
+    def test_autodelete_old_jobs_backfill(self):
+        self.addCleanup(setattr, tasks.delete_job, "delay",
+                        tasks.delete_job.delay)
+        deleted = []
+        tasks.delete_job.delay = deleted.append
+        self.addCleanup(setattr, tasks, "BACKFILL_BATCH_SIZE",
+                        tasks.BACKFILL_BATCH_SIZE)
+        tasks.BACKFILL_BATCH_SIZE = 1
+
+        jobs = [self.job]
+        for title in ("Old Job 2", "Old Job 3"):
+            jobs.append(Job(title=title, group=self.group,
+                            jobtype_version=self.job.jobtype_version))
+        for job in jobs:
+            job.to_be_deleted = False
+            job.state = WorkState.DONE
+        db.session.add_all(jobs)
+        db.session.commit()
+
+        # Jobs which finished before delete_after was maintained
+        finished = datetime.utcnow() - timedelta(hours=2)
+        Job.query.filter(Job.id.in_([job.id for job in jobs])).update(
+            {"time_finished": finished, "autodelete_time": 3600,
+             "delete_after": None}, synchronize_session=False)
+        Job.query.filter_by(id=jobs[2].id).update(
+            {"autodelete_time": 3 * 3600}, synchronize_session=False)
+        db.session.commit()
+
+        self.assertEqual(tasks.backfill_delete_after(), 3)
+        self.assertEqual(
+            Job.query.filter_by(id=jobs[2].id).one().delete_after,
+            finished + timedelta(hours=3))
+        self.assertEqual(tasks.backfill_delete_after(), 0)
+
+        tasks.autodelete_old_jobs()
+        self.assertEqual(sorted(deleted), sorted([jobs[0].id, jobs[1].id]))
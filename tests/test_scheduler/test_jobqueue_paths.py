@@ -0,0 +1,52 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# test class must be loaded first
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.master.application import db
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.scheduler import tasks
+
+
+class TestBackfillJobQueuePaths(BaseTestCase):
+    def setup_database(self):
+        super(TestBackfillJobQueuePaths, self).setup_database()
+        top = JobQueue(name="top")
+        middle = JobQueue(name="middle", parent=top)
+        db.session.add_all([
+            top, middle, JobQueue(name="bottom", parent=middle),
+            JobQueue(name="other", parent=top)])
+        db.session.commit()
+
+        # Paths of queues written before they were stored
+        JobQueue.query.update({"fullpath": None}, synchronize_session=False)
+        db.session.commit()
+
+    def test_backfill_jobqueue_paths(self):
+        self.addCleanup(setattr, tasks, "JOBQUEUE_BACKFILL_BATCH_SIZE",
+                        tasks.JOBQUEUE_BACKFILL_BATCH_SIZE)
+        tasks.JOBQUEUE_BACKFILL_BATCH_SIZE = 3
+        self.assertTrue(JobQueue.has_missing_paths())
+
+        self.assertEqual(tasks.backfill_jobqueue_paths(), 4)
+        db.session.expire_all()
+        self.assertEqual(
+            sorted(queue.fullpath for queue in JobQueue.query),
+            ["/top", "/top/middle", "/top/middle/bottom", "/top/other"])
+        self.assertFalse(JobQueue.has_missing_paths())
+        self.assertEqual(tasks.backfill_jobqueue_paths(), 0)
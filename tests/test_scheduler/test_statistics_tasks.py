@@ -0,0 +1,265 @@
+# No shebang line, this module is meant to be imported
+#
+# Copyright 2015 Oliver Palmer
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+from datetime import datetime, timedelta
+
+from pyfarm.master.testutil import BaseTestCase
+BaseTestCase.build_environment()
+
+from pyfarm.core.enums import AgentState, WorkState
+from pyfarm.master.application import db
+from pyfarm.models.agent import Agent
+from pyfarm.models.job import Job
+from pyfarm.models.jobqueue import JobQueue
+from pyfarm.models.jobtype import JobType, JobTypeVersion
+from pyfarm.models.statistics.agent_count import AgentCount
+from pyfarm.models.statistics.collector_runtime import CollectorRuntime
+from pyfarm.models.statistics.rollups import (
+    AgentCountRollup, TaskCountRollup, TaskEventCountRollup,
+    choose_resolution)
+from pyfarm.models.statistics.task_count import TaskCount
+from pyfarm.models.statistics.task_event_count import TaskEventCount
+from pyfarm.models.task import Task
+from pyfarm.scheduler import statistics_tasks
+from pyfarm.scheduler.statistics_tasks import count_agents, count_tasks
+
+
+class TestCountStatistics(BaseTestCase):
+    def test_count_agents(self):
+        for i, state in enumerate([AgentState.ONLINE, AgentState.ONLINE,
+                                   AgentState.RUNNING, AgentState.DISABLED]):
+            db.session.add(Agent(hostname="agent%s" % i, id=uuid.uuid4(),
+                                 ram=32, free_ram=32, cpus=1, port=50000,
+                                 state=state))
+        db.session.commit()
+
+        count_agents()
+
+        agent_count = AgentCount.query.one()
+        self.assertEqual(
+            (agent_count.num_online, agent_count.num_running,
+             agent_count.num_offline, agent_count.num_disabled),
+            (2, 1, 0, 1))
+        runtime = CollectorRuntime.query.filter_by(
+            collector="count_agents").one()
+        self.assertEqual(runtime.num_samples, 1)
+        self.assertGreaterEqual(runtime.runtime, 0)
+
+    def test_count_tasks(self):
+        jobtype = JobType(name="TestJobType", description="for testing")
+        jobtype_version = JobTypeVersion(
+            jobtype=jobtype, version=1, classname="Foobar",
+            code="dummy code".encode("utf-8"))
+        busy_queue = JobQueue(name="Busy")
+        idle_queue = JobQueue(name="Idle")
+        queued_job = Job(title="Queued Job", jobtype_version=jobtype_version)
+        busy_job = Job(title="Busy Job", jobtype_version=jobtype_version,
+                       queue=busy_queue)
+        db.session.add_all([idle_queue, queued_job, busy_job])
+        for frame in range(3):
+            db.session.add(Task(job=queued_job, frame=frame, attempts=0))
+            db.session.add(Task(job=busy_job, frame=frame, attempts=0))
+        db.session.commit()
+        for frame, state in ((0, WorkState.RUNNING), (1, WorkState.DONE),
+                             (2, WorkState.FAILED)):
+            Task.query.filter_by(job=busy_job, frame=frame).update(
+                {"state": state})
+        db.session.commit()
+
+        count_tasks()
+
+        counts = dict(
+            (task_count.job_queue_id,
+             (task_count.total_queued, task_count.total_running,
+              task_count.total_done, task_count.total_failed))
+            for task_count in TaskCount.query)
+        self.assertEqual(counts, {
+            None: (3, 0, 0, 0),
+            busy_queue.id: (0, 1, 1, 1),
+            idle_queue.id: (0, 0, 0, 0)})
+        self.assertEqual(
+            len(set(task_count.counted_time for task_count in TaskCount.query)),
+            1)
+        runtime = CollectorRuntime.query.filter_by(
+            collector="count_tasks").one()
+        self.assertEqual(runtime.num_samples, 3)
+
+
+
+class TestConsolidateTaskEvents(BaseTestCase):
+    def setup_database(self):
+        super(TestConsolidateTaskEvents, self).setup_database()
+        self.addCleanup(setattr, statistics_tasks, "CONSOLIDATE_BATCH_SIZE",
+                        statistics_tasks.CONSOLIDATE_BATCH_SIZE)
+        statistics_tasks.CONSOLIDATE_BATCH_SIZE = 1
+        interval = statistics_tasks.CONSOLIDATE_INTERVAL
+        now = datetime.utcnow()
+        self.bucket = (datetime(now.year, now.month, now.day) -
+                       timedelta(days=1))
+        self.end = self.bucket + interval
+
+    def add_event(self, time, job_queue_id=None, **counts):
+        event_count = TaskEventCount(job_queue_id=job_queue_id, **counts)
+        event_count.time_start = time
+        event_count.time_end = time
+        db.session.add(event_count)
+
+    def counts(self):
+        return sorted(
+            ((event_count.job_queue_id, event_count.time_start,
+              event_count.time_end, event_count.num_new, event_count.num_done)
+             for event_count in TaskEventCount.query),
+            key=lambda count: (count[0] is not None, count))
+
+    def test_consolidate(self):
+        interval = statistics_tasks.CONSOLIDATE_INTERVAL
+        for minutes in (0, 1, 5):
+            self.add_event(self.bucket + timedelta(minutes=minutes),
+                           num_new=1)
+        self.add_event(self.bucket + timedelta(seconds=30), job_queue_id=1,
+                       num_done=2)
+        self.add_event(self.end + timedelta(seconds=1), num_done=1)
+        # The current bucket is left alone until it ends
+        self.add_event(datetime.utcnow(), num_new=1)
+        db.session.commit()
+
+        statistics_tasks.consolidate_task_events()
+
+        self.assertEqual(
+            [count for count in self.counts() if count[1] < self.end],
+            [(None, self.bucket, self.end, 3, 0),
+             (1, self.bucket, self.end, 0, 2)])
+        self.assertIn((None, self.end, self.end + interval, 0, 1),
+                      self.counts())
+        self.assertEqual(TaskEventCount.query.count(), 4)
+
+        # Running again changes nothing, late events are merged
+        statistics_tasks.consolidate_task_events()
+        self.assertEqual(TaskEventCount.query.count(), 4)
+        self.add_event(self.bucket + timedelta(minutes=2), num_new=2)
+        db.session.commit()
+        statistics_tasks.consolidate_task_events_for_queue(None)
+        self.assertEqual(
+            [count for count in self.counts() if count[1] < self.end],
+            [(None, self.bucket, self.end, 5, 0),
+             (1, self.bucket, self.end, 0, 2)])
+
+
+class TestRollups(BaseTestCase):
+    def setup_database(self):
+        super(TestRollups, self).setup_database()
+        self.addCleanup(setattr, statistics_tasks, "ROLLUPS",
+                        statistics_tasks.ROLLUPS)
+        statistics_tasks.ROLLUPS = [
+            (60, timedelta(days=3)), (3600, timedelta(days=400)),
+            (86400, None)]
+        now = datetime.utcnow()
+        self.day = datetime(now.year, now.month, now.day) - timedelta(days=2)
+
+    def add_agent_count(self, seconds, num_online):
+        db.session.add(AgentCount(
+            counted_time=self.day + timedelta(seconds=seconds),
+            num_online=num_online, num_running=0, num_offline=1,
+            num_disabled=0))
+
+    def rollups(self, model, time_name, *columns):
+        rollups = (
+            (rollup.resolution,
+             (getattr(rollup, time_name) - self.day).total_seconds()) +
+            tuple(getattr(rollup, name) for name in columns)
+            for rollup in model.query)
+        return sorted(rollups, key=lambda rollup: [
+            (value is not None, value) for value in rollup])
+
+    def test_agent_counts(self):
+        for seconds, num_online in ((0, 2), (30, 4), (90, 6)):
+            self.add_agent_count(seconds, num_online)
+        db.session.commit()
+
+        statistics_tasks.update_rollups(now=self.day + timedelta(days=1))
+        expected = [
+            (60, 0, 2, 3.0, 1.0), (60, 60, 1, 6.0, 1.0),
+            (3600, 0, 3, 4.0, 1.0), (86400, 0, 3, 4.0, 1.0)]
+        self.assertEqual(
+            self.rollups(AgentCountRollup, "counted_time", "num_samples",
+                         "num_online", "num_offline"), expected)
+
+        # Updating again changes nothing, late samples are picked up
+        statistics_tasks.update_rollups(now=self.day + timedelta(days=1))
+        self.assertEqual(
+            self.rollups(AgentCountRollup, "counted_time", "num_samples",
+                         "num_online", "num_offline"), expected)
+        self.add_agent_count(70, 0)
+        db.session.commit()
+        statistics_tasks.update_rollups(now=self.day + timedelta(days=1))
+        self.assertEqual(
+            self.rollups(AgentCountRollup, "counted_time", "num_samples",
+                         "num_online"),
+            [(60, 0, 2, 3.0), (60, 60, 2, 3.0), (3600, 0, 4, 3.0),
+             (86400, 0, 4, 3.0)])
+
+        # Rollups older than their retention are deleted
+        statistics_tasks.update_rollups(now=self.day + timedelta(days=5))
+        self.assertEqual(
+            [rollup[0] for rollup in
+             self.rollups(AgentCountRollup, "counted_time")], [3600, 86400])
+
+    def test_task_counts_and_events(self):
+        for seconds, job_queue_id, total_queued in (
+                (0, None, 4), (30, None, 2), (30, 1, 8)):
+            db.session.add(TaskCount(
+                counted_time=self.day + timedelta(seconds=seconds),
+                job_queue_id=job_queue_id, total_queued=total_queued,
+                total_running=0, total_done=0, total_failed=0))
+        for seconds, job_queue_id, num_new in (
+                (10, None, 1), (20, None, 2), (3700, None, 4), (20, 1, 8)):
+            event_count = TaskEventCount(job_queue_id=job_queue_id,
+                                         num_new=num_new)
+            event_count.time_start = self.day + timedelta(seconds=seconds)
+            event_count.time_end = event_count.time_start
+            db.session.add(event_count)
+        # Buckets which have not ended yet are left alone
+        db.session.add(TaskCount(
+            counted_time=self.day + timedelta(hours=23, minutes=30),
+            total_queued=1, total_running=0, total_done=0, total_failed=0))
+        db.session.commit()
+
+        statistics_tasks.update_rollups(
+            now=self.day + timedelta(hours=23, minutes=10))
+
+        task_counts = self.rollups(
+            TaskCountRollup, "counted_time", "job_queue_id", "num_samples",
+            "total_queued")
+        self.assertIn((60, 0, None, 2, 3.0), task_counts)
+        self.assertIn((60, 0, 1, 1, 8.0), task_counts)
+        self.assertIn((3600, 0, None, 2, 3.0), task_counts)
+        self.assertEqual(len(task_counts), 4)
+
+        self.assertEqual(
+            self.rollups(TaskEventCountRollup, "time_start", "job_queue_id",
+                         "num_new"),
+            [(60, 0, None, 3), (60, 0, 1, 8), (60, 3660, None, 4),
+             (3600, 0, None, 3), (3600, 0, 1, 8), (3600, 3600, None, 4)])
+
+    def test_choose_resolution(self):
+        now = datetime.utcnow()
+        for days, points, resolution in (
+                (90, 2000, 3600), (1, 2000, None), (1, 1000, 60),
+                (7, 100, 3600), (730, 500, 86400), (5, 7200, None)):
+            self.assertEqual(
+                choose_resolution(now - timedelta(days=days), now, points),
+                resolution)